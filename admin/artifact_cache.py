@@ -0,0 +1,333 @@
+"""
+Local cache of the files pulled from object storage.
+
+The normals, mosaics and reprojected granules the pipeline pulls from object
+storage are kept at their usual local paths, and recorded in the cache with
+the ETag and size of the object and when they were last used:
+
+* a cached file is reused when the object still has the recorded ETag (the
+  listing of the object storage directory comes from the transfer engine,
+  one request per directory), otherwise it is downloaded again.  A file that
+  is already there but not in the cache is adopted when its md5 (or size, for
+  multipart ETags) matches the object
+* after a pull the least recently used files are deleted until the cache is
+  below const.CACHE_MAX_BYTES, and files not used for const.CACHE_MAX_AGE_DAYS
+  days are deleted as well
+* files the current run still needs are pinned and are never evicted:
+
+    with artifact_cache.pinned([norm10yr_tif, norm20yr_tif]):
+        ...
+
+  the pins are in the cache db so they hold for the worker processes (and the
+  disk manager), and expire after const.CACHE_PIN_TTL seconds in case a run
+  dies without unpinning
+
+Only files pulled through the cache are ever evicted, the outputs the
+pipeline computes locally are not in it.  The cache is a sqlite db,
+const.ARTIFACT_CACHE (see admin/sqlite_db.py).
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+import admin.constants as const
+
+from admin import catalog, metrics, sqlite_db, transfer
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path text PRIMARY KEY,
+    ostore_path text NOT NULL,
+    etag text,
+    size integer NOT NULL,
+    last_used real NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_last_used ON artifacts (last_used);
+CREATE TABLE IF NOT EXISTS pins (
+    path text NOT NULL,
+    token text NOT NULL,
+    expires real NOT NULL,
+    PRIMARY KEY (path, token)
+);
+"""
+
+
+def normalize_etag(etag: str) -> str:
+    return etag.strip('"') if etag else None
+
+
+def md5_digest(pth: str) -> str:
+    digest = hashlib.md5()
+    with open(pth, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def matches(pth: str, size: int, etag: str) -> bool:
+    """whether a local file is the object with the size and ETag, the ETag of
+    a multipart upload is not the md5 of the object so only the size is
+    compared for those
+    """
+    if os.path.getsize(pth) != size:
+        return False
+    etag = normalize_etag(etag)
+    if not etag or '-' in etag:
+        return True
+    return md5_digest(pth) == etag
+
+
+class ArtifactCache(sqlite_db.Database):
+    """the files pulled from object storage, see the module docstring
+
+    :param db_pth: path to the cache db, defaults to const.ARTIFACT_CACHE
+    :type db_pth: str, optional
+    :param max_bytes: size of the cache, defaults to const.CACHE_MAX_BYTES
+    :type max_bytes: int, optional
+    :param max_age: seconds a file is kept after it was last used, 0 to keep
+        files until the cache is full, defaults to const.CACHE_MAX_AGE_DAYS
+    :type max_age: float, optional
+    """
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, db_pth: str = None, max_bytes: int = None,
+                 max_age: float = None):
+        super().__init__(db_pth or const.ARTIFACT_CACHE)
+        self.max_bytes = const.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_age = const.CACHE_MAX_AGE_DAYS * 86400 if max_age is None else max_age
+
+    def get(self, pth: str) -> dict:
+        """the cache entry of a local file, None if it is not cached
+        """
+        row = self.conn.execute('SELECT ostore_path, etag, size, last_used '
+                                'FROM artifacts WHERE path=?',
+                                (os.path.abspath(pth),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['ostore_path', 'etag', 'size', 'last_used'], row))
+
+    def get_under(self, directory: str) -> dict:
+        """the cache entries of the files below a directory
+
+        :return: local path -> entry, see get
+        :rtype: dict
+        """
+        prefix = os.path.join(os.path.abspath(directory), '')
+        rows = self.conn.execute('SELECT path, ostore_path, etag, size, last_used '
+                                 'FROM artifacts WHERE substr(path, 1, ?) = ?',
+                                 (len(prefix), prefix))
+        return {row[0]: dict(zip(['ostore_path', 'etag', 'size', 'last_used'], row[1:]))
+                for row in rows}
+
+    def _record(self, rows: list):
+        """rows of (local path, object storage path, etag, size)
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)',
+                [(os.path.abspath(pth), ostore_path, normalize_etag(etag), size, now)
+                 for pth, ostore_path, etag, size in rows])
+
+    def _is_hit(self, pth: str, ostore_path: str, stat: tuple) -> bool:
+        """whether the local file can be used for the object, stat is its
+        (size, etag) or None when it could not be listed
+        """
+        if not os.path.exists(pth):
+            return False
+        if stat is None:
+            # not in object storage (or it could not be listed), the local
+            # file is all there is
+            return True
+        size, etag = stat
+        entry = self.get(pth)
+        if entry and etag and entry['etag']:
+            return (entry['etag'] == normalize_etag(etag)
+                    and entry['size'] == os.path.getsize(pth))
+        return matches(pth, size, etag)
+
+    def fetch_many(self, items: list, engine, missing_ok: bool = False) -> list:
+        """pulls objects into the cache, objects that are cached with the
+        current ETag are not downloaded again
+
+        :param items: (object storage path, local path) pairs
+        :type items: list[tuple]
+        :param engine: admin.transfer.TransferEngine of the object store
+        :param missing_ok: skip the objects that do not exist, otherwise
+            admin.transfer.TransferError is raised for them
+        :type missing_ok: bool, optional
+        :return: the local paths that were downloaded
+        :rtype: list[str]
+        """
+        items = list(items)
+        try:
+            stats = engine.stat_many([ostore_path for ostore_path, _ in items])
+        except Exception as e:
+            if not all(os.path.exists(local_path) for _, local_path in items):
+                raise
+            LOGGER.warning(f'could not validate the cached files, using them as they '
+                           f'are: {e}')
+            stats = dict.fromkeys([ostore_path for ostore_path, _ in items])
+
+        hits, misses = [], []
+        for ostore_path, local_path in items:
+            stat = stats[ostore_path]
+            if self._is_hit(local_path, ostore_path, stat):
+                if stat is not None:
+                    hits.append((local_path, ostore_path, stat[1], stat[0]))
+            else:
+                misses.append((ostore_path, local_path))
+        metrics.METRICS.count('artifact_cache', len(hits), result='hit')
+        metrics.METRICS.count('artifact_cache', len(misses), result='miss')
+        self._record(hits)
+
+        pulled = []
+        if misses:
+            try:
+                pulled = engine.get_many(misses, missing_ok=missing_ok)
+            except transfer.TransferError as e:
+                # the downloads are renamed into place, what is there and
+                # did not fail was downloaded
+                pulled = [local_path for ostore_path, local_path in misses
+                          if ostore_path not in e.failed and os.path.exists(local_path)]
+                raise
+            finally:
+                done = set(pulled)
+                self._record([(local_path, ostore_path, stats[ostore_path][1],
+                               stats[ostore_path][0])
+                              for ostore_path, local_path in misses
+                              if local_path in done])
+            self.evict(keep=[local_path for _, local_path in items])
+        return pulled
+
+    def fetch(self, ostore_path: str, local_path: str, engine,
+              missing_ok: bool = False) -> bool:
+        """see fetch_many
+
+        :return: whether the object was downloaded
+        :rtype: bool
+        """
+        return bool(self.fetch_many([(ostore_path, local_path)], engine, missing_ok))
+
+    # pins
+
+    def pin(self, paths: list, ttl: float = None) -> str:
+        """pins files so they are not evicted
+
+        :param paths: local paths
+        :type paths: list[str]
+        :param ttl: seconds the pins hold if they are not released, defaults
+            to const.CACHE_PIN_TTL
+        :type ttl: float, optional
+        :return: token to release the pins with, see unpin
+        :rtype: str
+        """
+        token = uuid.uuid4().hex
+        expires = time.time() + (ttl or const.CACHE_PIN_TTL)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO pins VALUES (?, ?, ?)',
+                [(os.path.abspath(pth), token, expires) for pth in paths])
+        return token
+
+    def unpin(self, token: str):
+        with self.conn:
+            self.conn.execute('DELETE FROM pins WHERE token=?', (token,))
+
+    @contextlib.contextmanager
+    def pinned(self, paths: list, ttl: float = None):
+        """pins files for the duration of the with block
+        """
+        token = self.pin(paths, ttl)
+        try:
+            yield
+        finally:
+            self.unpin(token)
+
+    def get_pinned(self) -> set:
+        """local paths that are pinned
+        """
+        rows = self.conn.execute('SELECT DISTINCT path FROM pins WHERE expires > ?',
+                                 (time.time(),))
+        return {row[0] for row in rows}
+
+    # eviction
+
+    def size(self) -> int:
+        """bytes of the cached files
+        """
+        query = 'SELECT coalesce(sum(size), 0) FROM artifacts'
+        return self.conn.execute(query).fetchone()[0]
+
+    def remove(self, pth: str) -> int:
+        """deletes a cached file
+
+        :return: bytes freed
+        :rtype: int
+        """
+        pth = os.path.abspath(pth)
+        freed = 0
+        try:
+            freed = os.path.getsize(pth)
+            os.remove(pth)
+            if catalog.classify(pth) is not None:
+                catalog.get_catalog().unregister(pth)
+        except FileNotFoundError:
+            pass
+        with self.conn:
+            self.conn.execute('DELETE FROM artifacts WHERE path=?', (pth,))
+        return freed
+
+    def evict(self, keep: list = ()) -> int:
+        """deletes the files not used for max_age seconds, then the least
+        recently used files until the cache is below max_bytes.  Pinned
+        files and the files in keep are never evicted.
+
+        :param keep: local paths that must not be evicted
+        :type keep: list, optional
+        :return: bytes freed
+        :rtype: int
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM pins WHERE expires <= ?', (time.time(),))
+        protected = self.get_pinned() | {os.path.abspath(pth) for pth in keep}
+        rows = self.conn.execute('SELECT path, size, last_used FROM artifacts '
+                                 'ORDER BY last_used').fetchall()
+        total = sum(size for _, size, _ in rows)
+        oldest = time.time() - self.max_age if self.max_age else None
+        freed = 0
+        for pth, size, last_used in rows:
+            expired = oldest is not None and last_used < oldest
+            if not expired and total <= self.max_bytes:
+                break
+            if pth in protected:
+                continue
+            LOGGER.debug(f'evicting {pth}, last used {time.ctime(last_used)}')
+            freed += self.remove(pth)
+            total -= size
+        if freed:
+            metrics.METRICS.count('artifact_cache_evicted_bytes', freed)
+            LOGGER.info(f'evicted {freed / 1e6:.1f} MB from the artifact cache')
+        return freed
+
+
+_cache = sqlite_db.Singleton(ArtifactCache)
+
+
+def get_cache() -> ArtifactCache:
+    """the artifact cache of the pipeline, const.ARTIFACT_CACHE
+    """
+    return _cache.get()
+
+
+def pinned(paths: list, ttl: float = None):
+    return get_cache().pinned(paths, ttl)
@@ -1,4 +1,6 @@
 import os
+import datetime
+import json
 import simplekml
 import zipfile
 import logging
@@ -6,106 +8,206 @@ import logging
 import rasterio as rio
 import numpy as np
 
+from affine import Affine
 from glob import glob
+from multiprocessing.pool import ThreadPool
+from rasterio import windows
 
-from admin.color_ramp import color_ramp
+from admin.color_ramp import snow_colormap
 from admin.db_handler import DBHandler
+from admin.kml_tiles import SuperOverlay, expand_palette, get_cutline, to_rgba
 
 logger = logging.getLogger(__name__)
 
 import admin.constants as const
+import admin.snow_path_lib
 
-def daily_kml(date: str, typ: str, sat: str, db_handler: DBHandler):
+snow_path = admin.snow_path_lib.SnowPathLib()
+
+# directory of the provincial tile pyramid under kml/<date>/<sat>
+TILES = 'tiles'
+# windows of the sheds in the pyramid, in the pyramid directory
+SHED_WINDOWS = 'sheds.json'
+
+def get_tiles_dir(date: str, sat: str):
     """
-    Apply color ramp and build KML's
+    Directory of the provincial tile pyramid of a date / satellite
+
+    Parameters
+    ----------
+    date : str
+        Target date
+    sat : str
+        Target satellite [modis | viirs]
+    """
+    return os.path.join(const.KML, date, sat, TILES)
+
+def _paste_window(src_transform, width: int, height: int, dst_transform):
+    """
+    Window of a raster in a grid with the same resolution and alignment
+    """
+    col_off = int(round((src_transform.c - dst_transform.c) / dst_transform.a))
+    row_off = int(round((src_transform.f - dst_transform.f) / dst_transform.e))
+    return windows.Window(col_off, row_off, width, height)
+
+def province_tiles(date: str, sat: str):
+    """
+    Render one tile pyramid for the whole province from the EPSG4326 rasters
+    of all the watersheds and basins, masked to their outlines. Tiles that did
+    not change since the previous day are linked instead of rendered. The
+    pyramid is a step of its own, the KMLs of the watersheds and of the basins
+    link to it, see daily_kml
 
     Parameters
     ----------
     date : str
         Target date to process
-    typ : str
-        Target type to process [watersheds | basins]
     sat : str
         Target satellite to process [modis | viirs]
+
+    Returns
+    -------
+    tuple
+        The SuperOverlay and a dict of (typ, name) -> window of the shed in
+        the pyramid, (None, {}) if there are no shed rasters
     """
-    sheds = glob(os.path.join(const.TOP, typ,'*'))
-    for shed in sheds:
-        for crs in ['EPSG4326', 'EPSG3153']:
-            # Apply /data thresholding and balancing
+    sheds = []
+    for typ in ['watersheds', 'basins']:
+        for shed in snow_path.get_shed_dirs(typ):
             name = os.path.split(shed)[-1]
-            shed_pth = os.path.join(const.TOP, typ, name, sat, date, f'{name}_{sat}_{date}_{crs}.tif')
+            shed_pth = os.path.join(const.TOP, typ, name, sat, date, f'{name}_{sat}_{date}_EPSG4326.tif')
             if not os.path.exists(shed_pth):
                 logger.warning(f'Could not find {shed_pth}')
-                continue            
-            intermediate_pth = os.path.join(const.INTERMEDIATE_KML,f'{name}.tif')
-            if os.path.exists(intermediate_pth):
-                os.remove(intermediate_pth)
-            with rio.open(shed_pth, 'r') as src:
-                out_meta = src.meta.copy()
-                with rio.open(intermediate_pth, 'w', **out_meta) as dst:
-                    data = src.read(1, masked=True)
-                    data[(data < 20)] = 0.0 # threshold
-                    data[(data > 100) & (data < 255)] = 254 #dst.nodata
-                    dst.write(data, indexes=1)
-
-            color_ramp(intermediate_pth)
-
-            output_pth = os.path.join(const.INTERMEDIATE_KML,f'{name}_{crs}_col.tif')
-            
-            try:
-                os.remove(output_pth)
-            except OSError as e:
-                pass
-            os.system(f'gdal_translate -q -expand rgb -of GTiff \
-                {intermediate_pth} {output_pth}')
-            # Process kmls on EPSG4326 ( EPSG3005 does not work )
-            intermediate_fin_pth = os.path.join(const.INTERMEDIATE_TIF, sat, date,f'{name}_{crs}_fin.tif')
-            shp_pth = os.path.join(const.TOP, typ, name, "shape", crs, f"{name}.shp")
-            os.system(f'gdalwarp -overwrite -q --config GDALWARP_IGNORE_BAD_CUTLINE YES -dstalpha -cutline \
-                {shp_pth} \
-                -crop_to_cutline {output_pth} \
-                {intermediate_fin_pth}')
-
-            if crs == 'EPSG4326':
-                kml_pth = os.path.join(const.KML,date,sat,typ,f'{name}_{date}')
-                try:
-                    os.makedirs(kml_pth)
-                except:
-                    pass
-                os.system(f'gdal2tiles.py -q -p raster -t {name} --tilesize=128 -s \
-                    EPSG:4326 -k -r near {intermediate_fin_pth} {kml_pth}')  
-
-                with rio.open(intermediate_fin_pth) as src:
-                    upperleft = src.transform * (0,0)
-                    bottomright = src.transform * (src.width, src.height)
-                coverage = [0,0,0]
-                coverage[0] = db_handler.select(f'SELECT nodata FROM \
-                    {sat} WHERE date_="{date}" and name="{os.path.split(shed)[-1]}"')
-                coverage[1] = db_handler.select(f'SELECT below_threshold FROM \
-                    {sat} WHERE date_="{date}" and name="{os.path.split(shed)[-1]}"')
-                coverage[2] = db_handler.select(f'SELECT snow_coverage FROM \
-                    {sat} WHERE date_="{date}" and name="{os.path.split(shed)[-1]}"')
-                if None in coverage:
-                    continue
-                kml = simplekml.Kml(name=name)
-                link = kml.newnetworklink(name=name)
-                # Link low level kml
-                link.link.href = os.path.join('doc.kml')
-                link.link.viewrefreshmode = simplekml.ViewRefreshMode.onrequest
-                fmt = lambda x: np.around(x, decimals=2)
-                # Attach metadata
-                pnt = kml.newpoint(name=name, description=f'NODATA: {fmt(coverage[0])}%,\
-                    BELOW: {fmt(coverage[1])}%, SNOW: {fmt(coverage[2])}%', 
-                     coords=[np.divide(np.add(upperleft, bottomright),2)])
-                pnt.style.iconstyle.icon.href = 'http://maps.google.com/mapfiles/kml/shapes/snowflake_simple.png'
-                #kml.document.description = f'NODATA: {fmt(coverage[0])}%,\
-                #    BELOW: {fmt(coverage[1])}%, SNOW: {fmt(coverage[2])}%'
-                # Save top level KML
-                if typ == 'basins': # Turn off basins by default
-                    pnt.visibility = 0
-                    link.visibility = 0
-                    kml.document.visibility = 0
-                kml.save(os.path.join(kml_pth, f'{name}_{date}.kml'))
+                continue
+            sheds.append((typ, name, shed_pth))
+    if not sheds:
+        return None, {}
+
+    # all the shed rasters are clipped from the same mosaic grid
+    with rio.open(sheds[0][2]) as src:
+        crs, res_x, res_y = src.crs, src.transform.a, src.transform.e
+    west, south, east, north = const.BBOX
+    transform = Affine(res_x, 0, west, 0, res_y, north)
+    full = windows.Window(0, 0, int(np.ceil((east - west) / res_x)), int(np.ceil((south - north) / res_y)))
+    data = np.full((full.height, full.width), 255, dtype='uint8')
+    alpha = np.zeros(data.shape, dtype=bool)
+
+    shed_windows = {}
+    for typ, name, shed_pth in sheds:
+        with rio.open(shed_pth, 'r') as src:
+            shed_data = src.read(1)
+            shed_transform = src.transform
+        shp_pth = os.path.join(const.TOP, typ, name, "shape", 'EPSG4326', f"{name}.shp")
+        cut_window, mask = get_cutline(shp_pth, crs, shed_transform, shed_data.shape[1], shed_data.shape[0])
+        if cut_window is None:
+            logger.warning(f'{shp_pth} does not intersect {shed_pth}')
+            continue
+        window = _paste_window(
+            windows.transform(cut_window, shed_transform), cut_window.width, cut_window.height, transform)
+        try:
+            window_in = window.intersection(full)
+        except windows.WindowError:
+            logger.warning(f'{shed_pth} is outside of the province')
+            continue
+        rows, cols = window_in.toslices()
+        src_rows, src_cols = windows.Window(
+            cut_window.col_off + window_in.col_off - window.col_off,
+            cut_window.row_off + window_in.row_off - window.row_off,
+            window_in.width, window_in.height).toslices()
+        mask = mask[rows.start - window.row_off:rows.stop - window.row_off,
+                    cols.start - window.col_off:cols.stop - window.col_off]
+        data[rows, cols][mask] = shed_data[src_rows, src_cols][mask]
+        alpha[rows, cols] |= mask
+        shed_windows[(typ, name)] = window_in
+
+    data[(data < 20)] = 0 # threshold
+    data[(data > 100) & (data < 255)] = 254 #dst.nodata
+    rgb = expand_palette(data, snow_colormap())
+    del data
+
+    tiles_dir = get_tiles_dir(date, sat)
+    os.makedirs(tiles_dir, exist_ok=True)
+    # written before the tiles, the pyramid is complete once its tile index is
+    windows_pth = os.path.join(tiles_dir, SHED_WINDOWS)
+    with open(windows_pth + '.tmp', 'w') as f:
+        json.dump([[typ, name, [int(window.col_off), int(window.row_off), int(window.width), int(window.height)]]
+                   for (typ, name), window in shed_windows.items()], f)
+    os.replace(windows_pth + '.tmp', windows_pth)
+    prev_date = (datetime.datetime.strptime(date, '%Y.%m.%d') - datetime.timedelta(days=1)).strftime('%Y.%m.%d')
+    overlay = SuperOverlay(to_rgba(rgb, alpha), transform, f'{sat}_{date}')
+    with ThreadPool(const.IO_WORKERS) as pool:
+        overlay.write(tiles_dir, pool=pool, previous_dir=get_tiles_dir(prev_date, sat))
+    return overlay, shed_windows
+
+def load_province_tiles(date: str, sat: str):
+    """
+    The provincial tile pyramid written by province_tiles
+
+    Returns
+    -------
+    tuple
+        The SuperOverlay and a dict of (typ, name) -> window of the shed in
+        the pyramid, (None, {}) if the pyramid has not been written
+    """
+    tiles_dir = get_tiles_dir(date, sat)
+    overlay = SuperOverlay.open(tiles_dir, f'{sat}_{date}')
+    windows_pth = os.path.join(tiles_dir, SHED_WINDOWS)
+    if overlay is None or not os.path.exists(windows_pth):
+        return None, {}
+    with open(windows_pth) as f:
+        shed_windows = {(typ, name): windows.Window(*window) for typ, name, window in json.load(f)}
+    return overlay, shed_windows
+
+def daily_kml(date: str, typ: str, sat: str, db_handler: DBHandler):
+    """
+    Build the KML's of the watersheds or basins. The tiles are rendered once
+    for the province by province_tiles, which has to run first, the KML of
+    each shed links to the tiles that cover it
+
+    Parameters
+    ----------
+    date : str
+        Target date to process
+    typ : str
+        Target type to process [watersheds | basins]
+    sat : str
+        Target satellite to process [modis | viirs]
+    """
+    overlay, shed_windows = load_province_tiles(date, sat)
+    if overlay is None:
+        raise FileNotFoundError(f'no provincial tiles in {get_tiles_dir(date, sat)}, run province_tiles first')
+    stats = db_handler.select_stats(sat, date)
+    for (shed_typ, name), window in shed_windows.items():
+        if shed_typ != typ:
+            continue
+        kml_pth = os.path.join(const.KML,date,sat,typ,f'{name}_{date}')
+        os.makedirs(kml_pth, exist_ok=True)
+        href = os.path.relpath(get_tiles_dir(date, sat), kml_pth).replace(os.sep, '/')
+        overlay.write_links(os.path.join(kml_pth, 'doc.kml'), name, window, href)
+
+        transform = windows.transform(window, overlay.transform)
+        upperleft = transform * (0,0)
+        bottomright = transform * (window.width, window.height)
+        if name not in stats:
+            continue
+        coverage = [stats[name]['nodata'], stats[name]['below_threshold'], stats[name]['snow_coverage']]
+        kml = simplekml.Kml(name=name)
+        link = kml.newnetworklink(name=name)
+        # Link low level kml
+        link.link.href = os.path.join('doc.kml')
+        link.link.viewrefreshmode = simplekml.ViewRefreshMode.onrequest
+        fmt = lambda x: np.around(x, decimals=2)
+        # Attach metadata
+        pnt = kml.newpoint(name=name, description=f'NODATA: {fmt(coverage[0])}%,\
+            BELOW: {fmt(coverage[1])}%, SNOW: {fmt(coverage[2])}%', 
+             coords=[np.divide(np.add(upperleft, bottomright),2)])
+        pnt.style.iconstyle.icon.href = 'http://maps.google.com/mapfiles/kml/shapes/snowflake_simple.png'
+        # Save top level KML
+        if typ == 'basins': # Turn off basins by default
+            pnt.visibility = 0
+            link.visibility = 0
+            kml.document.visibility = 0
+        kml.save(os.path.join(kml_pth, f'{name}_{date}.kml'))
 
 def composite_kml(date: str, sat: str):
     """
@@ -124,6 +226,8 @@ def composite_kml(date: str, sat: str):
     location = glob(os.path.join(const.TOP, 'kml',date,sat,'*'))
     for shed in location:
         shed = os.path.split(shed)[-1]
+        if shed == TILES: # shared tile pyramid, linked from the shed kmls
+            continue
         kmls = glob(os.path.join(const.TOP, 'kml',date,sat,shed,f'*_{date}*'))
         doc = kml.newfolder(name=shed)
         for k in kmls:
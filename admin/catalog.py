@@ -0,0 +1,372 @@
+"""
+Catalog of the local data of the pipeline.
+
+An index of the granules, intermediate tifs, daily mosaics and per shed
+outputs (and the shed shapefiles) under const.TOP / const.NORM_ROOT, keyed by
+the kind of file, sat, date, tile and product, so that finding the inputs of a
+step is an indexed query instead of a glob over the data directory:
+
+    granules = catalog.find(granule_dir, 'granule', sat='modis', date='2023.03.21')
+    composite = catalog.find(int_tif_dir, 'intermediate', sat='modis', date=date,
+                             product='composite')
+
+The kind and keys of a file come from its place in the data directory, see
+classify.  The index is updated as the steps write rasters (admin/raster_io.py
+registers every raster it writes), and a directory is rescanned when its mtime
+is not the one recorded the last time it was scanned, so files written by
+other means (downloads, files pulled from object storage, deletes) are picked
+up with a stat of the directory rather than a walk of the tree.
+
+The catalog also caches the results of the CMR queries (cached_query), see
+SnowPathLib.get_granules.
+
+The catalog is a sqlite db (const.CATALOG, see admin/sqlite_db.py), it only
+holds what can be rebuilt from the data directory (rebuild).
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+
+import admin.constants as const
+
+from admin import sqlite_db
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path text PRIMARY KEY,
+    dir text NOT NULL,
+    kind text NOT NULL,
+    sat text,
+    date text,
+    tile text,
+    product text,
+    typ text,
+    shed text,
+    size integer,
+    mtime_ns integer
+);
+CREATE INDEX IF NOT EXISTS files_kind ON files (kind, sat, date);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE TABLE IF NOT EXISTS dirs (
+    path text PRIMARY KEY,
+    parent text,
+    mtime_ns integer
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS cmr_queries (
+    key text PRIMARY KEY,
+    result text NOT NULL,
+    recorded real NOT NULL
+);
+"""
+
+KEYS = ['sat', 'date', 'tile', 'product', 'typ', 'shed']
+
+DATE_PATTERN = re.compile(r'^\d{4}\.\d{2}\.\d{2}$')
+TILE_PATTERN = re.compile(r'\.(h\d{2}v\d{2})\.')
+GRANULE_SUFFIXES = ('.hdf', '.h5')
+SHED_TYPES = ('watersheds', 'basins')
+SATS = ('modis', 'viirs')
+INSERT_FILE = f'INSERT OR REPLACE INTO files VALUES ({", ".join("?" * 11)})'
+
+
+def _get_parts(pth: str, root: str) -> list:
+    """the parts of pth below root, None if it is not below root
+    """
+    root = os.path.abspath(root)
+    if not pth.startswith(root + os.sep):
+        return None
+    return os.path.relpath(pth, root).split(os.sep)
+
+
+def _get_product(stem: str) -> str:
+    """the product of an intermediate / shed tif from its name:
+
+    * modis_composite_2023.03.21_..._2023.03.17 -> composite
+    * MOD10A1.A2023080.h10v02.061.2023082033825_EPSG4326 -> EPSG4326
+    * Stikine_modis_2023.03.21_EPSG3153 -> EPSG3153
+    * orig_Stikine_10yrNorm -> orig_10yrNorm
+    """
+    if stem.startswith('modis_composite'):
+        return 'composite'
+    if '_' not in stem:
+        return 'granule'
+    product = stem.rsplit('_', 1)[1]
+    if stem.startswith('orig_'):
+        product = f'orig_{product}'
+    return product
+
+
+def classify(pth: str) -> dict:
+    """the kind and keys of a file from its place in the data directory,
+    None for files that are not catalogued:
+
+    * granule: MODIS_TERRA/<product>/<date>/<granule>.hdf|.h5
+    * intermediate: INTERMEDIATE_TIF/<sat>/<date>/<name>.tif
+    * mosaic: MOSAICS/<sat>/<year>/<date>.tif
+    * shed: TOP/<typ>/<shed>/<sat>/<date>/<name>.tif
+    * shape: TOP/<typ>/<shed>/shape/<crs>/<shed>.shp
+
+    :param pth: path to the file
+    :type pth: str
+    :return: kind, sat, date, tile, product, typ and shed of the file
+    :rtype: dict
+    """
+    pth = os.path.abspath(pth)
+    name = os.path.basename(pth)
+    # temp files of raster_io and partial downloads
+    if name.startswith('.') or name.endswith('.tmp'):
+        return None
+    stem, suffix = os.path.splitext(name)
+    entry = dict.fromkeys(KEYS)
+
+    parts = _get_parts(pth, const.MODIS_TERRA)
+    if (parts and len(parts) == 3 and suffix in GRANULE_SUFFIXES
+            and DATE_PATTERN.match(parts[1])):
+        tile = TILE_PATTERN.search(name)
+        sat = 'viirs' if parts[0].upper().startswith(('VNP', 'VJ1')) else 'modis'
+        entry.update(kind='granule', sat=sat, date=parts[1], product=parts[0],
+                     tile=tile.group(1) if tile else None)
+        return entry
+
+    parts = _get_parts(pth, const.INTERMEDIATE_TIF)
+    if parts and len(parts) == 3 and suffix == '.tif' and parts[0] in SATS:
+        tile = TILE_PATTERN.search(name)
+        entry.update(kind='intermediate', sat=parts[0], date=parts[1],
+                     product=_get_product(stem), tile=tile.group(1) if tile else None)
+        return entry
+
+    parts = _get_parts(pth, const.MOSAICS)
+    if (parts and len(parts) == 3 and suffix == '.tif' and parts[0] in SATS
+            and DATE_PATTERN.match(stem)):
+        entry.update(kind='mosaic', sat=parts[0], date=stem, product='mosaic')
+        return entry
+
+    parts = _get_parts(pth, const.TOP)
+    if parts and len(parts) == 5 and parts[0] in SHED_TYPES:
+        if parts[2] in SATS and suffix == '.tif':
+            entry.update(kind='shed', typ=parts[0], shed=parts[1], sat=parts[2],
+                         date=parts[3], product=_get_product(stem))
+            return entry
+        if parts[2] == 'shape' and suffix == '.shp':
+            entry.update(kind='shape', typ=parts[0], shed=parts[1], product=parts[3])
+            return entry
+    return None
+
+
+class Catalog(sqlite_db.Database):
+    """index of the local data of the pipeline, see the module docstring
+    """
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, db_pth: str = None):
+        super().__init__(db_pth or const.CATALOG)
+
+    def _get_row(self, pth: str, entry: dict, st: os.stat_result) -> tuple:
+        return (pth, os.path.dirname(pth), entry['kind'], *[entry[key] for key in KEYS],
+                st.st_size, st.st_mtime_ns)
+
+    def register(self, pth: str) -> bool:
+        """adds (or updates) a file that has been written
+
+        :param pth: path to the file
+        :type pth: str
+        :return: whether the file is catalogued, see classify
+        :rtype: bool
+        """
+        pth = os.path.abspath(pth)
+        entry = classify(pth)
+        if entry is None:
+            return False
+        row = self._get_row(pth, entry, os.stat(pth))
+        with self.conn:
+            self.conn.execute(INSERT_FILE, row)
+        return True
+
+    def unregister(self, pth: str):
+        """removes a file that has been deleted
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE path=?', (os.path.abspath(pth),))
+
+    def refresh(self, directory: str, force: bool = False) -> bool:
+        """rescans a directory (not its sub directories) when its mtime is not
+        the one recorded the last time it was scanned
+
+        :param directory: the directory
+        :type directory: str
+        :param force: rescan even if the mtime has not changed
+        :type force: bool, optional
+        :return: whether the directory was rescanned
+        :rtype: bool
+        """
+        directory = os.path.abspath(directory)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        row = self.conn.execute('SELECT mtime_ns FROM dirs WHERE path=?',
+                                (directory,)).fetchone()
+        if not force and row and row[0] == mtime_ns:
+            return False
+
+        files, subdirs = [], []
+        if mtime_ns is not None:
+            with os.scandir(directory) as entries:
+                for dir_entry in entries:
+                    if dir_entry.is_dir():
+                        subdirs.append(dir_entry.path)
+                        continue
+                    entry = classify(dir_entry.path)
+                    if entry is not None:
+                        try:
+                            files.append(self._get_row(dir_entry.path, entry,
+                                                       dir_entry.stat()))
+                        except FileNotFoundError:  # deleted since the listing
+                            pass
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE dir=?', (directory,))
+            self.conn.executemany(INSERT_FILE, files)
+            known = {r[0] for r in self.conn.execute(
+                'SELECT path FROM dirs WHERE parent=?', (directory,))}
+            self.conn.executemany('DELETE FROM dirs WHERE path=?',
+                                  [(d,) for d in known - set(subdirs)])
+            self.conn.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)',
+                                  [(d, directory) for d in subdirs])
+            if mtime_ns is None:
+                self.conn.execute('DELETE FROM dirs WHERE path=?', (directory,))
+            else:
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                                  (directory, os.path.dirname(directory), mtime_ns))
+        LOGGER.debug(f'scanned {directory}: {len(files)} files, '
+                     f'{len(subdirs)} directories')
+        return True
+
+    def lookup(self, kind: str, directory: str = None, **keys) -> list:
+        """the catalogued files of a kind, filtered by the keys
+
+        :param kind: granule | intermediate | mosaic | shed | shape
+        :type kind: str
+        :param directory: only the files directly in this directory
+        :type directory: str, optional
+        :param keys: sat, date, tile, product, typ and / or shed
+        :return: sorted paths
+        :rtype: list[str]
+        """
+        unknown = set(keys) - set(KEYS)
+        if unknown:
+            raise ValueError(f'unknown catalog keys: {sorted(unknown)}, '
+                             f'valid keys: {KEYS}')
+        where = ['kind=?'] + [f'{key}=?' for key, value in keys.items()
+                              if value is not None]
+        values = [kind] + [value for value in keys.values() if value is not None]
+        if directory is not None:
+            where.append('dir=?')
+            values.append(os.path.abspath(directory))
+        rows = self.conn.execute(
+            f'SELECT path FROM files WHERE {" AND ".join(where)} ORDER BY path', values)
+        return [row[0] for row in rows]
+
+    def find(self, directory: str, kind: str, **keys) -> list:
+        """lookup of the files of a directory, the directory is rescanned
+        first if it has changed, see refresh.  Files of the same kind and keys
+        in other directories (copies under another root, directories that
+        were not refreshed) are not returned.
+        """
+        self.refresh(directory)
+        return self.lookup(kind, directory, **keys)
+
+    def subdirs(self, directory: str) -> list:
+        """the sub directories of a directory, ie the watershed / basin
+        directories of const.WATERSHEDS / const.BASINS
+
+        :return: sorted paths
+        :rtype: list[str]
+        """
+        directory = os.path.abspath(directory)
+        self.refresh(directory)
+        rows = self.conn.execute('SELECT path FROM dirs WHERE parent=? ORDER BY path',
+                                 (directory,))
+        return [row[0] for row in rows]
+
+    def rebuild(self, roots: list = None) -> int:
+        """rescans every directory below the roots
+
+        :param roots: directories to scan, defaults to const.TOP and const.NORM_ROOT
+        :type roots: list, optional
+        :return: number of files in the catalog
+        :rtype: int
+        """
+        roots = roots or sorted({os.path.abspath(const.TOP),
+                                 os.path.abspath(const.NORM_ROOT)})
+        for root in roots:
+            for directory, _, _ in os.walk(root):
+                self.refresh(directory, force=True)
+        return self.conn.execute('SELECT count(*) FROM files').fetchone()[0]
+
+    def cached_query(self, key: dict, query, max_age: float = None):
+        """the result of a query (ie CMR), from the cache if it was made
+        before and is not older than max_age.  Empty results are not cached.
+
+        :param key: what identifies the query, anything JSON serializable
+        :type key: dict
+        :param query: function that makes the query, the result has to be
+            JSON serializable
+        :type query: callable
+        :param max_age: seconds a cached result is used, defaults to always
+        :type max_age: float, optional
+        """
+        key = json.dumps(key, sort_keys=True, default=str)
+        row = self.conn.execute('SELECT result, recorded FROM cmr_queries WHERE key=?',
+                                (key,)).fetchone()
+        if row and (max_age is None or time.time() - row[1] <= max_age):
+            LOGGER.debug(f'cached query: {key}')
+            return json.loads(row[0])
+        result = query()
+        if result:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO cmr_queries VALUES (?, ?, ?)',
+                                  (key, json.dumps(result, default=str), time.time()))
+        return result
+
+
+_catalog = sqlite_db.Singleton(Catalog)
+
+
+def get_catalog() -> Catalog:
+    """the catalog of the pipeline, const.CATALOG
+    """
+    return _catalog.get()
+
+
+def register(pth: str) -> bool:
+    """registers a file that has been written, a failure to update the catalog
+    is logged and does not fail the step that wrote the file (the directory
+    is rescanned on the next lookup)
+    """
+    if classify(pth) is None:
+        return False
+    try:
+        return get_catalog().register(pth)
+    except (sqlite3.Error, OSError) as e:
+        LOGGER.warning(f'could not register {pth} in the catalog: {e}')
+        return False
+
+
+def find(directory: str, kind: str, **keys) -> list:
+    return get_catalog().find(directory, kind, **keys)
+
+
+def subdirs(directory: str) -> list:
+    return get_catalog().subdirs(directory)
+
+
+def cached_query(key: dict, query, max_age: float = None):
+    return get_catalog().cached_query(key, query, max_age)
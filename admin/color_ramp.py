@@ -1,5 +1,83 @@
 from osgeo import gdal
 
+# colour ramps as (start index, start colour, end index, end colour)
+SNOW_COLOR_RAMPS = [
+    (20, (255, 38, 56), 50, (255, 254, 189)),
+    (50, (255, 254, 189), 100, (25, 147, 255))
+]
+S2_COLOR_RAMPS = [
+    (0, (255, 38, 56), 50, (255, 254, 189)),
+    (50, (255, 254, 189), 100, (25, 147, 255))
+]
+NODATA_COLOR_ENTRY = (254, (0, 0, 0))
+
+def create_color_ramp(colormap, start, start_colour, end, end_colour):
+    """
+    Pure python equivalent of gdal.ColorTable.CreateColorRamp, adds the
+    linearly interpolated entries to the colormap dictionary
+
+    Parameters
+    ----------
+    colormap : dict
+        Colormap of index -> (r, g, b, a) to add the ramp to
+    start : int
+        Index of the first entry of the ramp
+    start_colour : tuple
+        Colour of the first entry of the ramp
+    end : int
+        Index of the last entry of the ramp
+    end_colour : tuple
+        Colour of the last entry of the ramp
+    """
+    start_colour = tuple(start_colour) + (255,) * (4 - len(start_colour))
+    end_colour = tuple(end_colour) + (255,) * (4 - len(end_colour))
+    steps = end - start
+    for i in range(steps + 1):
+        colormap[start + i] = tuple(
+            int(i * (e - s) / steps + s) for s, e in zip(start_colour, end_colour))
+
+def build_colormap(ramps, entries=None):
+    """
+    Build a rasterio colormap (index -> (r, g, b, a)) from colour ramps,
+    unset entries are transparent black like a gdal.ColorTable
+
+    Parameters
+    ----------
+    ramps : list
+        List of (start index, start colour, end index, end colour)
+    entries : list, optional
+        List of (index, colour) single entries to set after the ramps
+
+    Returns
+    -------
+    dict
+        The colormap
+    """
+    colormap = {}
+    for ramp in ramps:
+        create_color_ramp(colormap, *ramp)
+    for index, colour in (entries or []):
+        colormap[index] = tuple(colour) + (255,) * (4 - len(colour))
+    return {i: colormap.get(i, (0, 0, 0, 0)) for i in range(max(colormap) + 1)}
+
+def snow_colormap():
+    """
+    Colormap used for the MODIS / VIIRS snow rasters
+    """
+    return build_colormap(SNOW_COLOR_RAMPS, [NODATA_COLOR_ENTRY])
+
+def s2_colormap():
+    """
+    Colormap used for the Sentinel-2 NDSI rasters
+    """
+    return build_colormap(S2_COLOR_RAMPS, [NODATA_COLOR_ENTRY])
+
+def _gdal_color_table(colormap):
+    colours = gdal.ColorTable()
+    for index, colour in colormap.items():
+        colours.SetColorEntry(index, colour)
+    return colours
+
 def color_ramp(pth):
     """
     Apply colour ramp to GTiff
@@ -15,10 +93,7 @@ def color_ramp(pth):
     existing_color_table = band.GetColorTable()
     # only apply color ramp if there isn't one already
     if not existing_color_table:
-        colours = gdal.ColorTable()
-        colours.CreateColorRamp(20, (255, 38, 56), 50, (255, 254, 189))
-        colours.CreateColorRamp(50, (255, 254, 189), 100, (25, 147, 255) )
-        colours.SetColorEntry(254, (0,0,0))
+        colours = _gdal_color_table(snow_colormap())
         band.SetRasterColorTable(colours)
         band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
     del band, ds
@@ -35,10 +110,7 @@ def s2_color_ramp(pth):
      # Apply color ramp
     ds = gdal.Open(pth, 1)
     band = ds.GetRasterBand(1)
-    colours = gdal.ColorTable()
-    colours.CreateColorRamp(0, (255, 38, 56), 50, (255, 254, 189))
-    colours.CreateColorRamp(50, (255, 254, 189), 100, (25, 147, 255) )
-    colours.SetColorEntry(254, (0,0,0))
+    colours = _gdal_color_table(s2_colormap())
     band.SetRasterColorTable(colours)
     band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
     del band, ds
@@ -62,6 +62,47 @@ VIIRS_NORM = os.path.join(NORM, 'viirs')
 VIIRS_DAILY_NORM = os.path.join(VIIRS_NORM, 'daily')
 VIIRS_DAILY_10YR = os.path.join(VIIRS_DAILY_NORM, '10yr')
 VIIRS_DAILY_20YR = os.path.join(VIIRS_DAILY_NORM, '20yr')
+DATACUBE = os.path.join(NORM, 'datacube')
+
+# fingerprints of the outputs of the pipeline, see admin/manifest.py
+MANIFEST = os.getenv('MANIFEST', os.path.join(TOP, 'manifest.db'))
+
+# index of the local data, see admin/catalog.py
+CATALOG = os.getenv('CATALOG', os.path.join(TOP, 'catalog.db'))
+# seconds the result of a CMR query is reused while granules of the dates
+# can still be published, queries of dates older than CMR_SETTLED_DAYS are
+# reused for good
+CMR_CACHE_MAX_AGE = int(os.getenv('CMR_CACHE_MAX_AGE', '3600'))
+CMR_SETTLED_DAYS = int(os.getenv('CMR_SETTLED_DAYS', '7'))
+
+# files pulled from object storage, see admin/artifact_cache.py.  The cache
+# is kept below CACHE_MAX_BYTES, files not used for CACHE_MAX_AGE_DAYS days
+# are evicted (0 keeps them until the cache is full), a pin holds for
+# CACHE_PIN_TTL seconds if the run that set it does not release it
+ARTIFACT_CACHE = os.getenv('ARTIFACT_CACHE', os.path.join(TOP, 'artifact_cache.db'))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(20 * 1024 ** 3)))
+CACHE_MAX_AGE_DAYS = float(os.getenv('CACHE_MAX_AGE_DAYS', '0'))
+CACHE_PIN_TTL = int(os.getenv('CACHE_PIN_TTL', str(6 * 3600)))
+
+# retention of the working directories, see admin/disk_manager.py.  Archived
+# files older than RETENTION_<CATEGORY>_DAYS days are deleted, then the oldest
+# archived files until the category is below RETENTION_<CATEGORY>_GB, 0
+# disables a limit.  The MODIS composites read up to 8 days of granules and
+# intermediate tifs, so those are kept 10 days
+RETENTION = {
+    category: (float(os.getenv(f'RETENTION_{category.upper()}_DAYS', days)),
+               float(os.getenv(f'RETENTION_{category.upper()}_GB', gb)))
+    for category, (days, gb) in {
+        'downloads': ('10', '50'),
+        'intermediate': ('10', '50'),
+        'intermediate_kml': ('3', '5'),
+        'intermediate_plot': ('3', '5'),
+        'kml': ('0', '0'),
+        'plot': ('0', '0'),
+        'watersheds': ('0', '0'),
+        'basins': ('0', '0'),
+    }.items()
+}
 
 AOI = os.path.join(os.path.dirname(__file__), '..', 'aoi')
 
@@ -75,6 +116,17 @@ MODIS_OFFSET = 5
 if ('MODIS_OFFSET' in os.environ) and os.environ['MODIS_OFFSET']:
     MODIS_OFFSET=int(os.environ['MODIS_OFFSET'])
 
+# Output encodings for derived rasters, see admin/raster_encoding.py
+# PCT_CHANGE_ENCODING: int8 | float32 (the % difference to normal rasters)
+# NORMAL_ENCODING: uint8 | uint16 | float32 (the 10yr / 20yr daily normals)
+PCT_CHANGE_ENCODING = os.getenv('PCT_CHANGE_ENCODING', 'int8')
+NORMAL_ENCODING = os.getenv('NORMAL_ENCODING', 'uint8')
+
+# GeoTIFF layout used by admin/raster_io.py for all the pipeline outputs
+# RASTER_COMPRESS: DEFLATE | ZSTD | LZW | NONE (ZSTD requires GDAL >= 2.3)
+RASTER_COMPRESS = os.getenv('RASTER_COMPRESS', 'DEFLATE')
+RASTER_BLOCKSIZE = int(os.getenv('RASTER_BLOCKSIZE', '256'))
+
 
 EARTHDATA_USER = os.getenv("EARTHDATA_USER")
 EARTHDATA_PASS = os.getenv("EARTHDATA_PASS")
@@ -84,3 +136,19 @@ SENTINELSAT_PASS = os.getenv("SENTINELSAT_PASS")
 # this is the directory that all the data in TOP will get copied
 # to
 OBJ_STORE_TOP = 'snowpack_archive'
+
+# Daily mosaic datacube, see admin/datacube.py
+# DATACUBE_TIME_CHUNK: number of days per chunk (the spatial chunks are RASTER_BLOCKSIZE)
+DATACUBE_TIME_CHUNK = int(os.getenv('DATACUBE_TIME_CHUNK', '32'))
+
+# Worker pools, see admin/worker_pool.py and admin/task_graph.py
+# WORKERS: processes shared by the CPU bound stages (0 = number of CPUs)
+# IO_WORKERS: threads of the network / disk bound steps (downloads, tiles)
+WORKERS = int(os.getenv('WORKERS', '0'))
+IO_WORKERS = int(os.getenv('IO_WORKERS', '8'))
+
+# object storage transfers, see admin/transfer.py
+TRANSFER_PART_SIZE = int(os.getenv('TRANSFER_PART_SIZE', str(16 * 1024 * 1024)))
+TRANSFER_MAX_INFLIGHT = int(os.getenv('TRANSFER_MAX_INFLIGHT', str(256 * 1024 * 1024)))
+TRANSFER_RETRIES = int(os.getenv('TRANSFER_RETRIES', '4'))
+TRANSFER_BACKOFF = float(os.getenv('TRANSFER_BACKOFF', '0.5'))
@@ -0,0 +1,315 @@
+"""
+Time series datacube of the daily mosaics.
+
+The daily mosaics are one GeoTIFF per day under norm/mosaics/{sat}/{year}/,
+so any per pixel question over time (normals, cloud filling, basin
+summaries) has to open thousands of files.  The datacube keeps the same data
+as a single chunked, compressed (time, y, x) array per satellite that the
+process stage appends each day's mosaic to.
+
+The cube is an HDF5 file laid out as NetCDF4 (the `time`, `y` and `x`
+coordinates are dimension scales of the `snow` variable, with CF attributes),
+written with h5py which is already a dependency for the VIIRS granules, so it
+can also be opened with xarray / netCDF4.  There is a single writer per
+satellite (the process stage), any number of readers.
+
+    with DataCube.for_sat('modis') as cube:
+        data = cube.read_time_slice('2023.03.23')
+        dates, series = cube.read_pixel_series(-120.5, 54.2)
+        normal = cube.to_dataarray().groupby('time.dayofyear').mean()
+"""
+
+import datetime
+import logging
+import os
+
+import dask.array as da
+import h5py
+import numpy as np
+import rasterio as rio
+import rioxarray as rioxr  # noqa: F401 registers the .rio accessor
+import xarray as xr
+
+from affine import Affine
+from rasterio.crs import CRS
+
+import admin.constants as const
+
+LOGGER = logging.getLogger(__name__)
+
+VARIABLE = 'snow'
+EPOCH = datetime.date(1970, 1, 1)
+DATE_FMT = '%Y.%m.%d'
+
+
+def get_datacube_path(sat: str) -> str:
+    """path to the datacube of a satellite
+
+    :param sat: satellite [modis | viirs]
+    :type sat: str
+    :return: the path of the cube
+    :rtype: str
+    """
+    return os.path.join(const.DATACUBE, f'{sat}_mosaics.nc')
+
+
+def _to_days(date: str) -> int:
+    return (datetime.datetime.strptime(date, DATE_FMT).date() - EPOCH).days
+
+
+def _to_date(days: int) -> str:
+    return (EPOCH + datetime.timedelta(days=int(days))).strftime(DATE_FMT)
+
+
+class DataCube:
+    """chunked (time, y, x) store of the daily mosaics of one satellite
+
+    :param path: path to the cube
+    :type path: str
+    :param mode: 'r' to read, 'a' to create / append, defaults to 'r'
+    :type mode: str, optional
+    """
+
+    def __init__(self, path: str, mode: str = 'r'):
+        if mode not in ('r', 'a'):
+            raise ValueError(f'invalid datacube mode: {mode}, valid values: r, a')
+        if mode == 'a':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.mode = mode
+        self.h5 = h5py.File(path, mode)
+        self._index = None
+
+    @classmethod
+    def for_sat(cls, sat: str, mode: str = 'r'):
+        """opens the cube of a satellite, see get_datacube_path
+        """
+        return cls(get_datacube_path(sat), mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.h5.close()
+
+    @property
+    def exists(self) -> bool:
+        """whether the cube has been created (has a grid)
+        """
+        return VARIABLE in self.h5
+
+    @property
+    def transform(self) -> Affine:
+        return Affine(*self.h5[VARIABLE].attrs['transform'][:6])
+
+    @property
+    def crs(self) -> CRS:
+        return CRS.from_wkt(self.h5[VARIABLE].attrs['crs_wkt'])
+
+    @property
+    def nodata(self):
+        return self.h5[VARIABLE].attrs.get('_FillValue')
+
+    @property
+    def shape(self) -> tuple:
+        """(height, width) of the grid
+        """
+        return self.h5[VARIABLE].shape[1:]
+
+    @property
+    def dates(self) -> list:
+        """dates in the cube in date order
+        """
+        return sorted(self._get_index())
+
+    def _get_index(self) -> dict:
+        """{date: position along the time dimension}
+        """
+        if self._index is None:
+            days = self.h5['time'][:] if 'time' in self.h5 else []
+            self._index = {_to_date(d): i for i, d in enumerate(days)}
+        return self._index
+
+    def _create(self, shape: tuple, dtype, transform: Affine, crs, nodata):
+        """creates the variable and the coordinates of the cube
+        """
+        height, width = shape
+        blocksize = const.RASTER_BLOCKSIZE
+        chunks = (const.DATACUBE_TIME_CHUNK, min(blocksize, height),
+                  min(blocksize, width))
+        time = self.h5.create_dataset(
+            'time', shape=(0,), maxshape=(None,), dtype='int32', chunks=(chunks[0],))
+        time.attrs['units'] = f'days since {EPOCH.isoformat()}'
+        time.attrs['calendar'] = 'standard'
+        time.attrs['standard_name'] = 'time'
+        # pixel centres
+        xs = transform.c + (np.arange(width) + 0.5) * transform.a
+        ys = transform.f + (np.arange(height) + 0.5) * transform.e
+        x = self.h5.create_dataset('x', data=xs)
+        y = self.h5.create_dataset('y', data=ys)
+        for ds in (time, y, x):
+            ds.make_scale(ds.name.strip('/'))
+
+        fillvalue = nodata if nodata is not None else 0
+        snow = self.h5.create_dataset(
+            VARIABLE, shape=(0, height, width), maxshape=(None, height, width),
+            dtype=dtype, chunks=chunks, compression='gzip', compression_opts=4,
+            shuffle=True, fillvalue=np.array(fillvalue, dtype=dtype))
+        snow.dims[0].attach_scale(time)
+        snow.dims[1].attach_scale(y)
+        snow.dims[2].attach_scale(x)
+        snow.attrs['transform'] = np.array(tuple(transform)[:6])
+        snow.attrs['crs_wkt'] = CRS.from_user_input(crs).to_wkt()
+        if nodata is not None:
+            snow.attrs['_FillValue'] = np.array(nodata, dtype=dtype)
+        LOGGER.debug(f'created datacube {self.path}: {shape} chunks {chunks}')
+
+    def write(self, date: str, data: np.ndarray, transform: Affine, crs, nodata=None):
+        """appends the mosaic of a date, or replaces it if the date is already
+        in the cube
+
+        :param date: date in format YYYY.MM.DD
+        :type date: str
+        :param data: the mosaic, 2d
+        :type data: np.ndarray
+        :param transform: transform of the mosaic
+        :type transform: Affine
+        :param crs: crs of the mosaic
+        :param nodata: nodata value, used when the cube is created
+        :raises ValueError: if the mosaic is not on the grid of the cube
+        """
+        if self.mode != 'a':
+            raise ValueError(f'datacube {self.path} is open read only')
+        if not self.exists:
+            self._create(data.shape, data.dtype, transform, crs, nodata)
+        if data.shape != self.shape or not self.transform.almost_equals(transform):
+            raise ValueError(
+                f'{date} mosaic {data.shape} {tuple(transform)[:6]} is not on the grid '
+                f'of {self.path} {self.shape} {tuple(self.transform)[:6]}')
+        index = self._get_index()
+        snow = self.h5[VARIABLE]
+        if date not in index:
+            i = snow.shape[0]
+            snow.resize(i + 1, axis=0)
+            self.h5['time'].resize(i + 1, axis=0)
+            self.h5['time'][i] = _to_days(date)
+            index[date] = i
+        snow[index[date]] = data
+        self.h5.flush()
+
+    def append_raster(self, date: str, pth: str):
+        """appends the first band of a raster, see write
+        """
+        with rio.open(pth) as src:
+            data = src.read(1)
+            transform, crs, nodata = src.transform, src.crs, src.nodata
+        self.write(date, data, transform, crs, nodata)
+        LOGGER.debug(f'added {pth} to {self.path} as {date}')
+
+    def read_time_slice(self, date: str):
+        """the mosaic of a date
+
+        :param date: date in format YYYY.MM.DD
+        :type date: str
+        :return: 2d array, None if the date is not in the cube
+        :rtype: np.ndarray
+        """
+        i = self._get_index().get(date)
+        if i is None:
+            return None
+        return self.h5[VARIABLE][i]
+
+    def read_time_range(self, start: str, end: str):
+        """the mosaics between two dates (inclusive)
+
+        :param start: first date in format YYYY.MM.DD
+        :type start: str
+        :param end: last date in format YYYY.MM.DD
+        :type end: str
+        :return: the dates in the range that are in the cube and the
+            (time, y, x) array of their mosaics
+        :rtype: tuple(list, np.ndarray)
+        """
+        index = self._get_index()
+        dates = [d for d in sorted(index) if start <= d <= end]
+        return dates, self._read_dates(dates)
+
+    def _read_dates(self, dates: list, rows=slice(None),
+                    cols=slice(None)) -> np.ndarray:
+        """reads dates in the given order, h5py needs increasing indices
+        """
+        positions = np.array([self._get_index()[d] for d in dates], dtype='int64')
+        if len(positions) == 0:
+            empty = np.empty((0, *self.shape), dtype=self.h5[VARIABLE].dtype)
+            return empty[:, rows, cols]
+        order = np.argsort(positions)
+        data = self.h5[VARIABLE][np.sort(positions), rows, cols]
+        out = np.empty_like(data)
+        out[order] = data
+        return out
+
+    def read_pixel_series(self, x: float, y: float):
+        """time series of the pixel at a coordinate
+
+        :param x: x coordinate, in the crs of the cube
+        :type x: float
+        :param y: y coordinate, in the crs of the cube
+        :type y: float
+        :raises ValueError: if the coordinate is outside of the cube
+        :return: the dates and the values of the pixel in date order
+        :rtype: tuple(list, np.ndarray)
+        """
+        col, row = ~self.transform * (x, y)
+        row, col = int(np.floor(row)), int(np.floor(col))
+        height, width = self.shape
+        if not (0 <= row < height and 0 <= col < width):
+            raise ValueError(f'({x}, {y}) is outside of {self.path}')
+        dates = self.dates
+        return dates, self._read_dates(dates, row, col)
+
+    def to_dataarray(self) -> xr.DataArray:
+        """the cube as a lazy (dask) DataArray in date order, chunked as it
+        is stored so reductions run chunk by chunk
+
+        :return: (time, y, x) DataArray with the crs, transform and nodata set
+        :rtype: xr.DataArray
+        """
+        snow = self.h5[VARIABLE]
+        index = self._get_index()
+        dates = sorted(index, key=index.get)
+        data = da.from_array(snow, chunks=snow.chunks)
+        times = [datetime.datetime.strptime(d, DATE_FMT) for d in dates]
+        dataarray = xr.DataArray(
+            data, dims=('time', 'y', 'x'),
+            coords={'time': times, 'y': self.h5['y'][:], 'x': self.h5['x'][:]},
+            name=VARIABLE)
+        dataarray = dataarray.sortby('time')
+        dataarray.rio.write_crs(self.crs, inplace=True)
+        dataarray.rio.write_transform(self.transform, inplace=True)
+        if self.nodata is not None:
+            dataarray.rio.write_nodata(self.nodata.item(), encoded=False, inplace=True)
+        return dataarray
+
+
+def sync_mosaics(sat: str, mosaics: dict):
+    """adds the daily mosaics written by the process stage to the cube of
+    the satellite, failures are logged and do not stop the pipeline
+
+    :param sat: satellite [modis | viirs]
+    :type sat: str
+    :param mosaics: {date: path to the mosaic}, missing files are skipped
+    :type mosaics: dict
+    """
+    mosaics = {d: p for d, p in mosaics.items() if p and os.path.exists(p)}
+    if not mosaics:
+        return
+    try:
+        with DataCube.for_sat(sat, 'a') as cube:
+            for date in sorted(mosaics):
+                cube.append_raster(date, mosaics[date])
+        LOGGER.info(f'{len(mosaics)} {sat} mosaics added to the datacube')
+    except Exception as e:
+        LOGGER.exception(f'could not update the {sat} datacube: {e}')
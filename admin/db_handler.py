@@ -10,13 +10,16 @@ class DBHandler(object):
     """
     Database Handler Class
     """
+    # one table of statistics per satellite
+    TABLES = ['modis', 'viirs', 'sentinel2']
+
     def __init__(self):
         """
         Setup db connection and missing tables
         """
         super().__init__()
-        self.conn = self._init_connection()
         self.logger = logging.getLogger(__name__)
+        self.conn = self._init_connection()
         self._setup_tables()
 
     def __del__(self):
@@ -33,14 +36,18 @@ class DBHandler(object):
         sqlite3 connection
             Connector object to a sqlite3 db
         """
-        return sqlite3.connect(os.path.join(const.ANALYSIS, 'analysis.db'))
+        conn = sqlite3.connect(os.path.join(const.ANALYSIS, 'analysis.db'), timeout=30)
+        # WAL so that readers don't block the writer and vice versa
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
 
     def _setup_tables(self):
         """
         Internal function to set up missing tables
         """
         self.logger.info('Creating tables if not exists')
-        for sat in ['modis', 'viirs', 'sentinel2']:
+        for sat in self.TABLES:
             create = f"CREATE TABLE IF NOT EXISTS {sat} ( \
                                             id integer PRIMARY KEY, \
                                             name text NOT NULL, \
@@ -50,6 +57,42 @@ class DBHandler(object):
                                             below_threshold real \
                                         );"
             self.execute(create)
+            self._setup_index(sat)
+
+    def _setup_index(self, sat):
+        """
+        Internal function to add the unique (name, date_) index that the
+        upserts rely on. Duplicates left by older versions are removed
+        first, keeping the most recent row
+
+        Parameters
+        ----------
+        sat : str
+            Satellite table [modis | viirs | sentinel2]
+        """
+        index = f'{sat}_name_date_'
+        exists = self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND name=?", (index,)).fetchone()
+        if exists:
+            return
+        self.logger.info(f'Creating index {index}')
+        with self.conn:
+            self.conn.execute(f"DELETE FROM {sat} WHERE id NOT IN \
+                (SELECT MAX(id) FROM {sat} GROUP BY name, date_)")
+            self.conn.execute(f"CREATE UNIQUE INDEX {index} ON {sat}(name, date_)")
+
+    def _check_table(self, sat):
+        """
+        Internal function to validate the table name before it is used in a
+        statement
+
+        Parameters
+        ----------
+        sat : str
+            Satellite table [modis | viirs | sentinel2]
+        """
+        if sat not in self.TABLES:
+            raise ValueError(f'invalid table: {sat}, valid values: {", ".join(self.TABLES)}')
 
 
     def get_conn(self):
@@ -96,19 +139,70 @@ class DBHandler(object):
         below_threshold : float
             % of values below 20% NDSI threshold
         """
-        insert = f"""INSERT OR REPLACE INTO {sat}(
-                id, name, date_, snow_coverage, nodata, below_threshold
+        self.insert_many(sat, [{
+            'name': name,
+            'date_': date_,
+            'coverage': coverage,
+            'nodata': nodata,
+            'below_threshold': below_threshold
+        }])
+
+    def insert_many(self, sat, rows):
+        """Upsert a batch of statistics in a single transaction
+
+        Parameters
+        ----------
+        sat : str
+            Satellite table to reference [modis | viirs | sentinel2]
+        rows : list
+            List of dicts with the name, date_, coverage, nodata and
+            below_threshold of each entry, see insert
+        """
+        self._check_table(sat)
+        upsert = f"""INSERT INTO {sat}(
+                name, date_, snow_coverage, nodata, below_threshold
             ) VALUES(
-                (SELECT id FROM {sat} WHERE name='{name}' AND date_='{date_}'),'{name}', '{date_}', {coverage}, {nodata}, {below_threshold}
-            );
+                :name, :date_, :coverage, :nodata, :below_threshold
+            ) ON CONFLICT(name, date_) DO UPDATE SET
+                snow_coverage=excluded.snow_coverage,
+                nodata=excluded.nodata,
+                below_threshold=excluded.below_threshold;
             """
+        # numpy scalars are not supported by sqlite3
+        rows = [
+            {k: (v.item() if hasattr(v, 'item') else v) for k, v in row.items()}
+            for row in rows
+        ]
         try:
-            cur = self.conn.cursor()
-            cur.execute(insert)
-            self.conn.commit()
+            with self.conn:
+                self.conn.executemany(upsert, rows)
         except sqlite3.Error as e:
             self.logger.error(e)
-            self.logger.debug(f'data to handler: {insert}')
+            self.logger.debug(f'data to handler: {rows}')
+
+    def select_stats(self, sat, date_):
+        """Fetch the statistics of every aoi for a date in one query
+
+        Parameters
+        ----------
+        sat : str
+            Satellite table to reference [modis | viirs | sentinel2]
+        date_ : str
+            Date in format YYYY.MM.DD
+
+        Returns
+        -------
+        dict
+            name -> dict of snow_coverage, nodata and below_threshold
+        """
+        self._check_table(sat)
+        cur = self.conn.execute(
+            f"SELECT name, snow_coverage, nodata, below_threshold FROM {sat} WHERE date_=?",
+            (date_,))
+        return {
+            name: {'snow_coverage': snow, 'nodata': nodata, 'below_threshold': below}
+            for name, snow, nodata, below in cur.fetchall()
+        }
 
     def select(self, stmt):
         """Select statement for sqlite3 db
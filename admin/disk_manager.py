@@ -0,0 +1,259 @@
+"""
+Retention of the working directories.
+
+The granules, intermediate tifs and the kml / plot temp files the pipeline
+writes below const.TOP accumulate until the volume is full.  The disk manager
+keeps every category of files within the age and size quota of
+const.RETENTION:
+
+* the files older than the max age of their category are deleted
+* then the oldest files, until the category is below its max size
+
+Only files that are archived are deleted: the object at the same path in
+object storage has the ETag of the file (the md5 of its content, or its size
+for multipart uploads), or the file was pulled from that object through the
+artifact cache (admin/artifact_cache.py).  Files pinned in the artifact cache
+are never deleted, and the age of a cached file counts from when it was last
+used, so the recent days the runs keep reading stay on disk.  The categories
+are scanned and checked concurrently:
+
+    report = disk_manager.enforce()
+    report['intermediate']['freed']
+
+or from the command line, `python run.py prune --dry-run`.
+"""
+
+import concurrent.futures
+import logging
+import os
+import time
+
+import admin.constants as const
+
+from admin import artifact_cache, metrics
+
+LOGGER = logging.getLogger(__name__)
+
+CATEGORIES = {
+    'downloads': const.MODIS_TERRA,
+    'intermediate': const.INTERMEDIATE_TIF,
+    'intermediate_kml': const.INTERMEDIATE_KML,
+    'intermediate_plot': const.INTERMEDIATE_TIF_PLOT,
+    'kml': const.KML,
+    'plot': const.PLOT,
+    'watersheds': const.WATERSHEDS,
+    'basins': const.BASINS,
+}
+# files hashed at once to compare them to the ETags
+HASH_WORKERS = 4
+
+
+def scan(directory: str, exclude: list = ()) -> list:
+    """the files below a directory
+
+    :param directory: the directory
+    :type directory: str
+    :param exclude: directories below it that are not scanned
+    :type exclude: list, optional
+    :return: (path, size, mtime) of the files
+    :rtype: list[tuple]
+    """
+    exclude = {os.path.abspath(pth) for pth in exclude}
+    files = []
+    for root, dirs, names in os.walk(os.path.abspath(directory)):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) not in exclude]
+        for name in names:
+            pth = os.path.join(root, name)
+            try:
+                st = os.stat(pth)
+            except FileNotFoundError:
+                continue
+            files.append((pth, st.st_size, st.st_mtime))
+    return files
+
+
+def plan(files: list, max_age_days: float, max_gb: float, protected: set = (),
+         now: float = None) -> list:
+    """the files to delete to bring a category within its quota
+
+    :param files: (path, size, last used) of the files of the category
+    :type files: list[tuple]
+    :param max_age_days: files last used before are deleted, 0 to keep them
+    :type max_age_days: float
+    :param max_gb: size of the category, 0 for no limit
+    :type max_gb: float
+    :param protected: paths that must not be deleted (pinned or not archived)
+    :type protected: set, optional
+    :return: the paths, oldest first
+    :rtype: list[str]
+    """
+    now = time.time() if now is None else now
+    oldest = now - max_age_days * 86400 if max_age_days else None
+    max_bytes = max_gb * 1024 ** 3 if max_gb else None
+    total = sum(size for _, size, _ in files)
+    delete = []
+    for pth, size, last_used in sorted(files, key=lambda f: f[2]):
+        expired = oldest is not None and last_used < oldest
+        over = max_bytes is not None and total > max_bytes
+        if not expired and not over:
+            break
+        if pth in protected:
+            continue
+        delete.append(pth)
+        total -= size
+    return delete
+
+
+class DiskManager:
+    """enforces the retention quotas, see the module docstring
+
+    :param ostore: admin.object_store_util.OStore the files are archived to,
+        the shared one by default
+    :param policy: category -> (max age in days, max size in GB), defaults to
+        const.RETENTION
+    :type policy: dict, optional
+    :param cache: the artifact cache, defaults to artifact_cache.get_cache()
+    """
+
+    def __init__(self, ostore=None, policy: dict = None, cache=None):
+        if ostore is None:
+            import admin.object_store_util  # needs the object store client
+            ostore = admin.object_store_util.get_ostore()
+        self.ostore = ostore
+        self.policy = const.RETENTION if policy is None else policy
+        self.cache = cache or artifact_cache.get_cache()
+
+    def get_files(self, category: str) -> list:
+        """(path, size, last used) of the files of a category, the
+        directories of the other categories below it are not included
+        """
+        directory = CATEGORIES[category]
+        prefix = os.path.join(os.path.abspath(directory), '')
+        nested = [other for name, other in CATEGORIES.items()
+                  if name != category and os.path.abspath(other).startswith(prefix)]
+        entries = self.cache.get_under(directory)
+        files = []
+        for pth, size, mtime in scan(directory, nested):
+            entry = entries.get(pth)
+            last_used = max(mtime, entry['last_used']) if entry else mtime
+            files.append((pth, size, last_used))
+        return files
+
+    def get_archived(self, files: list) -> set:
+        """the files that are in object storage with their content
+
+        :param files: (path, size, last used) of the files
+        :type files: list[tuple]
+        :return: the paths of the archived files
+        :rtype: set[str]
+        """
+        ostore_paths = {pth: self.ostore.get_ostore_path(pth) for pth, _, _ in files}
+        # listed again, a file is deleted only if the object is there now
+        stats = self.ostore.transfer.stat_many(list(ostore_paths.values()),
+                                               refresh=True)
+        entries = {}
+        if files:
+            entries = self.cache.get_under(
+                os.path.commonpath([pth for pth, _, _ in files]))
+
+        archived, to_hash = set(), []
+        for pth, size, _ in files:
+            stat = stats[ostore_paths[pth]]
+            if stat is None:
+                continue
+            entry = entries.get(pth)
+            etag = artifact_cache.normalize_etag(stat[1])
+            if (entry and etag and entry['etag'] == etag
+                    and entry['size'] == size == stat[0]):
+                archived.add(pth)
+            else:
+                to_hash.append((pth, stat))
+        with concurrent.futures.ThreadPoolExecutor(HASH_WORKERS) as pool:
+            results = pool.map(lambda item: artifact_cache.matches(item[0], *item[1]),
+                               to_hash)
+            archived.update(pth for (pth, _), match in zip(to_hash, results) if match)
+        return archived
+
+    def enforce_category(self, category: str, dry_run: bool = False) -> dict:
+        """deletes the archived files of a category that are over its quota
+
+        :param category: one of CATEGORIES
+        :type category: str
+        :param dry_run: only report what would be deleted
+        :type dry_run: bool, optional
+        :return: files and bytes of the category, files deleted, bytes freed
+            and files over the quota that are not archived
+        :rtype: dict
+        """
+        max_age_days, max_gb = self.policy.get(category, (0, 0))
+        report = {'files': 0, 'bytes': 0, 'deleted': 0, 'freed': 0, 'unarchived': 0}
+        if not max_age_days and not max_gb:
+            return report
+        files = self.get_files(category)
+        report['files'], report['bytes'] = len(files), sum(size for _, size, _ in files)
+        pinned = self.cache.get_pinned()
+        # only the files over the quota are checked against object storage
+        candidates = set(plan(files, max_age_days, max_gb, pinned))
+        archived = self.get_archived([f for f in files if f[0] in candidates])
+        report['unarchived'] = len(candidates - archived)
+        if report['unarchived']:
+            LOGGER.warning(f"{report['unarchived']} {category} files over the quota "
+                           'are not archived, they are kept')
+        not_archived = set(f[0] for f in files) - archived
+        delete = plan(files, max_age_days, max_gb, pinned | not_archived)
+        sizes = {pth: size for pth, size, _ in files}
+        for pth in delete:
+            LOGGER.debug(f'deleting {pth}')
+            report['freed'] += sizes[pth] if dry_run else self.cache.remove(pth)
+        report['deleted'] = len(delete)
+        if not dry_run:
+            self.remove_empty_dirs(category, delete)
+            metrics.METRICS.count('disk_reclaimed_bytes', report['freed'],
+                                  category=category)
+        return report
+
+    def remove_empty_dirs(self, category: str, deleted: list):
+        """removes the directories the files were deleted from if they are
+        empty now, ie the date directories
+        """
+        root = os.path.abspath(CATEGORIES[category])
+        directories = {os.path.dirname(pth) for pth in deleted}
+        for directory in sorted(directories, reverse=True):
+            while directory != root and directory.startswith(root):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def enforce(self, categories: list = None, dry_run: bool = False) -> dict:
+        """enforces the quotas of the categories, concurrently
+
+        :param categories: defaults to all the categories of the policy
+        :type categories: list, optional
+        :param dry_run: only report what would be deleted
+        :type dry_run: bool, optional
+        :return: category -> report, see enforce_category
+        :rtype: dict
+        """
+        categories = [category for category in (categories or CATEGORIES)
+                      if any(self.policy.get(category, (0, 0)))]
+        if not categories:
+            return {}
+        with metrics.stage('disk_manager', dry_run=dry_run), \
+                concurrent.futures.ThreadPoolExecutor(len(categories)) as pool:
+            reports = dict(zip(categories, pool.map(
+                lambda c: self.enforce_category(c, dry_run), categories)))
+        for category, report in reports.items():
+            LOGGER.info(f"{category}: {'would delete' if dry_run else 'deleted'} "
+                        f"{report['deleted']} of {report['files']} files, "
+                        f"{report['freed'] / 1e6:.1f} of "
+                        f"{report['bytes'] / 1e6:.1f} MB")
+        freed = sum(report['freed'] for report in reports.values())
+        LOGGER.info(f"{'would reclaim' if dry_run else 'reclaimed'} "
+                    f"{freed / 1e6:.1f} MB")
+        return reports
+
+
+def enforce(categories: list = None, dry_run: bool = False) -> dict:
+    return DiskManager().enforce(categories, dry_run)
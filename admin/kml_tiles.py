@@ -0,0 +1,484 @@
+"""
+In process KML super-overlay builder.
+
+Replaces the `gdal_translate -expand rgb` / `gdalwarp -cutline` /
+`gdal2tiles.py -k` chain that used to be run through os.system for every
+shed.  The palette is expanded in memory, the cutline is rasterized once per
+shape / grid and cached, and the tile pyramid is rendered straight from the
+array.  The output follows the layout gdal2tiles uses for the raster profile:
+
+    <out_dir>/doc.kml
+    <out_dir>/<z>/<x>/<y>.kml
+    <out_dir>/<z>/<x>/<y>.png
+
+Zoom 0 is a single tile covering the whole raster and the highest zoom is
+the native resolution.  Tiles are resampled with nearest neighbour, tiles
+that are completely transparent are not written.
+
+The hash of every tile is kept in <out_dir>/tiles.json.  When a pyramid is
+rebuilt, or built next to the pyramid of the previous day, tiles whose hash
+did not change are kept / hard linked instead of being rendered again.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import warnings
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+import simplekml
+
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+
+LOGGER = logging.getLogger(__name__)
+
+TILESIZE = 128
+# tile hashes of a pyramid, used to skip unchanged tiles
+TILE_INDEX = 'tiles.json'
+
+# the png tiles are placed by the kml, not by a geotransform. Filtered at
+# module level as catch_warnings is not thread safe and tiles are rendered
+# from a pool
+warnings.filterwarnings(
+    'ignore', message='Dataset has no geotransform', category=NotGeoreferencedWarning)
+
+
+def expand_palette(data: np.ndarray, colormap: dict, bands: int = 3) -> np.ndarray:
+    """expands palette indexes into rgb(a) bands, the in memory equivalent of
+    `gdal_translate -expand rgb|rgba`.  Values that are not in the colormap
+    (including values outside of 0 .. 255) become transparent black.
+
+    :param data: 2d array of palette indexes
+    :type data: np.ndarray
+    :param colormap: colour table, index -> (r, g, b, a)
+    :type colormap: dict
+    :param bands: 3 for rgb or 4 for rgba, defaults to 3
+    :type bands: int, optional
+    :return: uint8 array of shape (bands, y, x)
+    :rtype: np.ndarray
+    """
+    lut = np.zeros((256, 4), dtype='uint8')
+    for index, colour in colormap.items():
+        if 0 <= index < 256:
+            lut[index] = tuple(colour) + (255,) * (4 - len(colour))
+    data = np.ma.filled(data, 0) if np.ma.isMaskedArray(data) else np.asarray(data)
+    valid = (data >= 0) & (data < 256)
+    idx = np.where(valid, data, 0).astype('uint8')
+    rgba = lut[:, :bands][idx]
+    rgba[~valid] = 0
+    return np.moveaxis(rgba, -1, 0)
+
+
+@functools.lru_cache(maxsize=256)
+def _get_cutline(shp_pth: str, crs_wkt: str, transform, width: int, height: int):
+    gdf = gpd.read_file(shp_pth)
+    crs = CRS.from_wkt(crs_wkt)
+    if gdf.crs is not None and CRS.from_user_input(gdf.crs) != crs:
+        gdf = gdf.to_crs(crs_wkt)
+    inside = ~geometry_mask(
+        gdf.geometry, out_shape=(height, width), transform=transform)
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    if not len(rows):
+        return None, None
+    window = Window(
+        int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+    mask = inside[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    mask.setflags(write=False)
+    return window, mask
+
+
+def get_cutline(shp_pth: str, crs, transform, width: int, height: int):
+    """rasterizes a cutline onto a grid, the in memory equivalent of
+    `gdalwarp -cutline -crop_to_cutline -dstalpha`.  The result is cached per
+    shape file and grid so repeated days / products reuse it.
+
+    :param shp_pth: path to the cutline shape file
+    :type shp_pth: str
+    :param crs: crs of the grid
+    :type crs: rasterio.crs.CRS
+    :param transform: transform of the grid
+    :type transform: affine.Affine
+    :param width: width of the grid
+    :type width: int
+    :param height: height of the grid
+    :type height: int
+    :return: the window that crops the grid to the cutline and the boolean
+        mask (True inside the cutline) for that window, (None, None) if the
+        cutline does not intersect the grid
+    :rtype: tuple(rasterio.windows.Window, np.ndarray)
+    """
+    return _get_cutline(shp_pth, CRS.from_user_input(crs).to_wkt(), transform, width, height)
+
+
+def get_max_zoom(width: int, height: int, tilesize: int = TILESIZE) -> int:
+    """the zoom level of the native resolution, zoom 0 fits in a single tile
+
+    :param width: width of the raster
+    :type width: int
+    :param height: height of the raster
+    :type height: int
+    :param tilesize: tile size in pixels, defaults to TILESIZE
+    :type tilesize: int, optional
+    :return: the highest zoom level
+    :rtype: int
+    """
+    return max(0, math.ceil(math.log2(max(width, height) / tilesize)))
+
+
+class SuperOverlay:
+    """tile pyramid + KML super-overlay of an rgba array in EPSG:4326
+
+    :param rgba: uint8 array of shape (4, y, x)
+    :type rgba: np.ndarray
+    :param transform: transform of the array, in degrees
+    :type transform: affine.Affine
+    :param title: name of the overlay
+    :type title: str
+    :param tilesize: tile size in pixels, defaults to TILESIZE
+    :type tilesize: int, optional
+    """
+
+    def __init__(self, rgba: np.ndarray, transform, title: str, tilesize: int = TILESIZE):
+        self.rgba = rgba
+        self.transform = transform
+        self.title = title
+        self.tilesize = tilesize
+        self.height, self.width = rgba.shape[1:]
+        self.max_zoom = get_max_zoom(self.width, self.height, tilesize)
+        self._tiles = {}
+
+    @classmethod
+    def open(cls, tile_dir: str, title: str = None):
+        """a pyramid written by write, to link to its tiles with write_links
+        without its data.  Its tiles can not be rendered again.
+
+        :param tile_dir: directory of the pyramid
+        :type tile_dir: str
+        :return: the pyramid, None if there is no complete pyramid in tile_dir
+        :rtype: SuperOverlay
+        """
+        index_pth = os.path.join(tile_dir, TILE_INDEX)
+        if not os.path.exists(index_pth):
+            return None
+        with open(index_pth) as f:
+            index = json.load(f)
+        if 'children' not in index: # written before the children were indexed
+            return None
+        transform, width, height, tilesize = index['grid']
+        overlay = cls.__new__(cls)
+        overlay.rgba = None
+        overlay.transform = Affine(*transform)
+        overlay.title = title or os.path.basename(tile_dir)
+        overlay.tilesize = tilesize
+        overlay.height, overlay.width = height, width
+        overlay.max_zoom = get_max_zoom(width, height, tilesize)
+        overlay._tiles = {tuple(int(i) for i in key.split('/')): [tuple(c) for c in children]
+                          for key, children in index['children'].items()}
+        return overlay
+
+    def get_span(self, z: int) -> int:
+        """native pixels covered by one tile at zoom z"""
+        return self.tilesize * 2 ** (self.max_zoom - z)
+
+    def get_tile_count(self, z: int):
+        """number of tiles (x, y) at zoom z"""
+        span = self.get_span(z)
+        return math.ceil(self.width / span), math.ceil(self.height / span)
+
+    def get_bounds(self, z: int, x: int, y: int):
+        """(west, south, east, north) of a tile"""
+        span = self.get_span(z)
+        west, north = self.transform * (x * span, y * span)
+        east, south = self.transform * ((x + 1) * span, (y + 1) * span)
+        return west, south, east, north
+
+    def read_tile(self, z: int, x: int, y: int) -> np.ndarray:
+        """the rgba data of a tile, nearest neighbour decimated and padded
+        with transparency to the full tile size"""
+        span = self.get_span(z)
+        step = span // self.tilesize
+        data = self.rgba[:, y * span:(y + 1) * span:step, x * span:(x + 1) * span:step]
+        tile = np.zeros((4, self.tilesize, self.tilesize), dtype='uint8')
+        tile[:, :data.shape[1], :data.shape[2]] = data
+        return tile
+
+    def get_children(self, z: int, x: int, y: int) -> list:
+        """the tiles at zoom z + 1 that cover this tile"""
+        if z >= self.max_zoom:
+            return []
+        ntx, nty = self.get_tile_count(z + 1)
+        return [
+            (z + 1, cx, cy)
+            for cy in (2 * y, 2 * y + 1) for cx in (2 * x, 2 * x + 1)
+            if cx < ntx and cy < nty
+        ]
+
+    def _region(self, z: int, x: int, y: int, leaf: bool):
+        west, south, east, north = self.get_bounds(z, x, y)
+        return simplekml.Region(
+            latlonaltbox=simplekml.LatLonAltBox(north=north, south=south, east=east, west=west),
+            lod=simplekml.Lod(
+                minlodpixels=self.tilesize // 2,
+                maxlodpixels=-1 if leaf else self.tilesize * 8))
+
+    def _write_tile(self, out_dir: str, z: int, x: int, y: int, children: list,
+                    tile: np.ndarray = None):
+        tile_dir = os.path.join(out_dir, str(z), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        png_pth = os.path.join(tile_dir, f'{y}.png')
+        kml_pth = os.path.join(tile_dir, f'{y}.kml')
+        # the files may be hard links to the previous day's tiles, never
+        # write through them
+        for pth in (png_pth, kml_pth):
+            if os.path.exists(pth):
+                os.remove(pth)
+        with rio.open(png_pth, 'w', driver='PNG', width=self.tilesize,
+                      height=self.tilesize, count=4, dtype='uint8') as dst:
+            dst.write(self.read_tile(z, x, y) if tile is None else tile)
+
+        west, south, east, north = self.get_bounds(z, x, y)
+        kml = simplekml.Kml(name=f'{z}/{x}/{y}.kml')
+        kml.document.region = self._region(z, x, y, leaf=not children)
+        ground = kml.newgroundoverlay(name=f'{z}/{x}/{y}.png', draworder=z)
+        ground.icon.href = f'{y}.png'
+        ground.latlonbox.north = north
+        ground.latlonbox.south = south
+        ground.latlonbox.east = east
+        ground.latlonbox.west = west
+        for cz, cx, cy in children:
+            self._add_link(kml, cz, cx, cy, f'../../{cz}/{cx}/{cy}.kml')
+        kml.save(kml_pth)
+
+    def _add_link(self, kml, z: int, x: int, y: int, href: str):
+        link = kml.newnetworklink(name=f'{z}/{x}/{y}.kml')
+        link.region = self._region(z, x, y, leaf=not self._tiles.get((z, x, y)))
+        link.link.href = href
+        link.link.viewrefreshmode = simplekml.ViewRefreshMode.onregion
+
+    def get_tiles(self) -> dict:
+        """all the non empty tiles and their non empty children, the root
+        tile is always included
+
+        :return: (z, x, y) -> list of child tiles
+        :rtype: dict
+        """
+        alpha = self.rgba[3] > 0
+        nonempty = {}
+        for z in range(self.max_zoom, -1, -1):
+            span = self.get_span(z)
+            ntx, nty = self.get_tile_count(z)
+            for y in range(nty):
+                for x in range(ntx):
+                    children = [
+                        c for c in self.get_children(z, x, y) if c in nonempty]
+                    if z == 0 or children or (z == self.max_zoom and alpha[
+                            y * span:(y + 1) * span, x * span:(x + 1) * span].any()):
+                        nonempty[(z, x, y)] = children
+        return nonempty
+
+    def get_grid(self) -> list:
+        """description of the tile grid, tiles are only comparable between
+        pyramids with the same grid"""
+        return [list(self.transform)[:6], self.width, self.height, self.tilesize]
+
+    @staticmethod
+    def tile_hash(tile: np.ndarray, children: list) -> str:
+        """hash of the rendered content of a tile: its decimated source block
+        and the child tiles its KML links to"""
+        digest = hashlib.blake2b(tile.tobytes(), digest_size=16)
+        digest.update(repr(children).encode())
+        return digest.hexdigest()
+
+    def load_index(self, tile_dir: str) -> dict:
+        """the tile hashes of a previously written pyramid, empty if there is
+        none or if it was written on a different grid
+
+        :param tile_dir: directory of the pyramid
+        :type tile_dir: str
+        :return: 'z/x/y' -> hash
+        :rtype: dict
+        """
+        index_pth = os.path.join(tile_dir, TILE_INDEX)
+        if not os.path.exists(index_pth):
+            return {}
+        with open(index_pth) as f:
+            index = json.load(f)
+        if index.get('grid') != self.get_grid():
+            LOGGER.debug(f'tile grid of {tile_dir} does not match, ignoring it')
+            return {}
+        return index['tiles']
+
+    def _update_tile(self, out_dir: str, z: int, x: int, y: int, children: list,
+                     previous: list):
+        """renders a tile unless an identical one already exists in out_dir
+        or in one of the previous pyramids, in which case it is hard linked
+
+        :return: the hash of the tile and whether it was rendered
+        :rtype: tuple(str, bool)
+        """
+        tile = self.read_tile(z, x, y)
+        # the kml of a tile depends on which of its children are leaves
+        digest = self.tile_hash(tile, [(c, not self._tiles.get(c)) for c in children])
+        key = f'{z}/{x}/{y}'
+        names = [os.path.join(str(z), str(x), f'{y}.{ext}') for ext in ('png', 'kml')]
+        for prev_dir, index in previous:
+            if index.get(key) != digest:
+                continue
+            if not all(os.path.exists(os.path.join(prev_dir, n)) for n in names):
+                continue
+            if prev_dir == out_dir:
+                return digest, False
+            os.makedirs(os.path.join(out_dir, str(z), str(x)), exist_ok=True)
+            for name in names:
+                _link_file(os.path.join(prev_dir, name), os.path.join(out_dir, name))
+            return digest, False
+        self._write_tile(out_dir, z, x, y, children, tile)
+        return digest, True
+
+    def write(self, out_dir: str, pool=None, previous_dir: str = None) -> str:
+        """renders the tiles and writes the KML files.  Tiles whose content is
+        unchanged from what is already in out_dir, or from the pyramid in
+        previous_dir, are not rendered again.
+
+        :param out_dir: directory to write the super-overlay to
+        :type out_dir: str
+        :param pool: pool to render the tiles with, rendered serially if None
+        :type pool: multiprocessing.pool.ThreadPool, optional
+        :param previous_dir: pyramid of the previous day to reuse tiles from
+        :type previous_dir: str, optional
+        :return: path to the top level doc.kml
+        :rtype: str
+        """
+        tiles = self._tiles = self.get_tiles()
+        previous = [(out_dir, self.load_index(out_dir))]
+        if previous_dir and os.path.exists(previous_dir):
+            previous.append((previous_dir, self.load_index(previous_dir)))
+        # the index is only valid once all the tiles are written
+        index_pth = os.path.join(out_dir, TILE_INDEX)
+        if os.path.exists(index_pth):
+            os.remove(index_pth)
+
+        args = [(out_dir, *tile, children, previous) for tile, children in tiles.items()]
+        if pool is None:
+            results = [self._update_tile(*arg) for arg in args]
+        else:
+            results = pool.starmap(self._update_tile, args)
+
+        kml = simplekml.Kml(name=self.title)
+        self._add_link(kml, 0, 0, 0, '0/0/0.kml')
+        doc_pth = os.path.join(out_dir, 'doc.kml')
+        kml.save(doc_pth)
+        with open(index_pth, 'w') as f:
+            json.dump({
+                'grid': self.get_grid(),
+                'tiles': {f'{z}/{x}/{y}': digest for (z, x, y), (digest, _) in zip(tiles, results)},
+                'children': {f'{z}/{x}/{y}': children for (z, x, y), children in tiles.items()},
+            }, f)
+        rendered = sum(r for _, r in results)
+        LOGGER.debug(f'rendered {rendered} of {len(tiles)} tiles in {out_dir}')
+        return doc_pth
+
+    def write_links(self, pth: str, title: str, window, href: str, max_links: int = 4):
+        """writes a KML that links to the tiles covering a window of the
+        pyramid, so an area can be shown without rendering its own tiles.
+        Links to the highest zoom level that needs at most max_links tiles.
+
+        :param pth: path of the KML to write
+        :type pth: str
+        :param title: name of the KML
+        :type title: str
+        :param window: the area to link to, in pixels of the pyramid
+        :type window: rasterio.windows.Window
+        :param href: relative path from the KML to the pyramid directory
+        :type href: str
+        :param max_links: maximum number of tiles to link to, defaults to 4
+        :type max_links: int, optional
+        """
+        links = [(0, 0, 0)]
+        for z in range(self.max_zoom + 1):
+            span = self.get_span(z)
+            xs = range(int(window.col_off) // span,
+                       int(window.col_off + window.width - 1) // span + 1)
+            ys = range(int(window.row_off) // span,
+                       int(window.row_off + window.height - 1) // span + 1)
+            if len(xs) * len(ys) > max_links:
+                break
+            links = [(z, x, y) for y in ys for x in xs if (z, x, y) in self._tiles]
+        kml = simplekml.Kml(name=title)
+        for z, x, y in links:
+            self._add_link(kml, z, x, y, f'{href}/{z}/{x}/{y}.kml')
+        kml.save(pth)
+
+
+def _link_file(src: str, dst: str):
+    """hard links src to dst, copies if the file system does not support it"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def to_rgba(rgb: np.ndarray, alpha: np.ndarray = None) -> np.ndarray:
+    """stacks rgb bands and an alpha band
+
+    :param rgb: uint8 array of shape (3, y, x) or (4, y, x)
+    :type rgb: np.ndarray
+    :param alpha: boolean mask of the visible cells, replaces the alpha band.
+        Defaults to the alpha band of `rgb` or fully opaque for rgb
+    :type alpha: np.ndarray, optional
+    :return: uint8 array of shape (4, y, x)
+    :rtype: np.ndarray
+    """
+    rgba = np.empty((4, *rgb.shape[1:]), dtype='uint8')
+    rgba[:3] = rgb[:3]
+    if alpha is not None:
+        rgba[3] = np.where(alpha, 255, 0)
+    elif rgb.shape[0] == 4:
+        rgba[3] = rgb[3]
+    else:
+        rgba[3] = 255
+    return rgba
+
+
+def build_superoverlay(rgb: np.ndarray, transform, out_dir: str, title: str,
+                       alpha: np.ndarray = None, tilesize: int = TILESIZE, pool=None,
+                       previous_dir: str = None) -> str:
+    """builds a KML super-overlay from an rgb(a) array, the in process
+    equivalent of `gdal2tiles.py -p raster -k -r near`
+
+    :param rgb: uint8 array of shape (3, y, x) or (4, y, x)
+    :type rgb: np.ndarray
+    :param transform: transform of the array, the array must be in EPSG:4326
+    :type transform: affine.Affine
+    :param out_dir: directory to write the super-overlay to
+    :type out_dir: str
+    :param title: name of the overlay
+    :type title: str
+    :param alpha: boolean mask of the visible cells, see `to_rgba`
+    :type alpha: np.ndarray, optional
+    :param tilesize: tile size in pixels, defaults to TILESIZE
+    :type tilesize: int, optional
+    :param pool: pool to render the tiles with, rendered serially if None
+    :type pool: multiprocessing.pool.ThreadPool, optional
+    :param previous_dir: pyramid of the previous day to reuse unchanged tiles
+        from
+    :type previous_dir: str, optional
+    :return: path to the top level doc.kml
+    :rtype: str
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    overlay = SuperOverlay(to_rgba(rgb, alpha), transform, title, tilesize)
+    return overlay.write(out_dir, pool, previous_dir)
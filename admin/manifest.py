@@ -0,0 +1,323 @@
+"""
+Manifest of the outputs of the pipeline.
+
+For every output the fingerprint of what it was made from is recorded: the
+step, the version of the code of the step (a hash of its module and of the
+helpers that write the output, without comments and docstrings), the
+parameters and the inputs.  An input that is itself an output of the pipeline
+contributes its recorded fingerprint, any other file (granules, normals,
+shapefiles) a hash of its content.  A step skips an output only when the file
+is there with the size and fingerprint that were recorded, otherwise it is
+recomputed, so a partial or stale file is never reused and a changed input
+invalidates exactly the outputs made from it:
+
+    fp = manifest.fingerprint('reproject_modis', [granule], {'dst_crs': dst_crs},
+                              code=[__name__, 'admin.raster_io'])
+    if not manifest.is_current(out_pth, fp):
+        ...
+        write_raster(out_pth, ...)
+        manifest.record(out_pth, fp, 'reproject_modis')
+
+The manifest is a sqlite db (const.MANIFEST, see admin/sqlite_db.py), the
+steps record their outputs from the worker processes as well.  A copy is kept in
+object storage: the pipeline merges it into the local manifest before it runs
+(pull) and merges and uploads the local manifest after (push), so outputs
+pulled from object storage are current as well.
+"""
+
+import ast
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import admin.constants as const
+
+from admin import sqlite_db
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    path text PRIMARY KEY,
+    fingerprint text NOT NULL,
+    size integer NOT NULL,
+    step text,
+    recorded real NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path text PRIMARY KEY,
+    size integer NOT NULL,
+    mtime_ns integer NOT NULL,
+    digest text NOT NULL
+);
+"""
+
+
+def get_key(pth: str) -> str:
+    """the key of a file in the manifest, the path relative to const.TOP (or
+    const.NORM_ROOT) so the manifest can be shared between machines
+    """
+    pth = os.path.abspath(pth)
+    for root in [const.TOP, const.NORM_ROOT]:
+        root = os.path.abspath(root)
+        if pth.startswith(root + os.sep):
+            return os.path.relpath(pth, root)
+    return pth
+
+
+_parse_lock = threading.Lock()
+
+
+def code_dump(source: bytes) -> str:
+    """the code of a module without its comments and docstrings
+    """
+    tree = ast.parse(source)
+    for node in ast.walk(tree):
+        body = getattr(node, 'body', None)
+        if (isinstance(body, list) and body and isinstance(body[0], ast.Expr)
+                and isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str)):
+            node.body = body[1:] or [ast.Pass()]
+    return ast.dump(tree)
+
+
+def get_ostore_path() -> str:
+    """path of the manifest in object storage
+    """
+    return '/'.join([const.OBJ_STORE_TOP, 'manifest', os.path.basename(const.MANIFEST)])
+
+
+class Manifest(sqlite_db.Database):
+    """the outputs of the pipeline and their fingerprints, see the module
+    docstring
+    """
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, db_pth: str = None):
+        super().__init__(db_pth or const.MANIFEST)
+        self._code_versions = {}
+
+    def code_version(self, modules) -> str:
+        """hash of the code of the modules of a step, e.g. __name__ of the step
+        and the helpers that write its output.  The comments and docstrings
+        are not part of it, editing them does not invalidate the outputs.
+
+        :param modules: module name or list of module names
+        :type modules: str | list
+        """
+        if isinstance(modules, str):
+            modules = [modules]
+        digest = hashlib.sha256()
+        for module in sorted(set(modules)):
+            if module not in self._code_versions:
+                spec = importlib.util.find_spec(module)
+                with open(spec.origin, 'rb') as f:
+                    source = f.read()
+                # ast.parse is not thread safe in python < 3.12
+                with _parse_lock:
+                    self._code_versions[module] = hashlib.sha256(code_dump(source).encode()).hexdigest()
+            digest.update(f'{module}:{self._code_versions[module]}'.encode())
+        return digest.hexdigest()
+
+    def file_digest(self, pth: str) -> str:
+        """hash of the content of a file, cached until its size or mtime changes
+        """
+        st = os.stat(pth)
+        key = os.path.abspath(pth)
+        row = self.conn.execute('SELECT size, mtime_ns, digest FROM files WHERE path=?', (key,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        digest = hashlib.sha256()
+        with open(pth, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                              (key, st.st_size, st.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def input_digest(self, pth: str) -> str:
+        """fingerprint of an input: the recorded fingerprint when it is a
+        current output of the pipeline, the hash of its content otherwise
+        """
+        if not os.path.exists(pth):
+            return 'missing'
+        row = self.get(pth)
+        if row and row['size'] == os.path.getsize(pth):
+            return row['fingerprint']
+        return self.file_digest(pth)
+
+    def fingerprint(self, step: str, inputs: list = (), params: dict = None, code: str = None) -> str:
+        """fingerprint of an output
+
+        :param step: name of the step that makes the output
+        :type step: str
+        :param inputs: paths to the files the output is made from
+        :type inputs: list, optional
+        :param params: parameters of the step, anything JSON serializable
+        :type params: dict, optional
+        :param code: module of the step, or the list of the modules of the
+            step and of the helpers that make the output, their code is part
+            of the fingerprint, see code_version
+        :type code: str | list, optional
+        :return: sha256 hex digest
+        :rtype: str
+        """
+        fp = {
+            'step': step,
+            'code': self.code_version(code) if code else None,
+            'params': params or {},
+            'inputs': [[os.path.basename(pth), self.input_digest(pth)] for pth in inputs],
+        }
+        return hashlib.sha256(json.dumps(fp, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, pth: str) -> dict:
+        """the record of an output, None if it is not in the manifest
+        """
+        row = self.conn.execute('SELECT fingerprint, size, step, recorded FROM outputs WHERE path=?',
+                                (get_key(pth),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['fingerprint', 'size', 'step', 'recorded'], row))
+
+    def is_current(self, pth: str, fingerprint: str) -> bool:
+        """whether an output exists and was made from what the fingerprint
+        describes
+
+        :param pth: path to the output
+        :type pth: str
+        :param fingerprint: fingerprint of the output, see fingerprint
+        :type fingerprint: str
+        :rtype: bool
+        """
+        if not os.path.exists(pth):
+            return False
+        row = self.get(pth)
+        current = bool(row) and row['fingerprint'] == fingerprint and row['size'] == os.path.getsize(pth)
+        if not current:
+            LOGGER.debug(f'{pth} is {"stale" if row else "not in the manifest"}')
+        return current
+
+    def record(self, pth: str, fingerprint: str, step: str = None):
+        """records an output once it has been written
+        """
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                              (get_key(pth), fingerprint, os.path.getsize(pth), step, time.time()))
+
+    def forget(self, pth: str):
+        """removes an output from the manifest
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM outputs WHERE path=?', (get_key(pth),))
+
+    def merge(self, other_pth: str) -> int:
+        """merges the outputs of another manifest, the most recent record of an
+        output wins
+
+        :param other_pth: path to the other manifest db
+        :type other_pth: str
+        :return: number of outputs added or updated
+        :rtype: int
+        """
+        conn = self.conn
+        conn.execute('ATTACH DATABASE ? AS other', (other_pth,))
+        try:
+            with conn:
+                before = conn.total_changes
+                conn.execute("""
+                    INSERT INTO outputs SELECT * FROM other.outputs WHERE true
+                    ON CONFLICT(path) DO UPDATE SET
+                        fingerprint=excluded.fingerprint, size=excluded.size,
+                        step=excluded.step, recorded=excluded.recorded
+                    WHERE excluded.recorded > outputs.recorded""")
+                changes = conn.total_changes - before
+        finally:
+            conn.execute('DETACH DATABASE other')
+        return changes
+
+    def pull(self, ostore) -> int:
+        """merges the manifest in object storage into the local manifest,
+        failures are logged and do not stop the pipeline
+
+        :param ostore: object store client (get_object)
+        :return: number of outputs added or updated
+        :rtype: int
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            remote_pth = os.path.join(tmp_dir, 'manifest.db')
+            try:
+                ostore.get_object(file_path=get_ostore_path(), local_path=remote_pth)
+            except Exception as e:
+                LOGGER.warning(f'could not pull the manifest from object storage: {e}')
+                return 0
+            try:
+                changes = self.merge(remote_pth)
+            except sqlite3.Error as e:
+                LOGGER.exception(f'could not merge the manifest from object storage: {e}')
+                return 0
+        LOGGER.info(f'{changes} outputs merged from the manifest in object storage')
+        return changes
+
+    def push(self, ostore) -> bool:
+        """merges the manifest in object storage (outputs recorded by other
+        runs) and uploads the local manifest, failures are logged and do not
+        stop the pipeline
+
+        :param ostore: object store client (get_object, put_object)
+        :return: whether the manifest was uploaded
+        :rtype: bool
+        """
+        self.pull(ostore)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_pth = os.path.join(tmp_dir, 'manifest.db')
+            try:
+                snapshot = sqlite3.connect(snapshot_pth)
+                self.conn.backup(snapshot)
+                # the content hashes are only valid for the local files
+                snapshot.execute('DELETE FROM files')
+                snapshot.commit()
+                snapshot.execute('VACUUM')
+                snapshot.close()
+                ostore.put_object(ostore_path=get_ostore_path(), local_path=snapshot_pth)
+            except Exception as e:
+                LOGGER.exception(f'could not push the manifest to object storage: {e}')
+                return False
+        return True
+
+
+_manifest = sqlite_db.Singleton(Manifest)
+
+
+def get_manifest() -> Manifest:
+    """the manifest of the pipeline, const.MANIFEST
+    """
+    return _manifest.get()
+
+
+def fingerprint(step: str, inputs: list = (), params: dict = None, code: str = None) -> str:
+    return get_manifest().fingerprint(step, inputs, params, code)
+
+
+def is_current(pth: str, fingerprint: str) -> bool:
+    return get_manifest().is_current(pth, fingerprint)
+
+
+def record(pth: str, fingerprint: str, step: str = None):
+    get_manifest().record(pth, fingerprint, step)
+
+
+def pull(ostore) -> int:
+    return get_manifest().pull(ostore)
+
+
+def push(ostore) -> bool:
+    return get_manifest().push(ostore)
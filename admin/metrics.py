@@ -0,0 +1,500 @@
+"""
+Run time metrics of the pipeline stages.
+
+Off by default, enabled by the `--profile` / `--metrics-out` options of
+run.py.  When it is off every helper here is a no-op, so the stages are
+instrumented unconditionally:
+
+    with metrics.stage('process', sat='modis', date=date):
+        ...
+        with metrics.timer('shed', sat=sat, typ=typ, shed=name):
+            ...
+
+    ostore = metrics.instrument_ostore(NRObjStoreUtil.ObjectStoreUtil())
+    metrics.starmap(pool, reproject_modis, args, 'reproject_modis', 6)
+
+What is recorded:
+
+* stages: wall and cpu seconds, peak RSS while the stage ran, bytes read
+  and written (/proc/self/io, Linux only), object store requests and bytes.
+  Stages can be nested, the outer stage includes its inner stages.  These
+  are counters of the whole process, so a stage that overlaps a stage of
+  another thread (the task graph runs its steps concurrently, see
+  admin/task_graph.py) is marked overlapped and only its wall time is
+  recorded, its usage is in the totals of the run.
+* timers: count, total and max seconds of repeated steps (per shed)
+* counters: object store requests per operation and bytes per direction
+* pools: tasks, workers and utilisation (busy time of the tasks / workers x
+  wall time) of the process and thread pools of the stages
+
+The report is written as JSON, or as a Prometheus textfile (for the node
+exporter textfile collector) when the output path ends with `.prom`.
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = 'snowpack'
+IO_FIELDS = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+# help of the Prometheus series of the counters, by counter name
+COUNTER_HELP = {
+    'ostore_requests': 'Object store requests',
+    'ostore_bytes': 'Bytes transferred to / from the object store',
+    'transfer_requests': 'Operations of the transfer engine',
+    'transfer_retries': 'Retried operations of the transfer engine',
+    'transfer_bytes': 'Bytes moved by the transfer engine',
+    'artifact_cache': 'Lookups of the artifact cache',
+    'artifact_cache_evicted_bytes': 'Bytes evicted from the artifact cache',
+    'disk_reclaimed_bytes': 'Bytes deleted by the disk manager',
+    'plot_failures': 'Plots that could not be made',
+}
+
+
+def _read_io() -> dict:
+    """/proc/self/io counters, empty if not available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {k: int(counters[k]) for k in IO_FIELDS if k in counters}
+
+
+def _read_hwm_kb() -> int:
+    """peak RSS of the process in KB since the last _reset_hwm
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+def _reset_hwm():
+    """resets the peak RSS of the process to the current RSS (Linux >= 4.0),
+    elsewhere the peak is the peak since the start of the process
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _children_maxrss_kb() -> int:
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+class Metrics:
+    """collects the metrics of a run, see the module docstring
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = None
+        self.start_time = None
+        self.stages = []
+        self.timers = {}
+        self.counters = {}
+        self.pools = []
+        self.peak_rss_kb = 0
+        # nesting of the stages per thread, the stages of the task graph
+        # (admin/task_graph.py) run in several threads at once
+        self._local = threading.local()
+        # the open stages of all the threads
+        self._open = []
+
+    @property
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _reset_hwm(self):
+        self.peak_rss_kb = max(self.peak_rss_kb, _read_hwm_kb())
+        _reset_hwm()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self.start_time = time.perf_counter()
+        self._reset_hwm()
+
+    def disable(self):
+        self.enabled = False
+
+    def _ostore_totals(self) -> tuple:
+        with self.lock:
+            requests = sum(v for (name, _), v in self.counters.items() if name == 'ostore_requests')
+            size = sum(v for (name, _), v in self.counters.items() if name == 'ostore_bytes')
+        return requests, size
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **labels):
+        """measures a stage of the pipeline
+
+        :param name: name of the stage
+        :type name: str
+        :param labels: what the stage ran on, e.g. sat and date
+        """
+        if not self.enabled:
+            yield
+            return
+        frame = {'peak': 0, 'thread': threading.get_ident(), 'overlapped': False}
+        with self.lock:
+            others = [other for other in self._open if other['thread'] != frame['thread']]
+            for other in others:
+                other['overlapped'] = True
+            frame['overlapped'] = bool(others)
+            self._open.append(frame)
+        if self._stack:
+            parent = self._stack[-1]
+            parent['peak'] = max(parent['peak'], _read_hwm_kb())
+        # the peak of the stages of the other threads is not reset under them
+        if not others:
+            self._reset_hwm()
+        self._stack.append(frame)
+        io_before = _read_io()
+        requests_before, bytes_before = self._ostore_totals()
+        cpu_before = time.process_time()
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_before
+            io_after = _read_io()
+            requests_after, bytes_after = self._ostore_totals()
+            frame['peak'] = max(frame['peak'], _read_hwm_kb())
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame['peak'])
+            entry = {
+                'stage': name,
+                'labels': {k: str(v) for k, v in labels.items()},
+                'status': status,
+                'seconds': seconds,
+                'overlapped': frame['overlapped'],
+                'children_maxrss_kb': _children_maxrss_kb(),
+            }
+            if not frame['overlapped']:
+                entry.update({
+                    'cpu_seconds': cpu_seconds,
+                    'peak_rss_kb': frame['peak'],
+                    'ostore_requests': requests_after - requests_before,
+                    'ostore_bytes': bytes_after - bytes_before,
+                })
+                for field in IO_FIELDS:
+                    if field in io_after:
+                        entry[field] = io_after[field] - io_before[field]
+            with self.lock:
+                self._open = [other for other in self._open if other is not frame]
+                self.stages.append(entry)
+            LOGGER.debug(f'stage {name} {labels}: {seconds:.2f}s peak rss {frame["peak"]} KB')
+
+    def record_time(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self.lock:
+            timer = self.timers.setdefault(key, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            timer['count'] += 1
+            timer['seconds'] += seconds
+            timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """times a repeated step, e.g. one shed
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(name, time.perf_counter() - start, **labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record_pool(self, name: str, workers: int, tasks: int, wall_seconds: float, busy_seconds: float):
+        if not self.enabled:
+            return
+        utilisation = busy_seconds / (workers * wall_seconds) if workers and wall_seconds else 0.0
+        with self.lock:
+            self.pools.append({
+                'pool': name, 'workers': workers, 'tasks': tasks, 'wall_seconds': wall_seconds,
+                'busy_seconds': busy_seconds, 'utilisation': utilisation,
+            })
+
+    def report(self) -> dict:
+        """the metrics collected so far
+        """
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': time.perf_counter() - self.start_time if self.start_time else 0.0,
+                'peak_rss_kb': max(self.peak_rss_kb, _read_hwm_kb()),
+                'children_maxrss_kb': _children_maxrss_kb(),
+                'stages': list(self.stages),
+                'timers': [{'timer': name, 'labels': dict(labels), **values}
+                           for (name, labels), values in self.timers.items()],
+                'counters': [{'counter': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self.counters.items()],
+                'pools': list(self.pools),
+            }
+
+
+METRICS = Metrics()
+
+enable = METRICS.enable
+stage = METRICS.stage
+timer = METRICS.timer
+record_time = METRICS.record_time
+count = METRICS.count
+
+
+def is_enabled() -> bool:
+    return METRICS.enabled
+
+
+class _TimedTask:
+    """wraps a pool task so it returns how long it ran, picklable as long as
+    func is
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        result = self.func(*args)
+        return result, time.perf_counter() - start
+
+
+def starmap(pool, func, args: list, name: str, workers: int, label_arg: int = None) -> list:
+    """pool.starmap that records the utilisation of the pool, and the time
+    of each task if label_arg is the index of the argument that names it
+
+    :param pool: multiprocessing Pool or ThreadPool
+    :param func: the task
+    :param args: argument tuples of the tasks
+    :type args: list
+    :param name: name of the pool in the report
+    :type name: str
+    :param workers: number of workers of the pool
+    :type workers: int
+    :param label_arg: index of the argument to label the task timer with
+    :type label_arg: int, optional
+    :return: results of the tasks
+    :rtype: list
+    """
+    if not METRICS.enabled:
+        return pool.starmap(func, args)
+    args = list(args)
+    start = time.perf_counter()
+    timed = pool.starmap(_TimedTask(func), args)
+    wall_seconds = time.perf_counter() - start
+    for task_args, (_, seconds) in zip(args, timed):
+        if label_arg is not None:
+            METRICS.record_time(f'{name}_task', seconds, task=task_args[label_arg])
+    METRICS.record_pool(name, workers, len(args), wall_seconds, sum(s for _, s in timed))
+    return [result for result, _ in timed]
+
+
+class InstrumentedObjectStore:
+    """wraps an NRObjStoreUtil.ObjectStoreUtil and counts its requests and
+    the bytes transferred, every other attribute is passed through
+
+    :param client: the object store client
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        if name == '_client':
+            raise AttributeError(name)
+        return getattr(self._client, name)
+
+    def _call(self, op: str, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            METRICS.count('ostore_requests', op=op)
+
+    def get_object(self, *args, **kwargs):
+        result = self._call('get_object', self._client.get_object, *args, **kwargs)
+        local_path = kwargs.get('local_path', args[1] if len(args) > 1 else None)
+        if local_path and os.path.exists(local_path):
+            METRICS.count('ostore_bytes', os.path.getsize(local_path), direction='read')
+        return result
+
+    def put_object(self, *args, **kwargs):
+        local_path = kwargs.get('local_path', args[1] if len(args) > 1 else None)
+        result = self._call('put_object', self._client.put_object, *args, **kwargs)
+        if local_path and os.path.exists(local_path):
+            METRICS.count('ostore_bytes', os.path.getsize(local_path), direction='write')
+        return result
+
+    def get_object_range(self, *args, **kwargs):
+        data = self._call('get_object_range', self._client.get_object_range, *args, **kwargs)
+        METRICS.count('ostore_bytes', len(data), direction='read')
+        return data
+
+    def list_objects(self, *args, **kwargs):
+        return self._call('list_objects', self._client.list_objects, *args, **kwargs)
+
+    def stat_object(self, *args, **kwargs):
+        return self._call('stat_object', self._client.stat_object, *args, **kwargs)
+
+
+def instrument_ostore(client):
+    """see InstrumentedObjectStore, counts nothing while metrics are off
+    """
+    return InstrumentedObjectStore(client)
+
+
+def _prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items())) + '}'
+
+
+def to_prometheus(report: dict) -> str:
+    """formats a report for the Prometheus textfile collector, repeated
+    stages with the same labels are summed (peaks are the max)
+
+    :param report: see Metrics.report
+    :type report: dict
+    :return: the textfile contents
+    :rtype: str
+    """
+    metrics = {}
+
+    def add(name, help_text, labels, value, agg=sum):
+        family = metrics.setdefault(name, {'help': help_text, 'samples': {}})
+        key = tuple(sorted(labels.items()))
+        samples = family['samples']
+        samples[key] = agg([samples[key], value]) if key in samples else value
+
+    add('run_seconds', 'Wall clock time of the run', {}, report['seconds'])
+    add('run_peak_rss_bytes', 'Peak RSS of the run', {}, report['peak_rss_kb'] * 1024)
+    add('run_children_peak_rss_bytes', 'Peak RSS of the largest worker process', {},
+        report['children_maxrss_kb'] * 1024)
+    stage_fields = [
+        ('seconds', 'stage_seconds', 'Wall clock time of a stage', 1, sum),
+        ('cpu_seconds', 'stage_cpu_seconds', 'CPU time of a stage in the main process', 1, sum),
+        ('peak_rss_kb', 'stage_peak_rss_bytes', 'Peak RSS while a stage ran', 1024, max),
+        ('read_bytes', 'stage_disk_read_bytes', 'Bytes read from disk by a stage', 1, sum),
+        ('write_bytes', 'stage_disk_write_bytes', 'Bytes written to disk by a stage', 1, sum),
+        ('rchar', 'stage_read_chars', 'Bytes read by a stage, including the page cache', 1, sum),
+        ('wchar', 'stage_write_chars', 'Bytes written by a stage, including the page cache', 1, sum),
+        ('ostore_requests', 'stage_ostore_requests', 'Object store requests of a stage', 1, sum),
+        ('ostore_bytes', 'stage_ostore_bytes', 'Bytes transferred to / from the object store by a stage', 1, sum),
+    ]
+    for entry in report['stages']:
+        labels = {'stage': entry['stage'], **entry['labels']}
+        for field, name, help_text, scale, agg in stage_fields:
+            if field in entry:
+                add(name, help_text, labels, entry[field] * scale, agg)
+        add('stage_failures', 'Failed runs of a stage', labels, int(entry['status'] != 'ok'))
+    for timer in report['timers']:
+        labels = {'timer': timer['timer'], **timer['labels']}
+        add('timer_seconds_total', 'Total time of a repeated step', labels, timer['seconds'])
+        add('timer_count', 'Number of times a step ran', labels, timer['count'])
+        add('timer_max_seconds', 'Longest run of a step', labels, timer['max_seconds'], max)
+    for counter in report['counters']:
+        add(f'{counter["counter"]}_total', COUNTER_HELP.get(counter['counter'], 'Counter of the run'),
+            counter['labels'], counter['value'])
+    for pool in report['pools']:
+        labels = {'pool': pool['pool']}
+        add('pool_tasks', 'Tasks run by a pool', labels, pool['tasks'])
+        add('pool_workers', 'Workers of a pool', labels, pool['workers'], max)
+        add('pool_busy_seconds', 'Time the tasks of a pool ran for', labels, pool['busy_seconds'])
+        add('pool_wall_seconds', 'Time a pool was in use', labels, pool['wall_seconds'])
+
+    lines = []
+    for name, family in metrics.items():
+        full_name = f'{PROMETHEUS_PREFIX}_{name}'
+        lines.append(f'# HELP {full_name} {family["help"]}')
+        lines.append(f'# TYPE {full_name} gauge')
+        for labels, value in family['samples'].items():
+            lines.append(f'{full_name}{_prometheus_labels(dict(labels))} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(out_pth: str, report: dict = None):
+    """writes the report as JSON, or as a Prometheus textfile if out_pth ends
+    with .prom.  The file is replaced atomically so a collector never reads a
+    partial file
+
+    :param out_pth: path of the report
+    :type out_pth: str
+    :param report: the report, defaults to the current metrics
+    :type report: dict, optional
+    """
+    report = report or METRICS.report()
+    if out_pth.endswith('.prom'):
+        contents = to_prometheus(report)
+    else:
+        contents = json.dumps(report, indent=2)
+    out_dir = os.path.dirname(os.path.abspath(out_pth))
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(out_pth)}.', dir=out_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(contents)
+    os.replace(tmp_path, out_pth)
+    LOGGER.info(f'metrics written to {out_pth}')
+
+
+def log_summary(report: dict = None):
+    """logs the time and peak memory of every stage
+    """
+    report = report or METRICS.report()
+    for entry in report['stages']:
+        labels = ' '.join(f'{k}={v}' for k, v in entry['labels'].items())
+        if entry.get('overlapped'):
+            LOGGER.info(f'{entry["stage"]} {labels}: {entry["seconds"]:.1f}s, overlapped other stages')
+            continue
+        LOGGER.info(
+            f'{entry["stage"]} {labels}: {entry["seconds"]:.1f}s, peak rss '
+            f'{entry["peak_rss_kb"] / 1024:.0f} MB, {entry["ostore_requests"]} object store requests')
+    for pool in report['pools']:
+        LOGGER.info(f'pool {pool["pool"]}: {pool["tasks"]} tasks, {pool["utilisation"]:.0%} utilised')
+    LOGGER.info(f'run: {report["seconds"]:.1f}s, peak rss {report["peak_rss_kb"] / 1024:.0f} MB')
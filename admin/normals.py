@@ -0,0 +1,135 @@
+"""
+The 10 and 20 year daily normals.
+
+The normals a run needs are known up front from its dates and satellites, so
+they are prefetched: downloaded in one parallel batch (through the artifact
+cache, admin/artifact_cache.py) before the steps that use them start, and the
+first ones preloaded into memory:
+
+    normals.prefetch(['2023.03.21', '2023.03.22'], ['modis'])
+    ...
+    norm10yr = normals.load(normals.get_normal_path('modis', '2023.03.21', '10yr'))
+
+The daily pipeline and the backfill run the prefetch as an io step of their
+task graphs, next to the downloads, so the clipping of the sheds never waits
+for object storage.
+"""
+
+import collections
+import logging
+import os
+import threading
+
+import rioxarray as rioxr
+
+import admin.constants as const
+
+from admin import artifact_cache, metrics
+
+LOGGER = logging.getLogger(__name__)
+
+PERIODS = ['10yr', '20yr']
+NORM_DIRS = {
+    ('modis', '10yr'): const.MODIS_DAILY_10YR,
+    ('modis', '20yr'): const.MODIS_DAILY_20YR,
+    ('viirs', '10yr'): const.VIIRS_DAILY_10YR,
+    ('viirs', '20yr'): const.VIIRS_DAILY_20YR,
+}
+# path of the normals in object storage, relative to the bucket
+OSTORE_PATH = "norm/{sat}/daily/{period}/{month}.{day}.tif"
+# normals kept in memory by a process, the two periods of two satellites
+MAX_LOADED = 4
+
+
+def get_month_day(date: str) -> tuple:
+    """'2023.03.21' -> ('03', '21')
+    """
+    _, month, day = date.split('.')
+    return month, day
+
+
+def get_normal_path(sat: str, date: str, period: str) -> str:
+    """local path of the normal of a date
+
+    :param sat: modis | viirs
+    :type sat: str
+    :param date: date string in the format YYYY.MM.DD
+    :type date: str
+    :param period: 10yr | 20yr
+    :type period: str
+    :return: ie './data/norm/modis/daily/10yr/03.21.tif'
+    :rtype: str
+    """
+    month, day = get_month_day(date)
+    return os.path.join(NORM_DIRS[(sat, period)], f'{month}.{day}.tif')
+
+
+def get_ostore_path(sat: str, date: str, period: str) -> str:
+    month, day = get_month_day(date)
+    return OSTORE_PATH.format(sat=sat, period=period, month=month, day=day)
+
+
+def prefetch(dates: list, sats: list, ostore=None, preload: bool = True) -> list:
+    """downloads the normals of the dates in parallel, the normals missing in
+    object storage are logged and skipped (the step that needs them fails)
+
+    :param dates: date strings in the format YYYY.MM.DD
+    :type dates: list[str]
+    :param sats: modis and / or viirs
+    :type sats: list[str]
+    :param ostore: admin.object_store_util.OStore, the shared one by default
+    :param preload: load the normals of the first dates into memory, see load
+    :type preload: bool, optional
+    :return: local paths of the normals
+    :rtype: list[str]
+    """
+    if ostore is None:
+        import admin.object_store_util # needs the object store client
+        ostore = admin.object_store_util.OStore()
+    items = {}
+    for date in dates:
+        for sat in sats:
+            for period in PERIODS:
+                items[get_normal_path(sat, date, period)] = get_ostore_path(sat, date, period)
+    with metrics.stage('prefetch_normals', sats='_'.join(sats), count=len(items)):
+        artifact_cache.get_cache().fetch_many(
+            [(ostore_path, pth) for pth, ostore_path in items.items()], ostore.transfer, missing_ok=True)
+        paths = [pth for pth in items if os.path.exists(pth)]
+        missing = sorted(set(items) - set(paths))
+        if missing:
+            LOGGER.warning(f'normals not in object storage: {missing}')
+        if preload:
+            for pth in paths[:MAX_LOADED]:
+                load(pth)
+    LOGGER.info(f'prefetched {len(paths)} normals')
+    return paths
+
+
+_loaded = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def load(pth: str):
+    """the normal in memory, read once per process (the MAX_LOADED most
+    recently used normals are kept).  The raster is still encoded, see
+    admin.raster_encoding.decode_normal_dataarray, and is shared: clip or
+    copy it before changing it.
+
+    :param pth: local path of the normal
+    :type pth: str
+    :rtype: xarray.DataArray
+    """
+    st = os.stat(pth)
+    key = (os.path.abspath(pth), st.st_size, st.st_mtime_ns)
+    with _lock:
+        if key in _loaded:
+            _loaded.move_to_end(key)
+            return _loaded[key]
+    with rioxr.open_rasterio(pth) as src:
+        dataarray = src.load()
+    with _lock:
+        _loaded[key] = dataarray
+        while len(_loaded) > MAX_LOADED:
+            _loaded.popitem(last=False)
+    LOGGER.debug(f'loaded {pth}')
+    return dataarray
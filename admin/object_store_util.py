@@ -1,36 +1,84 @@
 import logging
+import threading
+
 import minio
 import NRUtil.NRObjStoreUtil
 import admin.snow_path_lib
 import os.path
 import admin.constants
 
+from admin import artifact_cache, metrics, transfer
+
 LOGGER = logging.getLogger(__name__)
 
+_client = None
+_client_pid = None
+_ostore = None
+_lock = threading.Lock()
+
+
+def get_client():
+    """the object store client of the process, shared by all the OStores so
+    they share one transfer engine: one connection pool, one in-flight byte
+    budget and one cache of the directory listings (admin/transfer.py)
+    """
+    global _client, _client_pid
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = metrics.instrument_ostore(NRUtil.NRObjStoreUtil.ObjectStoreUtil())
+            _client_pid = os.getpid()
+        return _client
+
+
+def get_ostore() -> 'OStore':
+    """the OStore of the process, used by the modules that keep one as a
+    global
+    """
+    global _ostore
+    with _lock:
+        if _ostore is None:
+            _ostore = OStore()
+        return _ostore
+
 
 class OStore:
     def __init__(self):
-        self.ostore = NRUtil.NRObjStoreUtil.ObjectStoreUtil()
+        # the shared client of the process (get_client) unless one is set,
+        # created on first use so the modules that keep an OStore as a global
+        # can be imported without connecting to object storage
+        self._ostore = None
         self.historical_norms_path = "norm/{sat}/daily/{period}/{month}.{day}.tif"
         self.snow_path = admin.snow_path_lib.SnowPathLib()
-        self.cache = {}
+
+    @property
+    def ostore(self):
+        if self._ostore is None:
+            return get_client()
+        return self._ostore
+
+    @ostore.setter
+    def ostore(self, client):
+        self._ostore = client
+
+    @property
+    def transfer(self) -> transfer.TransferEngine:
+        """the transfer engine of the client, see admin/transfer.py
+        """
+        return transfer.get_engine(self.ostore)
 
     def get_10yr_tif(self, sat, month, day, out_path):
-        if not os.path.exists(out_path):
-            ostore_path = self.historical_norms_path.format(
-                period="10yr", month=month, day=day, sat=sat
-            )
-            LOGGER.debug(f"pulling the 10yr file: {ostore_path} down from obj store")
-            self.ostore.get_object(file_path=ostore_path, local_path=out_path)
+        ostore_path = self.historical_norms_path.format(
+            period="10yr", month=month, day=day, sat=sat
+        )
+        if artifact_cache.get_cache().fetch(ostore_path, out_path, self.transfer):
+            LOGGER.debug(f"pulled the 10yr file: {ostore_path} down from obj store")
 
     def get_20yr_tif(self, sat, month, day, out_path):
-        if not os.path.exists(out_path):
-
-            ostore_path = self.historical_norms_path.format(
-                period="20yr", month=month, day=day, sat=sat
-            )
-            LOGGER.debug(f"pulling the 20yr file: {ostore_path} down from obj store")
-            self.ostore.get_object(file_path=ostore_path, local_path=out_path)
+        ostore_path = self.historical_norms_path.format(
+            period="20yr", month=month, day=day, sat=sat
+        )
+        if artifact_cache.get_cache().fetch(ostore_path, out_path, self.transfer):
+            LOGGER.debug(f"pulled the 20yr file: {ostore_path} down from obj store")
 
     def get_mosaic_plot_dir(self, date: str, sat: str):
         ostore_util = NRUtil.NRObjStoreUtil.ObjectStoragePathLib()
@@ -119,31 +167,42 @@ class OStore:
 
     def get_file(self, local_path):
         ostore_path = self.get_ostore_path(local_path)
-        self.ostore.get_object(
-            file_path=ostore_path,
-            local_path=local_path
-        )
+        artifact_cache.get_cache().fetch(ostore_path, local_path, self.transfer)
 
     def ostore_file_exists(self, local_path):
-        exists = False
-        orig_dir = os.path.dirname(local_path)
+        # the listings of the object storage directories are cached by the
+        # transfer engine
         ostore_path = self.get_ostore_path(local_path=local_path)
-        if orig_dir not in self.cache:
-            ostr_dir = os.path.dirname(ostore_path)
-            ostr_files = self.ostore.list_objects(
-                objstore_dir=ostr_dir, recursive=True, return_file_names_only=True
-            )
-            self.cache[ostr_dir] = ostr_files
-        if ostore_path in self.cache[ostr_dir]:
-            # file is in ostore so pull it
-            exists = True
-        return exists
+        return self.transfer.exists_many([ostore_path])[ostore_path]
 
     def get_file_if_exists(self, local_file):
         LOGGER.debug(f"local file: {local_file}")
-        if not os.path.exists(local_file):
-            if self.ostore_file_exists(local_path=local_file):
-                # file is in ostore so pull it
-                LOGGER.debug(f"pulling {local_file} from ostore")
-                self.get_file(local_file)
+        self.get_files_if_exist([local_file])
+
+    def get_files_if_exist(self, local_files):
+        """pulls the files that do not exist locally but exist in object
+        storage, concurrently, into the artifact cache (admin/artifact_cache.py)
 
+        :param local_files: local paths
+        :type local_files: list[str]
+        :return: the local paths that were pulled
+        :rtype: list[str]
+        """
+        items = [(self.get_ostore_path(local_file), local_file)
+                 for local_file in local_files if not os.path.exists(local_file)]
+        pulled = artifact_cache.get_cache().fetch_many(items, self.transfer, missing_ok=True)
+        for local_file in pulled:
+            LOGGER.debug(f"pulled {local_file} from ostore")
+        return pulled
+
+    def put_files(self, local_files):
+        """pushes local files to the equivalent paths in object storage,
+        concurrently
+
+        :param local_files: local paths
+        :type local_files: list[str]
+        :return: the object storage paths that were pushed
+        :rtype: list[str]
+        """
+        items = [(local_file, self.get_ostore_path(local_file)) for local_file in local_files]
+        return self.transfer.put_many(items)
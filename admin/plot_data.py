@@ -0,0 +1,140 @@
+"""
+Reduced resolution reads of the rasters that get plotted.
+
+The plots are a few hundred pixels per panel, reading the full resolution
+rasters only to let matplotlib throw most of the pixels away wastes IO and
+memory (the provincial mosaic is several thousand pixels wide).  The readers
+here ask rasterio for an `out_shape` matched to the pixel size of the panel,
+GDAL then serves the read from the internal overviews written by
+admin/raster_io.py (or decimates on the fly for older rasters without them).
+Nearest neighbour is used so the nodata / flag values survive the
+decimation, and the masking is applied to the reduced array.
+"""
+
+import logging
+import math
+
+import numpy as np
+import rasterio as rio
+import rioxarray as rioxr # registers the .rio accessor
+import xarray as xr
+
+from rasterio.enums import Resampling
+
+from admin.raster_encoding import decode_normal, decode_pct_change
+
+LOGGER = logging.getLogger(__name__)
+
+# matplotlib savefig default
+DEFAULT_DPI = 100
+
+
+def get_target_size(figsize: tuple, ncols: int = 1, dpi: int = DEFAULT_DPI) -> int:
+    """the size in pixels of one panel of a figure
+
+    :param figsize: figure size in inches (width, height)
+    :type figsize: tuple
+    :param ncols: number of panels side by side, defaults to 1
+    :type ncols: int, optional
+    :param dpi: resolution the figure is saved at, defaults to DEFAULT_DPI
+    :type dpi: int, optional
+    :return: the largest dimension of a panel in pixels
+    :rtype: int
+    """
+    return int(max(figsize[0] / ncols, figsize[1]) * dpi)
+
+
+def get_out_shape(width: int, height: int, target: int):
+    """the decimated shape of a raster so its largest dimension is at most
+    target, rasters that are already smaller are not upsampled
+
+    :param width: width of the raster
+    :type width: int
+    :param height: height of the raster
+    :type height: int
+    :param target: largest dimension of the output in pixels
+    :type target: int
+    :return: (height, width) of the read and the decimation factor
+    :rtype: tuple(tuple, int)
+    """
+    factor = max(1, math.ceil(max(width, height) / target))
+    return (math.ceil(height / factor), math.ceil(width / factor)), factor
+
+
+def read_plot_dataarray(pth: str, target: int):
+    """reads the first band of a raster decimated to the target size, as a
+    rioxarray DataArray in the source data type (nodata and scale factor are
+    kept so the raster_encoding decoders can be applied)
+
+    :param pth: path to the raster
+    :type pth: str
+    :param target: largest dimension of the output in pixels
+    :type target: int
+    :return: the decimated raster
+    :rtype: xarray.DataArray
+    """
+    with rio.open(pth) as src:
+        out_shape, factor = get_out_shape(src.width, src.height, target)
+        data = src.read(1, out_shape=out_shape, resampling=Resampling.nearest)
+        transform = src.transform * src.transform.scale(
+            src.width / out_shape[1], src.height / out_shape[0])
+        crs, nodata, scale = src.crs, src.nodata, src.scales[0]
+    LOGGER.debug(f'read {pth} decimated by {factor}: {out_shape}')
+
+    xs = transform.c + (np.arange(out_shape[1]) + 0.5) * transform.a
+    ys = transform.f + (np.arange(out_shape[0]) + 0.5) * transform.e
+    dataarray = xr.DataArray(data[np.newaxis, ...], dims=('band', 'y', 'x'),
+                             coords={'band': [1], 'y': ys, 'x': xs})
+    if scale != 1.0:
+        dataarray.attrs['scale_factor'] = scale
+    dataarray.rio.write_crs(crs, inplace=True)
+    dataarray.rio.write_transform(transform, inplace=True)
+    if nodata is not None:
+        dataarray.rio.write_nodata(nodata, encoded=False, inplace=True)
+    return dataarray
+
+
+def read_daily(pth: str, target: int) -> np.ndarray:
+    """reads a daily snow raster for plotting, nodata and > 100 become nan
+
+    :param pth: path to the raster
+    :type pth: str
+    :param target: largest dimension of the output in pixels
+    :type target: int
+    :return: float32 array
+    :rtype: np.ndarray
+    """
+    d = read_plot_dataarray(pth, target)
+    data = d.data[0].astype('float32')
+    if d.rio.nodata is not None:
+        data[(data == d.rio.nodata)] = np.nan
+    data[(data > 100)] = np.nan
+    return data
+
+
+def read_pct_change(pth: str, target: int) -> np.ndarray:
+    """reads a % difference to normal raster for plotting, nodata becomes nan
+
+    :param pth: path to the raster
+    :type pth: str
+    :param target: largest dimension of the output in pixels
+    :type target: int
+    :return: float32 array
+    :rtype: np.ndarray
+    """
+    d = read_plot_dataarray(pth, target)
+    return decode_pct_change(d.data[0], d.rio.nodata)
+
+
+def read_normal(pth: str, target: int) -> np.ndarray:
+    """reads a normal raster for plotting, nodata and > 100 become nan
+
+    :param pth: path to the raster
+    :type pth: str
+    :param target: largest dimension of the output in pixels
+    :type target: int
+    :return: float32 array
+    :rtype: np.ndarray
+    """
+    d = read_plot_dataarray(pth, target)
+    return decode_normal(d.data[0], d.rio.nodata, d.attrs.get('scale_factor'))
@@ -1,29 +1,139 @@
 import os
-import rasterio.plot
 import logging
 
+import matplotlib
+# no display is needed, the plots are only saved to png
+matplotlib.use('Agg')
+
+import rasterio.plot
+
 import numpy as np
-import rioxarray as rioxr
-import rasterio as rio
 import matplotlib.pyplot as plt
-import geopandas as gpd
 
 import admin.constants as const
 
-from admin.color_ramp import color_ramp
+from admin.color_ramp import snow_colormap
+from admin import catalog, manifest, metrics, normals, plot_data, worker_pool
+from admin.kml_tiles import expand_palette, get_cutline, to_rgba
+from admin.raster_encoding import decode_normal_dataarray
 
-from collections import defaultdict
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
 from matplotlib.patches import Patch
-from glob import glob
-from collections import defaultdict
+from rasterio import windows
 
 import admin.object_store_util
+import admin.snow_path_lib
 
 LOGGER = logging.getLogger(__name__)
-ostore = admin.object_store_util.OStore()
+ostore = admin.object_store_util.get_ostore()
+snow_path = admin.snow_path_lib.SnowPathLib()
+
+SHED_FIGSIZE = (15,5)
+MOSAIC_FIGSIZE = (25,5)
+# the modules the shed plots are made with, part of their fingerprints (see
+# admin/manifest.py)
+PLOT_CODE = [__name__, 'admin.plot_data', 'admin.raster_encoding']
+
+# figure template reused for all the sheds plotted by a process, see
+# _get_shed_figure
+_shed_figure = None
+
+def _get_shed_figure():
+    """Three panel figure used to plot the sheds, created once per process.
+    The images are updated with set_data for every shed instead of building
+    a new figure and colourbars
+
+    Returns
+    -------
+    tuple
+        figure, suptitle, axes and images
+    """
+    global _shed_figure
+    if _shed_figure is None:
+        fig, ax = plt.subplots(1,3, figsize=SHED_FIGSIZE)
+        title = fig.suptitle('')
+        panels = [
+            ('', 0, 100),
+            ('% Difference to 10 Year Normal', -100, 100),
+            ('% Difference to 20 Year Normal', -100, 100)
+        ]
+        images = []
+        for a, (panel_title, vmin, vmax) in zip(ax, panels):
+            a.set_title(panel_title)
+            a.axis('off')
+            im = a.imshow(np.full((1, 1), np.nan), cmap=plt.cm.RdYlBu,
+                          vmin=vmin, vmax=vmax, clim=[vmin,vmax], interpolation='none')
+            fig.colorbar(im, ax=a)
+            images.append(im)
+        _shed_figure = (fig, title, ax, images)
+    return _shed_figure
+
+def _plot_shed(name: str, sat: str, date: str, daily: str, norm10yr: str, norm20yr: str, out_pth: str,
+               fingerprint: str = None):
+    """Plot a single watershed/basin, runs in a worker process
+
+    Parameters
+    ----------
+    name : str
+        Name of the watershed or basin
+    sat : str
+        Source satellite [modis | viirs]
+    date : str
+        Target date in format YYYY.MM.DD
+    daily : str
+        Path to the daily EPSG3153 raster
+    norm10yr : str
+        Path to the % difference to 10 year normal raster
+    norm20yr : str
+        Path to the % difference to 20 year normal raster
+    out_pth : str
+        Path to the output png
+    fingerprint : str
+        Recorded in the manifest once the png is written
+
+    Returns
+    -------
+    bool
+        Whether the png was written, the error is logged otherwise
+    """
+    LOGGER.debug(f'PLOTTING {name}')
+    fig, title, ax, images = _get_shed_figure()
+    title.set_text(f'{name.upper()} - {sat.upper()} - {date}')
+    ax[0].set_title(date)
+    # read at the resolution of a panel, not the full resolution
+    target = plot_data.get_target_size(SHED_FIGSIZE, 3)
+    try:
+        for im, (pth, read) in zip(images, [
+                (daily, plot_data.read_daily),
+                (norm10yr, plot_data.read_pct_change),
+                (norm20yr, plot_data.read_pct_change)]):
+            d = read(pth, target)
+            im.set_data(d)
+            im.set_extent((-0.5, d.shape[1] - 0.5, d.shape[0] - 0.5, -0.5))
+            del d
+
+        # Make sure the output dir is accessible
+        out_dir = os.path.dirname(out_pth)
+        if not os.path.exists(out_dir):
+            LOGGER.debug(f"creating directory: {out_dir}")
+            os.makedirs(out_dir, exist_ok=True)
+        LOGGER.debug(f"creating the plot: {out_pth}")
+        fig.savefig(out_pth)
+        if fingerprint:
+            manifest.record(out_pth, fingerprint, 'plot_shed')
+        return True
+    except Exception:
+        LOGGER.exception(f'could not plot {name} to {out_pth}')
+        return False
+    finally:
+        # release the arrays until the next shed
+        for im in images:
+            im.set_data(np.full((1, 1), np.nan))
 
 def plot_sheds(sheds: list, typ: str, sat: str, date: str):
-    """Plot individual watersheds/basins
+    """Plot individual watersheds/basins, the sheds are plot concurrently
+    in a process pool
 
     Parameters
     ----------
@@ -35,92 +145,42 @@ def plot_sheds(sheds: list, typ: str, sat: str, date: str):
         Source satellite [modis | viirs]
     date : str
         Target date in format YYYY.MM.DD
+
+    Returns
+    -------
+    list
+        Names of the sheds that could not be plot
     """
-    chunk = 512 # Chunk size to read in as not to overwhelm memory
-    org = defaultdict(list) # Organizer for all open sheds to be plot
+    jobs = []
     for shed in sheds:
-        LOGGER.debug(f'PLOTTING {os.path.split(shed)[-1]}')
         # shed will be just the name of the watershed
         name = os.path.split(shed)[-1]
         base = os.path.join(shed, sat, date)
 
         out_pth = os.path.join(const.PLOT, sat, typ, date, f'{name}.png')
-        out_dir = os.path.dirname(out_pth)
-        if not os.path.exists(out_pth):
-
-            # prepare
-            try: # If the shed is not accessible, skip to next
-                daily = glob(os.path.join(base, '*EPSG3153.tif'))[0]
-            except Exception as e:
-                LOGGER.warning(e)
-                continue
-            d = rioxr.open_rasterio(daily, chunks={'band': 1, 'x': chunk, 'y': chunk})
-            # replace values that are = to _FillValue to non number
-            #d.data[(d.data == d._FillValue)] = np.nan
-            # raster = raster.where(raster != raster.rio.nodata, np.nan)
-
-            d = d.where(d != d._FillValue, np.nan)
-            d.data[(d.data > 100)] = np.nan
-            org['daily'].append(d)
-            try: # If generated normal file is missing, skip to next
-                norm10yr = glob(os.path.join(base, f'{name}_10yrNorm.tif'))[0]
-            except Exception as e:
-                LOGGER.warning(e)
-                continue
-            d = rioxr.open_rasterio(norm10yr, chunks={'band': 1, 'x': chunk, 'y': chunk})
-            d.data[(d.data == d._FillValue)] = np.nan
-            org['10yrnorm'].append(d)
-            try: # If generated normal file is missing, skip to next
-                norm20yr = glob(os.path.join(base, f'{name}_20yrNorm.tif'))[0]
-            except Exception as e:
-                LOGGER.warning(e)
-                continue
-            d = rioxr.open_rasterio(norm20yr, chunks={'band': 1, 'x': chunk, 'y': chunk})
-            d.data[(d.data == d._FillValue)] = np.nan
-            org['20yrnorm'].append(d)
-            ######################
-            # Plot individual shed
-            ######################
-            fig, ax = plt.subplots(1,3, figsize=(15,5))
-            fig.suptitle(f'{name.upper()} - {sat.upper()} - {date}')
-            # Plot date generated raster
-            ax[0].set_title(date)
-            ax[0].axis('off')
-            im1 = ax[0].imshow(org['daily'][-1].data.transpose(1,2,0), cmap=plt.cm.RdYlBu,
-                                    vmin=0, vmax=100, clim=[0,100], interpolation='none')
-            fig.colorbar(im1, ax=ax[0])
-            # Plot % difference to 10 year normal
-            ax[1].set_title('% Difference to 10 Year Normal')
-            ax[1].axis('off')
-            im2 = ax[1].imshow(org['10yrnorm'][-1].data.transpose(1,2,0), cmap=plt.cm.RdYlBu,
-                                    vmin=-100, vmax=100, clim=[-100,100], interpolation='none')
-            fig.colorbar(im2, ax=ax[1])
-            # Plot % different to 20 year normal
-            ax[2].set_title('% Difference to 20 Year Normal')
-            ax[2].axis('off')
-            im3 = ax[2].imshow(org['20yrnorm'][-1].data.transpose(1,2,0), cmap=plt.cm.RdYlBu,
-                                    vmin=-100, vmax=100, clim=[-100,100], interpolation='none')
-            fig.colorbar(im3, ax=ax[2])
-
-            # Make sure the output dir is accessible and replace with
-            # most up to date version
-            out_pth = os.path.join(const.PLOT, sat, typ, date, f'{name}.png')
-            out_dir = os.path.dirname(out_pth)
-            if not os.path.exists(out_dir):
-                LOGGER.debug(f"creating directory: {out_dir}")
-                os.makedirs(out_dir)
-            # why overwrite!!!!!?????
-            # if os.path.exists(out_pth):
-            #     LOGGER.debug(f"removing the path: {out_pth}")
-            #     os.remove(out_pth)
-            # could multiprocess this
-            try:
-                LOGGER.debug(f"creating the plot: {out_pth}")
-                plt.savefig(out_pth)
-                plt.close()
-            except Exception as e:
-                LOGGER.debug(e)
-                continue
+        # prepare, if the shed or a generated normal file is missing, skip to next
+        found = {
+            product: catalog.find(base, 'shed', typ=typ, shed=name, sat=sat, date=date, product=product)
+            for product in ['EPSG3153', '10yrNorm', '20yrNorm']
+        }
+        missing = [product for product, pths in found.items() if not pths]
+        if missing:
+            LOGGER.warning(f'{name}: no {", ".join(missing)} tif in {base}')
+            continue
+        daily, norm10yr, norm20yr = [pths[0] for pths in found.values()]
+        fingerprint = manifest.fingerprint('plot_shed', [daily, norm10yr, norm20yr], code=PLOT_CODE)
+        if manifest.is_current(out_pth, fingerprint):
+            continue
+        jobs.append((name, sat, date, daily, norm10yr, norm20yr, out_pth, fingerprint))
+
+    if not jobs:
+        return []
+    results = worker_pool.starmap(_plot_shed, jobs, 'plot_sheds', label_arg=0)
+    failed = [job[0] for job, ok in zip(jobs, results) if not ok]
+    if failed:
+        metrics.METRICS.count('plot_failures', len(failed), sat=sat, typ=typ)
+        LOGGER.warning(f'could not plot {len(failed)} of {len(jobs)} {typ}: {", ".join(failed)}')
+    return failed
 
 def norm_math(orig: np.array, norm: np.array):
     """Perform math against normal to calculate
@@ -169,118 +229,74 @@ def plot_mosaics(sat: str, date: str):
                 const.AOI,
                 'provincial_boundary',
                 'FLNR10747_AOI_BC_boundary_20210106_AnS.shp')
-            shapefile = gpd.read_file(shp_pth)
-            for _, row in shapefile.iterrows(): # Grab geometry
-                geom = row.geometry
-            fig, ax = plt.subplots(1,3, figsize=(25,5))
+            # Figure rather than pyplot, the plot steps of the task graph run
+            # in several threads and the pyplot figure manager is global
+            fig = Figure(figsize=MOSAIC_FIGSIZE)
+            ax = fig.subplots(1,3)
+            # read at the resolution of a panel, not the full resolution
+            target = plot_data.get_target_size(MOSAIC_FIGSIZE, 3)
             fig.suptitle(f'{sat.upper()} - {date}')
-            date_split = date.split('.')
-            d_year = date_split[0]
-            d_month = date_split[1]
-            d_day = date_split[2]
+            d_month, d_day = normals.get_month_day(date)
 
             # Gather satellite respective data and prepare path bases
             if sat == 'modis':
-                orig = glob(os.path.join(const.INTERMEDIATE_TIF_MODIS, date, '*modis_composite*.tif'))[0]
-                base10yr_dir = const.MODIS_DAILY_10YR
-                base20yr_dir = const.MODIS_DAILY_20YR
+                orig = snow_path.find_product_tif(sat, date)
             elif sat == 'viirs':
-                viirs_path = os.path.join(const.OUTPUT_TIF_VIIRS, d_year, f'{date}.tif')
-                LOGGER.debug(f"viirs_path: {viirs_path}")
-                orig = glob(viirs_path)[0]
-                base10yr_dir = const.VIIRS_DAILY_10YR
-                base20yr_dir = const.VIIRS_DAILY_20YR
+                orig = snow_path.find_product_tif(sat, date)
+                LOGGER.debug(f"viirs_path: {orig}")
             else: # @click should not let this else ever be reached
                 return
+            if orig is None:
+                raise FileNotFoundError(f'no {sat} mosaic to plot for {date}')
 
             # pull 10 year data
-            norm10yr = os.path.join(base10yr_dir, f'{date_split[1]}.{date_split[2]}.tif')
+            norm10yr = normals.get_normal_path(sat, date, '10yr')
             ostore.get_10yr_tif(sat=sat, month=d_month, day=d_day, out_path=norm10yr)
             LOGGER.debug(f"norm10yr: {norm10yr}")
 
             # pull 20 year data
-            norm20yr = os.path.join(base20yr_dir, f'{date_split[1]}.{date_split[2]}.tif')
+            norm20yr = normals.get_normal_path(sat, date, '20yr')
             ostore.get_20yr_tif(sat=sat, month=d_month, day=d_day, out_path=norm20yr)
-            LOGGER.debug(f"norm20yr: {norm10yr}")
+            LOGGER.debug(f"norm20yr: {norm20yr}")
+
+            # Plot user generated mosaic and clip to prov boundary, the
+            # provincial mask is cached per grid (see kml_tiles.get_cutline)
+            orig = plot_data.read_plot_dataarray(orig, target)
+            fill_val = orig.rio.nodata
+            orig = orig.rio.reproject('EPSG:3153')
+            window, msk = get_cutline(
+                shp_pth, orig.rio.crs, orig.rio.transform(), orig.rio.width, orig.rio.height)
+            rows, cols = window.toslices()
+            extent = rasterio.plot.plotting_extent(
+                msk, transform=windows.transform(window, orig.rio.transform()))
+            d_cp = orig.data[0]
 
-            # Plot user generated mosaic and clip to prov boundary
             ax[0].set_title(f'{date}')
             ax[0].axis('off')
-            tmp_daily_pth = os.path.join(const.INTERMEDIATE_TIF, 'plot', 'tmp_merged_daily.tif')
-            with rioxr.open_rasterio(orig) as orig:
-                fill_val = orig._FillValue
-                orig = orig.rio.reproject('EPSG:3153', resolution=const.RES[sat])
-                d_cp = orig.data.copy()
-                orig.rio.to_raster(tmp_daily_pth, recalc_transform=True)
-            color_ramp(tmp_daily_pth)
-
-            # implement gdal cutting to remove most nodata in plot
-            tmp_gdal_clipped = os.path.join(os.path.split(tmp_daily_pth)[0], 'tmp_gdal_clipped.tif')
-            os.system(f'gdal_translate -q -expand rgb -of GTiff \
-                        {tmp_daily_pth} {tmp_gdal_clipped}')
-            os.system(f'gdalwarp -overwrite -q --config GDALWARP_IGNORE_BAD_CUTLINE YES -dstalpha -cutline \
-                        {shp_pth} \
-                        -crop_to_cutline {tmp_gdal_clipped} \
-                    {tmp_daily_pth}')
-            with rio.open(tmp_daily_pth, 'r') as src:
-                im1 = ax[0].imshow(src.read().transpose(1,2,0), cmap=plt.cm.RdYlBu,
-                                    vmin=0, vmax=100, clim=[0,100], interpolation='none')
-                rasterio.plot.show((src.read()), transform=src.transform, ax=ax[0], cmap=plt.cm.RdYlBu,
-                                    vmin=0, vmax=100, clim=[0,100], interpolation='none')
-                fig.colorbar(im1, ax=ax[0])
+            rgba = to_rgba(expand_palette(d_cp[rows, cols], snow_colormap()), msk)
+            ax[0].imshow(rgba.transpose(1,2,0), extent=extent, interpolation='none')
+            fig.colorbar(plt.cm.ScalarMappable(norm=Normalize(vmin=0, vmax=100), cmap=plt.cm.RdYlBu),
+                         ax=ax[0])
 
             # Alter user generated data to prepare for norm math
+            d_cp = d_cp.copy()
             d_cp[(d_cp > 100)&(d_cp != fill_val)] = 0
 
-            # Plot % change to 10 year norm
-            ax[1].set_title('% Difference to 10 Year Normal')
-            ax[1].axis('off')
-            norm10yr_pth = os.path.join(const.INTERMEDIATE_TIF, 'plot', '10yr.tif')
-            with rioxr.open_rasterio(norm10yr) as norm10yr:
-                norm10yr = norm10yr.rio.reproject('EPSG:3153', resolution=const.RES[sat])
-                norm10yr.data = norm_math(d_cp, norm10yr.data)
-                norm10yr = norm10yr.rio.clip([geom], drop=True, all_touched=True)
-                norm10yr.rio.to_raster(norm10yr_pth, recalc_transform=True)
-
-            # Cut to prov boundary
-            os.system(f'gdalwarp -overwrite -q --config GDALWARP_IGNORE_BAD_CUTLINE YES -dstalpha -cutline \
-                        {shp_pth} \
-                        -crop_to_cutline {norm10yr_pth} \
-                    {tmp_gdal_clipped}')
-            with rio.open(tmp_gdal_clipped) as src:
-                d = src.read(1)
-                msk = src.read(2)
-                d[(msk == False)] = np.nan
-                im2 = ax[1].imshow(d, cmap=plt.cm.RdYlBu,
-                                    vmin=-100, vmax=100, clim=[-100,100], interpolation='none')
-                fig.colorbar(im2, ax=ax[1])
-                rasterio.plot.show((d), ax=ax[1], cmap=plt.cm.RdYlBu,
-                                    vmin=-100, vmax=100, clim=[-100,100], interpolation='none')
-
-            #  Plot % change to 20 year norm
-            ax[2].set_title('% Difference to 20 Year Normal')
-            ax[2].axis('off')
-            norm20yr_pth = os.path.join(const.INTERMEDIATE_TIF, 'plot', '20yr.tif')
-            with rioxr.open_rasterio(norm20yr) as norm20yr:
-                norm20yr = norm20yr.rio.reproject('EPSG:3153', resolution=const.RES[sat])
-                norm20yr.data = norm_math(d_cp, norm20yr.data)
-                norm20yr = norm20yr.rio.clip([geom], drop=True, all_touched=True)
-                norm20yr.rio.to_raster(norm20yr_pth, recalc_transform=True)
-            # gdal_pth = os.path.join(os.path.split(daily_pth)[0], 'out_.tif')
-            # Clip to provincial boundary
-            os.system(f'gdalwarp -overwrite -q --config GDALWARP_IGNORE_BAD_CUTLINE YES -dstalpha -cutline \
-                        {shp_pth} \
-                        -crop_to_cutline {norm20yr_pth} \
-                    {tmp_gdal_clipped}')
-            with rio.open(tmp_gdal_clipped) as src:
-                d = src.read(1)
-                msk = src.read(2)
-                d[(msk == False)] = np.nan
-                im3 = ax[2].imshow(d, cmap=plt.cm.RdYlBu,
-                                    vmin=-100, vmax=100, clim=[-100,100], interpolation='none')
-                fig.colorbar(im3, ax=ax[2])
-                rasterio.plot.show((d), ax=ax[2], cmap=plt.cm.RdYlBu,
-                                    vmin=-100, vmax=100, clim=[-100,100], interpolation='none')
+            # % change to the 10 and 20 year normals, computed together on
+            # the grid of the reprojected mosaic
+            norms = np.stack([
+                decode_normal_dataarray(plot_data.read_plot_dataarray(pth, target)).rio.reproject_match(orig).data[0]
+                for pth in (norm10yr, norm20yr)
+            ])
+            pct = norm_math(d_cp, norms)[:, rows, cols]
+            pct[:, ~msk] = np.nan
+            del norms
+            for i, label in [(1, '10'), (2, '20')]:
+                ax[i].set_title(f'% Difference to {label} Year Normal')
+                ax[i].axis('off')
+                im = ax[i].imshow(pct[i - 1], cmap=plt.cm.RdYlBu, extent=extent,
+                                  vmin=-100, vmax=100, clim=[-100,100], interpolation='none')
+                fig.colorbar(im, ax=ax[i])
 
             # Add legend for nodata
             legend_elements = [Patch(facecolor='black', edgecolor='k',
@@ -296,10 +312,10 @@ def plot_mosaics(sat: str, date: str):
                 os.remove(out_pth)
             try:
                 LOGGER.debug(f"creating the file: {out_pth}")
-                plt.savefig(out_pth)
-                plt.close()
-            except Exception as e:
-                LOGGER.debug(e)
+                fig.savefig(out_pth)
+            except Exception:
+                LOGGER.exception(f'could not plot the {sat} mosaic of {date} to {out_pth}')
+                raise
 
         # finally push up to object storage
         # ostore_path, local_path, bucket_name=None, public=False)ostore_path, local_path, bucket_name=None, public=False)
@@ -318,8 +334,12 @@ def plot_handler(date: str, sat: str):
     sat : str
         Source satellite [modis | viirs]
     """
-    watersheds = glob(os.path.join(const.TOP, 'watersheds', '*'))
-    plot_sheds(watersheds, 'watersheds', sat, date)
-    basins = glob(os.path.join(const.TOP, 'basins', '*'))
-    plot_sheds(basins, 'basins', sat, date)
-    plot_mosaics(sat, date)
+    failed = []
+    for typ in ['watersheds', 'basins']:
+        sheds = snow_path.get_shed_dirs(typ)
+        with metrics.stage('plot_sheds', sat=sat, typ=typ, date=date):
+            failed += plot_sheds(sheds, typ, sat, date)
+    with metrics.stage('plot_mosaics', sat=sat, date=date):
+        plot_mosaics(sat, date)
+    if failed:
+        LOGGER.error(f'{len(failed)} {sat} sheds could not be plot for {date}, see the errors above')
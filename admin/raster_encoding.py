@@ -0,0 +1,233 @@
+"""
+Compact on-disk encodings for the derived rasters.
+
+The % difference to normal rasters (`*_10yrNorm.tif`, `*_20yrNorm.tif`) and the
+daily normals calculated by `calculate_norm` used to be written as float64.
+Neither needs that precision:
+
+* % difference is clipped to -100 .. 100, so it fits in an int8 with -128
+  reserved as the nodata code.
+* normals are means of 0 .. 100 NDSI values, so they fit in a uint8 (whole
+  percent) or a uint16 scaled by 100 (hundredths of a percent).  The scale is
+  stored as the GDAL band scale so readers can recover the physical value.
+
+The encoding used is picked up from `admin.constants` (PCT_CHANGE_ENCODING,
+NORMAL_ENCODING) and can be overridden per call.  The decode helpers accept
+any of the encodings, including the legacy float rasters that already exist
+in object storage, and always return float32 with nan for nodata.
+"""
+
+import logging
+
+import numpy as np
+
+import admin.constants as const
+
+LOGGER = logging.getLogger(__name__)
+
+PCT_CHANGE_ENCODINGS = {
+    'int8': {'dtype': 'int8', 'nodata': -128},
+    'float32': {'dtype': 'float32', 'nodata': np.nan},
+}
+
+NORMAL_ENCODINGS = {
+    'uint8': {'dtype': 'uint8', 'nodata': 255, 'scale_factor': 1.0},
+    'uint16': {'dtype': 'uint16', 'nodata': 65535, 'scale_factor': 0.01},
+    'float32': {'dtype': 'float32', 'nodata': np.nan, 'scale_factor': 1.0},
+}
+
+
+def get_pct_change_encoding(encoding: str = None) -> dict:
+    """returns the encoding definition for the % difference rasters
+
+    :param encoding: name of the encoding (int8 | float32), defaults to the
+        value in const.PCT_CHANGE_ENCODING
+    :type encoding: str, optional
+    :raises ValueError: if the encoding is not known
+    :return: dictionary with the dtype and nodata value
+    :rtype: dict
+    """
+    encoding = encoding or const.PCT_CHANGE_ENCODING
+    if encoding not in PCT_CHANGE_ENCODINGS:
+        msg = (
+            f'invalid % change encoding: {encoding}, valid values: ' +
+            f'{", ".join(PCT_CHANGE_ENCODINGS)}')
+        raise ValueError(msg)
+    return PCT_CHANGE_ENCODINGS[encoding]
+
+
+def get_normal_encoding(encoding: str = None) -> dict:
+    """returns the encoding definition for the normal rasters
+
+    :param encoding: name of the encoding (uint8 | uint16 | float32), defaults
+        to the value in const.NORMAL_ENCODING
+    :type encoding: str, optional
+    :raises ValueError: if the encoding is not known
+    :return: dictionary with the dtype, nodata and scale_factor values
+    :rtype: dict
+    """
+    encoding = encoding or const.NORMAL_ENCODING
+    if encoding not in NORMAL_ENCODINGS:
+        msg = (
+            f'invalid normal encoding: {encoding}, valid values: ' +
+            f'{", ".join(NORMAL_ENCODINGS)}')
+        raise ValueError(msg)
+    return NORMAL_ENCODINGS[encoding]
+
+
+def _nodata_mask(data: np.ndarray, nodata) -> np.ndarray:
+    """mask of the cells that are equal to the nodata value or are not finite
+    """
+    mask = ~np.isfinite(data)
+    if nodata is not None and not np.isnan(nodata):
+        mask |= (data == nodata)
+    return mask
+
+
+def encode_pct_change(data: np.ndarray, encoding: str = None):
+    """encodes a % difference to normal array
+
+    Values are rounded, clipped to -100 .. 100 and nan / inf cells are set to
+    the nodata value of the encoding.
+
+    :param data: the % difference array, nan where there is no data
+    :type data: np.ndarray
+    :param encoding: name of the encoding, defaults to const.PCT_CHANGE_ENCODING
+    :type encoding: str, optional
+    :return: the encoded array and the nodata value that was used
+    :rtype: tuple(np.ndarray, number)
+    """
+    enc = get_pct_change_encoding(encoding)
+    data = np.asarray(data, dtype='float64')
+    invalid = ~np.isfinite(data)
+    encoded = np.clip(data, -100, 100)
+    if np.issubdtype(np.dtype(enc['dtype']), np.integer):
+        encoded = np.round(encoded)
+    encoded[invalid] = enc['nodata']
+    return encoded.astype(enc['dtype']), enc['nodata']
+
+
+def decode_pct_change(data: np.ndarray, nodata=None) -> np.ndarray:
+    """decodes a % difference to normal array into float32, nodata -> nan
+
+    :param data: the encoded array
+    :type data: np.ndarray
+    :param nodata: the nodata value of the source raster
+    :type nodata: number, optional
+    :return: the decoded array
+    :rtype: np.ndarray
+    """
+    decoded = np.asarray(data).astype('float32')
+    decoded[_nodata_mask(decoded, nodata)] = np.nan
+    return decoded
+
+
+def encode_normal(data: np.ndarray, encoding: str = None):
+    """encodes a normal array (mean NDSI, 0 .. 100)
+
+    Cells that are nan or outside of 0 .. 100 are set to the nodata value of
+    the encoding.
+
+    :param data: the normal array, nan where there is no data
+    :type data: np.ndarray
+    :param encoding: name of the encoding, defaults to const.NORMAL_ENCODING
+    :type encoding: str, optional
+    :return: the encoded array, the nodata value and the scale factor that
+        converts the encoded values back to percent
+    :rtype: tuple(np.ndarray, number, float)
+    """
+    enc = get_normal_encoding(encoding)
+    data = np.asarray(data, dtype='float64')
+    invalid = ~np.isfinite(data) | (data < 0) | (data > 100)
+    encoded = data / enc['scale_factor']
+    if np.issubdtype(np.dtype(enc['dtype']), np.integer):
+        encoded = np.round(encoded)
+    encoded[invalid] = enc['nodata']
+    return encoded.astype(enc['dtype']), enc['nodata'], enc['scale_factor']
+
+
+def decode_normal(data: np.ndarray, nodata=None, scale_factor: float = None) -> np.ndarray:
+    """decodes a normal array into float32 percent values, nodata -> nan
+
+    Also handles the legacy float normals where anything > 100 is nodata.
+
+    :param data: the encoded array
+    :type data: np.ndarray
+    :param nodata: the nodata value of the source raster
+    :type nodata: number, optional
+    :param scale_factor: the band scale of the source raster, defaults to 1
+    :type scale_factor: float, optional
+    :return: the decoded array
+    :rtype: np.ndarray
+    """
+    decoded = np.asarray(data).astype('float32')
+    mask = _nodata_mask(decoded, nodata)
+    if scale_factor not in (None, 1, 1.0):
+        decoded = decoded * np.float32(scale_factor)
+    mask |= (decoded > 100)
+    decoded[mask] = np.nan
+    return decoded
+
+
+def _get_scale_factor(dataarray) -> float:
+    # rioxarray exposes the GDAL band scale as the scale_factor attribute
+    return float(dataarray.attrs.get('scale_factor', 1.0))
+
+
+def encode_pct_change_dataarray(dataarray, encoding: str = None):
+    """encodes a rioxarray DataArray of % difference values, see
+    `encode_pct_change`.  The nodata value is written to the returned array so
+    that `rio.to_raster` persists it.
+    """
+    encoded, nodata = encode_pct_change(dataarray.data, encoding)
+    out = dataarray.copy(data=encoded)
+    out.attrs.pop('_FillValue', None)
+    out.rio.write_nodata(nodata, encoded=False, inplace=True)
+    return out
+
+
+def decode_pct_change_dataarray(dataarray):
+    """decodes a rioxarray DataArray of % difference values into float32 with
+    nan for nodata.  Lazy (dask backed) arrays stay lazy.
+    """
+    nodata = dataarray.rio.nodata
+    decoded = dataarray.astype('float32')
+    if nodata is not None and not np.isnan(nodata):
+        decoded = decoded.where(dataarray != nodata)
+    decoded.attrs.pop('_FillValue', None)
+    decoded.rio.write_nodata(np.nan, encoded=False, inplace=True)
+    return decoded
+
+
+def encode_normal_dataarray(dataarray, encoding: str = None):
+    """encodes a rioxarray DataArray of normal values, see `encode_normal`.
+    The nodata value and the scale factor are written to the returned array so
+    that `rio.to_raster` persists them.
+    """
+    encoded, nodata, scale_factor = encode_normal(dataarray.data, encoding)
+    out = dataarray.copy(data=encoded)
+    out.attrs.pop('_FillValue', None)
+    out.attrs.pop('scale_factor', None)
+    if scale_factor != 1.0:
+        out.attrs['scale_factor'] = scale_factor
+    out.rio.write_nodata(nodata, encoded=False, inplace=True)
+    return out
+
+
+def decode_normal_dataarray(dataarray):
+    """decodes a rioxarray DataArray of normal values into float32 percent
+    values with nan for nodata, see `decode_normal`.  Lazy (dask backed)
+    arrays stay lazy.
+    """
+    nodata = dataarray.rio.nodata
+    scale_factor = _get_scale_factor(dataarray)
+    decoded = dataarray.astype('float32')
+    if nodata is not None and not np.isnan(nodata):
+        decoded = decoded.where(dataarray != nodata)
+    if scale_factor != 1.0:
+        decoded = decoded * np.float32(scale_factor)
+    decoded = decoded.where(decoded <= 100)
+    decoded.attrs.pop('_FillValue', None)
+    decoded.attrs.pop('scale_factor', None)
+    decoded.rio.write_nodata(np.nan, encoded=False, inplace=True)
+    return decoded
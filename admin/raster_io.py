@@ -0,0 +1,209 @@
+"""
+Single place where the pipeline writes its GeoTIFF outputs.
+
+All rasters are written as cloud optimized GeoTIFFs: tiled, compressed with a
+predictor, with internal overviews, and with the colour table (if any) set
+when the file is created.  The data is first assembled in an in memory
+(/vsimem) file, then copied with the final layout to a temp file next to the
+destination and renamed into place, so a partially written raster is never
+visible to the stages that read it.  The written rasters are registered in
+the catalog of the local data (admin/catalog.py).
+
+Layout is controlled by the constants RASTER_COMPRESS and RASTER_BLOCKSIZE.
+"""
+
+import logging
+import os
+import tempfile
+import uuid
+
+import numpy as np
+import rasterio as rio
+import rasterio.shutil
+
+from rasterio.enums import Resampling
+
+import admin.constants as const
+
+from admin import catalog
+
+LOGGER = logging.getLogger(__name__)
+
+# creation options that get replaced by the cog layout
+_LAYOUT_KEYS = [
+    'tiled', 'blockxsize', 'blockysize', 'compress', 'predictor', 'interleave',
+    'zlevel', 'zstd_level', 'bigtiff'
+]
+
+
+def get_predictor(dtype) -> int:
+    """returns the tiff predictor to use for a data type, horizontal
+    differencing (2) for integers and floating point (3) for floats
+
+    :param dtype: numpy / rasterio data type
+    :return: the predictor
+    :rtype: int
+    """
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        return 3
+    return 2
+
+
+def get_overview_factors(width: int, height: int, blocksize: int = None) -> list:
+    """calculates the decimation factors for the internal overviews, keeps
+    halving until the overview fits into a single block
+
+    :param width: width of the raster in pixels
+    :type width: int
+    :param height: height of the raster in pixels
+    :type height: int
+    :param blocksize: size of the tiles, defaults to const.RASTER_BLOCKSIZE
+    :type blocksize: int, optional
+    :return: list of overview factors, empty if the raster is a single block
+    :rtype: list[int]
+    """
+    blocksize = blocksize or const.RASTER_BLOCKSIZE
+    factors = []
+    factor = 2
+    while max(width, height) / (factor / 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def get_cog_options(dtype, count: int, compress: str = None, blocksize: int = None) -> dict:
+    """creation options for the cloud optimized GeoTIFF layout
+
+    :param dtype: data type of the raster
+    :param count: number of bands
+    :type count: int
+    :param compress: compression, defaults to const.RASTER_COMPRESS
+    :type compress: str, optional
+    :param blocksize: tile size, defaults to const.RASTER_BLOCKSIZE
+    :type blocksize: int, optional
+    :return: the creation options
+    :rtype: dict
+    """
+    compress = (compress or const.RASTER_COMPRESS).upper()
+    blocksize = blocksize or const.RASTER_BLOCKSIZE
+    options = {
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+        'interleave': 'pixel' if count > 1 else 'band',
+        'bigtiff': 'IF_SAFER',
+    }
+    if compress != 'NONE':
+        options['compress'] = compress
+        options['predictor'] = get_predictor(dtype)
+    return options
+
+
+def _get_mem_path() -> str:
+    return f'/vsimem/{uuid.uuid4().hex}.tif'
+
+
+def _finalise(mem_path: str, out_path: str, colormap: dict = None,
+              overviews: bool = True, compress: str = None, tags: dict = None):
+    """adds the colour table, tags and overviews to the in memory raster and
+    copies it with the cog layout to out_path through a temp file
+    """
+    try:
+        with rio.open(mem_path, 'r+') as mem:
+            if colormap:
+                mem.write_colormap(1, colormap)
+            if tags:
+                mem.update_tags(**tags)
+            factors = []
+            if overviews:
+                factors = get_overview_factors(mem.width, mem.height)
+            if factors:
+                mem.build_overviews(factors, Resampling.nearest)
+                mem.update_tags(ns='rio_overview', resampling='nearest')
+            options = get_cog_options(mem.dtypes[0], mem.count, compress)
+
+        out_dir = os.path.dirname(os.path.abspath(out_path))
+        if not os.path.exists(out_dir):
+            LOGGER.debug(f"creating directory: {out_dir}")
+            os.makedirs(out_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=f'.{os.path.basename(out_path)}.', suffix='.tmp', dir=out_dir)
+        os.close(fd)
+        try:
+            rasterio.shutil.copy(
+                mem_path, tmp_path, driver='GTiff',
+                copy_src_overviews=bool(factors), **options)
+            os.replace(tmp_path, out_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        LOGGER.debug(f"wrote: {out_path}")
+        catalog.register(out_path)
+    finally:
+        rasterio.shutil.delete(mem_path)
+
+
+def write_raster(out_path: str, data: np.ndarray, profile: dict, colormap: dict = None,
+                 overviews: bool = True, compress: str = None, tags: dict = None):
+    """writes an array to a cloud optimized GeoTIFF
+
+    :param out_path: path to the output raster, replaced atomically if it
+        already exists
+    :type out_path: str
+    :param data: the data to write, 2d for a single band or 3d (band, y, x)
+    :type data: np.ndarray
+    :param profile: rasterio profile / meta, at minimum the crs, transform and
+        nodata of the output.  Shape and dtype are taken from `data`
+    :type profile: dict
+    :param colormap: colour table to set on the first band, see
+        admin.color_ramp.snow_colormap
+    :type colormap: dict, optional
+    :param overviews: whether to build internal overviews, defaults to True
+    :type overviews: bool, optional
+    :param compress: compression, defaults to const.RASTER_COMPRESS
+    :type compress: str, optional
+    :param tags: dataset tags to add to the raster
+    :type tags: dict, optional
+    """
+    if data.ndim == 2:
+        data = data[np.newaxis, ...]
+    mem_profile = {k: v for k, v in profile.items() if k not in _LAYOUT_KEYS}
+    mem_profile.update({
+        'driver': 'GTiff',
+        'count': data.shape[0],
+        'height': data.shape[1],
+        'width': data.shape[2],
+        'dtype': data.dtype.name,
+    })
+    mem_path = _get_mem_path()
+    with rio.open(mem_path, 'w', **mem_profile) as mem:
+        mem.write(data)
+    _finalise(mem_path, out_path, colormap=colormap, overviews=overviews,
+              compress=compress, tags=tags)
+
+
+def write_dataarray(dataarray, out_path: str, colormap: dict = None, overviews: bool = True,
+                    compress: str = None, tags: dict = None, **kwargs):
+    """writes a rioxarray DataArray to a cloud optimized GeoTIFF, the
+    replacement for `dataarray.rio.to_raster(out_path)`.
+
+    :param dataarray: the data array to write
+    :type dataarray: xarray.DataArray
+    :param out_path: path to the output raster, replaced atomically if it
+        already exists
+    :type out_path: str
+    :param colormap: colour table to set on the first band
+    :type colormap: dict, optional
+    :param overviews: whether to build internal overviews, defaults to True
+    :type overviews: bool, optional
+    :param compress: compression, defaults to const.RASTER_COMPRESS
+    :type compress: str, optional
+    :param tags: dataset tags to add to the raster
+    :type tags: dict, optional
+    :param kwargs: passed through to `rio.to_raster`, ie recalc_transform
+    """
+    mem_path = _get_mem_path()
+    dataarray.rio.to_raster(mem_path, driver='GTiff', **kwargs)
+    _finalise(mem_path, out_path, colormap=colormap, overviews=overviews,
+              compress=compress, tags=tags)
@@ -1,12 +1,13 @@
 # Centralize the calculation of file paths
 
+import datetime
 import os.path
 import admin.constants as const
-import glob
 import re
 import download_granules.download_granules_ostore_integration as dl_grans
 import download_granules.download_config as dl_config
-import osgeo.ogr
+
+from admin import catalog
 
 import logging
 
@@ -67,14 +68,14 @@ class SnowPathLib:
     def get_viirs_granules(self, date, product):
         # root_pth = self.get_viirs_VNP10A1F_001()
         root_pth = self.get_viirs_product_path(date)
-        glob_pattern = os.path.join(root_pth, date,  '*.h5')
-        viirs_granules = glob.glob(os.path.join(glob_pattern))
-        return viirs_granules
+        viirs_granules = catalog.find(
+            os.path.join(root_pth, date), 'granule', sat='viirs', date=date,
+            product=os.path.basename(root_pth))
+        return [granule for granule in viirs_granules if granule.endswith('.h5')]
 
     def get_intermediate_viirs_files(self, date):
         viirs_dir = self.get_viirs_int_tif(date)
-        glob_pattern = os.path.join(viirs_dir, '*.tif')
-        int_viirs_tifs = glob.glob(glob_pattern)
+        int_viirs_tifs = catalog.find(viirs_dir, 'intermediate', sat='viirs', date=date)
         return int_viirs_tifs
 
     def get_modis_granules(self, date):
@@ -98,7 +99,9 @@ class SnowPathLib:
         :rtype: _type_
         """
         mod_path = self.get_modis_MOD10A1V6()
-        files_in_granule_directory = glob.glob(os.path.join(mod_path, date,'*.hdf'))
+        files_in_granule_directory = catalog.find(
+            os.path.join(mod_path, date), 'granule', sat='modis', date=date,
+            product=os.path.basename(mod_path))
         modis_granules = self.filter_for_modis_granules(files_in_granule_directory, suffix='hdf')
         return modis_granules
 
@@ -142,6 +145,14 @@ class SnowPathLib:
         )
         return out_pth
 
+    def get_output_viirs_path(self, date:str):
+        year = date.split(".")[0]
+        file_name = f"{date}.tif"
+        out_pth = os.path.join(
+            const.OUTPUT_TIF_VIIRS, year, file_name
+        )
+        return out_pth
+
     def get_mosaic_dir(self, date, sat):
         """ returns the directory where the mosaic'd versions of the tif are located
         """
@@ -198,58 +209,59 @@ class SnowPathLib:
         :rtype: _type_
         """
         int_tifs = []
-        comp_dir = self.get_modis_int_tif_dir(date)
-        grans = self.get_modis_granules(date)
+        # get_modis_granules already filters for the granules
         modis_granules_src_files = self.get_modis_granules(date)
-        modis_granules_src_files_filtered = self.filter_for_modis_granules(modis_granules_src_files)
-        for granule_path in modis_granules_src_files_filtered:
+        for granule_path in modis_granules_src_files:
             int_tif = self.get_modis_reprojected_tif(granule_path, date, 'EPSG:4326')
             int_tifs.append(int_tif)
         return int_tifs
 
     def get_granules(self, date, dates, sat):
-        # TODO: This needs to become the source of data queries
-        # set it up with caching of data to speed up
-        # wrap with different paths.
-        # eliminate all glob calls, and use the data that
-        # comes direct from the sat query.
-                # get the granules
-        if sat == 'modis':
-            dl_sat_config = dl_config.SatDownloadConfig(
-                date_span=len(dates),
-                name='daily',
-                sat='modis',
-                date_str=date
-            )
-        elif sat == 'viirs':
-            dl_sat_config = dl_config.SatDownloadConfig(
-                date_span=len(dates),
-                name='daily',
-                sat='viirs',
-                date_str=date
-            )
+        """queries CMR for the granules of the dates, the results are cached in
+        the catalog (admin/catalog.py): for const.CMR_CACHE_MAX_AGE seconds
+        while granules of the dates can still be published, for good once the
+        dates are older than const.CMR_SETTLED_DAYS days
+
+        :param date: the last date, in the format YYYY.MM.DD
+        :type date: str
+        :param dates: the dates to query for, only the number of dates is used
+        :type dates: list[str]
+        :param sat: modis | viirs
+        :type sat: str
+        :return: the granules returned by CMR
+        :rtype: list[dict]
+        """
+        if sat not in ['modis', 'viirs']:
+            raise ValueError(f'unknown sat type: {sat}')
+        dl_sat_config = dl_config.SatDownloadConfig(
+            date_span=len(dates),
+            name='daily',
+            sat=sat,
+            date_str=date
+        )
 
         start_date = dl_sat_config.get_start_date()
         end_date = dl_sat_config.get_end_date()
-
-        # earthdata_user=const.EARTHDATA_USER,
-        # earthdata_pass=const.EARTHDATA_PASS,
-
-        # cmr_client = dl_grans.CMRClientOStore(
-        #     earthdata_user=earthdata_user,
-        #     earthdata_pass=earthdata_pass
-        #     )
-        earthdata_user=const.EARTHDATA_USER,
-        earthdata_pass=const.EARTHDATA_PASS,
-
-        cmr_client = dl_grans.CMRClientOStore(
-            earthdata_user=earthdata_user,
-            earthdata_pass=earthdata_pass
+        key = {
+            'product': dl_sat_config.get_product_version(),
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+            'bbox': [*const.BBOX],
+        }
+        settled = datetime.datetime.now() - end_date > datetime.timedelta(days=const.CMR_SETTLED_DAYS)
+        max_age = None if settled else const.CMR_CACHE_MAX_AGE
+
+        def query():
+            cmr_client = dl_grans.CMRClientOStore(
+                earthdata_user=const.EARTHDATA_USER,
+                earthdata_pass=const.EARTHDATA_PASS
+                )
+            return cmr_client.query(
+                dl_config=dl_sat_config,
+                bbox=[*const.BBOX]
             )
-        grans = cmr_client.query(
-            dl_config=dl_sat_config,
-            bbox=[*const.BBOX]
-        )
+
+        grans = catalog.cached_query(key, query, max_age)
         LOGGER.debug("got grans")
 
         return grans
@@ -283,6 +295,7 @@ class SnowPathLib:
 
         watershed_names = []
         shp_file_path = self.get_aoi_shp(wat_bas)
+        import osgeo.ogr # only needed here, gdal is slow to import
         shapefile = osgeo.ogr.Open(shp_file_path)
         layer = shapefile.GetLayer()
         for feature in layer:
@@ -328,6 +341,53 @@ class SnowPathLib:
             file_name)
         return full_path
 
+    def get_shed_dirs(self, wat_or_bas):
+        """returns the directories of the watersheds or basins, ie
+        ./data/watersheds/Stikine
+
+        :param wat_or_bas: watersheds | basins
+        :type wat_or_bas: str
+        :rtype: list[str]
+        """
+        return catalog.subdirs(os.path.join(const.TOP, wat_or_bas))
+
+    def get_shed_shapes(self, wat_or_bas, crs='EPSG4326'):
+        """returns the shapefiles of the watersheds or basins, ie
+        ./data/watersheds/Stikine/shape/EPSG4326/Stikine.shp
+
+        :param wat_or_bas: watersheds | basins
+        :type wat_or_bas: str
+        :param crs: projection of the shapefiles
+        :type crs: str
+        :rtype: list[str]
+        """
+        for shed_dir in self.get_shed_dirs(wat_or_bas):
+            catalog.get_catalog().refresh(os.path.join(shed_dir, 'shape', crs))
+        return catalog.get_catalog().lookup('shape', typ=wat_or_bas, product=crs)
+
+    def find_product_tif(self, sat, date):
+        """returns the tif the watershed / basin products of a date are made
+        from: the modis composite or the viirs daily mosaic, None if it
+        doesn't exist
+
+        :param sat: modis | viirs
+        :type sat: str
+        :param date: date string in the format YYYY.MM.DD
+        :type date: str
+        :rtype: str
+        """
+        if sat == 'modis':
+            tifs = catalog.find(self.get_modis_int_tif_dir(date), 'intermediate',
+                                sat=sat, date=date, product='composite')
+        elif sat == 'viirs':
+            tifs = catalog.find(os.path.dirname(self.get_output_viirs_path(date)), 'mosaic',
+                                sat=sat, date=date)
+        else:
+            raise ValueError(f'unknown sat type: {sat}')
+        if not tifs:
+            return None
+        return tifs[0]
+
     def get_plot_dir(self, sat, watershed_basin, date_str=None):
         # TODO: Go through plot code and move path calculation to this and other methods
         out_pth = os.path.join(const.PLOT, sat, watershed_basin)
@@ -0,0 +1,67 @@
+"""
+The sqlite dbs that hold the state of the pipeline: the manifest
+(admin/manifest.py), the catalog (admin/catalog.py) and the artifact cache
+(admin/artifact_cache.py).
+
+The steps use them from several threads and from the worker processes, a
+Database opens its connection once per process and thread, in WAL mode so
+readers do not block the writer:
+
+    class Manifest(sqlite_db.Database):
+        SCHEMA = '...'
+
+    _manifest = sqlite_db.Singleton(Manifest)
+    _manifest.get().conn.execute(...)
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class Database:
+    """a sqlite db with a connection per process and thread, created with
+    SCHEMA the first time it is opened
+
+    :param db_pth: path to the db
+    :type db_pth: str
+    """
+
+    SCHEMA = ''
+
+    def __init__(self, db_pth: str):
+        self.db_pth = db_pth
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """connection of the current process and thread
+        """
+        if getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_pth)), exist_ok=True)
+            conn = sqlite3.connect(self.db_pth, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+
+class Singleton:
+    """the instance of a class shared by the process, made with no arguments
+    on first use
+
+    :param cls: the class
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self.instance is None:
+                self.instance = self.cls()
+            return self.instance
@@ -0,0 +1,279 @@
+"""
+Runs the steps of the pipeline as a graph of tasks.
+
+Each task declares the data it reads (inputs) and writes (outputs) as keys,
+for example 'granules:modis:2023.03.03' or 'stats:viirs:2023.03.03:basins'.
+A task runs once every task that outputs one of its inputs has completed,
+inputs that no task of the graph outputs are expected to exist already.
+
+Tasks are either 'io' (downloads, uploads) or 'cpu' (processing).  They run
+in two lanes of threads so the downloads of the next day, or of the other
+satellite, overlap with the processing of the current one.  The cpu tasks
+distribute their work to the shared worker processes (admin/worker_pool.py).
+
+    graph = TaskGraph()
+    graph.add('download:modis:2023.03.03', down_load, sat='modis', date=date,
+              kind='io', outputs=['granules:modis:2023.03.03'])
+    graph.add('process:modis:2023.03.03', pro_cess, sat='modis', date=date,
+              inputs=['granules:modis:2023.03.03'],
+              outputs=['processed:modis:2023.03.03'])
+    graph.run(state_pth='daily.json', resume=True)
+
+With a state file the completed tasks are recorded as they complete and a
+run with resume=True continues from the tasks that had not completed.  When
+a task fails the tasks that depend on it are skipped, the others still run,
+and TaskGraphError is raised at the end.
+
+The number of tasks of each kind that run at once, and optionally the sum
+of their memory estimates, are limited by the arguments of run.
+"""
+
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import tempfile
+import time
+
+import admin.constants as const
+
+LOGGER = logging.getLogger(__name__)
+
+KINDS = ['io', 'cpu']
+
+
+class TaskGraphError(RuntimeError):
+    """raised by TaskGraph.run when tasks failed, failed maps the names of
+    the tasks that failed to their errors, skipped lists the tasks that did
+    not run because of them
+    """
+
+    def __init__(self, failed: dict, skipped: list):
+        self.failed = failed
+        self.skipped = skipped
+        super().__init__(f'{len(failed)} task(s) failed ({", ".join(failed)}), '
+                         f'{len(skipped)} skipped')
+
+
+Task = collections.namedtuple('Task', ['name', 'func', 'args', 'kwargs', 'kind',
+                                       'inputs', 'outputs', 'memory'])
+
+
+class TaskGraph:
+    """a graph of tasks, see the module docstring
+    """
+
+    def __init__(self):
+        self.tasks = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, name: str):
+        return name in self.tasks
+
+    def add(self, name: str, func, *args, kind: str = 'cpu', inputs: list = (),
+            outputs: list = (), memory: int = 0, **kwargs) -> Task:
+        """adds a task, func(*args, **kwargs) is called when it runs
+
+        :param name: unique name of the task
+        :type name: str
+        :param func: the task
+        :param kind: 'io' or 'cpu', defaults to 'cpu'
+        :type kind: str, optional
+        :param inputs: keys of the data the task reads
+        :type inputs: list, optional
+        :param outputs: keys of the data the task writes
+        :type outputs: list, optional
+        :param memory: estimate of the memory the task uses in MB, see run
+        :type memory: int, optional
+        :return: the task
+        :rtype: Task
+        """
+        if name in self.tasks:
+            raise ValueError(f'duplicate task {name}')
+        if kind not in KINDS:
+            raise ValueError(f'kind of {name} has to be one of {KINDS}, not {kind}')
+        task = Task(name, func, args, kwargs, kind, list(inputs), list(outputs), memory)
+        self.tasks[name] = task
+        return task
+
+    def dependencies(self) -> dict:
+        """the names of the tasks each task depends on
+
+        :return: name -> set of names
+        :rtype: dict
+        """
+        producers = {}
+        for task in self.tasks.values():
+            for key in task.outputs:
+                if key in producers:
+                    raise ValueError(f'{key} is an output of {producers[key]} and '
+                                     f'{task.name}')
+                producers[key] = task.name
+        return {task.name: {producers[key] for key in task.inputs
+                            if key in producers} - {task.name}
+                for task in self.tasks.values()}
+
+    def order(self) -> list:
+        """names of the tasks in an order they can run sequentially, the tasks
+        are kept in the order they were added where possible
+
+        :return: names of the tasks
+        :rtype: list
+        """
+        deps = {name: set(d) for name, d in self.dependencies().items()}
+        order = []
+        while deps:
+            ready = [name for name, d in deps.items() if not d]
+            if not ready:
+                raise ValueError(f'cycle between the tasks {sorted(deps)}')
+            name = ready[0]
+            order.append(name)
+            del deps[name]
+            for d in deps.values():
+                d.discard(name)
+        return order
+
+    def dependents(self, name: str) -> list:
+        """names of the tasks that depend on a task, directly or not
+        """
+        deps = self.dependencies()
+        found = []
+        todo = [name]
+        while todo:
+            current = todo.pop()
+            for other, d in deps.items():
+                if current in d and other not in found:
+                    found.append(other)
+                    todo.append(other)
+        return found
+
+    def run(self, state_pth: str = None, resume: bool = False, io_workers: int = None,
+            cpu_workers: int = 1, memory_budget: int = None) -> list:
+        """runs the tasks
+
+        :param state_pth: JSON file the completed tasks are recorded in
+        :type state_pth: str, optional
+        :param resume: skips the tasks recorded as completed in state_pth
+        :type resume: bool, optional
+        :param io_workers: number of io tasks that run at once, defaults to
+            const.IO_WORKERS
+        :type io_workers: int, optional
+        :param cpu_workers: number of cpu tasks that run at once, defaults to 1 (the
+            cpu tasks use all the worker processes)
+        :type cpu_workers: int, optional
+        :param memory_budget: MB the running tasks may use together (the sum of
+            their memory estimates), a task that does not fit waits until others
+            complete, unless nothing else runs.  Defaults to no limit
+        :type memory_budget: int, optional
+        :raises TaskGraphError: when a task failed
+        :return: names of the tasks that ran, in the order they completed
+        :rtype: list
+        """
+        order = self.order()
+        deps = self.dependencies()
+        done = set()
+        if resume and state_pth and os.path.exists(state_pth):
+            done = set(read_state(state_pth)['done']) & set(self.tasks)
+            if done:
+                LOGGER.info(f'resuming, {len(done)} of {len(order)} tasks completed '
+                            'already')
+        completed = []
+        failed = {}
+        skipped = []
+
+        def save():
+            if state_pth:
+                write_state(state_pth, [n for n in order if n in done], failed, skipped)
+
+        def call(task):
+            LOGGER.info(f'started {task.name}')
+            start = time.perf_counter()
+            task.func(*task.args, **task.kwargs)
+            LOGGER.info(f'completed {task.name} in {time.perf_counter() - start:.1f}s')
+
+        waiting = {n: deps[n] - done for n in order if n not in done}
+        workers = {'io': io_workers or const.IO_WORKERS, 'cpu': cpu_workers}
+        executors = {kind: concurrent.futures.ThreadPoolExecutor(
+                         workers[kind], thread_name_prefix=kind)
+                     for kind in KINDS}
+        position = {n: i for i, n in enumerate(order)}
+        ready = []
+        running = {}
+        try:
+            save()
+            while waiting or ready or running:
+                for name in [n for n, d in waiting.items() if not d]:
+                    del waiting[name]
+                    ready.append(name)
+                # the tasks that were added first start first
+                ready.sort(key=position.get)
+                for name in list(ready):
+                    task = self.tasks[name]
+                    busy = [self.tasks[n] for n in running.values()]
+                    same_kind = [t for t in busy if t.kind == task.kind]
+                    if len(same_kind) >= workers[task.kind]:
+                        continue
+                    memory = sum(t.memory for t in busy) + task.memory
+                    if memory_budget and busy and memory > memory_budget:
+                        continue
+                    ready.remove(name)
+                    running[executors[task.kind].submit(call, task)] = name
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        done.add(name)
+                        completed.append(name)
+                        for d in waiting.values():
+                            d.discard(name)
+                    else:
+                        LOGGER.error(f'{name} failed', exc_info=error)
+                        failed[name] = repr(error)
+                        for other in self.dependents(name):
+                            if other in waiting:
+                                del waiting[other]
+                                skipped.append(other)
+                                LOGGER.warning(f'skipped {other}, {name} failed')
+                    save()
+        finally:
+            # when interrupted the running tasks complete
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+        if failed:
+            raise TaskGraphError(failed, skipped)
+        return completed
+
+
+def read_state(state_pth: str) -> dict:
+    """reads the state file of a run
+
+    :return: done (names of the completed tasks), failed and skipped
+    :rtype: dict
+    """
+    with open(state_pth) as f:
+        state = json.load(f)
+    return {'done': state.get('done', []), 'failed': state.get('failed', {}),
+            'skipped': state.get('skipped', [])}
+
+
+def write_state(state_pth: str, done: list, failed: dict = None, skipped: list = None):
+    """writes the state file of a run, the file is replaced atomically so an
+    interrupted run leaves the previous state behind
+    """
+    state_dir = os.path.dirname(os.path.abspath(state_pth))
+    os.makedirs(state_dir, exist_ok=True)
+    fd, tmp_pth = tempfile.mkstemp(dir=state_dir,
+                                   prefix='.' + os.path.basename(state_pth) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'done': done, 'failed': failed or {}, 'skipped': skipped or []},
+                      f, indent=2)
+        os.replace(tmp_pth, state_pth)
+    except BaseException:
+        os.remove(tmp_pth)
+        raise
@@ -0,0 +1,453 @@
+"""
+Batched transfers to and from object storage.
+
+The TransferEngine moves many objects at once over a single connection pool:
+
+    engine = transfer.get_engine(ostore)
+    exists = engine.exists_many(ostore_paths)
+    engine.get_many([(ostore_path, local_path), ...], missing_ok=True)
+    engine.put_many([(local_path, ostore_path), ...])
+
+* the objects are transferred concurrently by const.IO_WORKERS threads, and
+  objects larger than const.TRANSFER_PART_SIZE are downloaded as ranged GETs
+  of the parts in parallel and uploaded as parallel multipart uploads
+* the bytes in flight are bounded by const.TRANSFER_MAX_INFLIGHT, a part (or
+  an object smaller than a part) waits until the bytes of the transfers in
+  flight are below the limit
+* a failed request is retried const.TRANSFER_RETRIES times with exponential
+  backoff, missing objects are not retried
+* the existence and size of the objects come from one listing per object
+  storage directory, cached by the engine and updated by its uploads
+* a download is written to a temp file next to the destination and renamed
+  into place, so a partial download is never visible
+
+With an NRUtil ObjectStoreUtil the engine talks to the bucket with its own
+minio client whose connection pool is sized for the workers.  Any other client
+with the ObjectStoreUtil methods (ie benchmarks.local_store.LocalObjectStore)
+is used through get_object / put_object / list_objects, with ranged GETs when
+it has get_object_range.  The requests of the minio client are counted under
+the ostore_requests / ostore_bytes metrics like those of the instrumented
+client (admin/metrics.py), so the stages are charged for them.
+"""
+
+import atexit
+import concurrent.futures
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import admin.constants as const
+
+from admin import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+# minio does not accept multipart uploads with smaller parts
+MIN_PART_SIZE = 5 * 1024 * 1024
+# error codes of missing objects, these are not retried
+MISSING_CODES = ('NoSuchKey', 'NoSuchObject', 'NoSuchBucket')
+
+
+class TransferError(RuntimeError):
+    """raised by a batch when some of its transfers failed
+
+    :param failed: object storage path -> exception of the failed transfers
+    :type failed: dict
+    """
+
+    def __init__(self, failed: dict):
+        self.failed = failed
+        names = ', '.join(sorted(failed)[:5])
+        super().__init__(f'{len(failed)} transfers failed: {names}')
+
+
+def is_missing(error: Exception) -> bool:
+    """whether an error of the object store means the object does not exist
+    """
+    return (isinstance(error, FileNotFoundError)
+            or getattr(error, 'code', None) in MISSING_CODES)
+
+
+def normalize(ostore_path: str) -> str:
+    """object storage paths are compared without a leading /
+    """
+    return ostore_path.lstrip('/')
+
+
+class ByteBudget:
+    """bounds the bytes of the transfers in flight, a transfer larger than
+    the limit can start when nothing else is in flight
+
+    :param limit: bytes
+    :type limit: int
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int):
+        with self._cond:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self._cond.wait()
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+
+    def release(self, size: int):
+        with self._cond:
+            self.in_flight -= size
+            self._cond.notify_all()
+
+
+class TransferEngine:
+    """concurrent transfers with one object store client, see the module
+    docstring
+
+    :param client: NRUtil ObjectStoreUtil or a client with the same methods
+    :param workers: objects transferred at once, defaults to const.IO_WORKERS
+    :type workers: int, optional
+    :param max_in_flight: bytes transferred at once, defaults to
+        const.TRANSFER_MAX_INFLIGHT
+    :type max_in_flight: int, optional
+    :param part_size: size of the parts of large objects, defaults to
+        const.TRANSFER_PART_SIZE
+    :type part_size: int, optional
+    :param retries: retries of a failed request, defaults to const.TRANSFER_RETRIES
+    :type retries: int, optional
+    :param backoff: seconds before the first retry, doubled for every retry,
+        defaults to const.TRANSFER_BACKOFF
+    :type backoff: float, optional
+    """
+
+    def __init__(self, client, workers: int = None, max_in_flight: int = None,
+                 part_size: int = None, retries: int = None, backoff: float = None):
+        self.client = client
+        self.workers = workers or const.IO_WORKERS
+        self.budget = ByteBudget(max_in_flight or const.TRANSFER_MAX_INFLIGHT)
+        self.part_size = part_size or const.TRANSFER_PART_SIZE
+        self.retries = const.TRANSFER_RETRIES if retries is None else retries
+        self.backoff = const.TRANSFER_BACKOFF if backoff is None else backoff
+        self.bucket = getattr(client, 'obj_store_bucket', None)
+        self._minio = None
+        self._listings = {}
+        self._listing_lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix='transfer')
+        # the parts of the large objects, a separate pool so an object never
+        # waits for its parts behind other objects
+        self._part_pool = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix='transfer-part')
+
+    @property
+    def minio(self):
+        """minio client of the bucket with a connection pool for the workers,
+        None when the client is not an NRUtil ObjectStoreUtil
+        """
+        is_nrutil = (hasattr(self.client, 'minio_client')
+                     and hasattr(self.client, 'obj_store_host'))
+        if self._minio is None and is_nrutil:
+            import certifi
+            import minio
+            import urllib3
+            timeout = 300
+            http_client = urllib3.PoolManager(
+                maxsize=self.workers * 2,
+                timeout=urllib3.util.Timeout(connect=timeout, read=timeout),
+                cert_reqs='CERT_REQUIRED',
+                ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+                # retried here, with the backoff of the engine
+                retries=False,
+            )
+            self._minio = minio.Minio(
+                self.client.obj_store_host, self.client.obj_store_user,
+                self.client.obj_store_secret, http_client=http_client)
+        return self._minio
+
+    def _minio_call(self, op: str, func, *args, **kwargs):
+        """a request of the minio client, counted as an object store request
+        """
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.METRICS.count('ostore_requests', op=op)
+
+    def _retry(self, op: str, func, *args, **kwargs):
+        """calls func, retrying with exponential backoff and jitter
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                result = func(*args, **kwargs)
+                metrics.METRICS.count('transfer_requests', op=op)
+                return result
+            except Exception as e:
+                if is_missing(e) or attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * (1 + random.random()) / 2
+                LOGGER.warning(f'{op} failed ({e}), retry {attempt + 1}/{self.retries} '
+                               f'in {delay:.1f}s')
+                metrics.METRICS.count('transfer_retries', op=op)
+                time.sleep(delay)
+
+    # listings
+
+    def _list_dir(self, ostore_dir: str) -> dict:
+        """name -> (size, etag) of the objects of a directory
+        """
+        prefix = f'{ostore_dir}/' if ostore_dir else None
+        # the minio listing is a generator, the requests are made as it is read
+        objects = self._retry('list', lambda: list(
+            self.client.list_objects(objstore_dir=prefix, recursive=True)))
+        listing = {}
+        for obj in objects:
+            name = normalize(obj.object_name)
+            if name.endswith('/') or os.path.dirname(name) != ostore_dir:
+                continue
+            listing[name] = (obj.size, getattr(obj, 'etag', None))
+        return listing
+
+    def _get_listing(self, ostore_dir: str, refresh: bool = False) -> dict:
+        with self._listing_lock:
+            listing = self._listings.get(ostore_dir)
+        if listing is None or refresh:
+            listing = self._list_dir(ostore_dir)
+            with self._listing_lock:
+                self._listings[ostore_dir] = listing
+        return listing
+
+    def invalidate(self, ostore_dir: str = None):
+        """forgets the cached listing of a directory, of all of them by default
+        """
+        with self._listing_lock:
+            if ostore_dir is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(normalize(ostore_dir).rstrip('/'), None)
+
+    def stat_many(self, ostore_paths: list, refresh: bool = False) -> dict:
+        """size and etag of objects, from one listing per directory
+
+        :param ostore_paths: object storage paths
+        :type ostore_paths: list[str]
+        :param refresh: list the directories again instead of using the cache
+        :type refresh: bool, optional
+        :return: object storage path -> (size, etag), None for missing objects
+        :rtype: dict
+        """
+        dirs = sorted({os.path.dirname(normalize(pth)) for pth in ostore_paths})
+        listings = dict(zip(
+            dirs, self._pool.map(lambda d: self._get_listing(d, refresh), dirs)))
+        return {pth: listings[os.path.dirname(normalize(pth))].get(normalize(pth))
+                for pth in ostore_paths}
+
+    def exists_many(self, ostore_paths: list, refresh: bool = False) -> dict:
+        """whether objects exist, from one listing per directory
+
+        :return: object storage path -> bool
+        :rtype: dict
+        """
+        stats = self.stat_many(ostore_paths, refresh)
+        return {pth: stat is not None for pth, stat in stats.items()}
+
+    # downloads
+
+    def _read_range(self, ostore_path: str, offset: int, length: int) -> bytes:
+        if self.minio is not None:
+            response = self._minio_call('get_object_range', self.minio.get_object,
+                                        self.bucket, ostore_path, offset=offset,
+                                        length=length)
+            try:
+                data = response.read()
+            finally:
+                response.close()
+                response.release_conn()
+            metrics.METRICS.count('ostore_bytes', len(data), direction='read')
+            return data
+        return self.client.get_object_range(ostore_path, offset, length)
+
+    def _get_part(self, ostore_path: str, fd: int, offset: int, length: int):
+        self.budget.acquire(length)
+        try:
+            data = self._retry('get_range', self._read_range, ostore_path, offset,
+                               length)
+            if len(data) != length:
+                raise IOError(f'short read of {ostore_path} at {offset}: '
+                              f'{len(data)} of {length} bytes')
+            os.pwrite(fd, data, offset)
+        finally:
+            self.budget.release(length)
+
+    def get(self, ostore_path: str, local_path: str, size: int = None):
+        """downloads an object, the size (see stat_many) is needed for the
+        ranged GETs of large objects
+
+        :param ostore_path: object storage path
+        :type ostore_path: str
+        :param local_path: where to write the object
+        :type local_path: str
+        :param size: size of the object in bytes
+        :type size: int, optional
+        """
+        local_dir = os.path.dirname(os.path.abspath(local_path))
+        os.makedirs(local_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(local_path)}.',
+                                        suffix='.tmp', dir=local_dir)
+        can_range = self.minio is not None or hasattr(self.client, 'get_object_range')
+        ranged = size is not None and can_range
+        try:
+            try:
+                if ranged:
+                    os.ftruncate(fd, size)
+                    parts = [
+                        self._part_pool.submit(self._get_part, ostore_path, fd, offset,
+                                               min(self.part_size, size - offset))
+                        for offset in range(0, size, self.part_size)
+                    ]
+                    # all the parts are done with the file before it is closed
+                    concurrent.futures.wait(parts)
+                    for part in parts:
+                        part.result()
+            finally:
+                os.close(fd)
+            if not ranged:
+                self.budget.acquire(size or self.part_size)
+                try:
+                    self._retry('get', self.client.get_object, file_path=ostore_path,
+                                local_path=tmp_path)
+                finally:
+                    self.budget.release(size or self.part_size)
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        metrics.METRICS.count('transfer_bytes', os.path.getsize(local_path),
+                              direction='read')
+
+    def get_many(self, items: list, missing_ok: bool = False) -> list:
+        """downloads objects concurrently
+
+        :param items: (object storage path, local path) pairs
+        :type items: list[tuple]
+        :param missing_ok: skip the objects that do not exist, otherwise they
+            are reported as failed
+        :type missing_ok: bool, optional
+        :raises TransferError: when some of the downloads failed, after the
+            others completed
+        :return: the local paths that were downloaded
+        :rtype: list[str]
+        """
+        items = list(items)
+        stats = self.stat_many([ostore_path for ostore_path, _ in items])
+        futures, failed = {}, {}
+        for ostore_path, local_path in items:
+            stat = stats[ostore_path]
+            if stat is None:
+                if not missing_ok:
+                    failed[ostore_path] = FileNotFoundError(
+                        f'no such object: {ostore_path}')
+                continue
+            future = self._pool.submit(self.get, ostore_path, local_path, stat[0])
+            futures[future] = (ostore_path, local_path)
+        done = []
+        for future in concurrent.futures.as_completed(futures):
+            ostore_path, local_path = futures[future]
+            try:
+                future.result()
+                done.append(local_path)
+            except Exception as e:
+                LOGGER.error(f'could not get {ostore_path}: {e}')
+                failed[ostore_path] = e
+        if failed:
+            raise TransferError(failed)
+        LOGGER.debug(f'got {len(done)} objects')
+        return done
+
+    # uploads
+
+    def put(self, local_path: str, ostore_path: str):
+        """uploads a file, as a parallel multipart upload when it is larger
+        than a part
+        """
+        size = os.path.getsize(local_path)
+        self.budget.acquire(size)
+        try:
+            if self.minio is not None:
+                self._retry('put', self._minio_call, 'put_object',
+                            self.minio.fput_object, self.bucket, ostore_path,
+                            local_path,
+                            part_size=max(self.part_size, MIN_PART_SIZE),
+                            num_parallel_uploads=max(
+                                1, min(self.workers, -(-size // self.part_size))))
+                metrics.METRICS.count('ostore_bytes', size, direction='write')
+            else:
+                self._retry('put', self.client.put_object, ostore_path=ostore_path,
+                            local_path=local_path)
+        finally:
+            self.budget.release(size)
+        name = normalize(ostore_path)
+        with self._listing_lock:
+            listing = self._listings.get(os.path.dirname(name))
+            if listing is not None:
+                listing[name] = (size, None)
+        metrics.METRICS.count('transfer_bytes', size, direction='write')
+
+    def put_many(self, items: list) -> list:
+        """uploads files concurrently
+
+        :param items: (local path, object storage path) pairs
+        :type items: list[tuple]
+        :raises TransferError: when some of the uploads failed, after the
+            others completed
+        :return: the object storage paths that were uploaded
+        :rtype: list[str]
+        """
+        futures = {self._pool.submit(self.put, local_path, ostore_path): ostore_path
+                   for local_path, ostore_path in items}
+        done, failed = [], {}
+        for future in concurrent.futures.as_completed(futures):
+            ostore_path = futures[future]
+            try:
+                future.result()
+                done.append(ostore_path)
+            except Exception as e:
+                LOGGER.error(f'could not put {ostore_path}: {e}')
+                failed[ostore_path] = e
+        if failed:
+            raise TransferError(failed)
+        LOGGER.debug(f'put {len(done)} objects')
+        return done
+
+    def shutdown(self):
+        self._pool.shutdown()
+        self._part_pool.shutdown()
+
+
+_engines = {}
+_lock = threading.Lock()
+
+
+def get_engine(client) -> TransferEngine:
+    """the engine of a client, shared by everything in the process that uses
+    the client (the engine holds the client so its id is not reused)
+    """
+    key = (id(client), os.getpid())
+    with _lock:
+        if key not in _engines:
+            _engines[key] = TransferEngine(client)
+        return _engines[key]
+
+
+@atexit.register
+def shutdown():
+    """stops the threads of the engines of the process
+    """
+    with _lock:
+        for (_, pid), engine in list(_engines.items()):
+            if pid == os.getpid():
+                engine.shutdown()
+        _engines.clear()
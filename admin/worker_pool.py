@@ -0,0 +1,84 @@
+"""
+Worker processes shared by the pipeline stages.
+
+The stages used to start and tear down a multiprocessing.Pool(6) every time
+they distributed work (every day's reprojection, every plot run).  They now
+submit to one pool per process, sized to the machine (const.WORKERS, the
+number of CPUs by default), created on first use and closed at exit.  The
+pool can be used from several threads at once, which is how the task graph
+(admin/task_graph.py) overlaps the stages.
+
+The pool forks its workers when it is created: create it (get_pool) from the
+main thread before starting other threads, and after anything the workers
+need has been set up.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+
+import admin.constants as const
+
+from admin import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def get_workers() -> int:
+    """number of worker processes, const.WORKERS or the number of CPUs
+    """
+    return const.WORKERS or os.cpu_count() or 1
+
+
+def get_pool():
+    """the shared process pool, created on the first call in a process
+
+    :return: the pool
+    :rtype: multiprocessing.pool.Pool
+    """
+    global _pool, _pool_pid
+    with _lock:
+        # a forked child gets a copy of the parent's pool object that it cannot use
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(get_workers())
+            _pool_pid = os.getpid()
+            LOGGER.debug(f'started {get_workers()} worker processes')
+        return _pool
+
+
+def starmap(func, args: list, name: str = None, label_arg: int = None) -> list:
+    """runs func over the argument tuples in the shared pool, see
+    admin.metrics.starmap
+
+    :param func: the task, has to be picklable
+    :param args: argument tuples
+    :type args: list
+    :param name: name of the tasks in the metrics, defaults to the name of func
+    :type name: str, optional
+    :param label_arg: index of the argument that names a task in the metrics
+    :type label_arg: int, optional
+    :return: results of the tasks
+    :rtype: list
+    """
+    args = list(args)
+    if not args:
+        return []
+    return metrics.starmap(get_pool(), func, args, name or func.__name__, get_workers(), label_arg)
+
+
+@atexit.register
+def shutdown():
+    """stops the worker processes
+    """
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+            _pool.join()
+        _pool = None
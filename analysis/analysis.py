@@ -1,21 +1,24 @@
 import os
 
 import admin.constants as const
+import admin.snow_path_lib
 
 import rioxarray as rioxr
 import geopandas as gpd
 
 from glob import glob
 
+snow_path = admin.snow_path_lib.SnowPathLib()
+
 def calculate_stats(typ: str, sat: str, date: str, db_handler):
-    if sat == 'modis':
-        mosaic = glob(os.path.join(const.INTERMEDIATE_TIF_MODIS, date, 'modis_composite*.tif'))[0]
-    elif sat == 'viirs':
-        mosaic = glob(os.path.join(const.OUTPUT_TIF_VIIRS, date.split('.')[0], f'{date}.tif'))[0]
-    else:
+    if sat not in ['modis', 'viirs']:
         return
+    mosaic = snow_path.find_product_tif(sat, date)
+    if mosaic is None:
+        raise FileNotFoundError(f'no {sat} mosaic for {date}')
     gdf = gpd.read_file(glob(os.path.join(f'aoi', typ,'*.shp'))[0])
     gdf = gdf.to_crs('EPSG:3153')
+    rows = []
     with rioxr.open_rasterio(mosaic) as src:
         src = src.rio.reproject('EPSG:3153', resolution=const.RES[sat])
         for _, row in gdf.iterrows():
@@ -42,14 +45,12 @@ def calculate_stats(typ: str, sat: str, date: str, db_handler):
             if below != 0 and area != 0:
                 below_threshold = (below/area)*100
 
-            # TODO: 
-            prepare = {
-                'sat': sat,
+            rows.append({
                 'name': name,
                 'date_': date,
                 'coverage': coverage,
                 'nodata': nodata,
                 'below_threshold': below_threshold
-            }
-
-            db_handler.insert(**prepare)
+            })
+    # all the sheds are written in one transaction
+    db_handler.insert_many(sat, rows)
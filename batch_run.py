@@ -3,8 +3,17 @@ This script is used to manually run a set of dates.  Under normal circumstances
 you shouldn't need to use this script, but in the event that bad data is encountered
 by the GHA runs, or if the GHA runs get disabled for a period of time and a bunch of
 data needs to be generated, this script can be used to fill those holes.
+
+By default the dates are backfilled as a task graph (admin/task_graph.py): the
+granules of every day in the range, and of the days before it that the MODIS
+composites of the first dates need, are downloaded and mosaicked once and in
+parallel, then the composites, watershed/basin tifs and plots of the dates
+are derived from the shared daily mosaics.
+
+    python batch_run.py --min-date 2024.05.18 --max-date 2024.06.01 --sat modis --workers 2 --memory-budget 8000
 """
 
+import click
 import datetime
 import json
 import logging
@@ -12,18 +21,34 @@ import sys
 import run
 import os
 
+import admin.constants as const
+
+from admin import datacube, manifest, object_store_util, task_graph, worker_pool
+from process import modis, viirs
+
 log_config_path = os.path.join(os.path.dirname(__file__), 'config', 'logging.config')
 logging.config.fileConfig(log_config_path)
 
 LOGGER = logging.getLogger(__name__)
 
+# rough peak memory of the steps of a backfill in MB, for the memory budget
+STEP_MEMORY = {
+    'download': 100,
+    'normals': 500,
+    'mosaic': 1500,
+    'datacube': 500,
+    'product': 2000,
+    'plot': 1000,
+}
+
 
 class BulkRun():
 
-    def __init__(self, min_date, max_date, sat):
+    def __init__(self, min_date, max_date, sat, days=5):
         self.min_date = min_date
         self.max_date = max_date
         self.sat = sat
+        self.days = int(days)
 
     def get_date_list(self):
         """
@@ -31,9 +56,9 @@ class BulkRun():
         the max dates in the list
         """
         date_list = []
-        delta = max_date - min_date
+        delta = self.max_date - self.min_date
         for i in range(delta.days + 1):
-            day = min_date + datetime.timedelta(days=i)
+            day = self.min_date + datetime.timedelta(days=i)
             date_list.append(day)
         return date_list
 
@@ -53,18 +78,121 @@ class BulkRun():
         LOGGER.info(f'running download for date: {datestr}')
         run.down_load(sat=self.sat, date=datestr)
         LOGGER.info(f'running process for date: {datestr}')
-        run.pro_cess(sat=self.sat, date=datestr, days=5)
+        run.pro_cess(sat=self.sat, date=datestr, days=self.days)
         LOGGER.info(f'running plot for date: {datestr}')
         run.p_lot(sat=self.sat, date=datestr)
 
-if __name__ == '__main__':
+    def get_windows(self):
+        """
+        the days of the mosaics each date is derived from, the 5 or 8 day window
+        ending on the date for modis and the date itself for viirs
+        """
+        windows = {}
+        for date in self.get_date_list():
+            datestr = date.strftime("%Y.%m.%d")
+            if self.sat == 'modis':
+                windows[datestr] = modis.get_datespan(datestr, self.days)
+            else:
+                windows[datestr] = [datestr]
+        return windows
+
+    def build_graph(self):
+        """
+        the task graph of the backfill, the daily mosaics are shared by the
+        windows they are in:
+
+            download:<sat>:<day> -> mosaic:<sat>:<day> -> datacube:<sat>
+            mosaic:<sat>:<day of the window> -> product:<sat>:<date> -> plot:<sat>:<date>
+            normals:<sat> -> product:<sat>:<date>, plot:<sat>:<date>
 
-    # the range of dates to run
-    min_date = datetime.datetime(2024, 5, 18)
-    max_date =  datetime.datetime(2024, 6, 1)
-    sat = 'viirs'
+        the normals of all the dates are pulled once, up front.  Unlike the
+        daily pipeline, where process:modis:<date> reprojects the granules the
+        next day's composite shares, the products of consecutive dates only
+        read the shared mosaics and write below their own date (see
+        modis.composite_modis), so they are not ordered and run concurrently
+        """
+        windows = self.get_windows()
+        days = sorted({day for window in windows.values() for day in window})
+        graph = task_graph.TaskGraph()
+        for day in days:
+            graph.add(f'download:{self.sat}:{day}', run.down_load, kind='io',
+                      outputs=[f'granules:{self.sat}:{day}'], memory=STEP_MEMORY['download'],
+                      sat=self.sat, date=day, days=1)
+        graph.add(f'normals:{self.sat}', run.normals_task, sorted(windows), self.sat, kind='io',
+                  outputs=[f'normals:{self.sat}'], memory=STEP_MEMORY['normals'])
+        mosaic = modis.mosaic_modis if self.sat == 'modis' else viirs.mosaic_viirs
+        for day in days:
+            graph.add(f'mosaic:{self.sat}:{day}', mosaic, day, inputs=[f'granules:{self.sat}:{day}'],
+                      outputs=[f'mosaic:{self.sat}:{day}'], memory=STEP_MEMORY['mosaic'])
+        graph.add(f'datacube:{self.sat}', self.sync_datacube, days,
+                  inputs=[f'mosaic:{self.sat}:{day}' for day in days], outputs=[f'datacube:{self.sat}'],
+                  memory=STEP_MEMORY['datacube'])
+        for datestr, window in windows.items():
+            if self.sat == 'modis':
+                func, args = modis.composite_modis, (datestr, self.days)
+            else:
+                func, args = viirs.clip_viirs, (datestr,)
+            graph.add(f'product:{self.sat}:{datestr}', func, *args,
+                      inputs=[f'mosaic:{self.sat}:{day}' for day in window] + [f'normals:{self.sat}'],
+                      outputs=[f'product:{self.sat}:{datestr}'], memory=STEP_MEMORY['product'])
+            graph.add(f'plot:{self.sat}:{datestr}', run.p_lot, datestr, self.sat,
+                      inputs=[f'product:{self.sat}:{datestr}', f'normals:{self.sat}'], outputs=[f'plot:{self.sat}:{datestr}'],
+                      memory=STEP_MEMORY['plot'])
+        return graph
 
-    br = BulkRun(min_date, max_date, sat)
+    def sync_datacube(self, days):
+        """
+        adds the daily mosaics to the datacube, once for the whole backfill
+        """
+        get_path = modis.snow_path.get_output_modis_path if self.sat == 'modis' else \
+            viirs.snow_path.get_output_viirs_path
+        datacube.sync_mosaics(self.sat, {day: get_path(day) for day in days})
+
+    def backfill(self, workers=2, memory_budget=None, state_pth=None, resume=False):
+        """
+        runs the backfill task graph
+
+        :param workers: number of mosaics / composites processed at once
+        :param memory_budget: MB the steps that run at once may use, see STEP_MEMORY
+        :param state_pth: file the completed steps are recorded in
+        :param resume: skip the steps recorded as completed in state_pth
+        """
+        graph = self.build_graph()
+        LOGGER.info(f"backfilling {len(self.get_date_list())} {self.sat} dates, {len(graph)} steps")
+        # outputs recorded by other runs are reused, see admin/manifest.py
+        ostore = object_store_util.get_client()
+        manifest.pull(ostore)
+        # the worker processes are forked before the steps start their threads
+        worker_pool.get_pool()
+        try:
+            return graph.run(state_pth=state_pth, resume=resume, cpu_workers=workers,
+                             memory_budget=memory_budget)
+        finally:
+            manifest.push(ostore)
+
+
+@click.command()
+@click.option('--min-date', type=click.DateTime(formats=['%Y.%m.%d']), required=True, help='First date, YYYY.MM.DD')
+@click.option('--max-date', type=click.DateTime(formats=['%Y.%m.%d']), required=True, help='Last date, YYYY.MM.DD')
+@click.option('--sat', type=const.SATS, required=True, help='Which satellite source to process [ modis | viirs ]')
+@click.option('--days', required=False, default='5', type=const.DAYS, help='Select 5 or 8 day composite for MODIS')
+@click.option('--workers', type=int, required=False, default=2, help='Number of mosaics / composites processed at once')
+@click.option('--memory-budget', type=int, required=False, help='MB the steps that run at once may use')
+@click.option('--state', type=click.Path(dir_okay=False), required=False,
+        help='File the completed steps are recorded in, defaults to backfill_<sat>_<min>_<max>.json in the log directory')
+@click.option('--resume', is_flag=True, help='Skip the steps a previous run recorded as completed in the state file')
+@click.option('--sequential', is_flag=True, help='Run the dates one after the other, without the task graph')
+def main(min_date, max_date, sat, days, workers, memory_budget, state, resume, sequential):
+    br = BulkRun(min_date, max_date, sat, days)
     date_list = br.get_date_list()
     LOGGER.info(f"running dates: {date_list}")
-    br.do_run()
\ No newline at end of file
+    if sequential:
+        br.do_run()
+    else:
+        state = state or os.path.join(
+            const.LOG, f"backfill_{sat}_{min_date:%Y.%m.%d}_{max_date:%Y.%m.%d}.json")
+        br.backfill(workers, memory_budget, state, resume)
+
+
+if __name__ == '__main__':
+    main()
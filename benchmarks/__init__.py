@@ -0,0 +1,12 @@
+"""
+Benchmarks of the pipeline stages on synthetic data.
+
+    python -m benchmarks --sizes small,medium --workers 1,4 --out results.json
+    python -m benchmarks --stages reproject_modis,composite_mosaics --baseline old.json
+
+Every stage runs against generated granules, mosaics, normals and watersheds
+(benchmarks.synthetic) in a directory of its own, with a directory backed
+object store (benchmarks.local_store) in place of the real one, so nothing
+is downloaded or uploaded.  The results are written as JSON with the machine
+they ran on, see benchmarks.harness for what is measured.
+"""
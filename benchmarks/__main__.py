@@ -0,0 +1,66 @@
+import logging
+import sys
+
+import click
+
+from benchmarks import harness
+from benchmarks.stages import SIZES, STAGES
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _split(value: str, choices) -> list:
+    items = [v.strip() for v in value.split(',') if v.strip()]
+    unknown = [v for v in items if v not in choices]
+    if unknown:
+        raise click.BadParameter(f'{", ".join(unknown)}, valid values: {", ".join(choices)}')
+    return items
+
+
+@click.command()
+@click.option('--stages', default=','.join(STAGES), show_default=True,
+              help='Comma separated stages to run')
+@click.option('--sizes', default='small', show_default=True,
+              help=f'Comma separated data sizes [{"|".join(SIZES)}]')
+@click.option('--workers', default='1,4', show_default=True,
+              help='Comma separated worker counts for the stages the benchmark distributes')
+@click.option('--repeat', default=3, show_default=True, type=int, help='Runs per case')
+@click.option('--out', 'out_pth', default='benchmark_results.json', show_default=True,
+              help='JSON file to write the results to')
+@click.option('--baseline', default=None, type=click.Path(exists=True),
+              help='Earlier results to compare against, exits with 1 on a regression')
+@click.option('--threshold', default=1.2, show_default=True, type=float,
+              help='Ratio to the baseline above which a case is a regression')
+@click.option('--tmpdir', default=None, help='Directory to create the case directories in')
+@click.option('--keep', is_flag=True, help='Keep the case directories')
+def main(stages, sizes, workers, repeat, out_pth, baseline, threshold, tmpdir, keep):
+    """Benchmark the pipeline stages on synthetic data"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    stages = _split(stages, STAGES)
+    sizes = _split(sizes, SIZES)
+    workers = [int(w) for w in workers.split(',')]
+
+    report = harness.run_benchmarks(stages, sizes, workers, repeat, tmpdir, keep)
+    harness.write_report(report, out_pth)
+
+    click.echo(f'{"stage":32} {"size":8} {"workers":>7} {"seconds":>9} {"peak MB":>9}')
+    for (stage, size, n), values in harness.summarise(report).items():
+        click.echo(f'{stage:32} {size:8} {str(n or "-"):>7} {values["seconds"]:9.2f} '
+                   f'{values["maxrss_kb"] / 1024:9.1f}')
+    failed = [e for e in report['results'] if 'error' in e]
+    if failed:
+        click.echo(f'{len(failed)} runs failed, see {out_pth}')
+    click.echo(f'results written to {out_pth}')
+
+    if baseline:
+        regressions = harness.compare(report, harness.read_report(baseline), threshold)
+        for (stage, size, n), metric, before, value in regressions:
+            click.echo(f'REGRESSION {stage} size={size} workers={n} {metric}: {before:.2f} -> {value:.2f}')
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Runs the benchmark cases and collects the measurements.
+
+A case is a (stage, size, workers, repeat).  Each case gets a new directory
+that SNOWPACK_DATA points at; the inputs are built in one process and the
+stage is timed in a second, fresh, process so the imports and the setup do
+not count towards its memory and I/O.
+
+Measured per case:
+
+* seconds: wall clock time of the stage
+* maxrss_kb / children_maxrss_kb: peak resident set size of the stage process
+  and of the largest of its pool workers (getrusage)
+* rchar / wchar / read_bytes / write_bytes: /proc/self/io of the stage
+  process, which includes the pool workers it has reaped (Linux only)
+* anything the stage returns, e.g. the object store traffic
+"""
+
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+LOGGER = logging.getLogger(__name__)
+
+IO_FIELDS = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+
+
+def get_io_counters() -> dict:
+    """the /proc/self/io counters, empty where they are not available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {k: int(counters[k]) for k in IO_FIELDS if k in counters}
+
+
+def get_maxrss_kb(who) -> int:
+    maxrss = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+def get_machine_info() -> dict:
+    """description of the machine and the software the results come from
+    """
+    info = {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'processor': platform.processor(),
+    }
+    for module in ['numpy', 'rasterio', 'geopandas', 'h5py']:
+        try:
+            info[module] = __import__(module).__version__
+        except ImportError:
+            info[module] = None
+    try:
+        import rasterio
+        info['gdal'] = rasterio.__gdal_version__
+    except ImportError:
+        info['gdal'] = None
+    try:
+        info['commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def _get_context(workdir: str, size: str):
+    """points the pipeline at the case directory, has to run before anything
+    imports admin.constants
+    """
+    top = os.path.join(workdir, 'top')
+    os.environ['SNOWPACK_DATA'] = top
+    os.environ['NORM_ROOT'] = top
+    # the object store client is created on import, it is replaced by the
+    # local object store before it is used
+    for var in ['OBJ_STORE_HOST', 'OBJ_STORE_BUCKET', 'OBJ_STORE_USER', 'OBJ_STORE_SECRET']:
+        os.environ.setdefault(var, 'benchmark')
+
+    from benchmarks.stages import Context
+
+    ctx = Context(workdir, size)
+    ctx.configure()
+    return ctx
+
+
+def _setup_case(stage_name: str, workdir: str, size: str):
+    from benchmarks.stages import STAGES
+
+    ctx = _get_context(workdir, size)
+    STAGES[stage_name].setup(ctx)
+
+
+def _run_case(stage_name: str, workdir: str, size: str, workers: int) -> dict:
+    from benchmarks.stages import STAGES
+
+    ctx = _get_context(workdir, size)
+    stage = STAGES[stage_name]
+    io_before = get_io_counters()
+    start = time.perf_counter()
+    extra = stage.run(ctx, workers)
+    seconds = time.perf_counter() - start
+    io_after = get_io_counters()
+
+    result = {
+        'seconds': seconds,
+        'maxrss_kb': get_maxrss_kb(resource.RUSAGE_SELF),
+        'children_maxrss_kb': get_maxrss_kb(resource.RUSAGE_CHILDREN),
+    }
+    for field in IO_FIELDS:
+        result[field] = io_after[field] - io_before[field] if field in io_after else None
+    result.update(extra or {})
+    return result
+
+
+def _call(queue, func, args):
+    try:
+        queue.put(('ok', func(*args)))
+    except BaseException:
+        queue.put(('error', traceback.format_exc()))
+
+
+def _in_process(func, *args):
+    """calls func in a new interpreter and returns its result
+
+    :raises RuntimeError: with the traceback if func raised
+    """
+    mp = multiprocessing.get_context('spawn')
+    queue = mp.Queue()
+    proc = mp.Process(target=_call, args=(queue, func, args))
+    proc.start()
+    status, value = queue.get()
+    proc.join()
+    if status != 'ok':
+        raise RuntimeError(value)
+    return value
+
+
+def run_case(stage_name: str, size: str, workers: int = None, tmpdir: str = None,
+             keep: bool = False) -> dict:
+    """builds the inputs and times one run of a stage
+
+    :param stage_name: name of the stage, see benchmarks.stages.STAGES
+    :type stage_name: str
+    :param size: data size, see benchmarks.stages.SIZES
+    :type size: str
+    :param workers: number of pool workers for the stages that are
+        distributed by the benchmark, None for the others
+    :type workers: int, optional
+    :param tmpdir: directory to create the case directory in
+    :type tmpdir: str, optional
+    :param keep: keep the case directory, defaults to False
+    :type keep: bool, optional
+    :return: the measurements
+    :rtype: dict
+    """
+    workdir = tempfile.mkdtemp(prefix=f'bench-{stage_name}-{size}-', dir=tmpdir)
+    try:
+        _in_process(_setup_case, stage_name, workdir, size)
+        result = _in_process(_run_case, stage_name, workdir, size, workers)
+    finally:
+        if keep:
+            LOGGER.info(f'kept {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def run_benchmarks(stages: list, sizes: list, workers: list, repeat: int = 1,
+                   tmpdir: str = None, keep: bool = False) -> dict:
+    """runs every combination of stage, size and workers
+
+    A case that fails is recorded with its error, the other cases still run.
+
+    :param stages: names of the stages
+    :type stages: list
+    :param sizes: data sizes
+    :type sizes: list
+    :param workers: worker counts, only used by the parallel stages
+    :type workers: list
+    :param repeat: runs per case, defaults to 1
+    :type repeat: int, optional
+    :return: machine info and one result per run
+    :rtype: dict
+    """
+    from benchmarks.stages import STAGES
+
+    report = {
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'machine': get_machine_info(),
+        'results': [],
+    }
+    for stage_name in stages:
+        stage_workers = workers if STAGES[stage_name].parallel else [None]
+        for size in sizes:
+            for n in stage_workers:
+                for i in range(repeat):
+                    entry = {'stage': stage_name, 'size': size, 'workers': n, 'repeat': i}
+                    LOGGER.info(f'running {stage_name} size={size} workers={n} repeat={i}')
+                    try:
+                        entry.update(run_case(stage_name, size, n, tmpdir, keep))
+                    except RuntimeError as e:
+                        LOGGER.error(f'{stage_name} size={size} workers={n} failed:\n{e}')
+                        entry['error'] = str(e)
+                    report['results'].append(entry)
+    return report
+
+
+def summarise(report: dict) -> dict:
+    """median seconds and worst peak memory of every (stage, size, workers)
+
+    :return: {(stage, size, workers): {'seconds': .., 'maxrss_kb': ..}}
+    :rtype: dict
+    """
+    cases = {}
+    for entry in report['results']:
+        if 'error' in entry:
+            continue
+        key = (entry['stage'], entry['size'], entry['workers'])
+        cases.setdefault(key, []).append(entry)
+    return {
+        key: {
+            'seconds': statistics.median(e['seconds'] for e in entries),
+            'maxrss_kb': max(max(e['maxrss_kb'], e['children_maxrss_kb']) for e in entries),
+        }
+        for key, entries in cases.items()
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float = 1.2) -> list:
+    """cases that got slower or bigger than the baseline by more than the
+    threshold ratio
+
+    :param report: results of run_benchmarks
+    :type report: dict
+    :param baseline: earlier results of run_benchmarks
+    :type baseline: dict
+    :param threshold: ratio above which a case is a regression
+    :type threshold: float, optional
+    :return: (key, metric, baseline value, value) of the regressions
+    :rtype: list
+    """
+    current, previous = summarise(report), summarise(baseline)
+    regressions = []
+    for key, values in current.items():
+        if key not in previous:
+            continue
+        for metric, value in values.items():
+            before = previous[key][metric]
+            if before and value / before > threshold:
+                regressions.append((key, metric, before, value))
+    return regressions
+
+
+def write_report(report: dict, out_pth: str):
+    with open(out_pth, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def read_report(pth: str) -> dict:
+    with open(pth) as f:
+        return json.load(f)
@@ -0,0 +1,127 @@
+"""
+Local stand-in for NRUtil.NRObjStoreUtil.ObjectStoreUtil.
+
+Objects are files under a root directory, keyed by their path relative to
+the root.  The methods the pipeline uses (get_object, put_object,
+list_objects, stat_object, delete_remote_file) have the same signatures as
+the real client, get_object_range stands in for the ranged GETs the transfer
+engine (admin/transfer.py) makes with minio, and every call is counted so benchmarks and tests can check
+how many round trips and bytes a stage costs.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import types
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LocalObjectStore:
+    """directory backed object store
+
+    :param root: directory the objects are stored in
+    :type root: str
+    :param bucket: bucket name reported in the object properties
+    :type bucket: str, optional
+    """
+
+    def __init__(self, root: str, bucket: str = 'local'):
+        self.root = str(root)
+        self.obj_store_bucket = bucket
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        # names of the objects requested with get_object, in order
+        self.gets = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, *name.strip('/').split('/'))
+
+    def _count(self, call: str, read: int = 0, written: int = 0):
+        with self.lock:
+            self.calls[call] += 1
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def put_file(self, name: str, local_path: str):
+        """adds a file without counting it, to set up the contents
+        """
+        dst = self._path(name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(local_path, dst)
+
+    def get_object(self, file_path, local_path, bucket_name=None):
+        with self.lock:
+            self.gets.append(file_path)
+        src = self._path(file_path)
+        if not os.path.isfile(src):
+            raise FileNotFoundError(f'no such object: {file_path}')
+        local_dir = os.path.dirname(local_path)
+        if local_dir:
+            os.makedirs(local_dir, exist_ok=True)
+        shutil.copyfile(src, local_path)
+        self._count('get_object', read=os.path.getsize(src))
+
+    def get_object_range(self, object_name, offset, length, bucket_name=None):
+        """bytes of an object from offset, like a ranged GET
+        """
+        src = self._path(object_name)
+        if not os.path.isfile(src):
+            raise FileNotFoundError(f'no such object: {object_name}')
+        with open(src, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        self._count('get_object_range', read=len(data))
+        return data
+
+    def put_object(self, ostore_path, local_path, bucket_name=None, public=False):
+        dst = self._path(ostore_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(local_path, dst)
+        self._count('put_object', written=os.path.getsize(dst))
+
+    def list_objects(self, objstore_dir=None, recursive=True, return_file_names_only=False):
+        self._count('list_objects')
+        prefix = (objstore_dir or '').lstrip('/')
+        names = []
+        for dirpath, _, files in os.walk(self.root):
+            for f in files:
+                name = os.path.relpath(os.path.join(dirpath, f), self.root).replace(os.sep, '/')
+                if not name.startswith(prefix):
+                    continue
+                if not recursive and '/' in name[len(prefix):].strip('/'):
+                    continue
+                names.append(name)
+        names.sort()
+        if return_file_names_only:
+            return names
+        return [self._props(name) for name in names]
+
+    def _props(self, name: str):
+        pth = self._path(name)
+        md5 = hashlib.md5()
+        with open(pth, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        stat = os.stat(pth)
+        return types.SimpleNamespace(
+            object_name=name, bucket_name=self.obj_store_bucket, size=stat.st_size,
+            etag=md5.hexdigest(), last_modified=stat.st_mtime)
+
+    def stat_object(self, object_name, bucket_name=None):
+        self._count('stat_object')
+        if not os.path.isfile(self._path(object_name)):
+            raise FileNotFoundError(f'no such object: {object_name}')
+        return self._props(object_name)
+
+    def delete_remote_file(self, dest_file, obj_store_bucket=None):
+        self._count('delete_remote_file')
+        pth = self._path(dest_file)
+        if os.path.isfile(pth):
+            os.remove(pth)
@@ -0,0 +1,305 @@
+"""
+Pipeline stages that are benchmarked.
+
+Each stage has a `setup` that builds its inputs (synthetic data and, where a
+stage needs the output of an earlier one, that earlier stage run untimed)
+and a `run` that is timed.  Both get a Context with the paths of the case;
+they run in separate fresh processes so only `run` shows up in the
+measurements.  The pipeline modules are imported inside the functions, the
+harness has to point SNOWPACK_DATA at the case directory first.
+
+Stages whose `parallel` is True are driven by a pool of `workers` processes
+here, the same way process_viirs / process_modis distribute them.  The other
+stages have their own pools (or none), for those `workers` is None.
+"""
+
+import collections
+import os
+
+from glob import glob
+
+# the date every case processes, day == month so the normals lookup in
+# process.support finds the synthetic normals
+DATE = '2023.03.03'
+DAYS = 5
+SAT = 'modis'
+TYP = 'watersheds'
+
+# data sizes: `scale` divides the resolution of the granules and grids (1 is
+# the resolution of the products), `granules` is the number of granules a day
+# and `sheds` the number of watersheds
+SIZES = collections.OrderedDict([
+    ('small', {'scale': 8, 'granules': 4, 'sheds': 4}),
+    ('medium', {'scale': 3, 'granules': 6, 'sheds': 12}),
+    ('large', {'scale': 1, 'granules': 10, 'sheds': 40}),
+])
+
+Stage = collections.namedtuple('Stage', ['name', 'setup', 'run', 'parallel'])
+
+
+class Context:
+    """paths and parameters of a benchmark case
+
+    :param workdir: directory of the case, the working directory of the
+        stage.  SNOWPACK_DATA is workdir/top and the object store is
+        workdir/store
+    :type workdir: str
+    :param size: one of SIZES
+    :type size: str
+    """
+
+    def __init__(self, workdir: str, size: str):
+        self.workdir = workdir
+        self.size = size
+        self.params = SIZES[size]
+        self.top = os.path.join(workdir, 'top')
+        self.store_root = os.path.join(workdir, 'store')
+        self.aoi = os.path.join(workdir, 'aoi')
+        self._store = None
+
+    @property
+    def dates(self) -> list:
+        from process.modis import get_datespan
+        return get_datespan(DATE, DAYS)
+
+    @property
+    def store(self):
+        """the local object store, swapped in for the object store client of
+        the pipeline modules
+        """
+        if self._store is None:
+            from benchmarks.local_store import LocalObjectStore
+            import admin.plotter
+            import process.modis
+            import process.support
+
+            self._store = LocalObjectStore(self.store_root)
+            for ostore in (process.support.ostore, process.modis.ostore_util, admin.plotter.ostore):
+                ostore.ostore = self._store
+        return self._store
+
+    def configure(self):
+        """scales the resolutions of the pipeline to the size of the case,
+        inherited by the pool workers of the stages as long as they are forked
+        """
+        import admin.constants as const
+
+        scale = self.params['scale']
+        const.MODIS_EPSG4326_RES *= scale
+        const.VIIRS_EPSG4326_RES *= scale
+        const.RES = {sat: (x * scale, y * scale) for sat, (x, y) in const.RES.items()}
+        os.makedirs(self.top, exist_ok=True)
+        os.makedirs(const.ANALYSIS, exist_ok=True)
+        os.chdir(self.workdir)
+
+
+def _pool_starmap(func, args: list, workers: int):
+    from multiprocessing import Pool
+
+    with Pool(workers) as pool:
+        pool.starmap(func, args)
+
+
+# ---------------------------------------------------------------- inputs ----
+
+def _viirs_granule_dir() -> str:
+    import admin.constants as const
+    return os.path.join(const.MODIS_TERRA, 'VNP10A1F.001', DATE)
+
+
+def _modis_granule_dir() -> str:
+    from admin.snow_path_lib import SnowPathLib
+    return os.path.join(SnowPathLib().get_modis_MOD10A1V6(), DATE)
+
+
+def _write_granules(ctx: Context, writer, out_dir: str, pixels: int):
+    from benchmarks import synthetic
+
+    pixels = pixels // ctx.params['scale']
+    tiles = synthetic.get_tiles(ctx.params['granules'])
+    for seed, (h, v) in enumerate(tiles):
+        writer(out_dir, DATE, h, v, pixels, seed)
+
+
+def _modis_granules() -> list:
+    return sorted(glob(os.path.join(_modis_granule_dir(), 'MOD10A1.*.tif')))
+
+
+def _reproject_args() -> list:
+    return [(DATE, os.path.basename(g), g, 'EPSG:4326') for g in _modis_granules()]
+
+
+def _reprojected(ctx: Context):
+    from benchmarks import synthetic
+    from process import modis
+
+    _write_granules(ctx, synthetic.write_modis_granule, _modis_granule_dir(),
+                    synthetic.MODIS_TILE_PIXELS)
+    for args in _reproject_args():
+        modis.reproject_modis(*args)
+
+
+def _mosaics(ctx: Context):
+    import admin.constants as const
+    from admin.snow_path_lib import SnowPathLib
+    from benchmarks import synthetic
+
+    snow_path = SnowPathLib()
+    for seed, date in enumerate(ctx.dates):
+        synthetic.write_mosaic(
+            snow_path.get_output_modis_path(date), const.MODIS_EPSG4326_RES, seed, cloud=0.3)
+
+
+def _composite_path(ctx: Context) -> str:
+    from admin.snow_path_lib import SnowPathLib
+    return SnowPathLib().get_modis_composite_mosaic_file_name(DATE, ctx.dates)
+
+
+def _composite(ctx: Context):
+    from process import modis
+
+    _mosaics(ctx)
+    modis.composite_mosaics(DATE, ctx.dates, _composite_path(ctx))
+
+
+def _sheds(ctx: Context) -> list:
+    from benchmarks import synthetic
+
+    sheds = synthetic.make_sheds(ctx.params['sheds'], seed=0)
+    return synthetic.write_aoi(sheds, TYP, ctx.top, ctx.aoi)
+
+
+def _shed_dirs(ctx: Context) -> list:
+    return sorted(glob(os.path.join(ctx.top, TYP, '*')))
+
+
+def _normals(ctx: Context):
+    import admin.constants as const
+    from benchmarks import synthetic
+
+    month, day = DATE.split('.')[1:]
+    for seed, period in enumerate(['10yr', '20yr']):
+        pth = os.path.join(ctx.workdir, f'{period}.tif')
+        synthetic.write_normal(pth, const.MODIS_EPSG4326_RES, seed)
+        ctx.store.put_file(f'norm/{SAT}/daily/{period}/{month}.{day}.tif', pth)
+        os.remove(pth)
+
+
+def _clipped(ctx: Context):
+    from process.support import process_by_watershed_or_basin
+
+    _composite(ctx)
+    _sheds(ctx)
+    _normals(ctx)
+    process_by_watershed_or_basin(SAT, TYP, DATE, ctx.dates)
+
+
+def _store_metrics(ctx: Context) -> dict:
+    return {
+        'store_bytes_read': ctx.store.bytes_read,
+        'store_bytes_written': ctx.store.bytes_written,
+        'store_calls': dict(ctx.store.calls),
+    }
+
+
+# ---------------------------------------------------------------- stages ----
+
+def setup_build_viirs_tif(ctx: Context):
+    from benchmarks import synthetic
+    _write_granules(ctx, synthetic.write_viirs_granule, _viirs_granule_dir(),
+                    synthetic.VIIRS_TILE_PIXELS)
+
+
+def run_build_viirs_tif(ctx: Context, workers: int):
+    import admin.constants as const
+    from process import viirs
+
+    os.makedirs(os.path.join(const.INTERMEDIATE_TIF_VIIRS, DATE), exist_ok=True)
+    granules = sorted(glob(os.path.join(_viirs_granule_dir(), '*.h5')))
+    _pool_starmap(viirs.build_viirs_tif, [(DATE, g) for g in granules], workers)
+
+
+def setup_reproject_modis(ctx: Context):
+    from benchmarks import synthetic
+    _write_granules(ctx, synthetic.write_modis_granule, _modis_granule_dir(),
+                    synthetic.MODIS_TILE_PIXELS)
+
+
+def run_reproject_modis(ctx: Context, workers: int):
+    from process import modis
+
+    os.makedirs(modis.snow_path.get_modis_int_tif_dir(DATE), exist_ok=True)
+    _pool_starmap(modis.reproject_modis, _reproject_args(), workers)
+
+
+def run_create_modis_mosaic(ctx: Context, workers: int):
+    from process import modis
+
+    tifs = [modis.snow_path.get_modis_reprojected_tif(g, DATE, 'EPSG:4326') for g in _modis_granules()]
+    modis.create_modis_mosaic(
+        modis.snow_path.get_modis_int_tif_dir(DATE), modis.snow_path.get_output_modis_path(DATE), tifs)
+
+
+def run_composite_mosaics(ctx: Context, workers: int):
+    from process import modis
+    modis.composite_mosaics(DATE, ctx.dates, _composite_path(ctx))
+
+
+def setup_process_by_watershed_or_basin(ctx: Context):
+    _composite(ctx)
+    _sheds(ctx)
+    _normals(ctx)
+
+
+def run_process_by_watershed_or_basin(ctx: Context, workers: int):
+    from process.support import process_by_watershed_or_basin
+
+    ctx.store # swaps in the local object store
+    process_by_watershed_or_basin(SAT, TYP, DATE, ctx.dates)
+    return _store_metrics(ctx)
+
+
+def setup_calculate_stats(ctx: Context):
+    _composite(ctx)
+    _sheds(ctx)
+
+
+def run_calculate_stats(ctx: Context, workers: int):
+    from admin.db_handler import DBHandler
+    from analysis import analysis
+
+    analysis.calculate_stats(TYP, SAT, DATE, DBHandler())
+
+
+def setup_daily_kml(ctx: Context):
+    from admin.db_handler import DBHandler
+    from analysis import analysis
+
+    _clipped(ctx)
+    analysis.calculate_stats(TYP, SAT, DATE, DBHandler())
+
+
+def run_daily_kml(ctx: Context, workers: int):
+    from admin.buildkml import daily_kml, province_tiles
+    from admin.db_handler import DBHandler
+
+    province_tiles(DATE, SAT)
+    daily_kml(DATE, TYP, SAT, DBHandler())
+
+
+def run_plot_sheds(ctx: Context, workers: int):
+    from admin.plotter import plot_sheds
+    plot_sheds(_shed_dirs(ctx), TYP, SAT, DATE)
+
+
+STAGES = collections.OrderedDict((stage.name, stage) for stage in [
+    Stage('build_viirs_tif', setup_build_viirs_tif, run_build_viirs_tif, True),
+    Stage('reproject_modis', setup_reproject_modis, run_reproject_modis, True),
+    Stage('create_modis_mosaic', _reprojected, run_create_modis_mosaic, False),
+    Stage('composite_mosaics', _mosaics, run_composite_mosaics, False),
+    Stage('process_by_watershed_or_basin', setup_process_by_watershed_or_basin,
+          run_process_by_watershed_or_basin, False),
+    Stage('calculate_stats', setup_calculate_stats, run_calculate_stats, False),
+    Stage('daily_kml', setup_daily_kml, run_daily_kml, False),
+    Stage('plot_sheds', _clipped, run_plot_sheds, False),
+])
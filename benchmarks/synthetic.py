@@ -0,0 +1,235 @@
+"""
+Synthetic inputs for the benchmarks.
+
+Everything is generated from a seed so runs are comparable: the values look
+like NDSI snow cover (a smooth 0 - 100 field with cloud / water / fill codes
+above 100), the granules sit on the real MODIS / VIIRS sinusoidal tiles over
+the province, and the mosaics and normals are on the BBOX grid of the
+pipeline at the resolution in admin.constants (which the harness scales per
+data size).
+
+MODIS granules are written as single band sinusoidal GeoTIFFs rather than
+HDF4, the HDF4 driver is read only and usually missing from GDAL builds;
+reproject_modis reads both.
+"""
+
+import os
+
+import geopandas as gpd
+import h5py
+import numpy as np
+import rasterio as rio
+
+from affine import Affine
+from shapely.geometry import Polygon
+
+import admin.constants as const
+
+# MODIS / VIIRS sinusoidal tile grid
+SINUSOIDAL = '+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +R=6371007.181 +units=m +no_defs'
+TILE_SIZE = 1111950.5197665
+GRID_ULX = -20015109.354
+GRID_ULY = 10007554.677
+MODIS_TILE_PIXELS = 2400
+VIIRS_TILE_PIXELS = 3000
+# (h, v) of the tiles that intersect the BBOX, the ones covering most of the
+# province first
+BC_TILES = [(10, 3), (11, 3), (9, 3), (9, 4), (11, 2), (12, 2), (10, 4), (10, 2), (12, 3), (8, 4)]
+
+# codes above 100 in the snow cover products
+CLOUD = 250
+WATER = 237
+FILL = 255
+
+
+def snow_field(shape: tuple, seed: int, cloud: float = 0.2, water: float = 0.02) -> np.ndarray:
+    """smooth 0 - 100 snow cover field with cloud, water and fill codes
+
+    :param shape: (height, width)
+    :type shape: tuple
+    :param seed: random seed
+    :type seed: int
+    :param cloud: fraction of the pixels under cloud
+    :type cloud: float, optional
+    :param water: fraction of the pixels flagged as water
+    :type water: float, optional
+    :return: uint8 array
+    :rtype: np.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    # coarse field upsampled to get spatially correlated values
+    coarse = rng.uniform(-40, 140, (height // 32 + 2, width // 32 + 2))
+    field = np.kron(coarse, np.ones((32, 32)))[:height, :width]
+    field += rng.normal(0, 8, shape)
+    data = np.clip(field, 0, 100).astype('uint8')
+    noise = rng.random(shape)
+    data[noise < cloud] = CLOUD
+    data[(noise >= cloud) & (noise < cloud + water)] = WATER
+    return data
+
+
+def get_tiles(count: int) -> list:
+    """the first `count` tiles over the province, repeated if more are asked
+    for than there are tiles
+    """
+    return [BC_TILES[i % len(BC_TILES)] for i in range(count)]
+
+
+def tile_transform(h: int, v: int, pixels: int) -> Affine:
+    res = TILE_SIZE / pixels
+    return Affine(res, 0, GRID_ULX + h * TILE_SIZE, 0, -res, GRID_ULY - v * TILE_SIZE)
+
+
+def write_modis_granule(out_dir: str, date: str, h: int, v: int, pixels: int, seed: int) -> str:
+    """writes a MODIS snow cover granule for a tile
+
+    :param out_dir: directory of the granule
+    :type out_dir: str
+    :param date: acquisition date in format YYYY.MM.DD
+    :type date: str
+    :param h: horizontal tile number
+    :type h: int
+    :param v: vertical tile number
+    :type v: int
+    :param pixels: width and height of the granule, 2400 at full resolution
+    :type pixels: int
+    :param seed: random seed
+    :type seed: int
+    :return: path of the granule, named like the MOD10A1 granules
+    :rtype: str
+    """
+    julian = np.datetime64(date.replace('.', '-'), 'D').item().strftime('%Y%j')
+    pth = os.path.join(out_dir, f'MOD10A1.A{julian}.h{h:02d}v{v:02d}.061.{julian}000000.tif')
+    os.makedirs(out_dir, exist_ok=True)
+    profile = {
+        'driver': 'GTiff', 'width': pixels, 'height': pixels, 'count': 1, 'dtype': 'uint8',
+        'crs': SINUSOIDAL, 'transform': tile_transform(h, v, pixels), 'nodata': FILL,
+        'tiled': True, 'compress': 'DEFLATE',
+    }
+    with rio.open(pth, 'w', **profile) as dst:
+        dst.write(snow_field((pixels, pixels), seed), 1)
+    return pth
+
+
+def write_viirs_granule(out_dir: str, date: str, h: int, v: int, pixels: int, seed: int) -> str:
+    """writes a VNP10A1F granule for a tile, with the HDF-EOS layout and
+    metadata that process.viirs.build_viirs_tif reads
+
+    :return: path of the granule
+    :rtype: str
+    """
+    julian = np.datetime64(date.replace('.', '-'), 'D').item().strftime('%Y%j')
+    pth = os.path.join(out_dir, f'VNP10A1F.A{julian}.h{h:02d}v{v:02d}.001.{julian}000000.h5')
+    os.makedirs(out_dir, exist_ok=True)
+    transform = tile_transform(h, v, VIIRS_TILE_PIXELS)
+    ulx, uly = transform.c, transform.f
+    lrx, lry = ulx + TILE_SIZE, uly - TILE_SIZE
+    metadata = (
+        'GROUP=GridStructure\n\tGROUP=GRID_1\n\t\tGridName="VNP_Grid_IMG_2D"\n'
+        f'\t\tXDim={pixels}\n\t\tYDim={pixels}\n'
+        f'\t\tUpperLeftPointMtrs=({ulx:.6f},{uly:.6f})\n'
+        f'\t\tLowerRightMtrs=({lrx:.6f},{lry:.6f})\n'
+        '\t\tProjection=HE5_GCTP_SNSOID\n\tEND_GROUP=GRID_1\nEND_GROUP=GridStructure\nEND\n')
+    with h5py.File(pth, 'w') as f:
+        f.create_dataset('HDFEOS INFORMATION/StructMetadata.0', data=np.bytes_(metadata))
+        snow = f.create_dataset(
+            'HDFEOS/GRIDS/VNP_Grid_IMG_2D/Data Fields/CGF_NDSI_Snow_Cover',
+            data=snow_field((pixels, pixels), seed), chunks=True, compression='gzip')
+        snow.attrs['_FillValue'] = np.array([FILL], dtype='uint8')
+    return pth
+
+
+def get_bbox_grid(res: float):
+    """transform and shape of the BBOX grid at a resolution, same as
+    rasterio.merge with bounds=BBOX
+    """
+    west, south, east, north = const.BBOX
+    width = int(round((east - west) / res))
+    height = int(round((north - south) / res))
+    return Affine(res, 0, west, 0, -res, north), (height, width)
+
+
+def write_mosaic(pth: str, res: float, seed: int, cloud: float = 0.2) -> str:
+    """writes a daily mosaic on the BBOX grid
+    """
+    transform, shape = get_bbox_grid(res)
+    os.makedirs(os.path.dirname(pth), exist_ok=True)
+    with rio.open(pth, 'w', driver='GTiff', width=shape[1], height=shape[0], count=1,
+                  dtype='uint8', crs='EPSG:4326', transform=transform, nodata=FILL,
+                  tiled=True, compress='DEFLATE') as dst:
+        dst.write(snow_field(shape, seed, cloud=cloud), 1)
+    return pth
+
+
+def write_normal(pth: str, res: float, seed: int) -> str:
+    """writes a daily normal on the BBOX grid in the uint8 normal encoding
+    """
+    transform, shape = get_bbox_grid(res)
+    data = snow_field(shape, seed, cloud=0, water=0.02)
+    data[data > 100] = FILL
+    os.makedirs(os.path.dirname(pth), exist_ok=True)
+    with rio.open(pth, 'w', driver='GTiff', width=shape[1], height=shape[0], count=1,
+                  dtype='uint8', crs='EPSG:4326', transform=transform, nodata=FILL,
+                  tiled=True, compress='DEFLATE') as dst:
+        dst.write(data, 1)
+    return pth
+
+
+def make_sheds(count: int, seed: int) -> gpd.GeoDataFrame:
+    """irregular polygons spread over the BBOX, in EPSG:4326
+
+    :param count: number of polygons
+    :type count: int
+    :param seed: random seed
+    :type seed: int
+    :return: the polygons with the `name` of each shed
+    :rtype: gpd.GeoDataFrame
+    """
+    rng = np.random.default_rng(seed)
+    west, south, east, north = const.BBOX
+    cols = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / cols))
+    dx, dy = (east - west) / cols, (north - south) / rows
+    names, geoms = [], []
+    for i in range(count):
+        row, col = divmod(i, cols)
+        cx = west + (col + 0.5) * dx
+        cy = north - (row + 0.5) * dy
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 24))
+        radius = rng.uniform(0.25, 0.45, 24)
+        ring = [(cx + r * dx * np.cos(a), cy + r * dy * np.sin(a)) for a, r in zip(angles, radius)]
+        names.append(f'Shed {i:03d}')
+        geoms.append(Polygon(ring).buffer(0))
+    return gpd.GeoDataFrame({'name': names}, geometry=geoms, crs='EPSG:4326')
+
+
+def write_aoi(sheds: gpd.GeoDataFrame, typ: str, top: str, aoi_dir: str) -> list:
+    """writes the sheds as the pipeline expects them: one shapefile per shed
+    under TOP/{typ}/{name}/shape/EPSG4326/ and one shapefile of all the sheds
+    under aoi/{typ}/
+
+    :param sheds: polygons from make_sheds
+    :type sheds: gpd.GeoDataFrame
+    :param typ: watersheds | basins
+    :type typ: str
+    :param top: the TOP directory
+    :type top: str
+    :param aoi_dir: the aoi directory
+    :type aoi_dir: str
+    :return: the shed directories, TOP/{typ}/{name}
+    :rtype: list
+    """
+    column = 'basinName' if typ == 'watersheds' else 'WSDG_NAME'
+    sheds = sheds.rename(columns={'name': column})
+    shed_dirs = []
+    for i in range(len(sheds)):
+        shed = sheds.iloc[[i]]
+        name = '_'.join(shed[column].iloc[0].replace('.', '').split(' '))
+        shp_dir = os.path.join(top, typ, name, 'shape', 'EPSG4326')
+        os.makedirs(shp_dir, exist_ok=True)
+        shed.to_file(os.path.join(shp_dir, f'{name}.shp'))
+        shed_dirs.append(os.path.join(top, typ, name))
+    os.makedirs(os.path.join(aoi_dir, typ), exist_ok=True)
+    sheds.to_file(os.path.join(aoi_dir, typ, f'{typ}.shp'))
+    return shed_dirs
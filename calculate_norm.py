@@ -15,6 +15,8 @@ from glob import glob
 import admin.constants as const
 
 from analysis.support import date_fmt
+from admin.raster_encoding import encode_normal_dataarray
+from admin.raster_io import write_dataarray
 
 logger = ('snow_mapping')
 
@@ -135,7 +137,7 @@ def _seasonal_norm(rng: int, sat: str):
         os.makedirs(os.path.dirname(out_pth))
     except Exception as e:
         logger.debug(e)
-    mnth.rio.to_raster(out_pth)
+    write_dataarray(encode_normal_dataarray(mnth), out_pth)
         
 @click.command()
 @click.option('--rng', type=click.Choice(['10','20']))
@@ -167,7 +169,8 @@ def _daily_norm(rng: int, sat: str):
             ds[src] = read_lazy(pth)
         el = os.path.split(mosaics[0])[-1].split('.')[:-1]
         day = ds.to_array(dim='mean').mean(dim='mean', skipna=True)
-        day.rio.to_raster(os.path.join(base,f'{el[1]}.{el[2]}.tif'))
+        day = encode_normal_dataarray(day)
+        write_dataarray(day, os.path.join(base,f'{el[1]}.{el[2]}.tif'))
 
 @click.command()
 def build_dirs():
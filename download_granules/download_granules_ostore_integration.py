@@ -25,6 +25,8 @@ import requests
 
 import admin.constants as const
 
+from admin import metrics
+
 import NRUtil.NRObjStoreUtil
 
 LOGGER = logging.getLogger(__name__)
@@ -323,7 +325,7 @@ class CMRClientOStore(CMRClient):
 
     def __init__(self, earthdata_user, earthdata_pass):
         CMRClient.__init__(self, earthdata_user="", earthdata_pass="")
-        self.ostore = NRUtil.NRObjStoreUtil.ObjectStoreUtil()
+        self.ostore = metrics.instrument_ostore(NRUtil.NRObjStoreUtil.ObjectStoreUtil())
         self.ostore_cache = DirCache()
 
     def get_ostore_file_list(self, ostore_directory):
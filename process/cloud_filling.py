@@ -1,6 +1,24 @@
+"""
+Cloud filling of the daily MODIS mosaics: every pixel without a valid value
+(> 100) takes the value of the most recent day it was observed.
+
+CloudFillEngine keeps the running cloud filled raster in memory from one day
+to the next instead of downloading the raster it has just written, prefetches
+the upcoming daily composites in background threads while the current day is
+merged, and writes / uploads each day asynchronously.  The outputs have a
+second band with the age of every pixel in days (0 when observed that day,
+FILL_AGE_NODATA when it has never been observed).
+
+Run as a script (python -m process.cloud_filling) it fills from the most
+recent cloud filled raster in object storage to the most recent composite.
+"""
+
 from datetime import datetime, timedelta
+from collections import deque
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+import logging
 import os
-import NRUtil.NRObjStoreUtil as NRObjStoreUtil
 
 import rasterio as rio
 import rioxarray as rioxr
@@ -10,6 +28,10 @@ import pandas as pd
 
 import dotenv
 
+from admin.raster_io import write_raster
+
+LOGGER = logging.getLogger(__name__)
+
 envPath = '.env'
 if os.path.exists(envPath):
     print("loading dot env...")
@@ -29,21 +51,66 @@ def cloud_fill_mosaic(sat: str, typ: str, startdate: str, date_list=None):
     else: # @click will make sure this else is never hit
         return
 
-def get_image(dt, path):
+mosaic_path = 'norm/mosaics/modis/%Y'
+new_mosaic_path = 'snowpack_archive/intermediate_tif/modis/%Y.%m.%d'
+cloud_filled_path = 'snowpack_archive/cloud_filled'
+mosaic_fname = '%Y.%m.%d.tif'
+mosaic_objpath = os.path.join(mosaic_path,mosaic_fname)
+cloud_filled_objpath = os.path.join(cloud_filled_path,'%Y',mosaic_fname)
+
+# the composites in new_mosaic_path replace the norm mosaics from this date
+composite_start = datetime(2023,1,23)
+
+# fill age band, saturates at FILL_AGE_MAX days
+FILL_AGE_MAX = 254
+FILL_AGE_NODATA = 255
+FILL_AGE_BAND = 2
+
+
+def get_image(ostore, dt, path, bands=1):
+    """downloads (if not already local) and reads a raster
+
+    :param ostore: object store client (NRObjStoreUtil.ObjectStoreUtil)
+    :param dt: date the path is formatted with
+    :type dt: datetime
+    :param path: object path, strftime codes are filled in with dt
+    :type path: str
+    :param bands: bands to read, defaults to 1
+    :type bands: int | list, optional
+    :return: the data and the meta of the raster, None, None if it could not
+        be read
+    :rtype: tuple
+    """
     file_path = dt.strftime(path)
     try:
         if not os.path.isfile(file_path):
             ostore.get_object(local_path=file_path, file_path=file_path)
-            print(f'Retrieving {file_path}')
+            LOGGER.info(f'Retrieving {file_path}')
         with rio.open(file_path, "r") as src:
             meta = src.meta.copy()
-            data = src.read(1)
-    except:
-            meta = None
-            data = None
+            if isinstance(bands, list):
+                bands = [b for b in bands if b <= src.count]
+            data = src.read(bands)
+    except Exception as e:
+        LOGGER.debug(f'could not read {file_path}: {e}')
+        meta = None
+        data = None
     return data, meta
 
-def find_most_recent_image(obj_dirpath, obj_fpath, dt):
+
+def find_most_recent_image(ostore, obj_dirpath, obj_fpath, dt):
+    """most recent date, on or before dt, with an object named obj_fpath
+
+    :param ostore: object store client
+    :param obj_dirpath: directory to list, strftime codes are filled in with dt
+    :type obj_dirpath: str
+    :param obj_fpath: object path, strftime codes are filled in with the date
+    :type obj_fpath: str
+    :param dt: date to start looking back from
+    :type dt: datetime
+    :return: the date of the most recent object
+    :rtype: datetime
+    """
     olist = ostore.list_objects(dt.strftime(obj_dirpath),return_file_names_only=True)
     fname = dt.strftime(obj_fpath)
     while not any(fname in s for s in olist):
@@ -51,53 +118,205 @@ def find_most_recent_image(obj_dirpath, obj_fpath, dt):
         fname = dt.strftime(obj_fpath)
     return dt
 
-#date = '2000/02/24'
-#dt = datetime.strptime(date,'%Y/%m/%d')
-#datelist = pd.date_range(datetime.strptime(date,'%Y/%m/%d'), periods=365).tolist()
-#dt_prev = dt - datetime.timedelta(days=1)
 
-ostore = NRObjStoreUtil.ObjectStoreUtil()
-mosaic_path = 'norm/mosaics/modis/%Y'
-new_mosaic_path = 'snowpack_archive/intermediate_tif/modis/%Y.%m.%d'
-cloud_filled_path = 'snowpack_archive/cloud_filled'
-mosaic_fname = '%Y.%m.%d.tif'
-mosaic_objpath = os.path.join(mosaic_path,mosaic_fname)
-cloud_filled_objpath = os.path.join(cloud_filled_path,'%Y',mosaic_fname)
+def index_composites(ostore):
+    """lists the daily composites once, instead of once per day
 
-today = datetime.today()
-startdate = find_most_recent_image(cloud_filled_path,cloud_filled_objpath,dt = today)
-enddate = find_most_recent_image(os.path.dirname(new_mosaic_path),new_mosaic_path,dt = today)
-datelist = pd.date_range(startdate, enddate).tolist()
-
-
-for dt in datelist:
-    if dt < datetime(2023,1,23):
-    #if dt > datetime(2022,6,14):
-        data, meta = get_image(dt, mosaic_objpath)
-    else:
-        olist = ostore.list_objects(dt.strftime(new_mosaic_path),return_file_names_only=True)
-        matching = [s for s in olist if "modis_composite" in s]
-        if len(matching)>0:
-            data, meta = get_image(dt, matching[0])
+    :param ostore: object store client
+    :return: object path of the modis composite of each date, keyed by the
+        date in the format YYYY.MM.DD
+    :rtype: dict
+    """
+    composites = {}
+    for obj in ostore.list_objects(os.path.dirname(new_mosaic_path), return_file_names_only=True):
+        parts = obj.split('/')
+        if len(parts) > 1 and 'modis_composite' in parts[-1]:
+            composites.setdefault(parts[-2], obj)
+    LOGGER.debug(f'{len(composites)} daily composites')
+    return composites
+
+
+def age_fill(age, observed):
+    """ages the fill age band by a day
+
+    :param age: fill age of the running raster
+    :type age: np.ndarray
+    :param observed: mask of the pixels observed that day
+    :type observed: np.ndarray
+    :return: the new fill age
+    :rtype: np.ndarray
+    """
+    aged = np.minimum(age.astype('uint16') + 1, FILL_AGE_MAX).astype('uint8')
+    aged[age == FILL_AGE_NODATA] = FILL_AGE_NODATA
+    aged[observed] = 0
+    return aged
+
+
+class CloudFillEngine:
+    """fills a range of days keeping the running cloud filled raster in memory
+
+    :param ostore: object store client (NRObjStoreUtil.ObjectStoreUtil), the
+        client has to be thread safe
+    :param prefetch: number of daily composites downloaded ahead, defaults to 3
+    :type prefetch: int, optional
+    :param upload_workers: number of days written / uploaded at once,
+        defaults to 2
+    :type upload_workers: int, optional
+    """
+
+    def __init__(self, ostore, prefetch: int = 3, upload_workers: int = 2):
+        self.ostore = ostore
+        self.prefetch = prefetch
+        self.upload_workers = upload_workers
+        self.composites = None
+        self.data = None
+        self.age = None
+        self.meta = None
+
+    def get_composites(self):
+        """object paths of the daily composites, listed on first use
+        """
+        if self.composites is None:
+            self.composites = index_composites(self.ostore)
+        return self.composites
+
+    def load_daily(self, dt):
+        """downloads and reads the daily mosaic / composite of a date
+
+        :param dt: the date
+        :type dt: datetime
+        :return: the data and the meta, None, None if there is no imagery
+        :rtype: tuple
+        """
+        if dt < composite_start:
+            return get_image(self.ostore, dt, mosaic_objpath)
+        objpath = self.get_composites().get(dt.strftime('%Y.%m.%d'))
+        if objpath is None:
+            return None, None
+        return get_image(self.ostore, dt, objpath)
+
+    def seed(self, dt):
+        """loads the cloud filled raster of the day before dt as the running
+        raster.  Rasters written before the fill age band existed are taken as
+        observed that day
+
+        :param dt: first date that will be filled
+        :type dt: datetime
+        """
+        data, meta = get_image(self.ostore, dt - timedelta(days=1), cloud_filled_objpath,
+                               bands=[1, FILL_AGE_BAND])
+        if data is None:
+            LOGGER.info(f'no cloud filled raster before {dt:%Y.%m.%d}, starting empty')
+            return
+        self.data = data[0]
+        if data.shape[0] > 1:
+            self.age = data[1].astype('uint8')
         else:
-            data = None
-    data_prevday, meta_prevday = get_image(dt - timedelta(days=1), cloud_filled_objpath)
-    if data_prevday is not None:
+            self.age = np.where(self.data <= 100, 0, FILL_AGE_NODATA).astype('uint8')
+        self.meta = meta
+
+    def merge(self, data, meta):
+        """merges a day into the running raster, the pixels without a valid
+        value (> 100) keep the running value
+
+        :param data: daily mosaic, None if there is no imagery for the day
+        :type data: np.ndarray
+        :param meta: meta of the daily mosaic
+        :type meta: dict
+        """
         if data is None:
-            data = data_prevday
-            meta = meta_prevday
+            if self.data is not None:
+                self.age = age_fill(self.age, np.zeros(self.age.shape, dtype=bool))
+            return
+        observed = data <= 100
+        if self.data is None or self.data.shape != data.shape:
+            if self.data is not None:
+                LOGGER.warning(f'mosaic shape changed {self.data.shape} -> {data.shape}, restarting the fill')
+            self.data = data
+            self.age = np.where(observed, 0, FILL_AGE_NODATA).astype('uint8')
         else:
-            nodata_mask = data>100
-            data[nodata_mask]=data_prevday[nodata_mask]
+            self.data = np.where(observed, data, self.data)
+            self.age = age_fill(self.age, observed)
+        self.meta = meta
 
-    if data is None:
-        print(f'No imagery available')
-    else:
+    def save(self, dt, data, age, meta):
+        """writes the cloud filled raster of a day and uploads it
+
+        :param dt: the date
+        :type dt: datetime
+        :param data: cloud filled data
+        :type data: np.ndarray
+        :param age: fill age
+        :type age: np.ndarray
+        :param meta: meta of the raster
+        :type meta: dict
+        :return: path of the raster
+        :rtype: str
+        """
         out_path = dt.strftime(cloud_filled_objpath)
-        if not os.path.isdir(dt.strftime(cloud_filled_path)):
-            os.makedirs(dt.strftime(cloud_filled_path))
+        write_raster(out_path, np.stack([data, age.astype(data.dtype)]), meta,
+                     tags={'FILL_AGE_BAND': str(FILL_AGE_BAND)})
+        self.ostore.put_object(ostore_path=out_path, local_path=out_path)
+        LOGGER.info(f'Saving to {out_path}')
+        return out_path
+
+    def run(self, datelist):
+        """fills the dates in order
+
+        :param datelist: consecutive dates to fill
+        :type datelist: list[datetime]
+        :return: paths of the rasters that were written
+        :rtype: list[str]
+        """
+        if not datelist:
+            return []
+        if self.data is None:
+            self.seed(datelist[0])
+        written = []
+        dates = iter(datelist)
+        pending = deque()
+        uploads = deque()
+        with ThreadPool(self.prefetch) as fetch_pool, ThreadPool(self.upload_workers) as upload_pool:
+            for dt in islice(dates, self.prefetch):
+                pending.append((dt, fetch_pool.apply_async(self.load_daily, (dt,))))
+            while pending:
+                dt, result = pending.popleft()
+                nxt = next(dates, None)
+                if nxt is not None:
+                    pending.append((nxt, fetch_pool.apply_async(self.load_daily, (nxt,))))
+                data, meta = result.get()
+                self.merge(data, meta)
+                if self.data is None:
+                    LOGGER.info(f'No imagery available for {dt:%Y.%m.%d}')
+                    continue
+                # merge replaces the running arrays, the ones handed over are not modified
+                uploads.append(upload_pool.apply_async(
+                    self.save, (dt, self.data, self.age, self.meta)))
+                # bound the number of days waiting to be written
+                while len(uploads) > 2 * self.upload_workers:
+                    written.append(uploads.popleft().get())
+            while uploads:
+                written.append(uploads.popleft().get())
+        return written
+
+
+def main():
+    import NRUtil.NRObjStoreUtil as NRObjStoreUtil
+
+    ostore = NRObjStoreUtil.ObjectStoreUtil()
+    engine = CloudFillEngine(ostore)
+
+    today = datetime.today()
+    startdate = find_most_recent_image(ostore, cloud_filled_path, cloud_filled_objpath, dt = today)
+    composites = [
+        datetime.strptime(d, '%Y.%m.%d') for d in engine.get_composites()
+        if datetime.strptime(d, '%Y.%m.%d') <= today
+    ]
+    enddate = max(composites)
+    datelist = pd.date_range(startdate, enddate).tolist()
+    engine.run(datelist)
+
 
-        with rio.open(out_path, "w", **meta) as dst:
-            dst.write(data, indexes=1)
-        ostore.put_object(ostore_path=out_path, local_path=out_path)
-        print(f'Saving to {out_path}')
\ No newline at end of file
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -2,17 +2,19 @@ import os
 import warnings
 import logging
 
+import numpy as np
 import rasterio as rio
 import datetime
 
 import admin.constants as const
 
 from process.support import process_by_watershed_or_basin
-from admin.color_ramp import color_ramp
+from admin.color_ramp import snow_colormap
+from admin.raster_io import write_raster
+from admin import datacube, manifest, metrics, worker_pool
 import admin.object_store_util
 
 # from osgeo import gdal
-import multiprocessing
 from glob import glob
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from rasterio.merge import merge
@@ -22,7 +24,11 @@ import admin.snow_path_lib
 
 LOGGER = logging.getLogger(__name__)
 snow_path = admin.snow_path_lib.SnowPathLib()
-ostore_util = admin.object_store_util.OStore()
+ostore_util = admin.object_store_util.get_ostore()
+
+# the modules the outputs of the steps are made with, part of their
+# fingerprints (see admin/manifest.py)
+CODE = [__name__, "admin.raster_io"]
 
 
 # Suppress warning for GCP/RPC - inquiry does not affect workflow
@@ -58,11 +64,16 @@ def reproject_modis(date: str, name: str, pth: str, dst_crs: str):
     )
     LOGGER.debug(f"intermediate_tif: {intermediate_tif}")
     LOGGER.debug(f"pth: {pth}")
-    if not os.path.exists(intermediate_tif):
+    fingerprint = manifest.fingerprint(
+        "reproject_modis", [pth], {"dst_crs": dst_crs, "res": const.MODIS_EPSG4326_RES}, CODE)
+    if not manifest.is_current(intermediate_tif, fingerprint):
         try:
             LOGGER.debug(f"processing the modis granule: {pth_file_noext}")
             with rio.open(pth, "r") as modis_scene:
-                with rio.open(modis_scene.subdatasets[0], "r") as src:
+                # HDF4 granules hold the snow cover as the first subdataset,
+                # a granule already converted to a single band raster is read as is
+                snow_cover = modis_scene.subdatasets[0] if modis_scene.subdatasets else pth
+                with rio.open(snow_cover, "r") as src:
                     # transform raster to dst_crs------
                     transform, width, height = calculate_default_transform(
                         src.crs,
@@ -82,17 +93,21 @@ def reproject_modis(date: str, name: str, pth: str, dst_crs: str):
                             "height": height,
                         }
                     )
+                    reprojected = np.zeros((height, width), dtype=src.dtypes[0])
+                    if src.nodata is not None:
+                        reprojected[:] = src.nodata
+                    reproject(
+                        source=rio.band(src, 1),
+                        destination=reprojected,
+                        src_transform=src.transform,
+                        src_crs=src.crs,
+                        dst_transform=transform,
+                        dst_crs=dst_crs,
+                        resampling=Resampling.nearest,
+                    )
                     # Write reprojected granule into GTiff format
-                    with rio.open(intermediate_tif, "w", **kwargs) as dst:
-                        reproject(
-                            source=rio.band(src, 1),
-                            destination=rio.band(dst, 1),
-                            src_transform=src.transform,
-                            src_crs=src.crs,
-                            dst_transform=transform,
-                            dst_crs=dst_crs,
-                            resampling=Resampling.nearest,
-                        )
+                    write_raster(intermediate_tif, reprojected, kwargs)
+                    manifest.record(intermediate_tif, fingerprint, "reproject_modis")
                     # -------------------------------------
         except:
             LOGGER.debug(f"Reprojection failure: {pth_file_noext}")
@@ -120,7 +135,10 @@ def create_modis_mosaic(
     #           './data/intermediate_tif/modis/2023.03.21/modis_composite_2023.03.21_2023.03.20_2023.03.19_2023.03.18_2023.03.17.tif'
     #
     # output_mosaic_tif = snow_path.get_output_modis_path(date)
-    if not os.path.exists(output_mosaic_tif):
+    fingerprint = manifest.fingerprint(
+        "create_modis_mosaic", sorted(tifs_to_mosaic),
+        {"bbox": const.BBOX, "res": const.MODIS_EPSG4326_RES}, CODE)
+    if not manifest.is_current(output_mosaic_tif, fingerprint):
         LOGGER.debug(f"example of single file to mosaic: {tifs_to_mosaic[0]}")
         if tifs_to_mosaic:
             src_files_to_mosaic = []
@@ -162,8 +180,8 @@ def create_modis_mosaic(
                 except Exception as e:
                     LOGGER.debug(e)
                 LOGGER.debug(f"creating: {output_mosaic_tif}")
-                with rio.open(output_mosaic_tif, "w", **out_meta) as dst:
-                    dst.write(mosaic)
+                write_raster(output_mosaic_tif, mosaic, out_meta)
+                manifest.record(output_mosaic_tif, fingerprint, "create_modis_mosaic")
                 # Close all open tiffs that were mosaic'ed
                 for f in src_files_to_mosaic:
                     f.close()
@@ -182,18 +200,18 @@ def composite_mosaics(startdate: str, dates: list, out_pth: str):
     # TODO: rework so inputs and outputs are fed as args
     LOGGER.debug(f"startdate: {startdate}")
     base = snow_path.get_modis_int_tif_dir(date=startdate)
-    if not os.path.exists(base):
-        os.makedirs(base)
-        LOGGER.debug(f"created the directory {base}")
-    if not os.path.exists(out_pth):
+    os.makedirs(base, exist_ok=True)
+    mosaics = []
+    for date in dates:
+        # tif_by_date = os.path.join(const.OUTPUT_TIF_MODIS, startdate.split(".")[0],
+        #                f"{date}.tif")
+        tif_by_date = snow_path.get_output_modis_path(date=date)
+        if os.path.isfile(tif_by_date):
+            mosaics.append(tif_by_date)
+    # the order of the mosaics matters, the first one wins
+    fingerprint = manifest.fingerprint("composite_mosaics", mosaics, code=CODE + ["admin.color_ramp"])
+    if not manifest.is_current(out_pth, fingerprint):
         LOGGER.debug(f"out_pth: {out_pth}")
-        mosaics = []
-        for date in dates:
-            # tif_by_date = os.path.join(const.OUTPUT_TIF_MODIS, startdate.split(".")[0],
-            #                f"{date}.tif")
-            tif_by_date = snow_path.get_output_modis_path(date=date)
-            if os.path.isfile(tif_by_date):
-                mosaics.append(tif_by_date)
         with rio.open(mosaics[0], "r") as src:
             meta = src.meta.copy()
             data = src.read(1)
@@ -206,14 +224,14 @@ def composite_mosaics(startdate: str, dates: list, out_pth: str):
                     except Exception as e:
                         LOGGER.error(e)
                         continue
-            with rio.open(out_pth, "w", **meta) as dst:
-                dst.write(data, indexes=1)
+        # colour ramp is set when the composite is written
+        write_raster(out_pth, data, meta, colormap=snow_colormap())
+        manifest.record(out_pth, fingerprint, "composite_mosaics")
 
 
 def distribute(func, args):
-    # Multiprocessing support to manage Pool scope
-    with multiprocessing.Pool(6) as p:
-        p.starmap(func, args)
+    # the worker processes are shared by all the stages, see admin/worker_pool.py
+    worker_pool.starmap(func, args)
 
 
 def get_datespan(date: str, days: int) -> List[str]:
@@ -265,83 +283,126 @@ def process_modis(startdate, days):
         before clipping to watersheds/basins. days = 5 or days = 8 only.
     """
     LOGGER.info("MODIS Process Started")
-    # bc_albers = "EPSG:3153"
-    dst_crs = "EPSG:4326"
-
     dates = get_datespan(startdate, days)
 
-    # pull the date composite output if it exists
-    pull_date_composite(datestr_list=dates, start_date=startdate)
-
-    # pull watershed and basin processed data if exists
-    pull_watershed_basin_data(
-        start_date=startdate,
-        sat='modis',
-        wat_basin='watersheds',
-        process_async=True)
-    pull_watershed_basin_data(
-        start_date=startdate,
-        sat='modis',
-        wat_basin='basins',
-        process_async=True)
-
     # this function recieves a start date and a days arg.
     # the days tell it how many days back to process.
     #
     # iterates over each day creating a composite tif that combines all
     # the granules for that day.
-
     for date in dates:
-        # for each date will:
-        #  - create reprojected tif to EPSG:4326 in
-        #      the intermediate tif directory for each granule
-        #  - then mosaics all the granules together into
-
-        # intTif = os.path.join(const.INTERMEDIATE_TIF_MODIS, date)
-        # intTif is the local path for the intermediate tif directory
-        int_tif_dir = snow_path.get_modis_int_tif_dir(date)
-        LOGGER.debug(f"intTif: {int_tif_dir}")
-        if not os.path.exists(int_tif_dir):
-            os.makedirs(int_tif_dir)
-            LOGGER.debug(f"created folder: {int_tif_dir}")
-        # modis_granules = glob(os.path.join(pth, date,'*.hdf'))
-        # gets the granules from what exists locally after the download step
-        modis_granules = snow_path.get_modis_granules(date)
-        # why delete these files?  why not pick up where left off?
-        # commenting out, no need to delete
-        # clean_intermediate(date)
-
-        LOGGER.info(f"REPROJ GRANULES: {date}")
-        reproj_args = []
-        for gran in modis_granules:
-            try:
-                # name = os.path.split(gran)[-1]
-                name = os.path.basename(gran)
-                reproj_args.append((date, name, gran, dst_crs))
-            except Exception as e:
-                LOGGER.error(f"Could not append {gran} : {e}")
-                continue
-
-        # if the data already exists in ostore then pull it from there
+        mosaic_modis(date)
+
+    # keep the datacube in sync with the daily mosaics
+    datacube.sync_mosaics('modis', {date: snow_path.get_output_modis_path(date) for date in dates})
+
+    composite_modis(startdate, days)
+
+
+def mosaic_modis(date: str) -> str:
+    """
+    Reprojects the granules of a day to EPSG:4326 and mosaics them, the
+    daily mosaics are shared by the composites of all the windows the day
+    is in
+
+    Parameters
+    ----------
+    date : str
+        Date of the granules
+
+    Returns
+    ----------
+    str
+        Path to the daily mosaic
+    """
+    dst_crs = "EPSG:4326"
+    # for each date will:
+    #  - create reprojected tif to EPSG:4326 in
+    #      the intermediate tif directory for each granule
+    #  - then mosaics all the granules together into
+
+    # intTif = os.path.join(const.INTERMEDIATE_TIF_MODIS, date)
+    # intTif is the local path for the intermediate tif directory
+    int_tif_dir = snow_path.get_modis_int_tif_dir(date)
+    LOGGER.debug(f"intTif: {int_tif_dir}")
+    if not os.path.exists(int_tif_dir):
+        os.makedirs(int_tif_dir, exist_ok=True)
+        LOGGER.debug(f"created folder: {int_tif_dir}")
+    # modis_granules = glob(os.path.join(pth, date,'*.hdf'))
+    # gets the granules from what exists locally after the download step
+    modis_granules = snow_path.get_modis_granules(date)
+    # why delete these files?  why not pick up where left off?
+    # commenting out, no need to delete
+    # clean_intermediate(date)
+
+    LOGGER.info(f"REPROJ GRANULES: {date}")
+    reproj_args = []
+    for gran in modis_granules:
+        try:
+            # name = os.path.split(gran)[-1]
+            name = os.path.basename(gran)
+            reproj_args.append((date, name, gran, dst_crs))
+        except Exception as e:
+            LOGGER.error(f"Could not append {gran} : {e}")
+            continue
+
+    # if the data already exists in ostore then pull it from there
+    with metrics.stage("pull_modis_data", sat="modis", date=date):
         pull_modis_data(reproj_args)
 
-        LOGGER.debug("doing reprojections to EPSG:4326")
+    LOGGER.debug("doing reprojections to EPSG:4326")
 
-        # DEBUGGING... does same as distribute call but in sync.  useful for debugging
-        #              Comment out for prod
-        # for args in reproj_args:
-        #     reproject_modis(*args)
+    # DEBUGGING... does same as distribute call but in sync.  useful for debugging
+    #              Comment out for prod
+    # for args in reproj_args:
+    #     reproject_modis(*args)
+    with metrics.stage("reproject", sat="modis", date=date):
         distribute(reproject_modis, reproj_args)
 
-        LOGGER.info(f"CREATING MOSAICS: {date}")
-        # os.path.join(const.INTERMEDIATE_TIF_MODIS,date)
-        # creates the mosaic files:
-        # ./data/norm/mosaics/modis/2023/<processing date>
-        # example
-        # ./data/norm/mosaics/modis/2023/2023.03.22.tif
-        output_mosaic_tif = snow_path.get_output_modis_path(date)
-        files_to_mosaic = snow_path.get_modis_intermediate_tifs(date)
+    LOGGER.info(f"CREATING MOSAICS: {date}")
+    # os.path.join(const.INTERMEDIATE_TIF_MODIS,date)
+    # creates the mosaic files:
+    # ./data/norm/mosaics/modis/2023/<processing date>
+    # example
+    # ./data/norm/mosaics/modis/2023/2023.03.22.tif
+    output_mosaic_tif = snow_path.get_output_modis_path(date)
+    files_to_mosaic = snow_path.get_modis_intermediate_tifs(date)
+    with metrics.stage("mosaic", sat="modis", date=date):
         create_modis_mosaic(int_tif_dir, output_mosaic_tif, files_to_mosaic)
+    return output_mosaic_tif
+
+
+def composite_modis(startdate: str, days: int):
+    """
+    Composes the daily mosaics of the window ending on startdate and clips
+    the composite to the watersheds/basins, the daily mosaics have to exist
+    (mosaic_modis). Only reads the shared daily mosaics and writes below the
+    paths of startdate (intermediate_tif/modis/<startdate>,
+    <watersheds|basins>/<name>/modis/<startdate>), through temporary files
+    (admin/raster_io.py), so the composites of consecutive dates can run at
+    the same time (batch_run.py)
+
+    Parameters
+    ----------
+    startdate : str
+        Last date of the window
+    days : int
+        Number of days in the window, 5 or 8
+    """
+    dates = get_datespan(startdate, days)
+
+    # pull the date composite output if it exists
+    pull_date_composite(datestr_list=dates, start_date=startdate)
+
+    # pull watershed and basin processed data if exists
+    pull_watershed_basin_data(
+        start_date=startdate,
+        sat='modis',
+        wat_basin='watersheds')
+    pull_watershed_basin_data(
+        start_date=startdate,
+        sat='modis',
+        wat_basin='basins')
 
     LOGGER.info("COMPOSING MOSAICS INTO ONE TIF")
     # creates:
@@ -349,8 +410,8 @@ def process_modis(startdate, days):
     composite_mosaic_path = snow_path.get_modis_composite_mosaic_file_name(
         start_date=startdate, date_list=dates
     )
-    composite_mosaics(startdate, dates, composite_mosaic_path)
-    color_ramp(composite_mosaic_path)  # just adds the color ramp to the output file
+    with metrics.stage("composite", sat="modis", date=startdate):
+        composite_mosaics(startdate, dates, composite_mosaic_path)
 
     # creates the watershed/basin clipped versions of the composite mosaic
     # in both EPSG4326 and EPSG3153
@@ -358,12 +419,13 @@ def process_modis(startdate, days):
         LOGGER.info(f"CREATING {task.upper()}")
         # pull the 10y 20y data from object storage
         # send the dates along
-        process_by_watershed_or_basin("modis", task, startdate, dates)
+        with metrics.stage("clip", sat="modis", typ=task, date=startdate):
+            process_by_watershed_or_basin("modis", task, startdate, dates)
 
-def pull_modis_epsg4326(local_file_list, process_async=False):
+def pull_modis_epsg4326(local_file_list):
     """checks to see if the output files associated with the reproject step exist in
     object storage and if so then pulls those files from object storage vs. reprocessing
-    them.
+    them.  The files are pulled concurrently by the transfer engine (admin/transfer.py)
 
     :param local_file_list: list of the original source files that were downloaded from
         snow and ice data center.
@@ -371,10 +433,7 @@ def pull_modis_epsg4326(local_file_list, process_async=False):
         example path: './data/modis-terra/MOD10A1.061/2023.03.24/MOD10A1.A2023083.h09v03.061.2023085030249.hdf'
     :type local_file_list: list of files that should be created by the process/reproject
         step.
-    :param process_async: indicates whether to process as syncronous or async process
-    :type process_async: boolean
     """
-    ostore_dir_file_cache = {}  # a dictionary to cache list queries
     arg_list = []
 
     for local_file in local_file_list:
@@ -384,24 +443,10 @@ def pull_modis_epsg4326(local_file_list, process_async=False):
             input_source_path=local_file, date_str=date_str
         )
         arg_list.append(modis_reproj_file)
-    if process_async:
-        LOGGER.debug("args")
-        with multiprocessing.pool.ThreadPool(6) as p:
-            p.map(ostore_util.get_file_if_exists, arg_list)
-
-    else:
-        for arg in arg_list:
-            ostore_util.get_file_if_exists(arg)
-
-
-        # if not os.path.exists(modis_reproj_file):
-        #     if ostore_util.ostore_file_exists(local_path=modis_reproj_file):
-        #         # file is in ostore so pull it
-        #         LOGGER.debug(f"pulling {local_file} from ostore")
-        #         ostore_util.get_file(local_file)
+    ostore_util.get_files_if_exist(arg_list)
 
 
-def pull_mosaics(datestr_list, process_async=True):
+def pull_mosaics(datestr_list):
     """gets list of date strings, calculates the path that coresponsds with the mosaics
     for those dates, checks to see if they exist locally, and if they do not then looks
     to object storage bucket to get them.
@@ -413,17 +458,9 @@ def pull_mosaics(datestr_list, process_async=True):
     arg_list = []
 
     for date in datestr_list:
-        mosaic_dir = snow_path.get_mosaic_dir(sat="modis", date=date)
         mosaic_file = snow_path.get_mosaic_file(sat="modis", date=date)
-        # TODO get the object store path, test to see if file is in object store, if
-        # yes then pull it
         arg_list.append(mosaic_file)
-    if process_async:
-        with multiprocessing.pool.ThreadPool(6) as p:
-            p.map(ostore_util.get_file_if_exists, arg_list)
-    else:
-        for arg in arg_list:
-            ostore_util.get_file_if_exists(arg)
+    ostore_util.get_files_if_exist(arg_list)
 
 
 def pull_date_composite(datestr_list, start_date: str):
@@ -443,7 +480,7 @@ def pull_date_composite(datestr_list, start_date: str):
             ostore_util.get_file(composite_mosaic_path)
 
 
-def pull_watershed_basin_data(start_date, sat, wat_basin, process_async=False):
+def pull_watershed_basin_data(start_date, sat, wat_basin):
     # data/watersheds/Stikine/modis/2023.03.23/Stikine_modis_2023.03.23_EPSG4326.tif
     # data/watersheds/Northwest/modis/2023.03.23/Northwest_modis_2023.03.23_EPSG4326.tif'
     # TODO: find references to the string EPSG:4326 and EPSG:3153 and replace with a
@@ -460,20 +497,15 @@ def pull_watershed_basin_data(start_date, sat, wat_basin, process_async=False):
                 projection=projection
             )
             arg_list.append(local_path)
-    if process_async:
-        with multiprocessing.pool.ThreadPool(6) as p:
-            p.map(ostore_util.get_file_if_exists, arg_list)
-    else:
-        for arg in arg_list:
-            ostore_util.get_file_if_exists(arg)
+    ostore_util.get_files_if_exist(arg_list)
 
 def pull_modis_data(reproj_args):
     # pulling the files that generated by the reprojection step
     local_files = [arg[2] for arg in reproj_args]
-    pull_modis_epsg4326(local_files, process_async=True)
+    pull_modis_epsg4326(local_files)
 
     # pulling the mosaics of all the granules
     dates = list(set([arg[0] for arg in reproj_args]))
-    pull_mosaics(dates, process_async=False)
+    pull_mosaics(dates)
 
 
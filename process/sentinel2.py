@@ -4,6 +4,7 @@ import logging
 import datetime
 import platform
 import shutil
+import threading
 import simplekml
 
 import rasterio.plot
@@ -12,15 +13,20 @@ import rasterio as rio
 import numpy as np
 import matplotlib.pyplot as plt
 
+from contextlib import ExitStack
+from matplotlib.figure import Figure
 from shapely.geometry import Point
 from rasterio.warp import calculate_default_transform, reproject, Resampling
-from sentinelsat import SentinelAPI
+from rasterio.windows import Window
 from glob import glob
+from multiprocessing.pool import ThreadPool
 from zipfile import ZipFile
 
 from admin.db_handler import DBHandler
 import admin.constants as const
-from admin.color_ramp import s2_color_ramp
+from admin.color_ramp import s2_color_ramp, s2_colormap
+from admin.kml_tiles import build_superoverlay, expand_palette
+from admin.raster_io import get_cog_options, write_raster
 
 """
 S2 NDSI : https://sentinel.esa.int/web/sentinel/technical-guides/sentinel-2-msi/level-2a/algorithm
@@ -36,14 +42,42 @@ nodata_val = 254
 
 logger = logging.getLogger(__name__)
 
-def query(creds: str, udate: str, lat: float, lng: float, 
-            max_allowable_cloud: int, day_tolerance: int = 50):
-    """Query ESA Servers for Sentinel-2 L2A data
+def get_api(creds: str):
+    """Connect to the ESA Copernicus hub
 
     Parameters
     ----------
     creds : str
         Path to credential YAML file
+
+    Returns
+    -------
+    SentinelAPI
+        API interface used to query and download products
+    """
+    from sentinelsat import SentinelAPI
+
+    # Get credentials
+    with open(creds, 'r') as envvars:
+        secrets = yaml.load(envvars, Loader=yaml.FullLoader)
+
+    # Validate credentials for API access
+    return SentinelAPI(
+        secrets['SENTINELSAT_USER'],
+        secrets['SENTINELSAT_PASS'],
+        'https://scihub.copernicus.eu/apihub', #'https://scihub.copernicus.eu/dhus',
+        show_progressbars=True
+    )
+
+def query_products(api, udate: str, lat: float, lng: float,
+                   max_allowable_cloud: int, day_tolerance: int = 50):
+    """Query the catalogue for the Sentinel-2 L2A products over a point
+
+    Parameters
+    ----------
+    api : API interface
+        SentinelAPI, or any object with the same query() and download()
+        methods (ie a local stand-in)
     udate : str
         Target date in format YYYY.MM.DD
     lat : float
@@ -57,35 +91,12 @@ def query(creds: str, udate: str, lat: float, lng: float,
 
     Returns
     -------
-    ok : int
-        If the query returned more than 0 products, return 1, else return 0 and 
-        the rest of the pipeline will be skipped in favour of refining parameters
-    product : str
-        Product key to be passed to to download function
-    api : API interface
-        API interface that download() will use to get product
-    date : str
-        Date of selected tile as it may differ from target date
+    OrderedDict
+        Product metadata keyed by product id, most recent first
     """
     aoi = Point((lng, lat)) # WKT AOI
-
-    # Get credentials
-    envvars = open(creds ,'r')
-    secrets = yaml.load(envvars, Loader=yaml.FullLoader)
-    envvars.close()
-
-    # Validate credentials for API access
-    api = SentinelAPI(
-        secrets['SENTINELSAT_USER'], 
-        secrets['SENTINELSAT_PASS'], 
-        'https://scihub.copernicus.eu/apihub', #'https://scihub.copernicus.eu/dhus',
-        show_progressbars=True
-    )
-
-    # Query for products
     thisdate = udate.split('.')
     thisdate = datetime.date(int(thisdate[0]), int(thisdate[1]), int(thisdate[2]))
-    products = []
     before = thisdate-datetime.timedelta(days=day_tolerance)
     products = api.query(
                     aoi,
@@ -99,7 +110,58 @@ def query(creds: str, udate: str, lat: float, lng: float,
                     )
     logger.debug(f'PRODUCTS: {products}')
     logger.info(f'LEN PRODUCTS: {len(products)}')
-    
+    return products
+
+def get_product_date(product: dict):
+    """Sensing date of a product
+
+    Parameters
+    ----------
+    product : dict
+        Product metadata returned by query_products
+
+    Returns
+    -------
+    str
+        Date in format YYYY.MM.DD
+    """
+    dt = product['beginposition']
+    return datetime.date(dt.year, dt.month, dt.day).strftime('%Y.%m.%d')
+
+def query(creds: str, udate: str, lat: float, lng: float, 
+            max_allowable_cloud: int, day_tolerance: int = 50):
+    """Query ESA Servers for Sentinel-2 L2A data
+
+    Parameters
+    ----------
+    creds : str
+        Path to credential YAML file
+    udate : str
+        Target date in format YYYY.MM.DD
+    lat : float
+        Target latitude
+    lng : float
+        Target longitude
+    max_allowable_cloud : int
+        Top percentage allowable cloud coverage for a tile
+    day_tolerance : int, optional
+        The numbers of days to query back from the target date, by default 50
+
+    Returns
+    -------
+    ok : int
+        If the query returned more than 0 products, return 1, else return 0 and 
+        the rest of the pipeline will be skipped in favour of refining parameters
+    product : str
+        Product key to be passed to to download function
+    api : API interface
+        API interface that download() will use to get product
+    date : str
+        Date of selected tile as it may differ from target date
+    """
+    api = get_api(creds)
+    products = query_products(api, udate, lat, lng, max_allowable_cloud, day_tolerance)
+
     # User interface to select desired tile from date and cloud coverage
     if len(products) > 0:
         opts = []
@@ -120,10 +182,7 @@ def query(creds: str, udate: str, lat: float, lng: float,
             print(f'Invalid index selected, select an index between 0 and {len(opts)-1}')
             return 0, None, None, udate
         else: # Return user selected product to download
-            dt = products[opts[yn]]['beginposition']
-            d_truncated = datetime.date(dt.year, dt.month, dt.day)
-            date = datetime.datetime.strftime(d_truncated, '%Y.%m.%d')
-            return 1, opts[yn], api, date
+            return 1, opts[yn], api, get_product_date(products[opts[yn]])
     else: # If no products were found with given params
         print('Could not find any granules...')
         print('Try again with a higher cloud-tolerance')
@@ -150,15 +209,15 @@ def build_sentinel_dir_struture():
             logger.debug(f"creating directory: {d}")
             os.makedirs(d)
 
-def download(product: str, api: SentinelAPI, udate: str, lat: float, lng: float, force: str='false'):
+def download(product: str, api, udate: str, lat: float, lng: float, force: str='false'):
     """Download Sentinel-2 tile user selected
 
     Parameters
     ----------
     product : str
         Product key of selceted tile
-    api : SentinelAPI
-        API interface to Sentinel-2 data hub
+    api : API interface
+        API interface to Sentinel-2 data hub, see query_products
     udate : str
         Selected date in format YYYY.MM.DD
     lat : float
@@ -211,6 +270,62 @@ def fixLongWinPath(inPath, force=False):
             inPath = u"\\\\?\\" + inPath
     return inPath
     
+S2_BANDS = ['B02', 'B03', 'B04', 'B8A', 'B11', 'SCL']
+
+def index_safe_zip(gran: str, resolution: str = 'R20m'):
+    """Index the band images of a zipped SAFE product without extracting it
+
+    Parameters
+    ----------
+    gran : str
+        Path to downloaded zip tile
+    resolution : str, optional
+        IMG_DATA resolution directory, by default 'R20m'
+
+    Returns
+    -------
+    dict
+        Zip member path of each band, ie {'B02': '<name>.SAFE/GRANULE/.../R20m/T10UFA_..._B02_20m.jp2'}
+    """
+    with ZipFile(gran, 'r') as zipObj:
+        names = zipObj.namelist()
+    index = {}
+    for name in names:
+        parts = name.split('/')
+        if not name.endswith('.jp2') or len(parts) < 3 or parts[-2] != resolution:
+            continue
+        if 'GRANULE' not in parts or 'IMG_DATA' not in parts:
+            continue
+        stem = os.path.splitext(parts[-1])[0].split('_')
+        if len(stem) >= 2:
+            index[stem[-2]] = name
+    return index
+
+def get_band_paths(gran: str):
+    """GDAL /vsizip/ paths to the bands used to calculate the NDSI
+
+    Parameters
+    ----------
+    gran : str
+        Path to downloaded zip tile
+
+    Returns
+    -------
+    list
+        /vsizip/ paths in S2_BANDS order
+
+    Raises
+    ------
+    ValueError
+        If a band is missing from the zip
+    """
+    index = index_safe_zip(gran)
+    missing = [band for band in S2_BANDS if band not in index]
+    if missing:
+        raise ValueError(f'bands {", ".join(missing)} not found in {gran}')
+    zip_path = os.path.abspath(gran).replace('\\', '/')
+    return [f'/vsizip/{zip_path}/{index[band]}' for band in S2_BANDS]
+
 def process(info: str, udate: str, lat: float, lng: float, rgb: str):
     """Process the Sentinel-2 tile calculating NDSI and saving GTiffs
 
@@ -251,118 +366,147 @@ def process(info: str, udate: str, lat: float, lng: float, rgb: str):
     if not os.path.exists(intermediate_tif):
         logger.debug(f"creating directory: {intermediate_tif}")
         os.makedirs(intermediate_tif)
-    # Unzip downloaded tile
-    logger.info('[sentinel2.process] EXTRACTING ZIPFILE...')
+    # Bands are read in place from the zip, only the R20m members are indexed
+    logger.info('[sentinel2.process] INDEXING ZIPFILE...')
     logger.debug(f"sentinel file: {gran}")
-    exceedsWindowsPathLength = False
-    with ZipFile(gran, 'r') as zipObj:
-        logger.debug(f"extract all from {intermediate_tif}")
-
-        fileList = zipObj.namelist()
-
-        # reading the contents of the zip file to check for violation of max path
-        # length if on windows
-        if platform.system().lower() == 'windows':
-            for inFile in fileList:
-                fulloutpath = os.path.join(intermediate_tif, inFile)
-                fulloutpath = os.path.normpath(fulloutpath)
-                #logger.debug(f"    - {fulloutpath}")
-                fulloutpath = fixLongWinPath(fulloutpath)
-                if len(str(fulloutpath)) > 260:
-                    # exceeds windows path max length, to overcome need to tweak the path 
-                    # and add \\?\ to it, which gets around the restriction
-                    exceedsWindowsPathLength = True
-                    intermediate_tif = u"\\\\?\\" + intermediate_tif
-                    logger.debug(f"intermediate path: {intermediate_tif}")
-                    break
+    bands = get_band_paths(gran)
+    logger.debug(f"bands: {bands}")
+
+    intermediate_ndsi = os.path.join(intermediate_tif, f'NDSI_{udate}.tif')
+    rgb_out = None
+    if rgb == 'true': # Create RGB version if selected
+        rgb_out = os.path.join(const.SENTINEL_OUTPUT, udate, f'lat{lat}_lng{lng}', f'{udate}.tif')
         try:
-            zipObj.extractall(intermediate_tif)
+            os.makedirs(os.path.split(rgb_out)[0])
         except Exception as e:
-            logger.exception('zip error')
-            logger.error(e)
-        logger.debug("unzip complete")
-    unzipped = os.path.join(intermediate_tif,os.path.split(gran)[-1].split('.')[0]+'.SAFE')
-    base = os.path.join(intermediate_tif, glob(unzipped)[0], 'GRANULE', '**', 'IMG_DATA', 'R20m')
-
-    logger.debug(f"unzipped path: {unzipped}")
-    logger.debug(f"base path: {base}")
-
-    # Gather band paths
-    bands = [
-        glob(os.path.join(base,'*B02*.jp2'))[0], #b2
-        glob(os.path.join(base,'*B03*.jp2'))[0], #b3
-        glob(os.path.join(base,'*B04*.jp2'))[0], #b4
-        glob(os.path.join(base,'*B8A*.jp2'))[0], #b8
-        glob(os.path.join(base,'*B11*.jp2'))[0], #b11
-        glob(os.path.join(base,'*SCL*.jp2'))[0], #bCloud
+            logger.debug(f'[sentinel2.process] {e}')
+    logger.info('[sentinel2.process] WRITING NDSI GTIFF')
+    process_bands(bands, intermediate_ndsi, rgb_out)
+    return intermediate_ndsi
+
+def calculate_ndsi(b2: np.ndarray, b3: np.ndarray, b4: np.ndarray, b8: np.ndarray,
+                   b11: np.ndarray, cloud_mask: np.ndarray):
+    """Calculate the NDSI of a block of the tile
+
+    Parameters
+    ----------
+    b2, b3, b4, b8, b11 : np.ndarray
+        B02, B03, B04, B8A and B11 reflectances
+    cloud_mask : np.ndarray
+        Scene classification (SCL)
+
+    Returns
+    -------
+    np.ndarray
+        NDSI scaled to 0-100, nodata_val*100 where masked
+    """
+    b2, b3, b4, b8, b11 = [b.astype('float64') for b in (b2, b3, b4, b8, b11)]
+    inf_val = 0.0 #nodata_val
+    dival = 10000
+    nosnow = 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        NDSI = np.divide((b3-b11), (b3+b11)) # NDSI Calculation
+        NDSI[NDSI == np.inf] = inf_val # correct div by 0 and inf/nan
+        NDSI = np.nan_to_num(NDSI, nan=inf_val, posinf=inf_val, neginf=inf_val) # correct div by 0 and inf/nan
+        NDSI[(NDSI <= 0.0)] = nosnow # force no snow values to nosnow
+        NDSI[(NDSI > 1.0)&(NDSI != nodata_val)] = nosnow  # force non-NDSI values to nosnow
+        NDSI[(b8/dival < 0.35)] = nosnow # Step2.2 of NDSI calc
+        NDSI[(b2/dival < 0.18)] = nosnow # Step2.3 of NDSI calc
+        b2b4 = np.divide(b2/dival, b4/dival) # correct div by 0 and inf/nan
+    b2b4 = np.nan_to_num(b2b4, nan=inf_val, posinf=inf_val, neginf=inf_val) # correct div by 0 and inf/nan
+    NDSI[(b2b4 < 0.85)] = nosnow # Step2.4 of NDSI calc
+    #nodata_msk = ((b2 == 0)&(b3==0)&(b4==0)&(b11==0))
+    #NDSI[nodata_msk] = nodata_val
+    NDSI[(cloud_mask==6)] = nodata_val # Water mask
+    NDSI[(cloud_mask==8)] = nodata_val # Cloud_Medium_Probability mask
+    NDSI[(cloud_mask==9)] = nodata_val # Cloud_High_Probabiliter mask
+    return NDSI*100 # Scale to 0-100 range
+
+def get_block_windows(src, blocksize: int = None):
+    """Windows to process a tile in. The internal blocks of the band are used
+    when they line up with the output tiles, otherwise a grid of
+    4 x const.RASTER_BLOCKSIZE
+
+    Parameters
+    ----------
+    src : rasterio dataset
+        Band to process
+    blocksize : int, optional
+        Output tile size, defaults to const.RASTER_BLOCKSIZE
+
+    Returns
+    -------
+    list
+        List of rasterio windows covering the tile
+    """
+    blocksize = blocksize or const.RASTER_BLOCKSIZE
+    block_h, block_w = src.block_shapes[0]
+    if block_h % blocksize or block_w % blocksize:
+        block_h = block_w = blocksize * 4
+    return [
+        Window(col, row, min(block_w, src.width - col), min(block_h, src.height - row))
+        for row in range(0, src.height, block_h)
+        for col in range(0, src.width, block_w)
     ]
 
-    logger.info('[sentinel2.process] READING BANDS')
-    with rio.Env():
-        # Open bands and collect data for calculations
-        with rio.open(bands[0], 'r', nodata=nodata_val) as src:
-            b2 = src.read(1)
-            profile = src.profile
-        with rio.open(bands[1], 'r') as src:
-            b3 = src.read(1)
-        with rio.open(bands[2], 'r') as src:
-            b4 = src.read(1)
-        with rio.open(bands[3], 'r') as src:
-            b8 = src.read(1)
-        with rio.open(bands[4], 'r') as src:
-            b11 = src.read(1)
-        with rio.open(bands[5], 'r') as src:
-            cloud_mask = src.read(1)
-
-        # Create RGB version if selected
-        if rgb == 'true':
-            profile.update({
-                "count": 3,
-                "driver":"GTiff",
-            })
-            logger.info('[sentinel2.process] WRITING S2 RGB GTIFF')
-            rgb_out = os.path.join(const.SENTINEL_OUTPUT, udate, f'lat{lat}_lng{lng}', f'{udate}.tif')
-            try:
-                os.makedirs(os.path.split(rgb_out)[0])
-            except Exception as e:
-                logger.debug(f'[sentinel2.process] {e}')
-            with rio.open(rgb_out, 'w', **profile) as dst:
-                dst.write(b2 ,1)
-                dst.write(b3 ,2)
-                dst.write(b4 ,3)
-        
-        # Create NDSI profile
-        profile.update({
-                "driver": 'GTiff',
-                "count": 1,
-                'dtype' : rio.float64,
-                'nodata': nodata_val
-            })
-        inf_val = 0.0 #nodata_val
-        dival = 10000
-        nosnow = 0.0
-        intermediate_ndsi = os.path.join(intermediate_tif, f'NDSI_{udate}.tif')
-        logger.info('[sentinel2.process] WRITING NDSI GTIFF')
-        with rio.open(intermediate_ndsi, 'w', **profile) as dst:
-            np.seterr(divide='ignore', invalid='ignore')
-            NDSI = np.divide((b3-b11), (b3+b11)) # NDSI Calculation
-            NDSI[NDSI == np.inf] = inf_val # correct div by 0 and inf/nan
-            NDSI = np.nan_to_num(NDSI, nan=inf_val, posinf=inf_val, neginf=inf_val) # correct div by 0 and inf/nan
-            NDSI[(NDSI <= 0.0)] = nosnow # force no snow values to nosnow
-            NDSI[(NDSI > 1.0)&(NDSI != nodata_val)] = nosnow  # force non-NDSI values to nosnow
-            NDSI[(b8/dival < 0.35)] = nosnow # Step2.2 of NDSI calc
-            NDSI[(b2/dival < 0.18)] = nosnow # Step2.3 of NDSI calc
-            b2b4 = np.divide(b2/dival, b4/dival) # correct div by 0 and inf/nan
-            b2b4 = np.nan_to_num(b2b4, nan=inf_val, posinf=inf_val, neginf=inf_val) # correct div by 0 and inf/nan
-            NDSI[(b2b4 < 0.85)] = nosnow # Step2.4 of NDSI calc
-            #nodata_msk = ((b2 == 0)&(b3==0)&(b4==0)&(b11==0))
-            #NDSI[nodata_msk] = nodata_val
-            NDSI[(cloud_mask==6)] = nodata_val # Water mask
-            NDSI[(cloud_mask==8)] = nodata_val # Cloud_Medium_Probability mask
-            NDSI[(cloud_mask==9)] = nodata_val # Cloud_High_Probabiliter mask
-            NDSI = NDSI*100 # Scale to 0-100 range
-            dst.write(NDSI, 1) # Write data to file
-    return intermediate_ndsi
+def process_bands(bands: list, ndsi_out: str, rgb_out: str = None, workers: int = 4):
+    """Calculate the NDSI (and optionally the RGB) of a tile block by block.
+    The band windows are decoded and calculated in a thread pool, each thread
+    with its own dataset handles, and the blocks are streamed into tiled
+    GTiffs so only a few blocks are held in memory at once
+
+    Parameters
+    ----------
+    bands : list
+        Paths to the B02, B03, B04, B8A, B11 and SCL bands
+    ndsi_out : str
+        Path to the output NDSI GTiff
+    rgb_out : str, optional
+        Path to the output RGB GTiff, not written if None
+    workers : int, optional
+        Number of threads, by default 4
+    """
+    with rio.open(bands[0], 'r') as src:
+        profile = src.profile
+        block_windows = get_block_windows(src)
+
+    local = threading.local()
+    lock = threading.Lock()
+    opened = []
+
+    def process_window(window):
+        if not hasattr(local, 'srcs'):
+            local.srcs = [rio.open(band, 'r') for band in bands]
+            with lock:
+                opened.extend(local.srcs)
+        b2, b3, b4, b8, b11, cloud_mask = [src.read(1, window=window) for src in local.srcs]
+        rgb_block = np.stack([b2, b3, b4]) if rgb_out else None
+        return window, calculate_ndsi(b2, b3, b4, b8, b11, cloud_mask), rgb_block
+
+    # Create NDSI profile
+    ndsi_profile = {k: v for k, v in profile.items() if k not in ('blockxsize', 'blockysize', 'tiled')}
+    ndsi_profile.update({
+            "driver": 'GTiff',
+            "count": 1,
+            'dtype' : rio.float64,
+            'nodata': nodata_val
+        })
+    ndsi_profile.update(get_cog_options(rio.float64, 1))
+    rgb_profile = dict(ndsi_profile, count=3, dtype=profile['dtype'], nodata=profile.get('nodata'))
+    rgb_profile.update(get_cog_options(profile['dtype'], 3))
+
+    with rio.Env(), ExitStack() as stack:
+        dst = stack.enter_context(rio.open(ndsi_out, 'w', **ndsi_profile))
+        rgb_dst = stack.enter_context(rio.open(rgb_out, 'w', **rgb_profile)) if rgb_out else None
+        try:
+            with ThreadPool(workers) as pool:
+                for window, ndsi_block, rgb_block in pool.imap_unordered(process_window, block_windows):
+                    dst.write(ndsi_block, 1, window=window)
+                    if rgb_dst is not None:
+                        rgb_dst.write(rgb_block, window=window)
+        finally:
+            for src in opened:
+                src.close()
 
 def reproject_s2(pth: str, date: str, lat: float, lng: float, dst_crs: str):
     """Reproject GTiff to target CRS
@@ -436,27 +580,21 @@ def reproject_s2(pth: str, date: str, lat: float, lng: float, dst_crs: str):
     return out_pth
 
 
-def analysis(pth: str, date: str, name: str, db_handler: DBHandler):
-    """Calculate the snow coverage, nodata, and below threshold
-    values for the selected tile
+def calculate_coverage(pth: str):
+    """Calculate the nodata, below threshold and snow coverage percentages
+    of a tile
 
     Parameters
     ----------
     pth : str
         Path of tile to be analyzed
-    date : str
-        Date selected in format YYYY.MM.DD
-    name : str
-        Name for output
-    db_handler : DBHandler()
-        Handler class for database connection
 
     Returns
     -------
     tuple
         calculated values of (nodata, belowthreshold, snowcoverage)
-    """    
-    logger.info('[sentinel2.analysis] RUNNING ANALYSIS ON S2 SCENE')
+    """
+    logger.info('[sentinel2.calculate_coverage] RUNNING ANALYSIS ON S2 SCENE')
     with rio.Env():
         # Calculate values
         with rio.open(pth, 'r') as src:
@@ -466,22 +604,38 @@ def analysis(pth: str, date: str, name: str, db_handler: DBHandler):
             below_threshold =  np.around(((data <= 20).sum()/land)*100, 6)
             cover = (((data > 20) & (data <= 100)).sum())
             coverage = np.around((cover/land)*100, decimals=6)
+    return (nodata, below_threshold, coverage)
+
+
+def coverage_row(name: str, date: str, coverage: tuple):
+    """Statistics row of a tile for DBHandler.insert_many
+
+    Parameters
+    ----------
+    name : str
+        Name for output
+    date : str
+        Date selected in format YYYY.MM.DD
+    coverage : tuple
+        calculated values of (nodata, belowthreshold, snowcoverage)
 
+    Returns
+    -------
+    dict
+        Row for the sentinel2 table
+    """
+    nodata, below_threshold, snow = coverage
     logger.info(f'S2 SNOW COVERAGE FOR {name}')
     logger.info(f'NODATA: {nodata}')
     logger.info(f'BELOW {below_threshold}')
-    logger.info(f'COVERAGE {coverage}')
-
-    prepare = {
-        'sat': 'sentinel2',
+    logger.info(f'COVERAGE {snow}')
+    return {
         'name': name,
         'date_': date,
-        'coverage': coverage,
+        'coverage': snow,
         'nodata': nodata,
         'below_threshold': below_threshold
     }
-    db_handler.insert(**prepare)
-    return (nodata, below_threshold, coverage)
 
 
 def attach_colour_ramp(pth: str):
@@ -512,10 +666,11 @@ def expand(pth: str, date: str):
     """    
     logger.info('[sentinel2.expand] EXPANDING SINGLE BAND TO RGB OF COLOUR RAMP')
     output_pth = os.path.join(os.path.split(pth)[0], f'{date}_col.tif')
-    if os.path.exists(output_pth):
-        os.remove(output_pth) # Clean residual file
-    os.system(f'gdal_translate -q -ot Byte -expand rgb -of GTiff \
-                {pth} {output_pth}')
+    with rio.open(pth, 'r') as src:
+        profile = src.profile
+        rgb = expand_palette(src.read(1), s2_colormap())
+    profile.pop('nodata', None)
+    write_raster(output_pth, rgb, profile)
     return output_pth
 
 def kml(pth: str, date: str, name: str, coverage: float):
@@ -545,27 +700,12 @@ def kml(pth: str, date: str, name: str, coverage: float):
     with rio.open(pth) as src:
         upperleft = src.transform * (0,0)
         bottomright = src.transform * (src.width, src.height)
-
-    gdalCommand = 'gdal2tiles.py'
-    processes = 4
-    # on windows shebang interpreter asssociation in the conda install doesn't seem to work 
-    # when there is another verson of python installed... Modify the command to include the
-    # path to the conda scripts
-
-    if platform.system().lower() == 'windows':
-        gdalCommandfullPath = os.path.join(os.environ['CONDA_PREFIX'], 'Scripts', gdalCommand)
-        pythonFullPath = os.path.join(os.environ['CONDA_PREFIX'], 'python')
-        gdalCommand = f'{pythonFullPath} {gdalCommandfullPath}'
-        # spawining processes not working on windows
-        processes = 1
+        rgb = src.read()
+        transform = src.transform
 
     # Create KML version of expanded EPSG:4326 GTiff
-    gdal_str = f'{gdalCommand} -q --processes={processes} -p raster -t {name} --tilesize=128 -s \
-                    EPSG:4326 -k -r near {pth} {kml_pth}'
-    logger.debug("command is:")
-    logger.debug(gdal_str)
-    
-    os.system(gdal_str)
+    with ThreadPool(4) as pool:
+        build_superoverlay(rgb, transform, kml_pth, name, pool=pool)
     # Build top level KML to attach metadata to
     kml = simplekml.Kml(name=name)
     link = kml.newnetworklink(name=name)
@@ -594,7 +734,9 @@ def plot(pth: str, name: str):
         Output name for plot
     """
     logger.info('[sentinel2.plt] PLOTTING S2 SCENE')
-    fig, ax = plt.subplots(1,1, dpi=100)
+    # Figure rather than pyplot so tiles can be plot from several threads
+    fig = Figure(dpi=100)
+    ax = fig.subplots(1,1)
     out_pth = os.path.join(const.PLOT_SENTINEL, f'{name}.png')
     if os.path.exists(out_pth):
         os.remove(out_pth)
@@ -609,7 +751,42 @@ def plot(pth: str, name: str):
             rasterio.plot.show((src.read()), transform=src.transform, ax=ax, adjust=None)
             ax.axis('off')
             ax.set_title(name)
-        plt.savefig(out_pth)
+        fig.savefig(out_pth)
+
+def build_outputs(orig_pth: str, date: str, lat: float, lng: float, out_name: str):
+    """Build the BC Albers GTiff and plot, and the KML of a processed tile
+
+    Parameters
+    ----------
+    orig_pth : str
+        Path to NDSI GTiff returned by process()
+    date : str
+        Date selected in format YYYY.MM.DD
+    lat : float
+        Target latitude
+    lng : float
+        Target longitude
+    out_name : str
+        Name for the outputs
+
+    Returns
+    -------
+    tuple
+        calculated values of (nodata, belowthreshold, snowcoverage)
+    """
+    # BC Albers build
+    bc_pth = reproject_s2(orig_pth, date, lat, lng, 'EPSG:3153')
+    attach_colour_ramp(bc_pth)
+    bc_col = expand(bc_pth, date)
+    plot(bc_col, out_name)
+    coverage = calculate_coverage(bc_pth)
+
+    # KML build
+    pth = reproject_s2(orig_pth, date, lat, lng, 'EPSG:4326')
+    attach_colour_ramp(pth)
+    col_pth = expand(pth, date)
+    kml(col_pth, date, out_name, coverage)
+    return coverage
 
 def sentinel_pipeline(creds: str, date: str, 
                         lat: float, lng: float, rgb: str,
@@ -646,16 +823,5 @@ def sentinel_pipeline(creds: str, date: str,
         out_name = f'S2 - {date} - {lat}, {lng}'
         info = download(prod, api, date, lat, lng, force_download)
         orig_pth = process(info, date, lat, lng, rgb)
-        
-        # BC Albers build
-        bc_pth = reproject_s2(orig_pth, date, lat, lng, 'EPSG:3153')
-        attach_colour_ramp(bc_pth)
-        bc_col = expand(bc_pth, date)
-        plot(bc_col, out_name)
-        coverage = analysis(bc_pth, date, out_name, db_handler)
-
-        # KML build
-        pth = reproject_s2(orig_pth, date, lat, lng, 'EPSG:4326')
-        attach_colour_ramp(pth)
-        col_pth = expand(pth, date)
-        kml(col_pth, date, out_name, coverage)
\ No newline at end of file
+        coverage = build_outputs(orig_pth, date, lat, lng, out_name)
+        db_handler.insert_many('sentinel2', [coverage_row(out_name, date, coverage)])
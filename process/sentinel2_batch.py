@@ -0,0 +1,286 @@
+"""
+Batch, non-interactive Sentinel-2 pipeline.
+
+`sentinel2.sentinel_pipeline` asks the user to pick a product for a single
+point.  The batch pipeline reads a CSV of points of interest instead:
+
+    lat,lng,date
+    49.12,-126.5,2021.03.18
+    49.73,-126.5,2021.03.18
+
+and picks the product of each point with a selection policy (SELECTION_POLICIES).
+Points that select the same product (same tile and sensing time) are grouped
+so every product is downloaded and processed once, and the distinct products
+are downloaded and processed concurrently.
+
+The catalogue is anything with the `query()` / `download()` methods of
+sentinelsat.SentinelAPI, so a local stand-in can be passed in place of the
+Copernicus hub.
+"""
+
+import csv
+import datetime
+import logging
+import re
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from admin.db_handler import DBHandler
+from process import sentinel2
+
+LOGGER = logging.getLogger(__name__)
+
+# sort keys of the (product id, metadata) items, the first item is selected
+SELECTION_POLICIES = {
+    'least-cloud': lambda item: (item[1]['cloudcoverpercentage'], -item[1]['beginposition'].timestamp()),
+    'most-recent': lambda item: (-item[1]['beginposition'].timestamp(), item[1]['cloudcoverpercentage']),
+}
+
+TILE_RE = re.compile(r'_(T\d{2}[A-Z]{3})_')
+
+
+def read_points(pth: str):
+    """Read the points of interest file
+
+    Parameters
+    ----------
+    pth : str
+        Path to a CSV with lat, lng and date (YYYY.MM.DD) columns
+
+    Returns
+    -------
+    list
+        List of {'lat', 'lng', 'date'} dicts, duplicates removed
+
+    Raises
+    ------
+    ValueError
+        If a row has an invalid coordinate or date
+    """
+    points = []
+    with open(pth, 'r', newline='') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            try:
+                point = {
+                    'lat': float(row['lat']),
+                    'lng': float(row['lng']),
+                    'date': row['date'].strip()
+                }
+                datetime.datetime.strptime(point['date'], '%Y.%m.%d')
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f'{pth} line {line}: invalid point {row}') from e
+            if point not in points:
+                points.append(point)
+    LOGGER.info(f'{len(points)} points of interest in {pth}')
+    return points
+
+
+def select_product(products: dict, policy: str = 'least-cloud'):
+    """Select a product with a selection policy
+
+    Parameters
+    ----------
+    products : dict
+        Product metadata keyed by product id, see sentinel2.query_products
+    policy : str, optional
+        One of SELECTION_POLICIES, by default 'least-cloud'
+
+    Returns
+    -------
+    tuple
+        (product id, metadata) of the selected product, None if there are no
+        products
+
+    Raises
+    ------
+    ValueError
+        If the policy is not known
+    """
+    if policy not in SELECTION_POLICIES:
+        raise ValueError(
+            f'invalid selection policy: {policy}, valid values: {", ".join(SELECTION_POLICIES)}')
+    if not products:
+        return None
+    return min(products.items(), key=SELECTION_POLICIES[policy])
+
+
+def get_tile_id(product: dict):
+    """MGRS tile of a product, ie T10UCU
+
+    Parameters
+    ----------
+    product : dict
+        Product metadata
+
+    Returns
+    -------
+    str
+        The tile id, the product title if it can not be found
+    """
+    if product.get('tileid'):
+        return f"T{product['tileid']}"
+    match = TILE_RE.search(product.get('title', ''))
+    return match.group(1) if match else product.get('title')
+
+
+def get_out_name(date: str, tile: str, points: list):
+    """Name of the outputs of a product, the point for a single point
+    (as sentinel_pipeline) otherwise the tile
+
+    Parameters
+    ----------
+    date : str
+        Date of the product in format YYYY.MM.DD
+    tile : str
+        Tile id of the product
+    points : list
+        Points of interest served by the product
+
+    Returns
+    -------
+    str
+        Name for the outputs
+    """
+    if len(points) == 1:
+        return f"S2 - {date} - {points[0]['lat']}, {points[0]['lng']}"
+    return f'S2 - {date} - {tile}'
+
+
+def plan_batch(api, points: list, policy: str, max_allowable_cloud: int,
+               day_tolerance: int, workers: int = 4):
+    """Query the catalogue for every point and group the points by the product
+    they select
+
+    Parameters
+    ----------
+    api : API interface
+        Catalogue, see sentinel2.query_products
+    points : list
+        Points of interest, see read_points
+    policy : str
+        One of SELECTION_POLICIES
+    max_allowable_cloud : int
+        Max allowable cloud percentage when querying tiles
+    day_tolerance : int
+        Number of days to look back from the point date
+    workers : int, optional
+        Number of concurrent queries, by default 4
+
+    Returns
+    -------
+    OrderedDict
+        {product id: {'product': metadata, 'date': str, 'tile': str, 'points': list}}
+    """
+    def query_point(point):
+        products = sentinel2.query_products(
+            api, point['date'], point['lat'], point['lng'], max_allowable_cloud, day_tolerance)
+        return point, select_product(products, policy)
+
+    jobs = OrderedDict()
+    with ThreadPool(workers) as pool:
+        for point, selected in pool.imap(query_point, points):
+            if selected is None:
+                LOGGER.warning(f'no products found for {point}, try a higher cloud tolerance')
+                continue
+            product_id, product = selected
+            if product_id not in jobs:
+                jobs[product_id] = {
+                    'product': product,
+                    'date': sentinel2.get_product_date(product),
+                    'tile': get_tile_id(product),
+                    'points': []
+                }
+            jobs[product_id]['points'].append(point)
+    LOGGER.info(f'{len(points)} points served by {len(jobs)} products')
+    return jobs
+
+
+def process_product(api, product_id: str, job: dict, rgb: str, force_download: str):
+    """Download and process a product once for all of the points it serves
+
+    Parameters
+    ----------
+    api : API interface
+        Catalogue, see sentinel2.query_products
+    product_id : str
+        Product to download
+    job : dict
+        Product job, see plan_batch
+    rgb : str
+        Indicator to generate RGB version
+    force_download : str
+        Force download by removing previous downloaded zip files
+
+    Returns
+    -------
+    dict
+        Statistics row of the product, see sentinel2.coverage_row
+    """
+    date = job['date']
+    # outputs of a product are kept under its first point
+    lat, lng = job['points'][0]['lat'], job['points'][0]['lng']
+    out_name = get_out_name(date, job['tile'], job['points'])
+    LOGGER.info(f"processing {product_id} ({job['tile']}) for {len(job['points'])} points")
+    info = sentinel2.download(product_id, api, date, lat, lng, force_download)
+    if info is None:
+        raise RuntimeError(f'download of {product_id} failed')
+    orig_pth = sentinel2.process(info, date, lat, lng, rgb)
+    coverage = sentinel2.build_outputs(orig_pth, date, lat, lng, out_name)
+    return sentinel2.coverage_row(out_name, date, coverage)
+
+
+def sentinel_batch_pipeline(api, points_pth: str, policy: str, rgb: str,
+                            max_allowable_cloud: int, force_download: str,
+                            day_tolerance: int, db_handler: DBHandler, workers: int = 2):
+    """Batch pipeline kicker
+
+    Parameters
+    ----------
+    api : API interface
+        Catalogue, see sentinel2.query_products
+    points_pth : str
+        Path to the points of interest CSV, see read_points
+    policy : str
+        One of SELECTION_POLICIES
+    rgb : str
+        Indicator to generate RGB version
+    max_allowable_cloud : int
+        Max allowable cloud percentage when querying tiles
+    force_download : str
+        Force download by removing previous downloaded zip files
+    day_tolerance : int
+        Number of days to look back from the point dates
+    db_handler : DBHandler()
+        Handler class for database connection
+    workers : int, optional
+        Number of products downloaded and processed at once, by default 2.
+        Each product also processes its blocks with a thread pool
+
+    Returns
+    -------
+    dict
+        {product id: name of the outputs} of the products that were processed
+    """
+    LOGGER.info('[sentinel2_batch.sentinel_batch_pipeline] SENTINEL2 BATCH PIPELINE STARTING')
+    sentinel2.build_sentinel_dir_struture()
+    points = read_points(points_pth)
+    jobs = plan_batch(api, points, policy, max_allowable_cloud, day_tolerance)
+
+    def run_job(item):
+        product_id, job = item
+        try:
+            return product_id, process_product(api, product_id, job, rgb, force_download)
+        except Exception as e:
+            LOGGER.exception(f'failed to process {product_id}: {e}')
+            return product_id, None
+
+    rows = {}
+    with ThreadPool(workers) as pool:
+        for product_id, row in pool.imap_unordered(run_job, jobs.items()):
+            if row is not None:
+                rows[product_id] = row
+    # the sqlite connection belongs to this thread
+    db_handler.insert_many('sentinel2', list(rows.values()))
+    LOGGER.info(f'processed {len(rows)} of {len(jobs)} products')
+    return {product_id: row['name'] for product_id, row in rows.items()}
@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 
 import rioxarray as rioxr
@@ -7,15 +8,27 @@ import numpy as np
 
 import admin.constants as const
 
-from admin.color_ramp import color_ramp
+from admin import artifact_cache, manifest, metrics, normals
+from admin.color_ramp import snow_colormap
+from admin.raster_io import write_dataarray
+from admin.raster_encoding import (
+    decode_normal_dataarray,
+    encode_normal_dataarray,
+    encode_pct_change_dataarray
+)
 
 import admin.object_store_util as objstr_util
 import admin.snow_path_lib as spath_lib
 
-from glob import glob
 
 logger = logging.getLogger(__name__)
-ostore = objstr_util.OStore()
+
+# the modules the outputs of the steps are made with, part of their
+# fingerprints (see admin/manifest.py)
+CLIP_CODE = [__name__, 'admin.raster_io', 'admin.color_ramp']
+NORM_CODE = [__name__, 'admin.raster_io', 'admin.raster_encoding']
+
+ostore = objstr_util.get_ostore()
 snow_paths = spath_lib.SnowPathLib()
 
 def process_normals(norm: object, orig: object, geom: object, output_pth: str, sat: str):
@@ -26,7 +39,8 @@ def process_normals(norm: object, orig: object, geom: object, output_pth: str, s
     Parameters
     ----------
     norm : object
-        Xarray Dataset object containing the norm
+        Xarray Dataset object containing the norm, decoded to float with
+        `admin.raster_encoding.decode_normal_dataarray`
     orig : object
         Xarray Dataset object containing the current date data
     geom : object
@@ -45,7 +59,7 @@ def process_normals(norm: object, orig: object, geom: object, output_pth: str, s
     to_raster_path = os.path.join(to_raster_dir, to_raster_file)
     # insane!!!
     #norm.rio.to_raster(os.path.join(os.path.split(output_pth)[0], 'orig_'+os.path.split(output_pth)[-1]))
-    norm.rio.to_raster(to_raster_path)
+    write_dataarray(encode_normal_dataarray(norm), to_raster_path)
 
     cp = norm.data.copy()
     norm.data[(norm.data > 100)] = np.nan
@@ -61,7 +75,9 @@ def process_normals(norm: object, orig: object, geom: object, output_pth: str, s
     norm.data[((orig.data > 100)|(cp > 100))] = set_val
     norm_clipped = norm.rio.clip([geom], drop=True, all_touched=True)
     norm_clipped = norm.rio.reproject('EPSG:3153', resolution=const.RES[sat])
-    norm_clipped.rio.to_raster(output_pth)
+    # % change is stored as int8 (see admin/raster_encoding.py)
+    norm_clipped = encode_pct_change_dataarray(norm_clipped)
+    write_dataarray(norm_clipped, output_pth)
 
 def process_by_watershed_or_basin(sat: str, typ: str, startdate: str, date_list=None):
     """
@@ -90,93 +106,105 @@ def process_by_watershed_or_basin(sat: str, typ: str, startdate: str, date_list=
         mosaic = snow_paths.get_modis_composite_mosaic_file_name(
             start_date=startdate,
             date_list=date_list)
-        norm10yr_base = os.path.join(const.MODIS_DAILY_10YR)
-        norm20yr_base = os.path.join(const.MODIS_DAILY_20YR)
     elif sat == 'viirs':
-        # TODO: When run viirs make sure that this glob doesn't return unexpected files
-        mosaic = glob(os.path.join(const.OUTPUT_TIF_VIIRS, startdate.split('.')[0], '*.tif'))[0]
-        norm10yr_base = os.path.join(const.VIIRS_DAILY_10YR)
-        norm20yr_base = os.path.join(const.VIIRS_DAILY_20YR)
+        mosaic = snow_paths.find_product_tif(sat, startdate)
+        if mosaic is None:
+            raise FileNotFoundError(f'no viirs mosaic for {startdate}')
     else: # @click will make sure this else is never hit
         return
 
     logger.debug(f"mosaic path: {mosaic}")
-    logger.debug(f"norm10yr_base path: {norm10yr_base}")
-    logger.debug(f"norm20yr_base path: {norm20yr_base}")
+
+    d_month, d_day = normals.get_month_day(startdate)
+
+    # the normals are inputs of the fingerprints of the % change rasters,
+    # pulled once for all the sheds (usually prefetched, see admin/normals.py)
+    # './data/norm/modis/daily/10yr/02.16.tif'
+    norm10yr_tif = normals.get_normal_path(sat, startdate, '10yr')
+    norm20yr_tif = normals.get_normal_path(sat, startdate, '20yr')
+    logger.debug(f"norm10yr path: {norm10yr_tif}")
+    logger.debug(f"norm20yr path: {norm20yr_tif}")
+    clip_params = {'res': const.RES[sat]}
+    norm_params = dict(clip_params, pct_change_encoding=const.PCT_CHANGE_ENCODING,
+                       normal_encoding=const.NORMAL_ENCODING)
 
     # base=basins root/basins
-    # wrap this up into a script centralized pathlib
-    # gets the shape files list in each basin
+    # gets the shape files list in each basin from the catalog (admin/catalog.py)
     # TODO: should have a single way of iterating over watershed / basins, not one time
-    #       get those values from the shape file, and the next using a glob pattern
+    #       get those values from the shape file, and the next from the shape files
+    #       of the data directory
     #       single source will also identify missing / problematic data
-    sheds = glob(os.path.join(base, '**', 'shape', 'EPSG4326', '*.shp'))
-    for shed in sheds:
-        # shed = TOP/basins/<basin name>/shape/EPSG4326/<basin name>.shp
-        # TODO: should have used basename!!! then splitext
-        # filename operations could be centralized into a single library with
-        # documentation and tests
-        #name = os.path.split(shed)[-1].split('.')[0]
-        name = snow_paths.file_name_no_suffix(shed)
-        logger.debug(f'Processing {name} for {sat}')
-        pth = os.path.join(base, name, sat, startdate)
-        logger.debug(f"watershed path: {pth}")
-        if not os.path.exists(pth):
-            os.makedirs(pth)
-
-        # TODO: Why create temporary shape files to clip with.. Why not use a selection
-        #       from the original shapefile?
-
-        gdf = gpd.read_file(shed) # shapefile to cut to
-        gdf = gdf.to_crs('EPSG:4326')
-        for _, row in gdf.iterrows():
-            output_pth = os.path.join(pth,f'{name}_{sat}_{startdate}_EPSG4326.tif')
-            if not os.path.exists(output_pth):
-                if typ == 'watersheds':
-                    name = "_".join(row.basinName.replace('.', '').split(" "))
-                else:
-                    name = "_".join(row.WSDG_NAME.replace('.', '').split(" "))
-                with rioxr.open_rasterio(mosaic) as src:
-                    clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
-                clipped_.rio.to_raster(output_pth)
-                color_ramp(output_pth)
-
-            output_pth = os.path.join(pth,f'{name}_{sat}_{startdate}_EPSG3153.tif')
-            if not os.path.exists(output_pth):
-                with rioxr.open_rasterio(mosaic) as src:
-                    clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
-                clipped = clipped_.rio.reproject('EPSG:3153', resolution=const.RES[sat])
-                clipped.rio.to_raster(output_pth)
-                color_ramp(output_pth)
-
-            d_splt = startdate.split('.')
-            d_year = d_splt[0]
-            d_month = d_splt[1]
-            d_day = d_splt[1]
-
-
-            # Calculate % change against normals for each watershed/basin
-            # './data/norm/modis/daily/10yr/02.16.tif'
-
-            out_pth = os.path.join(os.path.split(output_pth)[0], f'{name}_10yrNorm.tif')
-            if not os.path.exists(out_pth):
-                norm10yr_tif = os.path.join(norm10yr_base, f'{d_month}.{d_day}.tif')
-                ostore.get_10yr_tif(sat, d_month, d_day, norm10yr_tif)
-
-                with rioxr.open_rasterio(norm10yr_tif) as norm10yr:
-                    norm = norm10yr.rio.clip([row.geometry], drop=True, all_touched=True)
-                with rioxr.open_rasterio(mosaic) as src:
-                    clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
-
-                process_normals(norm, clipped_, row.geometry, out_pth, sat)
-
-            out_pth = os.path.join(os.path.split(output_pth)[0], f'{name}_20yrNorm.tif')
-            if not os.path.exists(out_pth):
-                norm20yr_tif = os.path.join(norm20yr_base, f'{d_month}.{d_day}.tif')
-                ostore.get_20yr_tif(sat, d_month, d_day, norm20yr_tif)
-                with rioxr.open_rasterio(norm20yr_tif) as norm20yr:
-                    norm = norm20yr.rio.clip([row.geometry], drop=True, all_touched=True)
-                with rioxr.open_rasterio(mosaic) as src:
-                    clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
-
-                process_normals(norm, clipped_, row.geometry, out_pth, sat)
\ No newline at end of file
+    sheds = snow_paths.get_shed_shapes(typ)
+    # the normals are not evicted from the artifact cache while the sheds are processed
+    with artifact_cache.pinned([norm10yr_tif, norm20yr_tif]):
+        ostore.get_10yr_tif(sat, d_month, d_day, norm10yr_tif)
+        ostore.get_20yr_tif(sat, d_month, d_day, norm20yr_tif)
+        for shed in sheds:
+            shed_start = time.perf_counter()
+            # shed = TOP/basins/<basin name>/shape/EPSG4326/<basin name>.shp
+            # TODO: should have used basename!!! then splitext
+            # filename operations could be centralized into a single library with
+            # documentation and tests
+            #name = os.path.split(shed)[-1].split('.')[0]
+            name = snow_paths.file_name_no_suffix(shed)
+            logger.debug(f'Processing {name} for {sat}')
+            pth = os.path.join(base, name, sat, startdate)
+            logger.debug(f"watershed path: {pth}")
+            # the products of other dates create the same parent directories
+            os.makedirs(pth, exist_ok=True)
+
+            # TODO: Why create temporary shape files to clip with.. Why not use a selection
+            #       from the original shapefile?
+
+            gdf = gpd.read_file(shed) # shapefile to cut to
+            gdf = gdf.to_crs('EPSG:4326')
+            for _, row in gdf.iterrows():
+                output_pth = os.path.join(pth,f'{name}_{sat}_{startdate}_EPSG4326.tif')
+                fingerprint = manifest.fingerprint('clip_EPSG4326', [mosaic, shed], code=CLIP_CODE)
+                if not manifest.is_current(output_pth, fingerprint):
+                    if typ == 'watersheds':
+                        name = "_".join(row.basinName.replace('.', '').split(" "))
+                    else:
+                        name = "_".join(row.WSDG_NAME.replace('.', '').split(" "))
+                    with rioxr.open_rasterio(mosaic) as src:
+                        clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
+                    write_dataarray(clipped_, output_pth, colormap=snow_colormap())
+                    manifest.record(output_pth, fingerprint, 'clip_EPSG4326')
+
+                output_pth = os.path.join(pth,f'{name}_{sat}_{startdate}_EPSG3153.tif')
+                fingerprint = manifest.fingerprint('clip_EPSG3153', [mosaic, shed], clip_params, CLIP_CODE)
+                if not manifest.is_current(output_pth, fingerprint):
+                    with rioxr.open_rasterio(mosaic) as src:
+                        clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
+                    clipped = clipped_.rio.reproject('EPSG:3153', resolution=const.RES[sat])
+                    write_dataarray(clipped, output_pth, colormap=snow_colormap())
+                    manifest.record(output_pth, fingerprint, 'clip_EPSG3153')
+
+                # Calculate % change against normals for each watershed/basin
+                out_pth = os.path.join(os.path.split(output_pth)[0], f'{name}_10yrNorm.tif')
+                fingerprint = manifest.fingerprint('norm_10yr', [mosaic, shed, norm10yr_tif], norm_params, NORM_CODE)
+                if not manifest.is_current(out_pth, fingerprint):
+                    # read once for all the sheds
+                    norm = normals.load(norm10yr_tif).rio.clip([row.geometry], drop=True, all_touched=True)
+                    norm = decode_normal_dataarray(norm)
+                    with rioxr.open_rasterio(mosaic) as src:
+                        clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
+
+                    process_normals(norm, clipped_, row.geometry, out_pth, sat)
+                    manifest.record(out_pth, fingerprint, 'norm_10yr')
+
+                out_pth = os.path.join(os.path.split(output_pth)[0], f'{name}_20yrNorm.tif')
+                fingerprint = manifest.fingerprint('norm_20yr', [mosaic, shed, norm20yr_tif], norm_params, NORM_CODE)
+                if not manifest.is_current(out_pth, fingerprint):
+                    # read once for all the sheds
+                    norm = normals.load(norm20yr_tif).rio.clip([row.geometry], drop=True, all_touched=True)
+                    norm = decode_normal_dataarray(norm)
+                    with rioxr.open_rasterio(mosaic) as src:
+                        clipped_ = src.rio.clip([row.geometry], drop=True, all_touched=True)
+
+                    process_normals(norm, clipped_, row.geometry, out_pth, sat)
+                    manifest.record(out_pth, fingerprint, 'norm_20yr')
+
+            metrics.record_time(
+                'shed', time.perf_counter() - shed_start, sat=sat, typ=typ,
+                shed=snow_paths.file_name_no_suffix(shed))
@@ -2,12 +2,13 @@ import datetime
 import os
 import sys
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 import numpy as np
-import NRUtil.NRObjStoreUtil as NRObjStoreUtil
 import rasterio
+import rasterio.features
+import rasterio.windows
 import geopandas
-import rasterstats
 import dotenv
 
 envPath = '.env'
@@ -89,10 +90,134 @@ def find_most_recent_image(obj_dirpath, obj_fpath, dt):
         fname = dt.strftime(obj_fpath)
     return dt
 
+def get_basin_members(zones, transform, shape):
+    """Flat pixel indices of the pixels touching each basin, grouped by basin.
+
+    Every basin is rasterized on its own window so overlapping basins keep
+    their shared pixels (all_touched, as rasterstats.zonal_stats was called).
+
+    :param zones: basins, in the crs of the raster
+    :type zones: geopandas.GeoDataFrame
+    :param transform: transform of the raster
+    :param shape: (height, width) of the raster
+    :return: members (flat pixel indices of all basins, concatenated),
+        offsets (start of each basin in members) and counts (number of pixels
+        of each basin)
+    :rtype: tuple(np.ndarray, np.ndarray, np.ndarray)
+    """
+    height, width = shape
+    members = []
+    for geom in zones.geometry:
+        idx = np.empty(0, dtype='int64')
+        if geom is not None and not geom.is_empty:
+            # window of the basin clipped to the raster, as rasterstats
+            window = rasterio.windows.from_bounds(*geom.bounds, transform=transform)
+            col0 = max(int(np.floor(window.col_off)), 0)
+            row0 = max(int(np.floor(window.row_off)), 0)
+            col1 = min(int(np.ceil(window.col_off + window.width)), width)
+            row1 = min(int(np.ceil(window.row_off + window.height)), height)
+            if col1 > col0 and row1 > row0:
+                window = rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0)
+                mask = rasterio.features.geometry_mask(
+                    [geom], out_shape=(row1 - row0, col1 - col0),
+                    transform=rasterio.windows.transform(window, transform),
+                    all_touched=True, invert=True)
+                rows, cols = np.nonzero(mask)
+                idx = (rows + row0) * width + (cols + col0)
+        members.append(idx.astype('int64'))
+    counts = np.array([len(m) for m in members], dtype='int64')
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype('int64')
+    return np.concatenate(members), offsets, counts
+
+def zonal_means(values, offsets, counts):
+    """Mean of the valid (<= 100) values of every basin for every day with a
+    single grouped reduction.
+
+    :param values: day x member pixel values, see get_basin_members
+    :type values: np.ndarray
+    :param offsets: start of each basin in the members
+    :type offsets: np.ndarray
+    :param counts: number of pixels of each basin
+    :type counts: np.ndarray
+    :return: day x basin means, nan where a basin has no valid pixels
+    :rtype: np.ndarray
+    """
+    means = np.full((values.shape[0], len(counts)), np.nan)
+    has_pixels = counts > 0
+    if not has_pixels.any():
+        return means
+    valid = values <= 100
+    # empty basins have no segment, the other segments stay contiguous
+    starts = offsets[has_pixels]
+    sums = np.add.reduceat(np.where(valid, values, 0).astype('float64'), starts, axis=1)
+    n = np.add.reduceat(valid.astype('int64'), starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means[:, has_pixels] = np.where(n > 0, sums / n, np.nan)
+    return means
+
+def extract_zonal_means(ostore, zones, dates, objpath, chunk_days=31, workers=4):
+    """Basin means of the cloud filled rasters of many days.
+
+    The basins are rasterized once into a membership array, the days are read
+    (in a thread pool) into a day x member pixel stack chunk_days at a time,
+    and the means of all of the basins are calculated for the chunk at once.
+
+    :param ostore: object store client
+    :param zones: basins
+    :type zones: geopandas.GeoDataFrame
+    :param dates: dates to extract
+    :type dates: pd.DatetimeIndex
+    :param objpath: object path of the rasters, strftime codes are filled in
+        with the date
+    :type objpath: str
+    :param chunk_days: number of days stacked at once, defaults to 31
+    :type chunk_days: int, optional
+    :param workers: number of rasters downloaded / read at once, defaults to 4
+    :type workers: int, optional
+    :return: date x basin means, nan for missing days
+    :rtype: pd.DataFrame
+    """
+    output = pd.DataFrame(data=np.nan, index=dates, columns=zones.WSDG_ID, dtype='float64')
+    objects = set()
+    for prefix in sorted({os.path.dirname(dt.strftime(objpath)) for dt in dates}):
+        objects.update(ostore.list_objects(prefix, return_file_names_only=True))
+    grids = {}
+
+    def read_day(dt):
+        objname = dt.strftime(objpath)
+        if objname not in objects:
+            print(f'{objname} not found')
+            return dt, None
+        local_filename = os.path.join('rawdata', objname.split('/')[-1])
+        ostore.get_object(local_path=local_filename, file_path=objname)
+        print(f'Reading {local_filename}')
+        with rasterio.open(local_filename) as src:
+            return dt, (src.read(1), src.crs, src.transform)
+
+    with ThreadPool(workers) as pool:
+        for start in range(0, len(dates), chunk_days):
+            days = {}
+            for dt, read in pool.imap(read_day, dates[start:start + chunk_days]):
+                if read is None:
+                    continue
+                raster, crs, transform = read
+                key = (crs.to_string(), tuple(transform), raster.shape)
+                if key not in grids:
+                    grids[key] = get_basin_members(zones.to_crs(crs), transform, raster.shape)
+                days.setdefault(key, []).append((dt, raster.ravel()[grids[key][0]]))
+            for key, stack in days.items():
+                members, offsets, counts = grids[key]
+                index = [dt for dt, _ in stack]
+                values = np.stack([v for _, v in stack])
+                output.loc[index] = zonal_means(values, offsets, counts)
+    return output
+
 #year = max([int(i.split('.')[0][-4:]) for i in ostore_objs]) + 1
 #year = 2001
 
 if __name__ == '__main__':
+    import NRUtil.NRObjStoreUtil as NRObjStoreUtil
+
     #ostore object loads object store credentials from environment variables:
     ostore = NRObjStoreUtil.ObjectStoreUtil()
 
@@ -120,29 +245,10 @@ if __name__ == '__main__':
     importdates = pd.date_range(start = startdate, end = enddate)
 
     if len(importdates) > 0:
-        output = pd.DataFrame(data=None, index = importdates, columns = clever_shp.WSDG_ID)
-        colnames = output.columns
-        for dt in importdates:
-            objname = dt.strftime(objpath)
-            filename = objname.split('/')[-1]
-            local_filename = os.path.join('rawdata',filename)
-            if objname in ostore.list_objects(os.path.dirname(objname),return_file_names_only=True):
-                ostore.get_object(local_path=local_filename, file_path=objname)
-                print(f'Reading {local_filename}')
-                with rasterio.open(local_filename) as grib:
-                        raster = grib.read(1)
-                        affine = grib.transform
-                        zone = clever_shp.to_crs(grib.crs)
-                        #Rasterstats averages all pixels which touch the polygon, or all pixels whose centoids are within the polygon
-                        #For exact averaging, weighting pixels by fraction within polygon, investigate this package:
-                        #https://github.com/isciences/exactextract
-                        raster[raster>100] = 255
-                        stats = rasterstats.zonal_stats(zone, raster, affine=affine,stats="mean",all_touched=True,nodata=255)
-                        for j in range(len(stats)):
-                            output.loc[dt,colnames[j]] = stats[j]['mean']
-            else:
-                print(f'{objname} not found')
-
+        #Rasterstats averaged all pixels which touch the polygon, the same pixels are used here
+        #For exact averaging, weighting pixels by fraction within polygon, investigate this package:
+        #https://github.com/isciences/exactextract
+        output = extract_zonal_means(ostore, clever_shp, importdates, objpath)
 
         CLEVER_summary = update_data(CLEVER_summary, output)
         #Modis snow product missing 2001 Jun 16 to 2001 Jul 2, remove data and interpolate over these dates:
@@ -8,11 +8,13 @@ import rasterio as rio
 import admin.constants as const
 
 from process.support import process_by_watershed_or_basin
-from admin.color_ramp import color_ramp
+from admin.color_ramp import snow_colormap
+from admin.raster_io import write_raster
+from admin import datacube, metrics, worker_pool
 
-from osgeo import gdal
-from multiprocessing import Pool
+from affine import Affine
 from glob import glob
+from rasterio.crs import CRS
 from rasterio.merge import merge
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 
@@ -81,17 +83,14 @@ def build_viirs_tif(date: str, scene: str):
     yRes, xRes = -375,  375 # Define the x and y resolution
     geoInfo = (ulcLon, xRes, 0, ulcLat, 0, yRes)        # Define geotransform parameters
 
-    nRow, nCol = snow.shape[0], snow.shape[1]
-    driver = gdal.GetDriverByName('GTiff')
-    options = ['PROFILE=GeoTIFF']
-    outFile = driver.Create(dest, nCol, nRow, 1, options=options)
-    band = outFile.GetRasterBand(1)
-    band.WriteArray(snow)
-    band.FlushCache
-    band.SetNoDataValue(float(fillValue))
-    outFile.SetGeoTransform(geoInfo)
-    outFile.SetProjection(prj)
+    profile = {
+        'crs': CRS.from_wkt(prj),
+        'transform': Affine.from_gdal(*geoInfo),
+        'nodata': float(fillValue),
+    }
     f.close()
+    # the granules are always written as Byte, same as the gdal default
+    write_raster(dest, snow.astype('uint8'), profile)
 
 def reproject_viirs(date: str, name: str, src: str, dst_crs: str):
     """Reproject viirs into the target CRS
@@ -128,17 +127,18 @@ def reproject_viirs(date: str, name: str, src: str, dst_crs: str):
             'width': width,
             'height': height
         })
-        with rio.open(intermediate_tif, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rio.band(src, i),
-                    destination=rio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.nearest
-                )
+        reprojected = np.zeros((src.count, height, width), dtype=src.dtypes[0])
+        for i in range(1, src.count + 1):
+            reproject(
+                source=rio.band(src, i),
+                destination=reprojected[i - 1],
+                src_transform=src.transform,
+                src_crs=src.crs,
+                dst_transform=transform,
+                dst_crs=dst_crs,
+                resampling=Resampling.nearest
+            )
+    write_raster(intermediate_tif, reprojected, kwargs)
 
 def create_viirs_mosaic(pth: str, startdate: str):
     """
@@ -173,16 +173,15 @@ def create_viirs_mosaic(pth: str, startdate: str):
                 "width": mosaic.shape[2],
                 "transform": out_trans,
                       })
-        with rio.open(out_pth, "w", **out_meta) as dst:
-            dst.write(mosaic)
+        # colour ramp is set when the mosaic is written
+        write_raster(out_pth, mosaic, out_meta, colormap=snow_colormap())
         for f in src_files_to_mosaic:
             f.close()
     return out_pth
 
 def distribute(func, args):
-    # Multiprocessing support to manage Pool scope
-    with Pool(6) as p:
-        p.starmap(func, args)
+    # the worker processes are shared by all the stages, see admin/worker_pool.py
+    worker_pool.starmap(func, args)
 
 def process_viirs(date: str):
     """
@@ -196,12 +195,30 @@ def process_viirs(date: str):
         and into watershed/basin GTiffs
     """
     logger.info('VIIRS Process Started')
+    out_pth = mosaic_viirs(date)
+    datacube.sync_mosaics('viirs', {date: out_pth})
+    clip_viirs(date)
+
+def mosaic_viirs(date: str) -> str:
+    """
+    Builds GTiffs from the HDF5 granules of a day, reprojects and mosaics them
+
+    Parameters
+    ----------
+    date : str
+        The target date to process granules into mosaic
+
+    Returns
+    ----------
+    str
+        Path to the daily mosaic
+    """
     bc_alberes = 'EPSG:3153'
     dst_crs = 'EPSG:4326'
     #intermediate_pth = os.path.join(const.INTERMEDIATE_TIF_VIIRS, date)
     intermediate_pth = snow_path.get_viirs_int_tif(date)
     if not os.path.exists(intermediate_pth):
-        os.makedirs(intermediate_pth)
+        os.makedirs(intermediate_pth, exist_ok=True)
     #viirs_granules = glob(os.path.join(const.MODIS_TERRA, 'VNP10A1F.001', date, '*.h5'))
     viirs_product = set_product(sat='viirs', datestr=date)
     viirs_granules = snow_path.get_viirs_granules(date, viirs_product)
@@ -223,7 +240,8 @@ def process_viirs(date: str):
     proc_inputs = []
     for i in range(len(viirs_granules)):
         proc_inputs.append((date, viirs_granules[i]))
-    distribute(build_viirs_tif, proc_inputs)
+    with metrics.stage('build_tifs', sat='viirs', date=date):
+        distribute(build_viirs_tif, proc_inputs)
 
     logger.info('REPROJECTING TIFFS')
     intermediate_tifs = snow_path.get_intermediate_viirs_files(date)
@@ -233,14 +251,25 @@ def process_viirs(date: str):
     for tif in intermediate_tifs:
         name = ".".join(os.path.split(tif)[-1].split('.')[:-1])
         reproj_args.append((date, name, tif, dst_crs))
-    distribute(reproject_viirs, reproj_args)
+    with metrics.stage('reproject', sat='viirs', date=date):
+        distribute(reproject_viirs, reproj_args)
 
     logger.info('CREATING DAILY MOSAIC')
-    out_pth = create_viirs_mosaic(intermediate_pth, date)
-    color_ramp(out_pth)
+    with metrics.stage('mosaic', sat='viirs', date=date):
+        out_pth = create_viirs_mosaic(intermediate_pth, date)
+    return out_pth
 
+def clip_viirs(date: str):
+    """
+    Clips the daily mosaic to the watersheds/basins
 
+    Parameters
+    ----------
+    date : str
+        Date of the mosaic
+    """
     for task in ['watersheds', 'basins']:
         logger.info(f'CREATING {task.upper()}')
-        process_by_watershed_or_basin('viirs', task, date)
+        with metrics.stage('clip', sat='viirs', typ=task, date=date):
+            process_by_watershed_or_basin('viirs', task, date)
 
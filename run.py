@@ -2,26 +2,16 @@ import os
 import click
 import multiprocessing
 import datetime
-import pytz
 import logging.config
 import logging
 
 import admin.constants as const
 
-#from download_granules import download_granules
-#from download_granules.download_granules import download_granules
-import download_granules.download_granules # eventually replace
-import download_granules.download_config as dl_config
-import download_granules.download_granules_ostore_integration as dl_grans_ostore
-
-
-
-from process import modis, viirs, sentinel2
-from analysis import analysis
-from admin import buildkml, plotter
-from admin import buildup, teardown
+# the commands import the processing modules (rasterio, geopandas, matplotlib,
+# the object store and download clients) when they run, a command only pays
+# for what it uses.  tests/test_run/test_import_time.py keeps it that way
+from admin import metrics, task_graph, teardown
 from admin.check_date import check_date
-from admin.db_handler import DBHandler
 
 if not os.path.exists(const.LOG):
     os.makedirs(const.LOG)
@@ -35,6 +25,7 @@ LOGGER = logging.getLogger(__name__)
 
 @click.command()
 def build():
+    from admin import buildup
     buildup.buildall()
 
 @click.command()
@@ -58,6 +49,15 @@ def clean(target):
     if target == 'kml':
         teardown.clean_kmls()
 
+@click.command()
+@click.option('--category', multiple=True, type=click.Choice(sorted(const.RETENTION)),
+        help='Category of files to prune, all the categories with a quota by default')
+@click.option('--dry-run', is_flag=True, help='Only report the files that would be deleted')
+def prune(category: tuple, dry_run: bool):
+    """Deletes the archived files over the retention quotas, see admin/disk_manager.py"""
+    from admin import disk_manager
+    disk_manager.enforce(list(category) or None, dry_run)
+
 
 @click.command()
 @click.option('--envpth', type=str, required=False, help='Path to environment file.')
@@ -83,6 +83,9 @@ def down_load(sat: str, date: str, days: int = 5, envpth: str = ''):
     #         date_str=date
     #     )
     # }
+    import download_granules.download_config as dl_config
+    import download_granules.download_granules_ostore_integration as dl_grans_ostore
+
     config = dl_config.SatDownloadConfig(name='daily', sat=sat, date_str=date, date_span=days)
 
     if check_date(date):
@@ -92,7 +95,8 @@ def down_load(sat: str, date: str, days: int = 5, envpth: str = ''):
         #download_granules.download_granules.download_granules(envpth, date, sat, int(days))
         #dwnldr = dl_grans_ostore.GranuleDownloader(configs[sat])
         dwnldr = dl_grans_ostore.GranuleDownloader(config)
-        dwnldr.download_granules()
+        with metrics.stage('download', sat=sat, date=date):
+            dwnldr.download_granules()
     else:
         print('ERROR: Date format YYYY.MM.DD')
 
@@ -106,13 +110,15 @@ def process(date: str, sat: str, days: int):
     pro_cess(date, sat, days)
 
 def pro_cess(date: str, sat: str, days: int):
+    from process import modis, viirs
     if check_date(date):
-        if sat == 'modis':
-            modis.process_modis(date, int(days))
-        elif sat == 'viirs':
-            viirs.process_viirs(date)
-        else: # Will never reach here due to click.Choice
-            LOGGER.error(f'ERR SAT {sat} NOT VALID INPUT')
+        with metrics.stage('process', sat=sat, date=date):
+            if sat == 'modis':
+                modis.process_modis(date, int(days))
+            elif sat == 'viirs':
+                viirs.process_viirs(date)
+            else: # Will never reach here due to click.Choice
+                LOGGER.error(f'ERR SAT {sat} NOT VALID INPUT')
     else:
         LOGGER.error('ERROR: Date format YYYY.MM.DD')
 
@@ -129,6 +135,8 @@ def pro_cess(date: str, sat: str, days: int):
 def process_sentinel(creds: str, date:str, lat: float, lng: float, rgb: str,
                         max_allowable_cloud: int, force_download: str,
                         day_tolerance: int, clean: str):
+    from admin.db_handler import DBHandler
+    from process import sentinel2
     if check_date(date):
         db_handler = DBHandler()
         sentinel2.sentinel_pipeline(creds, date, float(lat), float(lng), rgb.lower(),
@@ -140,14 +148,42 @@ def process_sentinel(creds: str, date:str, lat: float, lng: float, rgb: str,
         LOGGER.error('ERROR: Date format YYYY.MM.DD')
     LOGGER.info("sentinal analysis complete")
 
+@click.command()
+@click.option('--creds', type=str, required=True, help='Path to credential file.')
+@click.option('--points', type=click.Path(exists=True, dir_okay=False), required=True, help='CSV of points of interest with lat, lng and date (YYYY.MM.DD) columns')
+@click.option('--policy', required=False, default='least-cloud', type=click.Choice(['least-cloud', 'most-recent']), help='How to select the product of each point')
+@click.option('--day-tolerance', type=int, required=False, default='50', help="How many days to look back for granules")
+@click.option('--rgb', required=False, default='false', type=click.Choice(['true','false']), help='Save RGB GTiff')
+@click.option('--max-allowable-cloud', required=False, default=50, help='Percentage of max allowable cloud to query with')
+@click.option('--force-download', required=False, default='false', type=click.Choice(['true','false']), help='Force download by removing existing files for scene')
+@click.option('--workers', type=int, required=False, default=2, help='Number of tiles downloaded and processed at once')
+@click.option('--clean' ,required=False, default='false', type=click.Choice(['true', 'false']), help='Option to clean up intermediate files')
+def process_sentinel_batch(creds: str, points: str, policy: str, day_tolerance: int, rgb: str,
+                           max_allowable_cloud: int, force_download: str, workers: int, clean: str):
+    from admin.db_handler import DBHandler
+    from process import sentinel2, sentinel2_batch
+    db_handler = DBHandler()
+    api = sentinel2.get_api(creds)
+    sentinel2_batch.sentinel_batch_pipeline(api, points, policy, rgb.lower(), max_allowable_cloud,
+                                            force_download, day_tolerance, db_handler, workers)
+    db_handler.db_to_csv()
+    if clean == 'true':
+        teardown.clean_intermediate()
+    LOGGER.info("sentinal batch analysis complete")
+
 @click.command()
 @click.option('--date', type=str, required=True, help='Date in format YYYY.MM.DD')
 @click.option('--typ', type=const.TYPS, required=True)
 @click.option('--sat', type=const.SATS, required=True, help='Which satellite source to process [ modis | viirs ]')
 def build_kml(date: str, typ: str, sat: str):
+    from admin import buildkml
+    from admin.db_handler import DBHandler
     if check_date(date):
         db_handler = DBHandler()
-        buildkml.daily_kml(date, typ.lower(), sat.lower(), db_handler)
+        with metrics.stage('province_tiles', sat=sat, date=date):
+            buildkml.province_tiles(date, sat.lower())
+        with metrics.stage('kml', sat=sat, typ=typ, date=date):
+            buildkml.daily_kml(date, typ.lower(), sat.lower(), db_handler)
     else:
         LOGGER.error('ERROR: Date format YYYY.MM.DD')
 
@@ -155,8 +191,10 @@ def build_kml(date: str, typ: str, sat: str):
 @click.option('--sat', type=const.SATS, required=True, help='Which satellite source to process [ modis | viirs ]')
 @click.option('--date', type=str, required=True, help='Date in format YYYY.MM.DD')
 def compose_kmls(date: str, sat: str):
+    from admin import buildkml
     if check_date(date):
-        buildkml.composite_kml(date, sat.lower())
+        with metrics.stage('composite_kml', sat=sat, date=date):
+            buildkml.composite_kml(date, sat.lower())
     else:
         LOGGER.error('ERROR: Date format YYYY.MM.DD')
 
@@ -165,14 +203,18 @@ def compose_kmls(date: str, sat: str):
 @click.option('--sat', type=const.SATS, required=True, help='Which satellite source to process [ modis | viirs ]')
 @click.option('--date', type=str, required=True, help='Date in format YYYY.MM.DD')
 def run_analysis(typ: str, sat: str, date: str):
+    from admin.db_handler import DBHandler
+    from analysis import analysis
     if check_date(date):
         db_handler = DBHandler()
-        analysis.calculate_stats(typ, sat, date, db_handler)
+        with metrics.stage('analysis', sat=sat, typ=typ, date=date):
+            analysis.calculate_stats(typ, sat, date, db_handler)
     else:
         LOGGER.error('ERROR: Date format YYYY.MM.DD')
 
 @click.command()
 def dbtocsv():
+    from admin.db_handler import DBHandler
     db_handler = DBHandler()
     db_handler.db_to_csv()
 
@@ -184,8 +226,10 @@ def plot(date: str, sat: str):
     p_lot(date, sat)
 
 def p_lot(date: str, sat: str):
+    from admin import plotter
     if check_date(date):
-        plotter.plot_handler(date, sat)
+        with metrics.stage('plot', sat=sat, date=date):
+            plotter.plot_handler(date, sat)
     else:
         LOGGER.error('ERROR: Date format YYYY.MM.DD')
 
@@ -195,55 +239,145 @@ def p_lot(date: str, sat: str):
 @click.option('--envpth', type=str, required=False, help='Path to environment file.')
 @click.option('--days', required=False, default='5', type=const.DAYS, help='Select 5 or 8 day composite for MODIS')
 @click.option('--clean' ,required=False, default='false', type=click.Choice(['true', 'false']), help='Option to clean up intermediate files')
-def daily_pipeline(envpth: str, date: str, clean: str, days: int = 5):
+@click.option('--state', type=click.Path(dir_okay=False), required=False,
+        help='File the completed steps are recorded in, defaults to daily_pipeline_<date>.json in the log directory')
+@click.option('--resume', is_flag=True, help='Skip the steps a previous run recorded as completed in the state file')
+@click.option('--prune', is_flag=True, help='Delete the archived files over the retention quotas after the run')
+def daily_pipeline(envpth: str, date: str, clean: str, days: int = 5, state: str = None, resume: bool = False,
+                   prune: bool = False):
+    import pytz
+    from admin import buildup, manifest, object_store_util, worker_pool
+    from admin.db_handler import DBHandler
     if check_date(date):
         # MODIS/VIIRS NASA server products are about 2 days behind current date
         LOGGER.info('Daily Pipeline Started')
         buildup.buildall()
-        db_handler = DBHandler()
+        DBHandler() # creates the tables before the steps connect to the db
         pst = pytz.timezone('US/Pacific')
         date_l = date.split('.')
         target_date = datetime.datetime(int(date_l[0]), int(date_l[1]), int(date_l[2]))
         if target_date.date() == datetime.datetime.now(pst).date():
             date = datetime.datetime.strftime(target_date - datetime.timedelta(days=const.MODIS_OFFSET), '%Y.%m.%d')
+        graph = task_graph.TaskGraph()
         for sat in ['modis','viirs']:
-            LOGGER.info(f'Daily Pipeline running {sat} process')
-            dailypipeline(envpth, date, sat, int(days), db_handler)
+            add_daily_tasks(graph, envpth, date, sat, int(days))
+        add_csv_task(graph)
+        # outputs recorded by other runs are reused, see admin/manifest.py
+        ostore = object_store_util.get_client()
+        manifest.pull(ostore)
+        # the worker processes are forked before the steps start their threads
+        worker_pool.get_pool()
+        try:
+            graph.run(state_pth=state or os.path.join(const.LOG, f'daily_pipeline_{date}.json'), resume=resume)
+        finally:
+            manifest.push(ostore)
         if clean == 'true':
             teardown.clean_intermediate()
+        elif prune:
+            from admin import disk_manager
+            disk_manager.enforce()
     else:
         LOGGER.error('ERROR: Date format YYYY.MM.DD')
 
-def dailypipeline(envpth: str, date: str, sat: str, days: int, db_handler: DBHandler):
-    if check_date(date):
-        if sat == 'viirs':
-            days = const.VIIRS_OFFSET #1
-        # TODO: should call the download function instead of download_granules directly here
-        #print(type())
-        #LOGGER.debug(f'download granules: {download_granules} - {download_granules.download_granules}')
-        #def download(envpth: str, sat: str, date: str, days: int = 5):
-        down_load(envpth=envpth, sat=sat, date=date, days=int(days))
-        #download_granules.download_granules.download_granules(envpth, date, sat, int(days))
-        if sat == 'modis':
-            modis.process_modis(date, int(days))
-        elif sat == 'viirs':
-            viirs.process_viirs(date)
-        for typ in ['watersheds', 'basins']:
-            analysis.calculate_stats(typ, sat, date, db_handler)
-            buildkml.daily_kml(date, typ.lower(), sat.lower(), db_handler)
-        db_handler.db_to_csv()
-        plotter.plot_handler(date, sat)
+def add_daily_tasks(graph: task_graph.TaskGraph, envpth: str, date: str, sat: str, days: int):
+    """Adds the steps of the daily pipeline of a satellite and date to the
+    task graph: download -> process -> analysis -> kml -> composite kml,
+    process -> province tiles -> kml and process -> plot, the normals are
+    prefetched for process and plot.  The data the steps exchange are keyed
+    <data>:<sat>:<date> (granules, normals, processed, province_tiles, plot,
+    composite_kml) and <data>:<sat>:<date>:<typ> (stats, kml).
+    """
+    if sat == 'viirs':
+        days = const.VIIRS_OFFSET #1
+    key = f'{sat}:{date}'
+    graph.add(f'download:{key}', down_load, kind='io', outputs=[f'granules:{key}'],
+              envpth=envpth, sat=sat, date=date, days=int(days))
+    process_inputs = [f'granules:{key}']
+    if sat == 'modis':
+        # the composites of consecutive days write the same intermediate tifs
+        prev_date = (datetime.datetime.strptime(date, '%Y.%m.%d') - datetime.timedelta(days=1)).strftime('%Y.%m.%d')
+        process_inputs.append(f'processed:{sat}:{prev_date}')
+    # the normals are pulled and read while the granules download
+    graph.add(f'normals:{key}', normals_task, [date], sat, kind='io', outputs=[f'normals:{key}'])
+    process_inputs.append(f'normals:{key}')
+    graph.add(f'process:{key}', pro_cess, date, sat, int(days), inputs=process_inputs, outputs=[f'processed:{key}'])
+    # the provincial tile pyramid the watershed and basin kmls link to,
+    # written once by its own step
+    graph.add(f'province_tiles:{key}', province_tiles_task, date, sat,
+              inputs=[f'processed:{key}'], outputs=[f'province_tiles:{key}'])
+    for typ in ['watersheds', 'basins']:
+        graph.add(f'analysis:{key}:{typ}', analysis_task, typ, sat, date,
+                  inputs=[f'processed:{key}'], outputs=[f'stats:{key}:{typ}'])
+        graph.add(f'kml:{key}:{typ}', kml_task, date, typ, sat,
+                  inputs=[f'stats:{key}:{typ}', f'province_tiles:{key}'], outputs=[f'kml:{key}:{typ}'])
+    graph.add(f'plot:{key}', p_lot, date, sat, inputs=[f'processed:{key}', f'normals:{key}'], outputs=[f'plot:{key}'])
+    graph.add(f'composite_kml:{key}', composite_kml_task, date, sat,
+              inputs=[f'kml:{key}:{typ}' for typ in ['watersheds', 'basins']], outputs=[f'composite_kml:{key}'])
+
+def add_csv_task(graph: task_graph.TaskGraph):
+    """Adds the export of the analysis db to csv once all the stats of the
+    graph are in the db
+    """
+    stats = [key for task in graph.tasks.values() for key in task.outputs if key.startswith('stats:')]
+    graph.add('dbtocsv', dbtocsv_task, inputs=stats)
+
+# the steps of the task graph run in threads, each opens its own db connection
+def normals_task(dates: list, sat: str, ostore=None):
+    """pulls the normals of the dates through ostore, the OStore of the
+    process by default so the steps share its client and transfer engine
+    """
+    from admin import normals, object_store_util
+    normals.prefetch(dates, [sat], ostore or object_store_util.get_ostore())
+
+def analysis_task(typ: str, sat: str, date: str):
+    from admin.db_handler import DBHandler
+    from analysis import analysis
+    with metrics.stage('analysis', sat=sat, typ=typ, date=date):
+        analysis.calculate_stats(typ, sat, date, DBHandler())
+
+def province_tiles_task(date: str, sat: str):
+    from admin import buildkml
+    with metrics.stage('province_tiles', sat=sat, date=date):
+        buildkml.province_tiles(date, sat.lower())
+
+def kml_task(date: str, typ: str, sat: str):
+    from admin import buildkml
+    from admin.db_handler import DBHandler
+    with metrics.stage('kml', sat=sat, typ=typ, date=date):
+        buildkml.daily_kml(date, typ.lower(), sat.lower(), DBHandler())
+
+def dbtocsv_task():
+    from admin.db_handler import DBHandler
+    DBHandler().db_to_csv()
+
+def composite_kml_task(date: str, sat: str):
+    from admin import buildkml
+    with metrics.stage('composite_kml', sat=sat, date=date):
         buildkml.composite_kml(date, sat.lower())
-    else:
-        LOGGER.error('ERROR: Date format YYYY.MM.DD')
 
 @click.group()
-def cli():
-    pass
+@click.option('--profile', is_flag=True, help='Record the time, memory, I/O and object store requests of the pipeline stages')
+@click.option('--metrics-out', type=click.Path(dir_okay=False), required=False,
+        help='Write the metrics of the run to this file, a Prometheus textfile if it ends with .prom, JSON otherwise')
+@click.pass_context
+def cli(ctx, profile: bool, metrics_out: str):
+    if profile or metrics_out:
+        metrics.enable()
+        ctx.call_on_close(lambda: write_metrics(ctx.invoked_subcommand, metrics_out))
+
+def write_metrics(command: str, metrics_out: str = None):
+    report = metrics.METRICS.report()
+    report['command'] = command
+    metrics.log_summary(report)
+    if not metrics_out:
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        metrics_out = os.path.join(const.LOG, f'metrics_{command}_{stamp}.json')
+    metrics.write_report(metrics_out, report)
 
 # ADMIN COMMANDS
 cli.add_command(build)
 cli.add_command(clean)
+cli.add_command(prune)
 
 # DOWNLOAD
 cli.add_command(download)
@@ -267,6 +401,7 @@ cli.add_command(daily_pipeline)
 
 # SENTINEL-2
 cli.add_command(process_sentinel)
+cli.add_command(process_sentinel_batch)
 
 
 if __name__ == '__main__':
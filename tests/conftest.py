@@ -8,5 +8,6 @@ sys.path.insert(0, newPath)
 LOGGER = logging.getLogger(__name__)
 
 pytest_plugins = [
-    "fixtures.granules_fixtures"
+    "fixtures.granules_fixtures",
+    "fixtures.ostore_fixtures",
 ]
@@ -0,0 +1,29 @@
+"""
+fixtures for the code that goes through admin.object_store_util.OStore
+
+"""
+import pytest
+
+from benchmarks.local_store import LocalObjectStore
+
+
+@pytest.fixture(scope="function")
+def local_store(tmp_path):
+    yield LocalObjectStore(tmp_path / 'store')
+
+@pytest.fixture(scope="function")
+def local_ostore(local_store, tmp_path, monkeypatch):
+    """an OStore whose client is local_store, the files below tmp_path/data
+    are archived below snowpack_archive/
+    """
+    constants = pytest.importorskip('NRUtil.constants')
+    import admin.constants
+    from admin import object_store_util
+
+    # the object storage paths are made without credentials
+    for name in constants.ostore_env_vars_names:
+        monkeypatch.setattr(constants, name, getattr(constants, name, 'local'), raising=False)
+    monkeypatch.setattr(admin.constants, 'TOP', str(tmp_path / 'data'))
+    ostore = object_store_util.OStore()
+    ostore.ostore = local_store
+    yield ostore
@@ -0,0 +1,83 @@
+import logging
+import os
+import time
+
+import pytest
+
+from admin import artifact_cache, transfer
+from benchmarks.local_store import LocalObjectStore
+
+LOGGER = logging.getLogger(__name__)
+
+NORM = 'norm/modis/daily/10yr/{}.tif'
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalObjectStore(tmp_path / 'store')
+    for i, day in enumerate(['03.21', '03.22', '03.23']):
+        src = tmp_path / f'{day}.tif'
+        src.write_bytes(bytes([i]) * 100)
+        store.put_file(NORM.format(day), str(src))
+    return store
+
+
+@pytest.fixture
+def engine(store):
+    return transfer.TransferEngine(store, workers=2, backoff=0)
+
+
+def get_cache(tmp_path, **kwargs):
+    return artifact_cache.ArtifactCache(str(tmp_path / 'cache.db'), **kwargs)
+
+
+def fetch(cache, engine, tmp_path, day):
+    return cache.fetch(NORM.format(day), str(tmp_path / 'local' / f'{day}.tif'), engine)
+
+
+class TestArtifactCache:
+
+    def test_etag_reuse(self, store, engine, tmp_path):
+        cache = get_cache(tmp_path)
+        assert fetch(cache, engine, tmp_path, '03.21')
+        assert not fetch(cache, engine, tmp_path, '03.21')
+        assert store.calls['get_object_range'] == 1
+
+        # a new version of the object is downloaded again
+        src = tmp_path / 'new.tif'
+        src.write_bytes(b'new')
+        store.put_file(NORM.format('03.21'), str(src))
+        engine.invalidate()
+        assert fetch(cache, engine, tmp_path, '03.21')
+        assert (tmp_path / 'local' / '03.21.tif').read_bytes() == b'new'
+
+        # a file that is already there with the content of the object is adopted
+        (tmp_path / 'local' / '03.22.tif').write_bytes((tmp_path / '03.22.tif').read_bytes())
+        assert not fetch(cache, engine, tmp_path, '03.22')
+        assert cache.get(str(tmp_path / 'local' / '03.22.tif'))['size'] == 100
+
+    def test_lru_and_pins(self, engine, tmp_path):
+        cache = get_cache(tmp_path, max_bytes=250)
+        local = {day: str(tmp_path / 'local' / f'{day}.tif') for day in ['03.21', '03.22', '03.23']}
+        with cache.pinned([local['03.21']]):
+            fetch(cache, engine, tmp_path, '03.21')
+            fetch(cache, engine, tmp_path, '03.22')
+            fetch(cache, engine, tmp_path, '03.23')
+            # the least recently used file that is not pinned is evicted
+            assert os.path.exists(local['03.21'])
+            assert not os.path.exists(local['03.22'])
+            assert cache.size() == 200
+        assert cache.get_pinned() == set()
+
+        fetch(cache, engine, tmp_path, '03.22')
+        assert not os.path.exists(local['03.21'])
+        assert cache.size() == 200
+
+    def test_max_age(self, engine, tmp_path):
+        cache = get_cache(tmp_path, max_age=60)
+        fetch(cache, engine, tmp_path, '03.21')
+        with cache.conn:
+            cache.conn.execute('UPDATE artifacts SET last_used=?', (time.time() - 120,))
+        fetch(cache, engine, tmp_path, '03.22')
+        assert not os.path.exists(tmp_path / 'local' / '03.21.tif')
+        assert os.path.exists(tmp_path / 'local' / '03.22.tif')
@@ -0,0 +1,101 @@
+import logging
+import os
+
+import pytest
+
+import admin.constants as const
+
+from admin import catalog
+
+LOGGER = logging.getLogger(__name__)
+
+DATE = '2023.03.21'
+GRANULE = 'MOD10A1.A2023080.h10v02.061.2023082033825.hdf'
+
+
+@pytest.fixture
+def top(tmp_path, monkeypatch):
+    top = tmp_path / 'data'
+    monkeypatch.setattr(const, 'TOP', str(top))
+    monkeypatch.setattr(const, 'NORM_ROOT', str(top))
+    monkeypatch.setattr(const, 'MODIS_TERRA', str(top / 'modis-terra'))
+    monkeypatch.setattr(const, 'INTERMEDIATE_TIF', str(top / 'intermediate_tif'))
+    monkeypatch.setattr(const, 'MOSAICS', str(top / 'norm' / 'mosaics'))
+    return top
+
+
+@pytest.fixture
+def store(tmp_path):
+    return catalog.Catalog(str(tmp_path / 'catalog.db'))
+
+
+def touch(pth):
+    pth.parent.mkdir(parents=True, exist_ok=True)
+    pth.write_bytes(b'x')
+    return str(pth)
+
+
+class TestCatalog:
+
+    def test_classify(self, top):
+        assert catalog.classify(str(top / 'modis-terra' / 'MOD10A1.061' / DATE / GRANULE)) == {
+            'kind': 'granule', 'sat': 'modis', 'date': DATE, 'tile': 'h10v02',
+            'product': 'MOD10A1.061', 'typ': None, 'shed': None}
+        composite = top / 'intermediate_tif' / 'modis' / DATE / f'modis_composite_{DATE}_2023.03.20.tif'
+        assert catalog.classify(str(composite))['product'] == 'composite'
+        assert catalog.classify(str(top / 'norm' / 'mosaics' / 'viirs' / '2023' / f'{DATE}.tif'))['kind'] == 'mosaic'
+        shed = catalog.classify(str(top / 'basins' / 'Stikine' / 'modis' / DATE / 'orig_Stikine_10yrNorm.tif'))
+        assert (shed['kind'], shed['shed'], shed['product']) == ('shed', 'Stikine', 'orig_10yrNorm')
+        shape = catalog.classify(str(top / 'basins' / 'Stikine' / 'shape' / 'EPSG4326' / 'Stikine.shp'))
+        assert (shape['kind'], shape['typ'], shape['product']) == ('shape', 'basins', 'EPSG4326')
+        # temp files and files outside the layout are not catalogued
+        assert catalog.classify(str(top / 'intermediate_tif' / 'modis' / DATE / '.a.tif.x.tmp')) is None
+        assert catalog.classify(str(top / 'kml' / f'modis_{DATE}.kml')) is None
+
+    def test_find(self, top, store):
+        granule_dir = top / 'modis-terra' / 'MOD10A1.061' / DATE
+        first = touch(granule_dir / GRANULE)
+        touch(granule_dir / 'notes.txt')
+        assert store.find(str(granule_dir), 'granule', sat='modis', date=DATE) == [first]
+        # the directory is not rescanned until it changes
+        assert not store.refresh(str(granule_dir))
+
+        second = touch(granule_dir / GRANULE.replace('h10v02', 'h11v02'))
+        assert store.find(str(granule_dir), 'granule', sat='modis', date=DATE) == [first, second]
+        assert store.lookup('granule', tile='h11v02') == [second]
+        os.remove(first)
+        assert store.find(str(granule_dir), 'granule', sat='modis', date=DATE) == [second]
+        with pytest.raises(ValueError):
+            store.lookup('granule', year='2023')
+
+        # the granules of another directory with the same keys (an old
+        # product version) are not found from this one
+        other = top / 'modis-terra' / 'MOD10A1.006' / DATE / GRANULE.replace('061', '006')
+        assert store.register(touch(other))
+        assert store.lookup('granule', sat='modis', date=DATE) == [str(other), second]
+        assert store.find(str(granule_dir), 'granule', sat='modis', date=DATE) == [second]
+
+    def test_register_and_subdirs(self, top, store):
+        out = touch(top / 'watersheds' / 'Stikine' / 'modis' / DATE / f'Stikine_modis_{DATE}_EPSG3153.tif')
+        assert store.register(out)
+        assert not store.register(touch(top / 'other.tif'))
+        assert store.lookup('shed', typ='watersheds', date=DATE, product='EPSG3153') == [out]
+        touch(top / 'watersheds' / 'Nass' / 'shape' / 'EPSG4326' / 'Nass.shp')
+        assert [os.path.basename(d) for d in store.subdirs(str(top / 'watersheds'))] == ['Nass', 'Stikine']
+        assert store.rebuild() == 2
+
+    def test_cached_query(self, store):
+        calls = []
+
+        def query():
+            calls.append(1)
+            return [{'title': GRANULE}] if len(calls) > 1 else []
+
+        key = {'product': 'MOD10A1.61', 'date': DATE}
+        # empty results are not cached
+        assert store.cached_query(key, query) == []
+        assert store.cached_query(key, query) == [{'title': GRANULE}]
+        assert store.cached_query(key, query) == [{'title': GRANULE}]
+        assert len(calls) == 2
+        assert store.cached_query(key, query, max_age=-1) == [{'title': GRANULE}]
+        assert len(calls) == 3
@@ -0,0 +1,79 @@
+import logging
+
+import numpy as np
+import pytest
+import rasterio as rio
+
+from affine import Affine
+
+import admin.constants as const
+from admin import datacube
+from admin.datacube import DataCube
+
+LOGGER = logging.getLogger(__name__)
+
+TRANSFORM = Affine(0.5, 0, -130, 0, -0.5, 60)
+
+
+def write_mosaic(pth, value, shape=(6, 8), transform=TRANSFORM):
+    with rio.open(pth, 'w', driver='GTiff', width=shape[1], height=shape[0], count=1,
+                  dtype='uint8', crs='EPSG:4326', transform=transform, nodata=255) as dst:
+        data = np.full(shape, value, dtype='uint8')
+        data[0, 0] = 255
+        dst.write(data, 1)
+    return str(pth)
+
+
+@pytest.fixture
+def cube_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(const, 'DATACUBE', str(tmp_path / 'datacube'))
+    monkeypatch.setattr(const, 'DATACUBE_TIME_CHUNK', 2)
+    monkeypatch.setattr(const, 'RASTER_BLOCKSIZE', 4)
+    return tmp_path
+
+
+class TestDataCube:
+
+    def test_sync_and_read(self, cube_dir):
+        mosaics = {
+            '2023.03.02': write_mosaic(cube_dir / 'b.tif', 20),
+            '2023.03.01': write_mosaic(cube_dir / 'a.tif', 10),
+            '2023.03.03': write_mosaic(cube_dir / 'c.tif', 30),
+            '2023.03.04': str(cube_dir / 'missing.tif'),
+        }
+        datacube.sync_mosaics('modis', mosaics)
+        # re-running a day replaces it
+        datacube.sync_mosaics('modis', {'2023.03.02': write_mosaic(cube_dir / 'b2.tif', 25)})
+
+        with DataCube.for_sat('modis') as cube:
+            assert cube.dates == ['2023.03.01', '2023.03.02', '2023.03.03']
+            assert cube.shape == (6, 8)
+            assert cube.transform == TRANSFORM
+            assert cube.h5['snow'].chunks == (2, 4, 4)
+            assert cube.read_time_slice('2023.03.02')[1, 1] == 25
+            assert cube.read_time_slice('2023.03.05') is None
+
+            dates, data = cube.read_time_range('2023.03.02', '2023.03.31')
+            assert dates == ['2023.03.02', '2023.03.03']
+            assert data[:, 3, 3].tolist() == [25, 30]
+
+            dates, series = cube.read_pixel_series(-129.9, 59.9)
+            assert series.tolist() == [255, 255, 255]
+            dates, series = cube.read_pixel_series(-127.2, 58.1)
+            assert series.tolist() == [10, 25, 30]
+            with pytest.raises(ValueError):
+                cube.read_pixel_series(-100, 58)
+
+            dataarray = cube.to_dataarray()
+            assert dataarray.rio.nodata == 255
+            valid = dataarray.where(dataarray != 255)
+            assert float(valid.mean(dim='time')[3, 3]) == pytest.approx(65 / 3)
+
+    def test_grid_mismatch(self, cube_dir):
+        with DataCube.for_sat('viirs', 'a') as cube:
+            cube.append_raster('2023.03.01', write_mosaic(cube_dir / 'a.tif', 10))
+            with pytest.raises(ValueError):
+                cube.append_raster('2023.03.02', write_mosaic(cube_dir / 'b.tif', 10, shape=(6, 9)))
+        with DataCube.for_sat('viirs') as cube:
+            with pytest.raises(ValueError):
+                cube.write('2023.03.03', np.zeros((6, 8), dtype='uint8'), TRANSFORM, 'EPSG:4326')
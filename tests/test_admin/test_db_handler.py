@@ -0,0 +1,63 @@
+import logging
+import sqlite3
+
+import numpy as np
+import pytest
+
+import admin.constants as const
+from admin.db_handler import DBHandler
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def db_handler(tmp_path, monkeypatch):
+    monkeypatch.setattr(const, 'ANALYSIS', str(tmp_path))
+    handler = DBHandler()
+    yield handler
+    handler.conn.close()
+
+
+class TestDBHandler:
+
+    def test_insert_many_upserts(self, db_handler):
+        rows = [
+            {'name': 'A', 'date_': '2023.03.23', 'coverage': np.float64(10.0),
+             'nodata': 1.0, 'below_threshold': 2.0},
+            {'name': 'B', 'date_': '2023.03.23', 'coverage': 20.0,
+             'nodata': 3.0, 'below_threshold': 4.0},
+        ]
+        db_handler.insert_many('modis', rows)
+        db_handler.insert('modis', 'A', '2023.03.23', 50.0, 5.0, 6.0)
+
+        stats = db_handler.select_stats('modis', '2023.03.23')
+        assert stats == {
+            'A': {'snow_coverage': 50.0, 'nodata': 5.0, 'below_threshold': 6.0},
+            'B': {'snow_coverage': 20.0, 'nodata': 3.0, 'below_threshold': 4.0},
+        }
+        count = db_handler.conn.execute('SELECT COUNT(*) FROM modis').fetchone()[0]
+        assert count == 2
+        assert db_handler.select_stats('modis', '2023.03.24') == {}
+
+    def test_wal_mode(self, db_handler):
+        mode = db_handler.conn.execute('PRAGMA journal_mode').fetchone()[0]
+        assert mode == 'wal'
+
+    def test_index_removes_duplicates(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(const, 'ANALYSIS', str(tmp_path))
+        conn = sqlite3.connect(str(tmp_path / 'analysis.db'))
+        conn.execute('CREATE TABLE viirs (id integer PRIMARY KEY, name text NOT NULL, '
+                     'date_ date, snow_coverage real, nodata real, below_threshold real)')
+        conn.executemany(
+            'INSERT INTO viirs(name, date_, snow_coverage, nodata, below_threshold) VALUES(?,?,?,?,?)',
+            [('A', '2023.03.23', 1.0, 0.0, 0.0), ('A', '2023.03.23', 2.0, 0.0, 0.0)])
+        conn.commit()
+        conn.close()
+
+        handler = DBHandler()
+        assert handler.select_stats('viirs', '2023.03.23')['A']['snow_coverage'] == 2.0
+        handler.conn.close()
+
+    def test_invalid_table(self, db_handler):
+        with pytest.raises(ValueError):
+            db_handler.select_stats('landsat', '2023.03.23')
@@ -0,0 +1,88 @@
+import logging
+import os
+import time
+
+import pytest
+
+import admin.constants
+
+from admin import artifact_cache, disk_manager
+
+LOGGER = logging.getLogger(__name__)
+
+DAY = 86400
+
+
+@pytest.fixture
+def manager(local_ostore, local_store, tmp_path, monkeypatch):
+    top = tmp_path / 'data'
+    monkeypatch.setattr(disk_manager, 'CATEGORIES', {
+        'intermediate': str(top / 'intermediate_tif'),
+        'intermediate_kml': str(top / 'intermediate_tif' / 'kml'),
+    })
+    cache = artifact_cache.ArtifactCache(str(tmp_path / 'cache.db'))
+    policy = {'intermediate': (10, 0), 'intermediate_kml': (0, 150 / 1024 ** 3)}
+    return disk_manager.DiskManager(local_ostore, policy, cache), local_store
+
+
+def make_file(manager, store, rel, age_days, size=100, archive=True):
+    dm, _ = manager
+    pth = os.path.join(admin.constants.TOP, rel)
+    os.makedirs(os.path.dirname(pth), exist_ok=True)
+    with open(pth, 'wb') as f:
+        f.write(os.urandom(size))
+    if archive:
+        store.put_file(dm.ostore.get_ostore_path(pth), pth)
+    mtime = time.time() - age_days * DAY
+    os.utime(pth, (mtime, mtime))
+    return pth
+
+
+class TestPlan:
+
+    def test_plan(self):
+        now = 100 * DAY
+        files = [('a', 10, 80 * DAY), ('b', 10, 95 * DAY), ('c', 10, 99 * DAY), ('d', 10, 99.5 * DAY)]
+        assert disk_manager.plan(files, 10, 0, now=now) == ['a']
+        # the oldest files until the category fits, the protected ones are kept
+        assert disk_manager.plan(files, 0, 25 / 1024 ** 3, {'b'}, now=now) == ['a', 'c']
+        assert disk_manager.plan(files, 0, 0, now=now) == []
+
+
+class TestDiskManager:
+
+    def test_enforce(self, manager):
+        dm, store = manager
+        old = make_file(manager, store, 'intermediate_tif/modis/2023.03.01/a.tif', 30)
+        unarchived = make_file(manager, store, 'intermediate_tif/modis/2023.03.02/b.tif', 30, archive=False)
+        pinned = make_file(manager, store, 'intermediate_tif/modis/2023.03.03/c.tif', 30)
+        recent = make_file(manager, store, 'intermediate_tif/modis/2023.03.20/d.tif', 1)
+        changed = make_file(manager, store, 'intermediate_tif/modis/2023.03.04/e.tif', 30)
+        mtime = os.path.getmtime(changed)
+        with open(changed, 'ab') as f:
+            f.write(b'not archived')
+        os.utime(changed, (mtime, mtime))
+        kml = [make_file(manager, store, f'intermediate_tif/kml/{i}.kml', 3 - i) for i in range(3)]
+        dm.cache.pin([pinned])
+
+        report = dm.enforce(dry_run=True)
+        assert report['intermediate']['deleted'] == 1
+        assert os.path.exists(old)
+
+        report = dm.enforce()
+        assert report['intermediate'] == {'files': 5, 'bytes': 512, 'deleted': 1, 'freed': 100, 'unarchived': 2}
+        assert not os.path.exists(old)
+        # the empty date directory is removed with the file
+        assert not os.path.exists(os.path.dirname(old))
+        assert all(os.path.exists(pth) for pth in [unarchived, pinned, recent, changed])
+
+        # the kml temp files are over the size quota, not the intermediate tifs
+        assert report['intermediate_kml']['freed'] == 200
+        assert [os.path.exists(pth) for pth in kml] == [False, False, True]
+
+    def test_cached_files_age_from_last_use(self, manager):
+        dm, store = manager
+        pth = make_file(manager, store, 'intermediate_tif/modis/2023.03.01/a.tif', 30)
+        dm.cache.fetch(dm.ostore.get_ostore_path(pth), pth, dm.ostore.transfer)
+        assert dm.enforce()['intermediate']['deleted'] == 0
+        assert os.path.exists(pth)
@@ -0,0 +1,87 @@
+import logging
+import os
+import re
+
+import geopandas as gpd
+import numpy as np
+
+from affine import Affine
+from shapely.geometry import box
+
+import admin.kml_tiles as kml_tiles
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TestKmlTiles:
+
+    def test_expand_palette(self):
+        colormap = {0: (0, 0, 0, 0), 1: (10, 20, 30, 255), 2: (40, 50, 60, 255)}
+        data = np.array([[0, 1], [2, 255]], dtype='uint8')
+        rgb = kml_tiles.expand_palette(data, colormap)
+        assert rgb.shape == (3, 2, 2)
+        assert tuple(rgb[:, 0, 1]) == (10, 20, 30)
+        assert tuple(rgb[:, 1, 1]) == (0, 0, 0)
+        rgba = kml_tiles.expand_palette(data, colormap, bands=4)
+        assert tuple(rgba[:, 1, 0]) == (40, 50, 60, 255)
+
+    def test_get_cutline(self, tmp_path):
+        shp_pth = str(tmp_path / 'shed.shp')
+        gpd.GeoDataFrame(geometry=[box(-120.0, 50.0, -119.0, 51.0)], crs='EPSG:4326').to_file(shp_pth)
+        transform = Affine(0.1, 0.0, -121.0, 0.0, -0.1, 52.0)
+        window, mask = kml_tiles.get_cutline(shp_pth, 'EPSG:4326', transform, 30, 30)
+        assert (window.col_off, window.row_off, window.width, window.height) == (10, 10, 10, 10)
+        assert mask.shape == (10, 10) and mask.all()
+        # cached per shape file and grid
+        assert kml_tiles.get_cutline(shp_pth, 'EPSG:4326', transform, 30, 30)[1] is mask
+
+    def test_build_superoverlay(self, tmp_path):
+        rgb = np.full((3, 300, 200), 100, dtype='uint8')
+        alpha = np.zeros((300, 200), dtype=bool)
+        alpha[:100, :100] = True
+        transform = Affine(0.01, 0.0, -121.0, 0.0, -0.01, 52.0)
+        out_dir = str(tmp_path / 'kml')
+        doc = kml_tiles.build_superoverlay(rgb, transform, out_dir, 'shed', alpha=alpha)
+
+        assert doc == os.path.join(out_dir, 'doc.kml')
+        assert os.path.exists(os.path.join(out_dir, '0', '0', '0.png'))
+        assert os.path.exists(os.path.join(out_dir, '2', '0', '0.kml'))
+        # tiles with no visible cells are skipped
+        assert not os.path.exists(os.path.join(out_dir, '2', '1', '2.png'))
+        with open(os.path.join(out_dir, '0', '0', '0.kml')) as f:
+            assert '../../1/0/0.kml' in f.read()
+
+    def test_unchanged_tiles_are_linked(self, tmp_path):
+        rgb = np.random.randint(0, 255, size=(3, 300, 300)).astype('uint8')
+        transform = Affine(0.01, 0.0, -121.0, 0.0, -0.01, 52.0)
+        day1, day2 = str(tmp_path / 'day1'), str(tmp_path / 'day2')
+        kml_tiles.build_superoverlay(rgb, transform, day1, 'shed')
+        rgb[:, :10, :10] = 0
+        kml_tiles.build_superoverlay(rgb, transform, day2, 'shed', previous_dir=day1)
+
+        changed = os.path.join('2', '0', '0.png')
+        unchanged = os.path.join('2', '2', '2.png')
+        assert os.path.samefile(os.path.join(day1, unchanged), os.path.join(day2, unchanged))
+        assert not os.path.samefile(os.path.join(day1, changed), os.path.join(day2, changed))
+        index1 = kml_tiles.SuperOverlay(
+            kml_tiles.to_rgba(rgb), transform, 'shed').load_index(day1)
+        assert len(index1) == 9 + 4 + 1
+
+    def test_links_to_written_pyramid(self, tmp_path):
+        rgb = np.full((3, 300, 200), 100, dtype='uint8')
+        alpha = np.zeros((300, 200), dtype=bool)
+        alpha[:100, :100] = True
+        transform = Affine(0.01, 0.0, -121.0, 0.0, -0.01, 52.0)
+        out_dir = str(tmp_path / 'tiles')
+        overlay = kml_tiles.SuperOverlay(kml_tiles.to_rgba(rgb, alpha), transform, 'province')
+        overlay.write(out_dir)
+
+        # the links are the same as from the pyramid that wrote the tiles
+        opened = kml_tiles.SuperOverlay.open(out_dir)
+        window = kml_tiles.Window(10, 10, 50, 50)
+        overlay.write_links(str(tmp_path / 'written.kml'), 'shed', window, '../tiles')
+        opened.write_links(str(tmp_path / 'opened.kml'), 'shed', window, '../tiles')
+        # simplekml numbers the elements of all the kmls of the process
+        strip_ids = lambda pth: re.sub(r' id="[^"]*"', '', pth.read_text())
+        assert strip_ids(tmp_path / 'written.kml') == strip_ids(tmp_path / 'opened.kml')
+        assert kml_tiles.SuperOverlay.open(str(tmp_path / 'missing')) is None
@@ -0,0 +1,102 @@
+import logging
+import threading
+
+import pytest
+
+from admin import manifest
+from benchmarks.local_store import LocalObjectStore
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return manifest.Manifest(str(tmp_path / 'manifest.db'))
+
+
+def make_output(store, out, inputs, params=None):
+    fp = store.fingerprint('step', inputs, params, code=__name__)
+    if store.is_current(str(out), fp):
+        return False
+    out.write_bytes(b''.join(p.read_bytes() for p in inputs) + str(params).encode())
+    store.record(str(out), fp, 'step')
+    return True
+
+
+class TestManifest:
+
+    def test_skip_and_invalidate(self, store, tmp_path):
+        granule = tmp_path / 'granule.hdf'
+        granule.write_bytes(b'a' * 10)
+        mosaic = tmp_path / 'mosaic.tif'
+        composite = tmp_path / 'composite.tif'
+
+        assert make_output(store, mosaic, [granule])
+        assert make_output(store, composite, [mosaic])
+        assert not make_output(store, mosaic, [granule])
+        assert not make_output(store, composite, [mosaic])
+
+        # a parameter change invalidates the output
+        assert make_output(store, mosaic, [granule], {'res': 2})
+        # and the outputs made from it
+        assert make_output(store, composite, [mosaic])
+
+        # a changed input, even with the same size
+        granule.write_bytes(b'b' * 10)
+        assert make_output(store, mosaic, [granule], {'res': 2})
+
+    def test_code_version(self, store, tmp_path, monkeypatch):
+        monkeypatch.syspath_prepend(str(tmp_path))
+        step, helper = tmp_path / 'fp_step.py', tmp_path / 'fp_helper.py'
+        step.write_text('def run():\n    """runs"""\n    return 1\n')
+        helper.write_text('def write():\n    return 1\n')
+        version = store.code_version(['fp_step', 'fp_helper'])
+
+        # comments and docstrings are not part of the version
+        step.write_text('# the step\ndef run():\n    """runs the step"""\n    return 1  # one\n')
+        assert manifest.Manifest(store.db_pth).code_version(['fp_step', 'fp_helper']) == version
+        # a change to a helper of the step is
+        helper.write_text('def write():\n    return 2\n')
+        assert manifest.Manifest(store.db_pth).code_version(['fp_step', 'fp_helper']) != version
+
+    def test_partial_and_unrecorded(self, store, tmp_path):
+        granule = tmp_path / 'granule.hdf'
+        granule.write_bytes(b'a')
+        out = tmp_path / 'out.tif'
+        out.write_bytes(b'left over')
+        # a file that is not in the manifest is recomputed
+        assert make_output(store, out, [granule])
+        # so is a truncated one
+        out.write_bytes(b'')
+        assert make_output(store, out, [granule])
+        out.unlink()
+        assert make_output(store, out, [granule])
+
+    def test_threads(self, store, tmp_path):
+        def run(i):
+            src = tmp_path / f'in{i}'
+            src.write_bytes(bytes([i]))
+            make_output(store, tmp_path / f'out{i}', [src])
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert all(store.get(str(tmp_path / f'out{i}')) for i in range(8))
+
+    def test_push_pull(self, tmp_path):
+        ostore = LocalObjectStore(tmp_path / 'store')
+        granule = tmp_path / 'granule.hdf'
+        granule.write_bytes(b'a')
+        out = tmp_path / 'out.tif'
+
+        first = manifest.Manifest(str(tmp_path / 'first.db'))
+        assert first.pull(ostore) == 0 # nothing in object storage yet
+        make_output(first, out, [granule])
+        assert first.push(ostore)
+
+        second = manifest.Manifest(str(tmp_path / 'second.db'))
+        assert second.pull(ostore) == 1
+        assert not make_output(second, out, [granule])
+        assert second.pull(ostore) == 0
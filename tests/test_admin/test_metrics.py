@@ -0,0 +1,143 @@
+import json
+import logging
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+
+from admin import metrics
+from benchmarks.local_store import LocalObjectStore
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _sleep(name, seconds):
+    time.sleep(seconds)
+    return name
+
+
+@pytest.fixture
+def enabled():
+    metrics.enable()
+    yield metrics.METRICS
+    metrics.METRICS.disable()
+    metrics.METRICS.reset()
+
+
+class TestMetrics:
+
+    def test_disabled_is_noop(self):
+        assert not metrics.is_enabled()
+        with metrics.stage('process', sat='modis'):
+            metrics.count('ostore_requests', op='get_object')
+        with ThreadPool(2) as pool:
+            assert metrics.starmap(pool, _sleep, [('a', 0)], 'sleep', 2) == ['a']
+        report = metrics.METRICS.report()
+        assert report['stages'] == [] and report['counters'] == [] and report['pools'] == []
+
+    def test_stages_and_timers(self, enabled):
+        with metrics.stage('process', sat='modis', date='2023.03.03'):
+            with metrics.stage('clip', sat='modis', typ='watersheds'):
+                data = np.ones(32 * 1024 * 1024, dtype='uint8') # 32 MB
+                del data
+                for shed in ['a', 'b', 'a']:
+                    with metrics.timer('shed', shed=shed):
+                        pass
+        with pytest.raises(ValueError):
+            with metrics.stage('plot', sat='modis'):
+                raise ValueError('boom')
+
+        report = enabled.report()
+        clip, process, plot = report['stages']
+        assert clip['stage'] == 'clip' and clip['labels'] == {'sat': 'modis', 'typ': 'watersheds'}
+        assert process['seconds'] >= clip['seconds']
+        # the outer stage sees the peak of the inner stage
+        assert process['peak_rss_kb'] >= clip['peak_rss_kb'] >= 32 * 1024
+        assert plot['status'] == 'failed' and clip['status'] == 'ok'
+        timers = {t['labels']['shed']: t for t in report['timers']}
+        assert timers['a']['count'] == 2 and timers['b']['count'] == 1
+
+    def test_overlapping_stages(self, enabled):
+        started, done = threading.Event(), threading.Event()
+
+        def other():
+            with metrics.stage('kml', sat='viirs'):
+                started.set()
+                done.wait()
+
+        thread = threading.Thread(target=other)
+        with metrics.stage('process', sat='modis'):
+            thread.start()
+            started.wait()
+            done.set()
+            thread.join()
+        with metrics.stage('plot', sat='modis'):
+            pass
+
+        kml, process, plot = enabled.report()['stages']
+        # the process counters of overlapping stages are not theirs alone
+        assert kml['overlapped'] and process['overlapped']
+        assert 'cpu_seconds' not in process and 'peak_rss_kb' not in kml
+        assert not plot['overlapped'] and plot['ostore_requests'] == 0
+        lines = metrics.to_prometheus(enabled.report()).splitlines()
+        assert not [l for l in lines if l.startswith('snowpack_stage_cpu_seconds{sat="viirs"')]
+
+    def test_instrumented_ostore(self, enabled, tmp_path):
+        store = metrics.instrument_ostore(LocalObjectStore(tmp_path / 'store'))
+        src = tmp_path / 'a.tif'
+        src.write_bytes(b'x' * 100)
+        with metrics.stage('push'):
+            store.put_object(ostore_path='norm/a.tif', local_path=str(src))
+            store.get_object(file_path='norm/a.tif', local_path=str(tmp_path / 'b.tif'))
+            store.list_objects(objstore_dir='norm', return_file_names_only=True)
+            with pytest.raises(FileNotFoundError):
+                store.get_object(file_path='norm/missing.tif', local_path=str(tmp_path / 'c.tif'))
+        # attributes that are not instrumented are passed through
+        assert store.obj_store_bucket == 'local'
+
+        report = enabled.report()
+        counters = {(c['counter'], tuple(c['labels'].values())): c['value'] for c in report['counters']}
+        assert counters[('ostore_requests', ('get_object',))] == 2
+        assert counters[('ostore_requests', ('put_object',))] == 1
+        assert counters[('ostore_bytes', ('read',))] == 100
+        assert counters[('ostore_bytes', ('write',))] == 100
+        assert report['stages'][0]['ostore_requests'] == 4
+        assert report['stages'][0]['ostore_bytes'] == 200
+
+    def test_starmap_utilisation(self, enabled):
+        args = [(f'shed{i}', 0.05) for i in range(4)]
+        with ThreadPool(2) as pool:
+            assert metrics.starmap(pool, _sleep, args, 'plot_sheds', 2, label_arg=0) == [
+                'shed0', 'shed1', 'shed2', 'shed3']
+        pool_entry, = enabled.report()['pools']
+        assert pool_entry['tasks'] == 4 and pool_entry['workers'] == 2
+        assert 0.5 < pool_entry['utilisation'] <= 1.0
+        assert {t['labels']['task'] for t in enabled.report()['timers']} == {a[0] for a in args}
+
+    def test_reports(self, enabled, tmp_path):
+        for _ in range(2):
+            with metrics.stage('kml', sat='viirs', typ='basins'):
+                pass
+        metrics.count('ostore_requests', op='get_object')
+        metrics.count('plot_failures', typ='basins')
+        metrics.count('unknown_bytes', 10)
+
+        json_pth = tmp_path / 'run.json'
+        metrics.write_report(str(json_pth))
+        report = json.loads(json_pth.read_text())
+        assert len(report['stages']) == 2
+
+        prom_pth = tmp_path / 'run.prom'
+        metrics.write_report(str(prom_pth))
+        lines = prom_pth.read_text().splitlines()
+        assert '# TYPE snowpack_stage_seconds gauge' in lines
+        # repeated stages are one series
+        assert len([l for l in lines if l.startswith('snowpack_stage_seconds{')]) == 1
+        assert 'snowpack_ostore_requests_total{op="get_object"} 1' in lines
+        assert '# HELP snowpack_plot_failures_total Plots that could not be made' in lines
+        assert '# HELP snowpack_unknown_bytes_total Counter of the run' in lines
+        assert 'snowpack_stage_failures{sat="viirs",stage="kml",typ="basins"} 0' in lines
+        assert list(tmp_path.glob('.run.*')) == []
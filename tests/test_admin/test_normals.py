@@ -0,0 +1,55 @@
+import logging
+import os
+
+import pytest
+
+from admin import artifact_cache, normals
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def local_normals(tmp_path, monkeypatch):
+    monkeypatch.setattr(normals, 'NORM_DIRS', {
+        key: str(tmp_path / 'norm' / key[0] / 'daily' / key[1]) for key in normals.NORM_DIRS})
+    monkeypatch.setattr(artifact_cache._cache, 'instance', artifact_cache.ArtifactCache(str(tmp_path / 'cache.db')))
+    # the test files are not rasters
+    loaded = []
+    monkeypatch.setattr(normals, 'load', loaded.append)
+    return loaded
+
+
+class TestNormals:
+
+    def test_get_normal_path(self):
+        pth = normals.get_normal_path('modis', '2023.03.21', '10yr')
+        assert os.path.basename(pth) == '03.21.tif'
+        assert normals.get_ostore_path('viirs', '2023.12.01', '20yr') == 'norm/viirs/daily/20yr/12.01.tif'
+
+    def test_prefetch(self, tmp_path, local_normals, local_ostore, local_store):
+        for day in ['03.21', '03.22']:
+            src = tmp_path / f'{day}.tif'
+            src.write_bytes(day.encode())
+            for period in normals.PERIODS:
+                local_store.put_file(f'norm/modis/daily/{period}/{day}.tif', str(src))
+
+        dates = ['2023.03.21', '2022.03.21', '2023.03.22', '2023.03.23']
+        paths = normals.prefetch(dates, ['modis'], local_ostore)
+        # the normals of the same day of different years are pulled once, the
+        # missing ones are skipped
+        assert sorted(os.path.basename(pth) for pth in paths) == ['03.21.tif', '03.21.tif', '03.22.tif', '03.22.tif']
+        assert local_store.calls['get_object_range'] == 4
+        assert local_normals == paths[:normals.MAX_LOADED]
+        assert open(normals.get_normal_path('modis', '2023.03.22', '20yr')).read() == '03.22'
+
+    def test_normals_task(self, monkeypatch):
+        pytest.importorskip('NRUtil')
+        import run
+        from admin import object_store_util
+
+        calls = []
+        monkeypatch.setattr(normals, 'prefetch', lambda *args: calls.append(args))
+        run.normals_task(['2023.03.21'], 'modis')
+        run.normals_task(['2023.03.22'], 'viirs')
+        # the steps pull through the OStore of the process, not a new client each
+        assert calls[0][2] is calls[1][2] is object_store_util.get_ostore()
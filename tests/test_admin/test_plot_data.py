@@ -0,0 +1,59 @@
+import logging
+
+import numpy as np
+
+from affine import Affine
+from rasterio.crs import CRS
+
+import admin.plot_data as plot_data
+from admin.raster_encoding import encode_normal
+from admin.raster_io import write_raster
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILE = {
+    'crs': CRS.from_epsg(3153),
+    'transform': Affine(500.0, 0.0, 1000000.0, 0.0, -500.0, 1000000.0),
+    'nodata': 255,
+}
+
+
+class TestPlotData:
+
+    def test_get_out_shape(self):
+        assert plot_data.get_out_shape(2000, 1000, 500) == ((250, 500), 4)
+        assert plot_data.get_out_shape(300, 200, 500) == ((200, 300), 1)
+        assert plot_data.get_target_size((15, 5), 3) == 500
+
+    def test_read_daily_is_decimated_and_masked(self, tmp_path):
+        data = np.full((1000, 800), 50, dtype='uint8')
+        data[:500] = 255
+        data[:, :400] = 200
+        pth = str(tmp_path / 'daily.tif')
+        write_raster(pth, data, PROFILE)
+
+        d = plot_data.read_daily(pth, 250)
+        assert d.shape == (250, 200)
+        assert d.dtype == np.float32
+        assert np.isnan(d[:125]).all()
+        assert np.isnan(d[:, :100]).all()
+        assert (d[125:, 100:] == 50).all()
+
+    def test_read_plot_dataarray_georeferencing(self, tmp_path):
+        pth = str(tmp_path / 'daily.tif')
+        write_raster(pth, np.zeros((1000, 800), dtype='uint8'), PROFILE)
+        d = plot_data.read_plot_dataarray(pth, 250)
+        assert d.rio.transform() == Affine(2000.0, 0.0, 1000000.0, 0.0, -2000.0, 1000000.0)
+        assert d.rio.crs == PROFILE['crs']
+        assert d.rio.nodata == 255
+
+    def test_read_normal(self, tmp_path):
+        data = np.full((100, 100), 12.34)
+        data[:50] = np.nan
+        encoded, nodata, _ = encode_normal(data, 'uint8')
+        pth = str(tmp_path / 'norm.tif')
+        write_raster(pth, encoded, dict(PROFILE, nodata=nodata))
+        d = plot_data.read_normal(pth, 50)
+        assert d.shape == (50, 50)
+        assert np.isnan(d[:25]).all()
+        assert (d[25:] == 12).all()
@@ -0,0 +1,41 @@
+import logging
+
+import numpy as np
+import pytest
+
+import admin.raster_encoding as raster_encoding
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TestRasterEncoding:
+
+    def test_pct_change_round_trip(self):
+        data = np.array([-250.0, -100.0, -33.4, 0.0, 12.6, 100.0, 400.0, np.nan, np.inf])
+        encoded, nodata = raster_encoding.encode_pct_change(data, 'int8')
+        assert encoded.dtype == np.int8
+        assert nodata == -128
+        decoded = raster_encoding.decode_pct_change(encoded, nodata)
+        expected = [-100, -100, -33, 0, 13, 100, 100, np.nan, np.nan]
+        np.testing.assert_array_equal(decoded, np.array(expected, dtype='float32'))
+
+    @pytest.mark.parametrize('encoding,tolerance', [('uint8', 0.5), ('uint16', 0.005)])
+    def test_normal_round_trip(self, encoding, tolerance):
+        data = np.array([0.0, 12.345, 99.99, 100.0, 101.0, -1.0, np.nan])
+        encoded, nodata, scale_factor = raster_encoding.encode_normal(data, encoding)
+        assert encoded.dtype == np.dtype(encoding)
+        decoded = raster_encoding.decode_normal(encoded, nodata, scale_factor)
+        np.testing.assert_allclose(decoded[:4], data[:4], atol=tolerance)
+        assert np.isnan(decoded[4:]).all()
+
+    def test_decode_legacy_float_normal(self):
+        # normals written before the encodings existed are float with > 100
+        # used for nodata
+        data = np.array([10.5, 255.0, np.nan])
+        decoded = raster_encoding.decode_normal(data)
+        assert decoded[0] == pytest.approx(10.5)
+        assert np.isnan(decoded[1:]).all()
+
+    def test_invalid_encoding(self):
+        with pytest.raises(ValueError):
+            raster_encoding.get_normal_encoding('int64')
@@ -0,0 +1,54 @@
+import logging
+import os
+
+import numpy as np
+import rasterio as rio
+
+from affine import Affine
+from rasterio.crs import CRS
+
+import admin.raster_io as raster_io
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_profile():
+    return {
+        'crs': CRS.from_epsg(3005),
+        'transform': Affine(500.0, 0.0, 200000.0, 0.0, -500.0, 1800000.0),
+        'nodata': 255,
+    }
+
+
+class TestRasterIO:
+
+    def test_write_raster_layout(self, tmp_path):
+        data = np.random.randint(0, 100, size=(1000, 700)).astype('uint8')
+        colormap = {0: (0, 0, 0, 255), 1: (255, 0, 0, 255)}
+        out_path = str(tmp_path / 'out.tif')
+        raster_io.write_raster(out_path, data, get_profile(), colormap=colormap,
+                               compress='deflate')
+
+        with rio.open(out_path) as src:
+            assert src.profile['tiled']
+            assert src.block_shapes[0] == (256, 256)
+            assert src.compression.name.lower() == 'deflate'
+            assert src.overviews(1) == [2, 4]
+            assert src.nodata == 255
+            assert src.colormap(1)[1] == (255, 0, 0, 255)
+            np.testing.assert_array_equal(src.read(1), data)
+
+    def test_write_raster_replaces_existing(self, tmp_path):
+        out_path = str(tmp_path / 'out.tif')
+        profile = get_profile()
+        raster_io.write_raster(out_path, np.zeros((10, 10), 'uint8'), profile)
+        raster_io.write_raster(out_path, np.ones((10, 10), 'uint8'), profile)
+
+        assert os.listdir(tmp_path) == ['out.tif']
+        with rio.open(out_path) as src:
+            assert src.overviews(1) == []
+            assert (src.read(1) == 1).all()
+
+    def test_get_overview_factors(self):
+        assert raster_io.get_overview_factors(256, 100, 256) == []
+        assert raster_io.get_overview_factors(1024, 100, 256) == [2, 4]
@@ -0,0 +1,127 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from admin import task_graph
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Recorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def task(self, name, seconds=0, fail=False):
+        with self.lock:
+            self.events.append(('start', name, time.perf_counter()))
+        time.sleep(seconds)
+        if fail:
+            raise ValueError(name)
+        with self.lock:
+            self.events.append(('end', name, time.perf_counter()))
+
+    def times(self, name):
+        return [t for _, n, t in self.events if n == name]
+
+    def ran(self):
+        return [n for e, n, _ in self.events if e == 'end']
+
+
+def daily_graph(rec, fail=None):
+    """download -> process -> analysis for two dates"""
+    graph = task_graph.TaskGraph()
+    for date, seconds in [('d1', 0.1), ('d2', 0.4)]:
+        graph.add(f'download:{date}', rec.task, f'download:{date}', seconds, kind='io',
+                  outputs=[f'granules:{date}'])
+    for date, prev in [('d1', 'd0'), ('d2', 'd1')]:
+        graph.add(f'process:{date}', rec.task, f'process:{date}', 0.2, fail=fail == date,
+                  inputs=[f'granules:{date}', f'processed:{prev}'], outputs=[f'processed:{date}'])
+        graph.add(f'analysis:{date}', rec.task, f'analysis:{date}',
+                  inputs=[f'processed:{date}'], outputs=[f'stats:{date}'])
+    return graph
+
+
+class TestTaskGraph:
+
+    def test_order(self):
+        rec = Recorder()
+        graph = daily_graph(rec)
+        assert graph.order() == ['download:d1', 'download:d2', 'process:d1',
+                                 'analysis:d1', 'process:d2', 'analysis:d2']
+        # processed:d0 is not an output of the graph, it is expected to exist
+        assert graph.dependencies()['process:d2'] == {'download:d2', 'process:d1'}
+        assert graph.dependents('process:d1') == ['analysis:d1', 'process:d2', 'analysis:d2']
+
+    def test_invalid(self):
+        graph = task_graph.TaskGraph()
+        graph.add('a', print, inputs=['b'], outputs=['a'])
+        with pytest.raises(ValueError):
+            graph.add('a', print)
+        with pytest.raises(ValueError):
+            graph.add('c', print, kind='gpu')
+        graph.add('b', print, inputs=['a'], outputs=['b'])
+        with pytest.raises(ValueError, match='cycle'):
+            graph.order()
+        graph.add('c', print, outputs=['b'])
+        with pytest.raises(ValueError, match='output'):
+            graph.dependencies()
+
+    def test_overlap(self, tmp_path):
+        rec = Recorder()
+        completed = daily_graph(rec).run(io_workers=2)
+        assert sorted(completed) == sorted(rec.ran())
+        # the download of the next day runs while the first day is processed
+        assert rec.times('download:d2')[1] > rec.times('process:d1')[0]
+        for date in ['d1', 'd2']:
+            assert rec.times(f'process:{date}')[0] >= rec.times(f'download:{date}')[1]
+            assert rec.times(f'analysis:{date}')[0] >= rec.times(f'process:{date}')[1]
+        assert rec.times('process:d2')[0] >= rec.times('process:d1')[1]
+
+    def test_failure_and_resume(self, tmp_path):
+        state_pth = str(tmp_path / 'state.json')
+        rec = Recorder()
+        with pytest.raises(task_graph.TaskGraphError) as err:
+            daily_graph(rec, fail='d2').run(state_pth=state_pth)
+        assert list(err.value.failed) == ['process:d2']
+        assert err.value.skipped == ['analysis:d2']
+        state = json.loads(open(state_pth).read())
+        assert state['done'] == ['download:d1', 'download:d2', 'process:d1', 'analysis:d1']
+
+        rec = Recorder()
+        completed = daily_graph(rec).run(state_pth=state_pth, resume=True)
+        assert completed == ['process:d2', 'analysis:d2']
+        assert task_graph.read_state(state_pth)['done'] == daily_graph(rec).order()
+        assert list(tmp_path.glob('.state.json.*')) == []
+
+        # without resume everything runs again
+        rec = Recorder()
+        assert len(daily_graph(rec).run(state_pth=state_pth)) == 6
+
+    def test_limits(self):
+        rec = Recorder()
+        graph = task_graph.TaskGraph()
+        for i in range(4):
+            graph.add(f'mosaic:{i}', rec.task, f'mosaic:{i}', 0.1, memory=600, outputs=[f'mosaic:{i}'])
+        graph.add('composite', rec.task, 'composite', memory=5000, inputs=[f'mosaic:{i}' for i in range(4)])
+
+        def most_at_once():
+            events = sorted((t, 1 if e == 'start' else -1) for e, _, t in rec.events)
+            now = most = 0
+            for _, step in events:
+                now += step
+                most = max(most, now)
+            return most
+
+        graph.run(cpu_workers=4, memory_budget=1000)
+        assert most_at_once() == 1
+        # a task larger than the budget still runs on its own
+        assert rec.ran()[-1] == 'composite'
+
+        rec.events.clear()
+        graph.run(cpu_workers=2, memory_budget=2000)
+        assert most_at_once() == 2
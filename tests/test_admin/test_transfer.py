@@ -0,0 +1,164 @@
+import logging
+import os
+
+import pytest
+
+from admin import metrics, transfer
+from benchmarks.local_store import LocalObjectStore
+
+LOGGER = logging.getLogger(__name__)
+
+KB = 1024
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalObjectStore(tmp_path / 'store')
+    for name, size in [('big.tif', 100 * KB), ('a.tif', 3 * KB), ('b.tif', 5 * KB)]:
+        src = tmp_path / name
+        src.write_bytes(bytes(range(256)) * (size // 256))
+        store.put_file(f'snowpack_archive/2023.03.21/{name}', str(src))
+    return store
+
+
+def get_engine(client, **kwargs):
+    kwargs = dict(dict(workers=4, part_size=16 * KB, max_in_flight=32 * KB, backoff=0), **kwargs)
+    return transfer.TransferEngine(client, **kwargs)
+
+
+class FlakyStore:
+    """fails the first `failures` ranged GETs"""
+
+    def __init__(self, store, failures):
+        self.store = store
+        self.failures = failures
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def get_object_range(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+        return self.store.get_object_range(*args, **kwargs)
+
+
+class LocalMinio:
+    """the requests the engine makes with minio, served by a LocalObjectStore"""
+
+    class Response:
+
+        def __init__(self, data):
+            self.data = data
+
+        def read(self):
+            return self.data
+
+        def close(self):
+            pass
+
+        def release_conn(self):
+            pass
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_object(self, bucket, name, offset=0, length=0):
+        return self.Response(self.store.get_object_range(name, offset, length))
+
+    def fput_object(self, bucket, name, local_path, **kwargs):
+        self.store.put_object(name, local_path)
+
+
+class TestTransferEngine:
+
+    def test_get_many(self, store, tmp_path):
+        engine = get_engine(store)
+        names = ['big.tif', 'a.tif', 'b.tif', 'missing.tif']
+        items = [(f'snowpack_archive/2023.03.21/{name}', str(tmp_path / 'out' / name)) for name in names]
+        pulled = engine.get_many(items, missing_ok=True)
+
+        assert sorted(pulled) == sorted(local for _, local in items[:3])
+        for name in names[:3]:
+            assert (tmp_path / 'out' / name).read_bytes() == (tmp_path / name).read_bytes()
+        # one listing for the directory, the big object in 16KB parts
+        assert store.calls['list_objects'] == 1
+        assert store.calls['get_object_range'] == 7 + 1 + 1
+        assert engine.budget.peak <= 32 * KB
+        assert engine.budget.in_flight == 0
+
+        with pytest.raises(transfer.TransferError) as e:
+            engine.get_many(items[3:])
+        assert list(e.value.failed) == [items[3][0]]
+
+    def test_retry(self, store, tmp_path):
+        name = 'snowpack_archive/2023.03.21/big.tif'
+        engine = get_engine(FlakyStore(store, failures=2))
+        engine.get_many([(name, str(tmp_path / 'big_out.tif'))])
+        assert (tmp_path / 'big_out.tif').read_bytes() == (tmp_path / 'big.tif').read_bytes()
+
+        engine = get_engine(FlakyStore(store, failures=100), retries=1)
+        with pytest.raises(transfer.TransferError):
+            engine.get_many([(name, str(tmp_path / 'failed.tif'))])
+        # no partial download is left behind
+        assert [p.name for p in tmp_path.iterdir() if 'failed' in p.name] == []
+
+    def test_put_many_and_exists(self, store, tmp_path):
+        engine = get_engine(store)
+        existing = 'snowpack_archive/2023.03.21/a.tif'
+        new = 'snowpack_archive/2023.03.21/new.tif'
+        assert engine.exists_many([existing, new]) == {existing: True, new: False}
+
+        (tmp_path / 'new.tif').write_bytes(b'new')
+        assert engine.put_many([(str(tmp_path / 'new.tif'), new)]) == [new]
+        # the cached listing is updated by the upload
+        assert engine.exists_many([existing, new]) == {existing: True, new: True}
+        assert store.calls['list_objects'] == 1
+        assert engine.exists_many([new], refresh=True) == {new: True}
+        assert store.calls['list_objects'] == 2
+
+    @pytest.mark.parametrize('direct', [False, True])
+    def test_stage_ostore_bytes(self, store, tmp_path, direct):
+        metrics.enable()
+        try:
+            engine = get_engine(metrics.instrument_ostore(store))
+            if direct:
+                # the requests of an NRUtil client bypass the instrumented client
+                engine._minio = LocalMinio(store)
+            (tmp_path / 'new.tif').write_bytes(b'x' * KB)
+            with metrics.stage('transfer'):
+                engine.get_many([('snowpack_archive/2023.03.21/big.tif', str(tmp_path / 'out.tif'))])
+                engine.put_many([(str(tmp_path / 'new.tif'), 'snowpack_archive/new.tif')])
+            entry, = metrics.METRICS.report()['stages']
+        finally:
+            metrics.METRICS.disable()
+            metrics.METRICS.reset()
+        assert entry['ostore_bytes'] == 100 * KB + KB
+        # the listing, the 7 parts of the object and the upload
+        assert entry['ostore_requests'] == 1 + 7 + 1
+
+
+class TestOStore:
+
+    def test_ostore_file_exists(self, store, tmp_path, monkeypatch):
+        pytest.importorskip('NRUtil')
+        from admin import object_store_util
+
+        ostore = object_store_util.OStore()
+        ostore.ostore = store
+        monkeypatch.setattr(ostore, 'get_ostore_path',
+                            lambda local_path: f'snowpack_archive/2023.03.21/{local_path}')
+        assert ostore.ostore_file_exists('a.tif')
+        assert not ostore.ostore_file_exists('c.tif')
+        # the listing of the directory is cached
+        assert store.calls['list_objects'] == 1
+
+    def test_shared_client(self, store, monkeypatch):
+        pytest.importorskip('NRUtil')
+        from admin import object_store_util
+
+        monkeypatch.setattr(object_store_util, '_client', store)
+        monkeypatch.setattr(object_store_util, '_client_pid', os.getpid())
+        # every OStore of the process uses the one client and engine
+        assert object_store_util.OStore().transfer is object_store_util.OStore().transfer
+        assert object_store_util.get_ostore() is object_store_util.get_ostore()
@@ -0,0 +1,74 @@
+import logging
+
+import h5py
+import numpy as np
+import pytest
+import rasterio as rio
+
+from benchmarks import synthetic
+from benchmarks.local_store import LocalObjectStore
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TestSynthetic:
+
+    def test_snow_field(self):
+        data = synthetic.snow_field((64, 96), seed=1, cloud=0.25)
+        assert data.dtype == np.uint8 and data.shape == (64, 96)
+        valid = data[data <= 100]
+        assert set(np.unique(data[data > 100])) <= {synthetic.CLOUD, synthetic.WATER}
+        assert (data == synthetic.CLOUD).mean() == pytest.approx(0.25, abs=0.05)
+        assert valid.min() == 0 and valid.max() == 100
+        np.testing.assert_array_equal(data, synthetic.snow_field((64, 96), seed=1, cloud=0.25))
+
+    def test_modis_granule(self, tmp_path):
+        pth = synthetic.write_modis_granule(str(tmp_path), '2023.03.03', 10, 3, 120, seed=0)
+        assert pth.endswith('MOD10A1.A2023062.h10v03.061.2023062000000.tif')
+        with rio.open(pth) as src:
+            assert src.shape == (120, 120)
+            assert src.nodata == synthetic.FILL
+            assert src.transform.c == pytest.approx(synthetic.GRID_ULX + 10 * synthetic.TILE_SIZE)
+
+    def test_viirs_granule(self, tmp_path):
+        pth = synthetic.write_viirs_granule(str(tmp_path), '2023.03.03', 10, 3, 150, seed=0)
+        with h5py.File(pth, 'r') as f:
+            metadata = f['HDFEOS INFORMATION']['StructMetadata.0'][()].decode().split()
+            snow = f['HDFEOS/GRIDS/VNP_Grid_IMG_2D/Data Fields/CGF_NDSI_Snow_Cover']
+            assert snow.shape == (150, 150)
+            assert snow.attrs['_FillValue'][0] == synthetic.FILL
+        ulc = [m for m in metadata if 'UpperLeftPointMtrs' in m][0]
+        ulx = float(ulc.split('=(')[-1].replace(')', '').split(',')[0])
+        assert ulx == pytest.approx(synthetic.GRID_ULX + 10 * synthetic.TILE_SIZE)
+
+    def test_aoi(self, tmp_path):
+        sheds = synthetic.make_sheds(5, seed=0)
+        assert len(sheds) == 5 and sheds.is_valid.all()
+        shed_dirs = synthetic.write_aoi(sheds, 'basins', str(tmp_path / 'top'), str(tmp_path / 'aoi'))
+        assert len(shed_dirs) == 5
+        assert (tmp_path / 'top' / 'basins' / 'Shed_000' / 'shape' / 'EPSG4326' / 'Shed_000.shp').exists()
+        assert (tmp_path / 'aoi' / 'basins' / 'basins.shp').exists()
+
+
+class TestLocalObjectStore:
+
+    def test_round_trip(self, tmp_path):
+        store = LocalObjectStore(tmp_path / 'store')
+        src = tmp_path / 'a.txt'
+        src.write_bytes(b'12345')
+        store.put_object(ostore_path='snowpack_archive/x/a.txt', local_path=str(src))
+        store.put_file('snowpack_archive/x/y/b.txt', str(src))
+
+        assert store.list_objects('snowpack_archive/x', return_file_names_only=True) == [
+            'snowpack_archive/x/a.txt', 'snowpack_archive/x/y/b.txt']
+        assert store.list_objects('snowpack_archive/x/', recursive=False,
+                                  return_file_names_only=True) == ['snowpack_archive/x/a.txt']
+        assert store.stat_object('snowpack_archive/x/a.txt').size == 5
+
+        store.get_object(file_path='snowpack_archive/x/a.txt', local_path=str(tmp_path / 'out' / 'a.txt'))
+        assert (tmp_path / 'out' / 'a.txt').read_bytes() == b'12345'
+        with pytest.raises(FileNotFoundError):
+            store.get_object('snowpack_archive/missing.txt', str(tmp_path / 'missing.txt'))
+
+        assert store.bytes_written == 5 and store.bytes_read == 5
+        assert store.calls['put_object'] == 1 and store.calls['get_object'] == 1
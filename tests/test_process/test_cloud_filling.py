@@ -0,0 +1,74 @@
+import logging
+import os
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+import rasterio as rio
+
+from affine import Affine
+
+import process.cloud_filling as cloud_filling
+
+from benchmarks.local_store import LocalObjectStore
+
+LOGGER = logging.getLogger(__name__)
+
+
+def write_composite(root, dt, data):
+    pth = os.path.join(
+        str(root), dt.strftime(cloud_filling.new_mosaic_path), f'modis_composite_{dt:%Y.%m.%d}.tif')
+    os.makedirs(os.path.dirname(pth), exist_ok=True)
+    with rio.open(pth, 'w', driver='GTiff', width=2, height=2, count=1, dtype='uint8',
+                  crs='EPSG:4326', transform=Affine(1, 0, 0, 0, -1, 2), nodata=255) as dst:
+        dst.write(np.array(data, dtype='uint8'), 1)
+
+
+@pytest.fixture
+def ostore(tmp_path, monkeypatch):
+    store = tmp_path / 'store'
+    work = tmp_path / 'work'
+    work.mkdir()
+    monkeypatch.chdir(work)
+    write_composite(store, datetime(2023, 3, 1), [[10, 200], [200, 200]])
+    write_composite(store, datetime(2023, 3, 2), [[20, 30], [200, 200]])
+    write_composite(store, datetime(2023, 3, 4), [[200, 200], [40, 200]])
+    return LocalObjectStore(store)
+
+
+class TestCloudFilling:
+
+    def test_age_fill(self):
+        age = np.array([0, 3, 254, 255], dtype='uint8')
+        observed = np.array([False, True, False, False])
+        assert cloud_filling.age_fill(age, observed).tolist() == [1, 0, 254, 255]
+
+    def test_run_fills_and_ages(self, ostore):
+        dates = [datetime(2023, 3, d) for d in range(1, 5)]
+        engine = cloud_filling.CloudFillEngine(ostore, prefetch=2, upload_workers=1)
+        written = engine.run(dates)
+
+        assert len(written) == 4
+        # every composite is downloaded once, the filled rasters are not read back
+        assert sorted(g.split('/')[-1] for g in ostore.gets if 'composite' in g) == [
+            'modis_composite_2023.03.01.tif', 'modis_composite_2023.03.02.tif',
+            'modis_composite_2023.03.04.tif']
+        assert [g for g in ostore.gets if 'cloud_filled' in g] == [
+            'snowpack_archive/cloud_filled/2023/2023.02.28.tif']
+        with rio.open(os.path.join(ostore.root, written[-1])) as src:
+            assert src.count == 2
+            assert src.tags()['FILL_AGE_BAND'] == '2'
+            data, age = src.read(1), src.read(2)
+        assert data.tolist() == [[20, 30], [40, 200]]
+        assert age.tolist() == [[2, 2], [0, 255]]
+
+    def test_seed_from_previous_run(self, ostore):
+        engine = cloud_filling.CloudFillEngine(ostore, prefetch=1, upload_workers=1)
+        engine.run([datetime(2023, 3, 1), datetime(2023, 3, 2)])
+
+        # a new engine picks up the running raster from object storage
+        engine = cloud_filling.CloudFillEngine(ostore, prefetch=1, upload_workers=1)
+        engine.run([datetime(2023, 3, 3)])
+        assert engine.data.tolist() == [[20, 30], [200, 200]]
+        assert engine.age.tolist() == [[1, 1], [255, 255]]
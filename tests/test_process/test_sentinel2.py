@@ -0,0 +1,163 @@
+import logging
+import os
+
+from types import SimpleNamespace
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+# sentinel2 imports admin.color_ramp, which needs the GDAL bindings
+pytest.importorskip('osgeo')
+
+import rasterio as rio
+
+from affine import Affine
+
+import admin.constants as const
+from process import sentinel2
+
+LOGGER = logging.getLogger(__name__)
+
+SAFE = 'S2A_MSIL2A_20210318T190049_N0214_R013_T10UCU_20210318T211232.SAFE'
+GRANULE = f'{SAFE}/GRANULE/L2A_T10UCU_A030040_20210318T190049'
+
+
+def whole_array_ndsi(b2, b3, b4, b8, b11, cloud_mask):
+    """the NDSI as process() calculated it on the whole bands, before it was
+    calculated block by block
+    """
+    nodata_val = sentinel2.nodata_val
+    inf_val = 0.0
+    dival = 10000
+    nosnow = 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        NDSI = np.divide((b3-b11), (b3+b11))
+        NDSI[NDSI == np.inf] = inf_val
+        NDSI = np.nan_to_num(NDSI, nan=inf_val, posinf=inf_val, neginf=inf_val)
+        NDSI[(NDSI <= 0.0)] = nosnow
+        NDSI[(NDSI > 1.0)&(NDSI != nodata_val)] = nosnow
+        NDSI[(b8/dival < 0.35)] = nosnow
+        NDSI[(b2/dival < 0.18)] = nosnow
+        b2b4 = np.divide(b2/dival, b4/dival)
+        b2b4 = np.nan_to_num(b2b4, nan=inf_val, posinf=inf_val, neginf=inf_val)
+        NDSI[(b2b4 < 0.85)] = nosnow
+        NDSI[(cloud_mask==6)] = nodata_val
+        NDSI[(cloud_mask==8)] = nodata_val
+        NDSI[(cloud_mask==9)] = nodata_val
+    return NDSI*100
+
+
+def make_bands(shape=(80, 96), seed=0):
+    """B02, B03, B04, B8A, B11 reflectances and the SCL of a synthetic tile"""
+    rng = np.random.default_rng(seed)
+    bands = [rng.integers(lo, hi, shape, dtype='uint16') for lo, hi in
+             [(1000, 5000), (0, 8000), (1000, 5000), (2000, 8000), (0, 8000)]]
+    bands[0][0, :4] = 0 # b2 / b4 of 0
+    bands[2][0, :4] = 0
+    bands.append(rng.choice(np.array([4, 5, 6, 8, 9], dtype='uint8'), shape))
+    return bands
+
+
+def write_band(pth, data, blocksize=32):
+    with rio.open(pth, 'w', driver='GTiff', width=data.shape[1], height=data.shape[0], count=1,
+                  dtype=data.dtype, crs='EPSG:32610', transform=Affine(20, 0, 600000, 0, -20, 5500000),
+                  tiled=True, blockxsize=blocksize, blockysize=blocksize) as dst:
+        dst.write(data, 1)
+
+
+def write_safe_zip(pth, members):
+    with ZipFile(pth, 'w') as zf:
+        for name in members:
+            zf.writestr(name, b'')
+
+
+def band_members(resolution, bands):
+    res = resolution[1:]
+    return [f'{GRANULE}/IMG_DATA/{resolution}/T10UCU_20210318T190049_{band}_{res}.jp2' for band in bands]
+
+
+class TestNDSI:
+
+    def test_blocks_match_whole_array(self, tmp_path, monkeypatch):
+        # 32 pixel blocks that line up with 16 pixel output tiles, so the
+        # tile is processed in 3 x 3 windows
+        monkeypatch.setattr(const, 'RASTER_BLOCKSIZE', 16)
+        bands = make_bands()
+        paths = []
+        for name, data in zip(sentinel2.S2_BANDS, bands):
+            paths.append(str(tmp_path / f'{name}.tif'))
+            write_band(paths[-1], data)
+        out = str(tmp_path / 'ndsi.tif')
+        sentinel2.process_bands(paths, out, str(tmp_path / 'rgb.tif'), workers=3)
+
+        with rio.open(out) as src:
+            ndsi = src.read(1)
+        b2, b3, b4, b8, b11, scl = bands
+        expected = whole_array_ndsi(*[b.astype('float64') for b in (b2, b3, b4, b8, b11)], scl)
+        np.testing.assert_array_equal(ndsi, expected)
+        with rio.open(str(tmp_path / 'rgb.tif')) as src:
+            np.testing.assert_array_equal(src.read(), np.stack([b2, b3, b4]))
+
+    def test_b3_below_b11(self):
+        b2, b3, b4, b8, b11, scl = make_bands(seed=1)
+        # bright B11, where b3 - b11 wrapped around to a value below b3 + b11
+        b3[:2], b11[:2] = 20000, 40000
+        b2[:2], b4[:2], b8[:2], scl[:2] = 3000, 3000, 5000, 4
+        below = (b3 < b11) & ~np.isin(scl, [6, 8, 9])
+        ndsi = sentinel2.calculate_ndsi(b2, b3, b4, b8, b11, scl)
+        # b3 - b11 is negative, no snow.  The whole array calculation ran on
+        # the uint16 bands and found snow in the bright pixels
+        assert (ndsi[below] == 0).all()
+        assert (whole_array_ndsi(b2, b3, b4, b8, b11, scl)[:2] > 0).all()
+        np.testing.assert_array_equal(
+            ndsi, whole_array_ndsi(*[b.astype('float64') for b in (b2, b3, b4, b8, b11)], scl))
+
+    @pytest.mark.parametrize('block, blocksize, window_size', [
+        ((64, 64), 32, 64), # the blocks line up with the output tiles
+        ((48, 48), 32, 128), # they do not, a grid of 4 output tiles
+        ((1, 300), 32, 128), # strips
+    ])
+    def test_block_windows_cover_the_tile(self, block, blocksize, window_size):
+        src = SimpleNamespace(block_shapes=[block], width=300, height=200)
+        windows = sentinel2.get_block_windows(src, blocksize)
+        covered = np.zeros((src.height, src.width), dtype='uint8')
+        for window in windows:
+            assert window.width <= window_size and window.height <= window_size
+            covered[window.toslices()] += 1
+        # every pixel is in exactly one window
+        assert (covered == 1).all()
+
+
+class TestSafeZip:
+
+    def test_band_paths(self, tmp_path):
+        pth = str(tmp_path / f'{SAFE[:-5]}.zip')
+        write_safe_zip(pth, [
+            f'{SAFE}/manifest.safe',
+            *band_members('R10m', ['B02', 'B03', 'B04', 'B08', 'TCI']),
+            *band_members('R20m', ['B02', 'B03', 'B04', 'B8A', 'B11', 'SCL', 'TCI']),
+            *band_members('R60m', ['B01', 'B02', 'B8A', 'B11', 'SCL']),
+            f'{GRANULE}/QI_DATA/MSK_CLDPRB_20m.jp2',
+            f'{GRANULE}/QI_DATA/MSK_SNWPRB_20m.jp2',
+        ])
+        index = sentinel2.index_safe_zip(pth)
+        # only the R20m bands, not QI_DATA or the other resolutions
+        assert index['B02'] == band_members('R20m', ['B02'])[0]
+        assert sorted(index) == sorted(sentinel2.S2_BANDS + ['TCI'])
+
+        paths = sentinel2.get_band_paths(pth)
+        zip_path = os.path.abspath(pth).replace('\\', '/')
+        assert paths == [f'/vsizip/{zip_path}/{member}'
+                         for member in band_members('R20m', sentinel2.S2_BANDS)]
+
+    def test_missing_band(self, tmp_path):
+        pth = str(tmp_path / 'tile.zip')
+        # B11 is only there at 60m
+        write_safe_zip(pth, [
+            *band_members('R20m', ['B02', 'B03', 'B04', 'B8A', 'SCL']),
+            *band_members('R60m', ['B11']),
+            f'{GRANULE}/QI_DATA/MSK_CLDPRB_20m.jp2',
+        ])
+        with pytest.raises(ValueError, match='bands B11 not found'):
+            sentinel2.get_band_paths(pth)
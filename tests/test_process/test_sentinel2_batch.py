@@ -0,0 +1,104 @@
+import datetime
+import logging
+import threading
+
+from collections import OrderedDict
+
+import pytest
+
+# sentinel2 imports admin.color_ramp, which needs the GDAL bindings
+pytest.importorskip('osgeo')
+
+import admin.constants as const
+from admin.db_handler import DBHandler
+from process import sentinel2, sentinel2_batch
+
+LOGGER = logging.getLogger(__name__)
+
+T10 = {'title': 'S2A_MSIL2A_20210318T190049_N0214_R013_T10UCU_20210318T211232',
+       'beginposition': datetime.datetime(2021, 3, 18, 19, 0), 'cloudcoverpercentage': 40.0}
+T10_OLD = {'title': 'S2B_MSIL2A_20210313T190049_N0214_R013_T10UCU_20210313T211232',
+           'beginposition': datetime.datetime(2021, 3, 13, 19, 0), 'cloudcoverpercentage': 5.0}
+T09 = {'title': 'S2A_MSIL2A_20210316T190049_N0214_R013_T09UXQ_20210316T211232',
+       'beginposition': datetime.datetime(2021, 3, 16, 19, 0), 'cloudcoverpercentage': 10.0}
+
+
+class LocalCatalogue:
+    """stand-in for SentinelAPI, points west of -127 are in T09UXQ"""
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.downloads = []
+        self.lock = threading.Lock()
+
+    def query(self, aoi, **kwargs):
+        if aoi.x < -127:
+            return OrderedDict([('t09', T09)])
+        return OrderedDict([('t10', T10), ('t10_old', T10_OLD)])
+
+    def download(self, product, directory_path):
+        with self.lock:
+            self.downloads.append(product)
+        return {'path': str(self.tmp_path / f'{product}.zip')}
+
+
+@pytest.fixture
+def points_pth(tmp_path):
+    pth = tmp_path / 'points.csv'
+    pth.write_text(
+        'lat,lng,date\n'
+        '49.12,-126.5,2021.03.18\n'
+        '49.73,-126.5,2021.03.18\n'
+        '49.73,-126.5,2021.03.18\n'
+        '50.1,-128.0,2021.03.18\n')
+    return str(pth)
+
+
+class TestSentinel2Batch:
+
+    def test_read_points(self, points_pth):
+        points = sentinel2_batch.read_points(points_pth)
+        assert len(points) == 3
+        assert points[0] == {'lat': 49.12, 'lng': -126.5, 'date': '2021.03.18'}
+
+    def test_read_points_invalid(self, tmp_path):
+        pth = tmp_path / 'points.csv'
+        pth.write_text('lat,lng,date\n49.12,-126.5,18-03-2021\n')
+        with pytest.raises(ValueError):
+            sentinel2_batch.read_points(str(pth))
+
+    def test_select_product(self):
+        products = OrderedDict([('t10', T10), ('t10_old', T10_OLD)])
+        assert sentinel2_batch.select_product(products, 'least-cloud')[0] == 't10_old'
+        assert sentinel2_batch.select_product(products, 'most-recent')[0] == 't10'
+        assert sentinel2_batch.select_product(OrderedDict(), 'most-recent') is None
+        with pytest.raises(ValueError):
+            sentinel2_batch.select_product(products, 'random')
+
+    def test_plan_batch_groups_points(self, tmp_path, points_pth):
+        points = sentinel2_batch.read_points(points_pth)
+        jobs = sentinel2_batch.plan_batch(LocalCatalogue(tmp_path), points, 'least-cloud', 50, 10)
+        assert list(jobs) == ['t10_old', 't09']
+        assert len(jobs['t10_old']['points']) == 2
+        assert jobs['t10_old']['tile'] == 'T10UCU'
+        assert jobs['t10_old']['date'] == '2021.03.13'
+
+    def test_pipeline_processes_each_product_once(self, tmp_path, points_pth, monkeypatch):
+        monkeypatch.setattr(const, 'ANALYSIS', str(tmp_path))
+        monkeypatch.setattr(sentinel2, 'build_sentinel_dir_struture', lambda: None)
+        monkeypatch.setattr(sentinel2, 'process', lambda info, *args: info['path'])
+        monkeypatch.setattr(sentinel2, 'build_outputs', lambda *args: (1.0, 2.0, 3.0))
+        catalogue = LocalCatalogue(tmp_path)
+        db_handler = DBHandler()
+
+        names = sentinel2_batch.sentinel_batch_pipeline(
+            catalogue, points_pth, 'most-recent', 'false', 50, 'false', 10, db_handler)
+
+        assert sorted(catalogue.downloads) == ['t09', 't10']
+        assert names == {
+            't10': 'S2 - 2021.03.18 - T10UCU',
+            't09': 'S2 - 2021.03.16 - 50.1, -128.0',
+        }
+        stats = db_handler.select_stats('sentinel2', '2021.03.18')
+        assert stats['S2 - 2021.03.18 - T10UCU']['snow_coverage'] == 3.0
+        db_handler.conn.close()
@@ -0,0 +1,81 @@
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+
+from affine import Affine
+from shapely.geometry import Polygon, box
+
+import process.tif2poly as tif2poly
+
+from benchmarks.local_store import LocalObjectStore
+
+LOGGER = logging.getLogger(__name__)
+
+TRANSFORM = Affine(1, 0, 0, 0, -1, 20)
+OBJPATH = 'cloud_filled/%Y/%Y.%m.%d.tif'
+
+
+@pytest.fixture
+def zones():
+    # A and B overlap, C is a triangle, D is outside of the raster
+    return gpd.GeoDataFrame(
+        {'WSDG_ID': ['A', 'B', 'C', 'D']},
+        geometry=[box(0, 0, 10, 10), box(5.5, 5.5, 15.5, 15.5),
+                  Polygon([(12, 2), (19, 2), (19, 9)]), box(100, 100, 110, 110)],
+        crs='EPSG:3005')
+
+
+def make_raster(seed):
+    rng = np.random.default_rng(seed)
+    raster = rng.integers(0, 101, (20, 20)).astype('uint8')
+    raster[rng.random((20, 20)) < 0.2] = 255
+    raster[12:14, 0:20] = 250 # invalid values > 100
+    return raster
+
+
+class TestTif2Poly:
+
+    def test_zonal_means_match_rasterstats(self, zones):
+        rasterstats = pytest.importorskip('rasterstats')
+        rasters = [make_raster(seed) for seed in range(3)]
+        members, offsets, counts = tif2poly.get_basin_members(zones, TRANSFORM, (20, 20))
+        assert counts[3] == 0
+
+        values = np.stack([r.ravel()[members] for r in rasters])
+        means = tif2poly.zonal_means(values, offsets, counts)
+        for day, raster in enumerate(rasters):
+            raster = raster.copy()
+            raster[raster > 100] = 255
+            stats = rasterstats.zonal_stats(
+                zones, raster, affine=TRANSFORM, stats='mean', all_touched=True, nodata=255)
+            expected = [np.nan if s['mean'] is None else s['mean'] for s in stats]
+            np.testing.assert_allclose(means[day], expected)
+
+    def test_zonal_means_no_valid_pixels(self):
+        values = np.array([[255, 255, 10]], dtype='uint8')
+        means = tif2poly.zonal_means(values, np.array([0, 2, 3]), np.array([2, 1, 0]))
+        assert np.isnan(means[0, 0]) and means[0, 1] == 10 and np.isnan(means[0, 2])
+
+    def test_extract_zonal_means(self, zones, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        dates = pd.date_range('2024-01-01', '2024-01-05')
+        for i, dt in enumerate(dates):
+            if i == 2:
+                continue # missing day
+            pth = tmp_path / 'store' / dt.strftime(OBJPATH)
+            pth.parent.mkdir(parents=True, exist_ok=True)
+            with rio.open(pth, 'w', driver='GTiff', width=20, height=20, count=1, dtype='uint8',
+                          crs='EPSG:3005', transform=TRANSFORM) as dst:
+                dst.write(np.full((20, 20), i * 10, dtype='uint8'), 1)
+
+        output = tif2poly.extract_zonal_means(
+            LocalObjectStore(tmp_path / 'store'), zones, dates, OBJPATH, chunk_days=2, workers=2)
+
+        assert list(output.columns) == ['A', 'B', 'C', 'D']
+        assert output.loc['2024-01-04', 'B'] == 30
+        assert output.loc['2024-01-03'].isna().all()
+        assert output['D'].isna().all()
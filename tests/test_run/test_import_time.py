@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+LOGGER = logging.getLogger(__name__)
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# seconds `import run` may take, the heavy modules are imported by the
+# commands.  Wall clock time depends on the machine, so the budget is only
+# checked when IMPORT_BUDGET is set, test_no_heavy_imports guards the imports
+IMPORT_BUDGET = float(os.getenv('IMPORT_BUDGET', '0'))
+HEAVY_MODULES = ['rasterio', 'rioxarray', 'xarray', 'geopandas', 'pandas', 'matplotlib',
+                 'osgeo', 'simplekml', 'cmr', 'NRUtil', 'minio', 'process']
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import run
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted(sys.modules)}))
+"""
+
+
+def import_run(tmp_path, code=SCRIPT):
+    env = dict(os.environ, SNOWPACK_DATA=str(tmp_path))
+    # a fresh interpreter, the test session has imported everything already
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class TestImportTime:
+
+    @pytest.mark.skipif(not IMPORT_BUDGET, reason='IMPORT_BUDGET is not set')
+    def test_budget(self, tmp_path):
+        # best of 3, the first run pays for the bytecode compilation
+        seconds = min(import_run(tmp_path)['seconds'] for _ in range(3))
+        assert seconds < IMPORT_BUDGET
+
+    def test_no_heavy_imports(self, tmp_path):
+        modules = import_run(tmp_path)['modules']
+        loaded = [m for m in modules if m.split('.')[0] in HEAVY_MODULES]
+        assert loaded == []
+
+    def test_policies(self):
+        sentinel2_batch = pytest.importorskip('process.sentinel2_batch')
+        import run
+        policy = [p for p in run.process_sentinel_batch.params if p.name == 'policy'][0]
+        assert list(policy.type.choices) == list(sentinel2_batch.SELECTION_POLICIES)